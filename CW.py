@@ -6,24 +6,42 @@
 ✅ 适配：lark-oapi V2 SDK
 """
 import os
+import re
 import sys
 import json
 import time
 import shutil
+import sqlite3
+import tempfile
+import uuid
+import zlib
+import zipfile
+import math
+import random
+import bisect
 import logging
+import multiprocessing
+import functools
+import threading
+import queue
 import requests
 import itertools
+import importlib.util
 import pandas as pd
 import openpyxl
+import xlsxwriter
 from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
 from openpyxl.utils import get_column_letter
 import tkinter as tk
 from tkinter import filedialog
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 import base64
 from io import BytesIO
+from html import escape as html_escape
 from PIL import Image, ImageGrab
 from datetime import datetime, timedelta
+from dateutil import tz
 from dotenv import load_dotenv
 
 # Lark OAPI V2 Imports
@@ -241,7 +259,14 @@ FILE_CATEGORY_RULES = os.path.join(CONFIG_DIR, "category_rules.json")
 FILE_PARTNER_ALIASES = os.path.join(CONFIG_DIR, "partner_aliases.json")
 FILE_VOUCHER_TEMPLATES = os.path.join(CONFIG_DIR, "voucher_templates.json")
 FILE_AI_CACHE = os.path.join(DATA_ROOT, "ai_category_cache.json")
+FILE_AI_CACHE_DB = os.path.join(DATA_ROOT, "ai_category_cache.db")
 FILE_DASHBOARD_CACHE = os.path.join(DATA_ROOT, "dashboard_cache.json")
+FILE_LOCAL_REPLICA = os.path.join(DATA_ROOT, "local_replica.db")
+FILE_TABLE_ID_CACHE = os.path.join(DATA_ROOT, "table_id_cache.json")
+FILE_OFFLINE_JOURNAL = os.path.join(DATA_ROOT, "offline_journal.db")
+FILE_HISTORY_INDEX = os.path.join(DATA_ROOT, "history_category_index.db")
+FILE_EXCEL_LAYOUT_CACHE = os.path.join(DATA_ROOT, "excel_layout_cache.json")
+FILE_PNL_CUBE_CACHE = os.path.join(DATA_ROOT, "pnl_cube_cache.json")
 
 # 自动迁移旧文件
 def migrate_legacy_files():
@@ -348,11 +373,265 @@ USER_ID = os.getenv("FEISHU_USER_ID", "")
 BOSS_ID = os.getenv("BOSS_FEISHU_ID", "")
 ZHIPUAI_API_KEY = os.getenv("ZHIPUAI_API_KEY", "")
 
+# -------------------------- 接口调用保护 (限流/退避/熔断) --------------------------
+# 所有飞书多维表格与智谱AI请求都经过 ServiceGuard：
+# - 按接口族(读/写/元数据/AI)各自一个令牌桶，被限流时降速并按服务端提示等待，之后逐步恢复
+# - 单个请求级别的指数退避重试 (不重跑整个业务函数)；写请求只在明确被限流 (未执行) 时重发，
+#   超时/断线/服务端错误时请求可能已生效，重发会产生重复记录，交给调用方核对
+# - 服务连续失败时熔断，冷却期内直接失败，避免堆积重试
+GUARD_MAX_RETRIES = int(os.getenv("GUARD_MAX_RETRIES", 3))
+GUARD_BACKOFF_BASE = float(os.getenv("GUARD_BACKOFF_BASE", 0.5)) # 首次退避(秒)，之后翻倍
+GUARD_BACKOFF_MAX = 8.0
+GUARD_BREAKER_THRESHOLD = int(os.getenv("GUARD_BREAKER_THRESHOLD", 5)) # 连续失败多少次后熔断
+GUARD_BREAKER_COOLDOWN = float(os.getenv("GUARD_BREAKER_COOLDOWN", 30)) # 熔断后多久放行一次试探请求(秒)
+GUARD_RATES = { # 接口族 -> (每秒请求数, 突发容量)
+    "feishu.read": (float(os.getenv("FEISHU_READ_QPS", 10)), 10),
+    "feishu.write": (float(os.getenv("FEISHU_WRITE_QPS", 8)), 8),
+    "feishu.meta": (float(os.getenv("FEISHU_META_QPS", 5)), 5),
+    "zhipu.chat": (float(os.getenv("ZHIPU_QPS", 2)), 2),
+}
+FEISHU_RATE_LIMIT_CODES = {99991400, 1254290} # 频率限制
+FEISHU_TRANSIENT_CODES = {1254291, 1254607, 1255040} # 写冲突、数据未就绪、超时；另外 1255xxx 为服务端内部错误
+FEISHU_READ_METHODS = {"list", "get", "search", "batch_get"}
+FEISHU_TABLE_NOT_FOUND_CODES = {1254041} # 表已被删除或重建 (缓存的 table_id 失效)
+
+class CircuitOpenError(Exception):
+    """服务处于熔断状态，请求未发出"""
+
+class TokenBucket:
+    """令牌桶；被限流时速率减半并暂停到服务端给出的时间，成功后逐步恢复到设定速率"""
+    def __init__(self, rate, burst):
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.base_rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def throttle(self, retry_after=None):
+        with self.lock:
+            self.rate = max(self.base_rate / 8, self.rate / 2)
+            self.tokens = 0
+            self.paused_until = max(self.paused_until, time.monotonic() + (retry_after or 1.0))
+
+    def recover(self):
+        if self.rate < self.base_rate:
+            with self.lock:
+                self.rate = min(self.base_rate, self.rate + self.base_rate / 20)
+
+class CircuitBreaker:
+    def __init__(self, name, threshold=GUARD_BREAKER_THRESHOLD, cooldown=GUARD_BREAKER_COOLDOWN):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.trips = 0
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+    def allow(self):
+        with self.lock:
+            state = self.state
+            if state == "closed":
+                return
+            if state == "half_open" and not self.probing:
+                self.probing = True # 冷却期满，只放行一个试探请求
+                return
+        raise CircuitOpenError(f"{self.name} 暂不可用 (熔断中，{self.cooldown:.0f}秒后重试)")
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or (self.opened_at is None and self.failures >= self.threshold):
+                self.trips += 1
+                self.opened_at = time.monotonic()
+                self.probing = False
+                log.warning(f"⚠️ {self.name} 连续失败 {self.failures} 次，已熔断 {self.cooldown:.0f} 秒",
+                            extra={"solution": "检查网络或服务状态"})
+
+def classify_api_error(error):
+    """异常 -> "throttle" / "transient" / "fatal" 以及服务端建议的等待秒数"""
+    status = getattr(error, "status_code", None)
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    retry_after = headers.get("retry-after") if hasattr(headers, "get") else None
+    try:
+        retry_after = float(retry_after) if retry_after else None
+    except ValueError:
+        retry_after = None
+    if status == 429:
+        return "throttle", retry_after
+    if status is not None:
+        return ("transient" if status >= 500 else "fatal"), None
+    if isinstance(error, (ConnectionError, TimeoutError, OSError, requests.RequestException)):
+        return "transient", None
+    name = type(error).__name__
+    return ("transient" if "Connection" in name or "Timeout" in name else "fatal"), None
+
+def classify_feishu_response(resp):
+    """飞书响应 -> None(成功或业务错误，直接返回) / "throttle" / "transient" 以及等待秒数"""
+    if resp is None or not hasattr(resp, "success") or resp.success():
+        return None, None
+    code = getattr(resp, "code", None) or 0
+    if code in FEISHU_RATE_LIMIT_CODES:
+        headers = getattr(getattr(resp, "raw", None), "headers", None) or {}
+        reset = headers.get("x-ogw-ratelimit-reset") if hasattr(headers, "get") else None
+        try:
+            return "throttle", float(reset) if reset else None
+        except ValueError:
+            return "throttle", None
+    if code in FEISHU_TRANSIENT_CODES or code >= 1255000:
+        return "transient", None
+    return None, None
+
+class ServiceGuard:
+    """单个服务 (飞书/智谱) 的调用保护：各接口族的令牌桶 + 共用的熔断器 + 调用统计"""
+    def __init__(self, name, families, classify_response=None):
+        self.name = name
+        self.classify_response = classify_response
+        self.breaker = CircuitBreaker(name)
+        self.buckets = {f: TokenBucket(*GUARD_RATES[f]) for f in families}
+        self.stats = {f: {"calls": 0, "retries": 0, "throttles": 0, "failures": 0, "rejected": 0} for f in families}
+        self.stats_lock = threading.Lock()
+
+    def count(self, family, key):
+        with self.stats_lock:
+            self.stats[family][key] += 1
+
+    def call(self, family, func, *args, retry_transient=True, **kwargs):
+        """retry_transient=False: 临时故障不重试 (非幂等的写请求)，只有限流时等待后重发"""
+        bucket = self.buckets[family]
+        self.count(family, "calls")
+        attempt = 0
+        while True:
+            try:
+                self.breaker.allow()
+            except CircuitOpenError:
+                self.count(family, "rejected")
+                raise
+            bucket.acquire()
+            error = resp = None
+            try:
+                resp = func(*args, **kwargs)
+                kind, retry_after = self.classify_response(resp) if self.classify_response else (None, None)
+            except Exception as e:
+                error = e
+                kind, retry_after = classify_api_error(e)
+                if kind == "fatal":
+                    self.breaker.record_success() # 请求本身有误，服务是正常的
+                    raise
+            if kind is None:
+                self.breaker.record_success()
+                bucket.recover()
+                return resp
+                
+            if kind == "throttle":
+                self.count(family, "throttles")
+                bucket.throttle(retry_after)
+            else:
+                self.count(family, "failures")
+                self.breaker.record_failure()
+            if attempt >= GUARD_MAX_RETRIES or (kind == "transient" and not retry_transient):
+                if error is not None:
+                    raise error
+                return resp
+            attempt += 1
+            self.count(family, "retries")
+            if kind == "transient": # 限流的等待由令牌桶负责
+                time.sleep(min(GUARD_BACKOFF_MAX, GUARD_BACKOFF_BASE * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0))
+
+    def summary_rows(self):
+        rows = []
+        for family, st in self.stats.items():
+            rows.append({"接口": family, **st, "当前速率": round(self.buckets[family].rate, 2)})
+        return rows
+
+FEISHU_GUARD = ServiceGuard("飞书", ["feishu.read", "feishu.write", "feishu.meta"], classify_feishu_response)
+ZHIPU_GUARD = ServiceGuard("智谱AI", ["zhipu.chat"])
+
+class GuardedResource:
+    """
+    包装一个接口资源 (如 app_table_record)，其方法调用都经过 ServiceGuard
+    idempotent(方法名) 为 False 的方法遇到临时故障不重试 (默认全部可重试)
+    wrap(call, *args, **kwargs): 可选，包在受保护的调用之外 (如表ID失效后重新定位)
+    """
+    def __init__(self, target, guard, family_for, idempotent=None, wrap=None):
+        self._target = target
+        self._guard = guard
+        self._family_for = family_for
+        self._idempotent = idempotent
+        self._wrap = wrap
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+        family = self._family_for(name)
+        retry = self._idempotent(name) if self._idempotent else True
+        call = functools.partial(self._guard.call, family, attr, retry_transient=retry)
+        return functools.partial(self._wrap, call) if self._wrap else call
+
+def guard_feishu_client(client):
+    """为飞书客户端的多维表格接口加上限流/退避/熔断 (重复调用安全)"""
+    v1 = client.bitable.v1
+    if isinstance(getattr(v1, "app_table_record", None), GuardedResource):
+        return client
+    record_family = lambda name: "feishu.read" if name in FEISHU_READ_METHODS else "feishu.write"
+    is_read = lambda name: name in FEISHU_READ_METHODS # 新增/修改/删除/建表只在被限流时重发
+    relocate = functools.partial(call_with_fresh_table_id, client)
+    v1.app_table_record = GuardedResource(v1.app_table_record, FEISHU_GUARD, record_family, is_read, relocate)
+    v1.app_table = GuardedResource(v1.app_table, FEISHU_GUARD, lambda name: "feishu.meta", is_read)
+    v1.app_table_field = GuardedResource(v1.app_table_field, FEISHU_GUARD, lambda name: "feishu.meta", is_read, relocate)
+    return client
+
+def guard_ai_client(ai_client):
+    """为智谱AI客户端的对话接口加上限流/退避/熔断"""
+    if ai_client is None or isinstance(ai_client.chat.completions, GuardedResource):
+        return ai_client
+    ai_client.chat.completions = GuardedResource(ai_client.chat.completions, ZHIPU_GUARD, lambda name: "zhipu.chat")
+    return ai_client
+
+def api_guard_stats():
+    """各接口族的调用统计 + 熔断状态"""
+    rows = []
+    for guard in (FEISHU_GUARD, ZHIPU_GUARD):
+        for row in guard.summary_rows():
+            row["熔断"] = f"{guard.breaker.state} (触发 {guard.breaker.trips} 次)"
+            rows.append(row)
+    return rows
+
 # 初始化 GLM-4 客户端
 zhipu_client = None
 if ZHIPUAI_API_KEY:
     try:
-        zhipu_client = ZhipuAI(api_key=ZHIPUAI_API_KEY)
+        zhipu_client = guard_ai_client(ZhipuAI(api_key=ZHIPUAI_API_KEY))
         # log.info("🧠 GLM-4 AI 模型已加载", extra={"solution": "无"}) # Avoid logging too early if log not setup, but log is setup at line 95
     except Exception as e:
         pass
@@ -365,6 +644,9 @@ TAX_CONFIG = {
     "surtax_rates": {"city": 7, "education": 3, "local_education": 2}
 }
 RECONCILE_THRESHOLD = float(os.getenv("RECONCILE_THRESHOLD", 0.01))
+AI_CATEGORY_CHOICES = "[差旅费-交通, 差旅费-住宿, 差旅费-加油, 业务招待费, 办公费, 房租物业, 水电费, 快递费, 营销推广费, 技术服务费, 采购款, 员工工资, 社保公积金, 税费]"
+AI_BATCH_SIZE = int(os.getenv("AI_BATCH_SIZE", 20)) # 每个提示词包含的交易笔数
+AI_BATCH_WORKERS = int(os.getenv("AI_BATCH_WORKERS", 3)) # 并发请求数 (另受 zhipu.chat 限流约束)
 
 def ai_guess_category(description, partner):
     """使用 AI 猜测交易分类"""
@@ -376,7 +658,7 @@ def ai_guess_category(description, partner):
 你是一名资深会计。请根据交易描述判断费用类型。
 交易对象: {partner}
 交易摘要: {description}
-可选分类: [差旅费-交通, 差旅费-住宿, 差旅费-加油, 业务招待费, 办公费, 房租物业, 水电费, 快递费, 营销推广费, 技术服务费, 采购款, 员工工资, 社保公积金, 税费]
+可选分类: {AI_CATEGORY_CHOICES}
 如果不确定，请根据经验推断最可能的分类。
 只返回分类名称，不要其他废话。
 """
@@ -392,22 +674,58 @@ def ai_guess_category(description, partner):
         # print(f"AI error: {e}")
         return None
 
-# 重试装饰器
-def retry_on_failure(max_retries=3, delay=3):
+def ai_guess_categories(items):
+    """一次请求推断多笔交易的分类，items 为 [(摘要, 往来单位)]；返回等长列表，无法判断的位置为 None"""
+    if not zhipu_client or not items: return [None] * len(items)
+    
+    lines = "\n".join(f"{i}. 交易对象: {partner} | 交易摘要: {desc}" for i, (desc, partner) in enumerate(items, 1))
+    prompt = f"""
+你是一名资深会计。请逐笔判断下列交易的费用类型。
+{lines}
+可选分类: {AI_CATEGORY_CHOICES}
+如果不确定，请根据经验推断最可能的分类。
+只返回一个 JSON 数组，按编号顺序给出每笔的分类名称 (共 {len(items)} 个)，例如 ["办公费", "快递费"]，不要其他废话。
+"""
+    try:
+        resp = zhipu_client.chat.completions.create(
+            model="glm-4-flash",
+            messages=[{"role": "user", "content": prompt}]
+        )
+        content = resp.choices[0].message.content.strip()
+        found = re.search(r"\[.*\]", content, re.S)
+        categories = json.loads(found.group(0)) if found else []
+    except Exception as e:
+        log.warning(f"⚠️ AI 批量分类失败 ({len(items)} 笔): {e}", extra={"solution": "本批保留默认分类"})
+        return [None] * len(items)
+    
+    if not isinstance(categories, list) or len(categories) != len(items):
+        # 条数对不上时无法确定对应关系，整批放弃
+        log.warning(f"⚠️ AI 批量分类返回 {len(categories) if isinstance(categories, list) else 0} 条，期望 {len(items)} 条", extra={"solution": "本批保留默认分类"})
+        return [None] * len(items)
+    return [str(c).replace("分类：", "").replace("。", "").strip() or None for c in categories]
+
+# 重试装饰器：记录异常并返回 False
+# 请求级别的重试由 ServiceGuard 负责；整个函数重跑只用于没有写入副作用的函数 (显式传 max_retries>1)，
+# 导入、对账、建表、结账等函数只执行一次，避免重复写入
+def retry_on_failure(max_retries=1, delay=3):
     def decorator(func):
+        @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            retries = 0
-            while retries < max_retries:
+            for attempt in range(1, max_retries + 1):
                 try:
                     return func(*args, **kwargs)
+                except CircuitOpenError as e:
+                    # 服务熔断中，整体重试没有意义，直接失败
+                    log.error(f"❌ 函数{func.__name__}执行失败：{str(e)}", extra={"solution": "稍后再试"})
+                    return False
                 except Exception as e:
-                    retries += 1
-                    log.error(f"❌ 函数{func.__name__}执行失败（第{retries}次重试）：{str(e)}",
+                    if attempt >= max_retries:
+                        log.error(f"❌ 函数{func.__name__}执行失败：{str(e)}",
+                                  extra={"solution": f"查看Wiki：{WIKI_EXCEPTION}"})
+                        return False
+                    log.error(f"❌ 函数{func.__name__}执行失败（第{attempt}次重试）：{str(e)}",
                               extra={"solution": f"等待{delay}秒后重试"})
                     time.sleep(delay)
-            log.error(f"❌ 函数{func.__name__}重试{max_retries}次失败",
-                      extra={"solution": f"查看Wiki：{WIKI_EXCEPTION}"})
-            return False
         return wrapper
     return decorator
 
@@ -459,29 +777,161 @@ def init_clients():
         .app_id(APP_ID) \
         .app_secret(APP_SECRET) \
         .build()
+    client = guard_feishu_client(client)
     log.info("✅ 飞书客户端初始化成功", extra={"solution": "无"})
     send_bot_message("飞书财务小助手V8.8已启动 (Lark OAPI V2)", "accountant")
+    if OFFLINE_MODE:
+        client = enable_offline_mode(client)
     return client
 
-# 辅助：根据表名获取TableID
+# 辅助：根据表名获取TableID (进程级缓存 + 本地持久化，未命中时才分页刷新表列表)
+# 缓存结构: {app_token: {"updated": timestamp, "tables": {表名: table_id}}}
+TABLE_ID_CACHE = None
+TABLE_ID_CACHE_TTL = float(os.getenv("TABLE_ID_CACHE_TTL", 24 * 3600)) # 持久化缓存的有效期(秒)
+TABLE_ID_MISS_TTL = 60 # 刷新后仍不存在的表名，60秒内不再重复刷新
+TABLE_ID_MISSES = {} # (app_token, 表名) -> 最近一次确认不存在的时间
+TABLE_ID_LOCK = threading.RLock()
+TABLE_LIST_STATS = {"list_calls": 0}
+
+def load_table_id_cache():
+    global TABLE_ID_CACHE
+    with TABLE_ID_LOCK:
+        if TABLE_ID_CACHE is None:
+            TABLE_ID_CACHE = {}
+            if os.path.exists(FILE_TABLE_ID_CACHE):
+                try:
+                    with open(FILE_TABLE_ID_CACHE, "r", encoding="utf-8") as f:
+                        TABLE_ID_CACHE = json.load(f)
+                except Exception as e:
+                    log.warning(f"⚠️ 表名缓存读取失败: {e}", extra={"solution": "将重新获取表列表"})
+        return TABLE_ID_CACHE
+
+def save_table_id_cache():
+    try:
+        with TABLE_ID_LOCK:
+            with open(FILE_TABLE_ID_CACHE, "w", encoding="utf-8") as f:
+                json.dump(TABLE_ID_CACHE or {}, f, ensure_ascii=False, indent=2)
+    except Exception as e:
+        log.warning(f"⚠️ 保存表名缓存失败: {e}")
+
+def list_app_tables(client, app_token):
+    """分页获取全部数据表 (同时刷新表名缓存)，失败返回 None"""
+    tables = []
+    page_token = None
+    while True:
+        builder = ListAppTableRequest.builder() \
+            .app_token(app_token) \
+            .page_size(100)
+        if page_token:
+            builder.page_token(page_token)
+        resp = client.bitable.v1.app_table.list(builder.build())
+        TABLE_LIST_STATS["list_calls"] += 1
+        if not resp.success():
+            log.error(f"❌ 获取表格列表失败: {resp.msg}", extra={"solution": "检查App Token"})
+            return None
+        if resp.data and resp.data.items:
+            tables.extend(resp.data.items)
+        if not (resp.data and resp.data.has_more):
+            break
+        page_token = resp.data.page_token
+        
+    cache = load_table_id_cache()
+    with TABLE_ID_LOCK:
+        cache[app_token] = {"updated": time.time(), "tables": {t.name: t.table_id for t in tables}}
+        for key in [k for k in TABLE_ID_MISSES if k[0] == app_token]:
+            del TABLE_ID_MISSES[key]
+    save_table_id_cache()
+    return tables
+
 def get_table_id_by_name(client, app_token, table_name):
-    req = ListAppTableRequest.builder() \
-        .app_token(app_token) \
-        .page_size(50) \
-        .build()
-    resp = client.bitable.v1.app_table.list(req)
-    if not resp.success():
-        log.error(f"❌ 获取表格列表失败: {resp.msg}", extra={"solution": "检查App Token"})
+    cache = load_table_id_cache()
+    with TABLE_ID_LOCK:
+        entry = cache.get(app_token)
+        if entry and time.time() - entry.get("updated", 0) < TABLE_ID_CACHE_TTL:
+            if table_name in entry["tables"]:
+                return entry["tables"][table_name]
+            # 最近刚确认过不存在，避免反复请求表列表
+            if time.time() - TABLE_ID_MISSES.get((app_token, table_name), 0) < TABLE_ID_MISS_TTL:
+                return None
+                
+    if list_app_tables(client, app_token) is None:
         return None
         
-    if resp.data and resp.data.items:
-        for table in resp.data.items:
-            if table.name == table_name:
-                return table.table_id
-    return None
+    with TABLE_ID_LOCK:
+        table_id = cache[app_token]["tables"].get(table_name)
+        if not table_id:
+            TABLE_ID_MISSES[(app_token, table_name)] = time.time()
+        return table_id
+
+def register_table_id(app_token, table_name, table_id):
+    """create_*_table 新建表后登记，使缓存立即生效"""
+    cache = load_table_id_cache()
+    with TABLE_ID_LOCK:
+        entry = cache.setdefault(app_token, {"updated": time.time(), "tables": {}})
+        entry["tables"][table_name] = table_id
+        TABLE_ID_MISSES.pop((app_token, table_name), None)
+    save_table_id_cache()
+
+TABLE_ID_REMAP = {} # (app_token, 失效的 table_id) -> 同名表的新 table_id
+
+def refresh_stale_table_id(client, app_token, table_id):
+    """
+    table_id 已失效：刷新表列表 (缓存中该表名随之更新或移除)，返回同名表的新 table_id，
+    表已不存在或该 ID 不是由表名缓存得到的时返回 None
+    """
+    cache = load_table_id_cache()
+    with TABLE_ID_LOCK:
+        tables = (cache.get(app_token) or {}).get("tables", {})
+        name = next((n for n, t in tables.items() if t == table_id), None)
+    if name is None or list_app_tables(client, app_token) is None:
+        return None
+    with TABLE_ID_LOCK:
+        fresh = cache[app_token]["tables"].get(name)
+    LOCAL_REPLICA.reset(table_id) # 旧表的副本数据已作废
+    if not fresh or fresh == table_id:
+        log.warning(f"⚠️ 数据表 [{name}] 已不存在", extra={"solution": "检查多维表格或重新初始化"})
+        return None
+    log.warning(f"⚠️ 数据表 [{name}] 已被删除或重建，改用新的表ID {fresh}", extra={"solution": "无"})
+    return fresh
+
+def retarget_request(req, table_id):
+    req.table_id = table_id
+    if isinstance(getattr(req, "paths", None), dict):
+        req.paths["table_id"] = table_id
+
+def call_with_fresh_table_id(client, call, req, *args, **kwargs):
+    """
+    表级接口调用：返回"表不存在"时按原表名重新获取 table_id 并重发一次；
+    之后仍带着旧 table_id 的请求 (调用方手里的旧值) 直接改写为新 ID
+    """
+    app_token, table_id = getattr(req, "app_token", None), getattr(req, "table_id", None)
+    if not (app_token and table_id):
+        return call(req, *args, **kwargs)
+    if (app_token, table_id) in TABLE_ID_REMAP:
+        retarget_request(req, TABLE_ID_REMAP[(app_token, table_id)])
+    resp = call(req, *args, **kwargs)
+    if getattr(resp, "code", None) in FEISHU_TABLE_NOT_FOUND_CODES:
+        fresh = refresh_stale_table_id(client, app_token, req.table_id)
+        if fresh:
+            TABLE_ID_REMAP[(app_token, table_id)] = fresh
+            retarget_request(req, fresh)
+            resp = call(req, *args, **kwargs)
+    return resp
+
+def invalidate_table_id_cache(app_token=None):
+    """清除表名缓存 (表被手工删除/重建后使用)"""
+    cache = load_table_id_cache()
+    with TABLE_ID_LOCK:
+        if app_token:
+            cache.pop(app_token, None)
+        else:
+            cache.clear()
+        TABLE_ID_MISSES.clear()
+        TABLE_ID_REMAP.clear()
+    save_table_id_cache()
 
 # 批量导入Excel
-@retry_on_failure(max_retries=2, delay=3)
+@retry_on_failure()
 def import_from_excel(client, app_token, excel_path=None):
     try:
         # 如果没有指定路径，尝试交互式选择或弹窗
@@ -513,19 +963,11 @@ def import_from_excel(client, app_token, excel_path=None):
                         }
                         records.append(AppTableRecord.builder().fields(fields).build())
                     
-                    # 分批写入 (API限制每次100条)
-                    batch_size = 100
-                    for i in range(0, len(records), batch_size):
-                        batch = records[i:i+batch_size]
-                        req = BatchCreateAppTableRecordRequest.builder() \
-                            .app_token(app_token) \
-                            .table_id(table_id) \
-                            .request_body(BatchCreateAppTableRecordRequestBody.builder().records(batch).build()) \
-                            .build()
-                        resp = client.bitable.v1.app_table_record.batch_create(req)
-                        if not resp.success():
-                            log.error(f"❌ 基础信息表部分导入失败: {resp.msg}", extra={"solution": "检查数据格式"})
-                    log.info(f"✅ 基础信息表导入完成: {len(records)}条", extra={"solution": "无"})
+                    # 批量写入管道 (自动分批/并发/失败重试)
+                    result = batch_write_records(client, app_token, table_id, records)
+                    if result.failed:
+                        log.error(f"❌ 基础信息表部分导入失败: {result.error_summary()}", extra={"solution": "检查数据格式"})
+                    log.info(f"✅ 基础信息表导入完成: {result.success_count}条", extra={"solution": "无"})
                 else:
                     log.error("❌ 未找到'基础信息表'", extra={"solution": "请先创建表格"})
 
@@ -659,7 +1101,7 @@ def import_from_excel(client, app_token, excel_path=None):
                 category = str(row.get("费用归类", ""))
                 if not category or category == "nan" or category == "未知" or category == "":
                     memo = str(row.get("备注", ""))
-                    category = auto_categorize(memo, "其他", partner_name=desc)
+                    category = auto_categorize(memo, "其他", partner_name=desc, defer_ai=True)
                     
                 fields = {
                     "记账日期": ts,
@@ -685,6 +1127,9 @@ def import_from_excel(client, app_token, excel_path=None):
                     
                 records.append(AppTableRecord.builder().fields(fields).build())
             
+            # 规则/历史未命中的行统一走 AI 批量推断
+            resolve_pending_categories(records)
+            
             if skipped_count > 0:
                 log.info(f"⏭️ 已自动跳过 {skipped_count} 条重复记录", extra={"solution": "无"})
             
@@ -692,18 +1137,10 @@ def import_from_excel(client, app_token, excel_path=None):
                 log.info("✅ 没有新数据需要导入", extra={"solution": "无"})
                 return True
 
-            batch_size = 100
-            for i in range(0, len(records), batch_size):
-                batch = records[i:i+batch_size]
-                req = BatchCreateAppTableRecordRequest.builder() \
-                    .app_token(app_token) \
-                    .table_id(table_id) \
-                    .request_body(BatchCreateAppTableRecordRequestBody.builder().records(batch).build()) \
-                    .build()
-                resp = client.bitable.v1.app_table_record.batch_create(req)
-                if not resp.success():
-                     log.error(f"❌ 日常台账表部分导入失败: {resp.msg}", extra={"solution": "检查数据"})
-            log.info(f"✅ 日常台账表导入完成: {len(records)}条", extra={"solution": "无"})
+            result = batch_write_records(client, app_token, table_id, records)
+            if result.failed:
+                 log.error(f"❌ 日常台账表部分导入失败: {result.error_summary()}", extra={"solution": "检查数据"})
+            log.info(f"✅ 日常台账表导入完成: {result.success_count}条", extra={"solution": "无"})
         else:
              log.error("❌ 未找到'日常台账表'", extra={"solution": "请先创建表格"})
                  
@@ -717,18 +1154,136 @@ def import_from_excel(client, app_token, excel_path=None):
         log.error(f"❌ Excel导入异常：{str(e)}", extra={"solution": "检查文件"})
         return False
 
+# -------------------------- 报表字段声明 (按需拉取列) --------------------------
+# 各报表在 REPORT_FIELDS 中声明每张表读取的列，取数时显式传入 field_names=REPORT_FIELDS["报表"]["表名"]；
+# @tracked_report 只负责按报表归集拉取诊断
+class ReportFields(list):
+    """报表声明的字段：可能含云端尚未建立的字段，远程拉取前先与实际字段取交集"""
+
+REPORT_FIELDS = {
+    "calculate_tax": {"日常台账表": ReportFields(["是否有票", "交易银行", "业务类型", "实际收付金额"])},
+    "debt_collection_assistant": {
+        "日常台账表": ReportFields(["业务类型", "往来单位费用", "实际收付金额", "记账日期"]),
+        "加工费明细表": ReportFields(["类型", "往来单位", "总金额", "日期"]),
+    },
+    "financial_health_check": {
+        "日常台账表": ReportFields(["实际收付金额", "是否现金", "是否有票", "业务类型", "费用归类", "备注", "往来单位费用", "记账日期"]),
+        "加工费明细表": ReportFields(["日期", "总金额", "数量", "单价", "往来单位"]),
+    },
+    "quick_search_ledger": {"日常台账表": ReportFields(["记账日期", "实际收付金额", "备注", "往来单位费用", "费用归类", "业务类型"])},
+}
+REPORT_CONTEXT = threading.local()
+FETCH_DIAGNOSTICS_ENABLED = os.getenv("FETCH_DIAGNOSTICS", "false").lower() == "true"
+FETCH_DIAGNOSTICS = {} # 报表名 -> {"calls", "records", "projected", "bytes": 报表直接从云端拉取的字节, "sync_bytes": 期间副本同步拉取的字节}
+FETCH_DIAGNOSTICS_LOCK = threading.Lock()
+TABLE_FIELD_CACHE = {} # table_id -> 字段名集合 (仅用于校验云端投影字段)
+
+def tracked_report(func):
+    """报表运行期间的拉取按报表名归集到 FETCH_DIAGNOSTICS，结束时输出本次拉取量"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        stack = REPORT_CONTEXT.__dict__.setdefault("stack", [])
+        stack.append(func.__name__)
+        before = dict(FETCH_DIAGNOSTICS.get(func.__name__, {}))
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stack.pop()
+            if FETCH_DIAGNOSTICS_ENABLED:
+                after = FETCH_DIAGNOSTICS.get(func.__name__, {})
+                n = after.get("records", 0) - before.get("records", 0)
+                size = after.get("bytes", 0) - before.get("bytes", 0)
+                synced = after.get("sync_bytes", 0) - before.get("sync_bytes", 0)
+                log.info(f"📦 {func.__name__} 读取 {n} 条记录, 网络拉取约 {(size + synced) / 1024:,.1f} KB "
+                         f"(其中副本同步 {synced / 1024:,.1f} KB)", extra={"solution": "无"})
+    return wrapper
+
+def active_report():
+    stack = getattr(REPORT_CONTEXT, "stack", None)
+    return stack[-1] if stack else None
+
+def list_table_fields(client, app_token, table_id):
+    """分页获取字段定义列表，失败返回 None"""
+    fields = []
+    page_token = None
+    while True:
+        builder = ListAppTableFieldRequest.builder().app_token(app_token).table_id(table_id).page_size(100)
+        if page_token:
+            builder.page_token(page_token)
+        resp = client.bitable.v1.app_table_field.list(builder.build())
+        if not resp.success():
+            log.warning(f"⚠️ 读取字段列表失败: {resp.msg}", extra={"solution": "检查权限"})
+            return None
+        fields.extend(resp.data.items or [])
+        if not resp.data.has_more:
+            return fields
+        page_token = resp.data.page_token
+
+def existing_field_subset(client, app_token, table_id, field_names):
+    """云端按字段名投影时，不存在的字段会导致整个请求失败，因此先与实际字段取交集"""
+    if table_id not in TABLE_FIELD_CACHE:
+        try:
+            fields = list_table_fields(client, app_token, table_id)
+        except Exception as e:
+            log.warning(f"⚠️ 读取字段列表失败: {e}", extra={"solution": "本次拉取全部字段"})
+            fields = None
+        if fields is None:
+            return None
+        TABLE_FIELD_CACHE[table_id] = {f.field_name for f in fields}
+    subset = [name for name in field_names if name in TABLE_FIELD_CACHE[table_id]]
+    return subset or None
+
+def fetch_diagnostics_entry():
+    return FETCH_DIAGNOSTICS.setdefault(active_report() or "(未声明报表)",
+                                        {"calls": 0, "records": 0, "bytes": 0, "sync_bytes": 0, "projected": 0})
+
+def record_fetch_diagnostics(records, projected):
+    """按报表累计交给报表的记录数 (FETCH_DIAGNOSTICS=true 时开启；网络字节数在云端分页拉取处统计)"""
+    if not FETCH_DIAGNOSTICS_ENABLED:
+        return
+    with FETCH_DIAGNOSTICS_LOCK:
+        entry = fetch_diagnostics_entry()
+        entry["calls"] += 1
+        entry["records"] += len(records)
+        if projected:
+            entry["projected"] += 1
+
+def record_network_bytes(items):
+    """统计云端返回的一页记录的字段内容字节数；本地副本同步期间拉取的单独计入 sync_bytes"""
+    if not FETCH_DIAGNOSTICS_ENABLED:
+        return
+    size = sum(len(json.dumps(record_to_parts(r)[1], ensure_ascii=False, default=str).encode("utf-8")) for r in items)
+    with FETCH_DIAGNOSTICS_LOCK:
+        fetch_diagnostics_entry()["sync_bytes" if getattr(REPORT_CONTEXT, "syncing", False) else "bytes"] += size
+
 # 辅助：获取所有记录 (支持过滤和字段选择，带TTL缓存)
 # 缓存结构: {(table_id, filter_str, fields_str): (timestamp, records)}
+# 开启本地副本后，RECORD_CACHE 只是副本之上的一层短期内存缓存
 RECORD_CACHE = {}
 CACHE_TTL = 300 # 5分钟
 
+# 本地副本配置 (SQLite，按"最后修改时间"水位增量同步)
+LOCAL_REPLICA_ENABLED = os.getenv("LOCAL_REPLICA", "true").lower() == "true"
+REPLICA_SYNC_INTERVAL = float(os.getenv("REPLICA_SYNC_INTERVAL", 0)) # 两次增量同步的最小间隔(秒)，0 表示每次读取前都同步
+REPLICA_FULL_SYNC_HOURS = float(os.getenv("REPLICA_FULL_SYNC_HOURS", 24)) # 定期全量校准
+REPLICA_PRUNE_INTERVAL = float(os.getenv("REPLICA_PRUNE_INTERVAL", 60)) # 增量同步时核对云端记录ID、清除他人删除记录的最小间隔(秒)，0 表示每次都核对
+REPLICA_AUTO_ADD_FIELD = os.getenv("REPLICA_AUTO_ADD_FIELD", "false").lower() == "true" # 是否自动给缺少修改时间字段的表加字段 (默认只在设置菜单中手动添加)
+REPLICA_ID_PAGE_SIZE = 500 # 核对记录ID时的分页大小 (接口上限)
+REPLICA_MODIFIED_FIELD = "最后修改时间"
+REPLICA_WATERMARK_SKEW_MS = 1000 # 水位回退1秒，避免同一毫秒内的修改被漏掉
+
 def get_all_records(client, app_token, table_id, filter_info=None, field_names=None, use_cache=False):
     """
     获取所有记录
     use_cache: 是否使用内存缓存 (默认False，对于频繁读取的场景建议开启)
+    开启本地副本时先增量同步，再从本地 SQLite 按 filter_info / field_names 读取；
+    过滤公式无法在本地解析时回退为云端分页查询
+    field_names 为 REPORT_FIELDS 中的报表声明时，远程拉取前会剔除表中不存在的字段
     """
     global RECORD_CACHE
     
+    projected = isinstance(field_names, ReportFields)
+    
     # 构造缓存Key
     cache_key = (table_id, str(filter_info), str(field_names))
     
@@ -743,43 +1298,1928 @@ def get_all_records(client, app_token, table_id, filter_info=None, field_names=N
                 # 缓存过期
                 del RECORD_CACHE[cache_key]
 
+    # 交互会话内优先使用会话快照 (无网络请求)
+    if SESSION_SNAPSHOT is not None and client is not None:
+        records = SESSION_SNAPSHOT.query(client, app_token, table_id, filter_info=filter_info, field_names=field_names)
+        if records is not None:
+            return records
+
+    records = None
+    if LOCAL_REPLICA_ENABLED and client is not None:
+        records = LOCAL_REPLICA.query(client, app_token, table_id, filter_info=filter_info, field_names=field_names)
+        
+    if records is None:
+        if projected:
+            field_names = existing_field_subset(client, app_token, table_id, field_names)
+        records = fetch_records_remote(client, app_token, table_id, filter_info=filter_info, field_names=field_names)
+    record_fetch_diagnostics(records, projected)
+        
+    # 写入缓存
+    if use_cache:
+        RECORD_CACHE[cache_key] = (time.time(), records)
+        
+    return records
+
+def iter_all_records(client, app_token, table_id, filter_info=None, field_names=None):
+    """
+    流式获取记录 (生成器)：逐条产出，调用方无需等待最后一页即可开始处理
+    参数语义与 get_all_records 相同
+    """
+    projected = isinstance(field_names, ReportFields)
+    if SESSION_SNAPSHOT is not None and client is not None:
+        records = SESSION_SNAPSHOT.query(client, app_token, table_id, filter_info=filter_info, field_names=field_names)
+        if records is not None:
+            yield from records
+            return
+    pages = None
+    if LOCAL_REPLICA_ENABLED and client is not None:
+        pages = LOCAL_REPLICA.iter_query(client, app_token, table_id, filter_info=filter_info, field_names=field_names)
+    if pages is None:
+        if projected:
+            field_names = existing_field_subset(client, app_token, table_id, field_names)
+        pages = iter_record_pages(client, app_token, table_id, filter_info=filter_info, field_names=field_names)
+    for page in pages:
+        record_fetch_diagnostics(page, projected)
+        yield from page
+
+def fetch_records_remote(client, app_token, table_id, filter_info=None, field_names=None, automatic_fields=False, raise_on_error=False,
+                         page_size=100):
+    """直接从飞书分页拉取记录 (默认每页100条)"""
     records = []
-    page_token = None
-    
-    # 只有当开启缓存且数据量很大时才显示进度提示
-    # 为了简化，暂不加进度条
-    
-    while True:
+    for page in iter_record_pages(client, app_token, table_id, filter_info=filter_info, field_names=field_names,
+                                  automatic_fields=automatic_fields, raise_on_error=raise_on_error, page_size=page_size):
+        records.extend(page)
+    return records
+
+# 分页预取：处理当前页的同时，下一页请求已经在后台发出
+PREFETCH_PAGES = os.getenv("PREFETCH_PAGES", "true").lower() == "true"
+FETCH_STATS_LOG_PAGES = 10 # 超过该页数的拉取会在日志中输出耗时统计
+LAST_FETCH_STATS = {} # table_id -> PageFetchStats (最近一次云端拉取)
+
+class PageFetchStats:
+    """分页拉取统计：每页耗时与总吞吐"""
+    def __init__(self, table_id):
+        self.table_id = table_id
+        self.page_latencies = []
+        self.records = 0
+        self.started = time.time()
+        self.finished = None
+
+    def add_page(self, latency, count):
+        self.page_latencies.append(latency)
+        self.records += count
+
+    def finish(self):
+        self.finished = time.time()
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def throughput(self):
+        return self.records / self.elapsed if self.elapsed > 0 else 0.0
+
+    def summary(self):
+        if not self.page_latencies:
+            return f"{self.table_id}: 0 页"
+        avg = sum(self.page_latencies) / len(self.page_latencies)
+        return (f"{self.table_id}: {len(self.page_latencies)} 页 / {self.records} 条, "
+                f"单页平均 {avg * 1000:.0f}ms (最慢 {max(self.page_latencies) * 1000:.0f}ms), "
+                f"总耗时 {self.elapsed:.2f}s, 吞吐 {self.throughput:.0f} 条/秒")
+
+def iter_record_pages(client, app_token, table_id, filter_info=None, field_names=None, automatic_fields=False,
+                      raise_on_error=False, prefetch=None, stats=None, page_size=100):
+    """
+    从飞书分页拉取记录 (生成器，每次产出一页)
+    prefetch 开启时，拿到本页的 page_token 后立即在后台请求下一页，与调用方处理本页并行
+    """
+    if prefetch is None:
+        prefetch = PREFETCH_PAGES
+    if stats is None:
+        stats = PageFetchStats(table_id)
+
+    def request_page(page_token):
         builder = ListAppTableRecordRequest.builder() \
             .app_token(app_token) \
             .table_id(table_id) \
-            .page_size(100)
+            .page_size(page_size)
         
         if filter_info:
             builder.filter(filter_info)
             
         if field_names:
-            builder.field_names(field_names)
+            # 接口要求 JSON 数组字符串，如 ["字段1","字段2"]
+            if not isinstance(field_names, str):
+                builder.field_names(json.dumps(list(field_names), ensure_ascii=False))
+            else:
+                builder.field_names(field_names)
+            
+        if automatic_fields:
+            builder.automatic_fields(True)
             
         if page_token:
             builder.page_token(page_token)
             
-        req = builder.build()
-        resp = client.bitable.v1.app_table_record.list(req)
-        if not resp.success():
-            log.error(f"❌ 获取记录失败: {resp.msg}", extra={"solution": "检查网络或Token"})
-            break
-        if resp.data.items:
-            records.extend(resp.data.items)
-        if not resp.data.has_more:
-            break
-        page_token = resp.data.page_token
-        
-    # 写入缓存
-    if use_cache:
-        RECORD_CACHE[cache_key] = (time.time(), records)
-        
-    return records
+        t0 = time.time()
+        resp = client.bitable.v1.app_table_record.list(builder.build())
+        return resp, time.time() - t0
+
+    executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+    try:
+        pending = executor.submit(request_page, None) if executor else None
+        page_token = None
+        while True:
+            resp, latency = pending.result() if executor else request_page(page_token)
+            if not resp.success():
+                if raise_on_error:
+                    raise RuntimeError(f"获取记录失败: {resp.msg}")
+                log.error(f"❌ 获取记录失败: {resp.msg}", extra={"solution": "检查网络或Token"})
+                break
+            items = resp.data.items or []
+            has_more = resp.data.has_more
+            if has_more:
+                page_token = resp.data.page_token
+                if executor:
+                    pending = executor.submit(request_page, page_token)
+            stats.add_page(latency, len(items))
+            record_network_bytes(items)
+            if items:
+                yield items
+            if not has_more:
+                break
+    finally:
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+        stats.finish()
+        LAST_FETCH_STATS[table_id] = stats
+        if len(stats.page_latencies) >= FETCH_STATS_LOG_PAGES:
+            log.info(f"📶 分页拉取统计 {stats.summary()}", extra={"solution": "无"})
+
+# -------------------------- 本地副本：过滤公式解释器 --------------------------
+# 支持代码中用到的飞书过滤公式子集:
+#   AND(...), OR(...), NOT(...), a && b, a || b
+#   CurrentValue.[字段] >= 123 / = "文本" / != "文本" ...
+#   CurrentValue.[字段].contains("文本")
+FILTER_TOKEN_RE = re.compile(
+    r'\s*(?:'
+    r'(?P<field>CurrentValue\.\[[^\]]+\])'
+    r'|(?P<contains>\.contains\s*\()'
+    r'|(?P<func>AND|OR|NOT)\s*\('
+    r'|(?P<str>"(?:[^"\\]|\\.)*")'
+    r'|(?P<num>-?\d+(?:\.\d+)?)'
+    r'|(?P<op>&&|\|\||>=|<=|!=|==|=|>|<|\(|\)|,)'
+    r')'
+)
+
+def tokenize_filter(filter_info):
+    tokens = []
+    pos = 0
+    text = filter_info.strip()
+    while pos < len(text):
+        m = FILTER_TOKEN_RE.match(text, pos)
+        if not m or m.end() == pos:
+            raise ValueError(f"无法解析的过滤公式片段: {text[pos:pos+20]}")
+        kind = m.lastgroup
+        val = m.group(kind)
+        if kind == "field":
+            val = val[len("CurrentValue.["):-1]
+        elif kind == "func":
+            val = val.upper()
+        elif kind == "str":
+            val = val[1:-1].replace('\\"', '"')
+        elif kind == "num":
+            val = float(val)
+        tokens.append((kind, val))
+        pos = m.end()
+        # 跳过尾部空白
+        while pos < len(text) and text[pos].isspace():
+            pos += 1
+    return tokens
+
+def normalize_field_value(value):
+    """把飞书字段值统一成可比较的标量 (文本段落数组 -> 字符串)"""
+    if isinstance(value, list):
+        parts = []
+        for x in value:
+            if isinstance(x, dict):
+                parts.append(str(x.get("text", x.get("name", ""))))
+            else:
+                parts.append(str(x))
+        return "".join(parts)
+    if isinstance(value, dict):
+        return value.get("text", value.get("value"))
+    return value
+
+def compare_field_value(value, op, literal):
+    value = normalize_field_value(value)
+    if value is None or value == "":
+        return op == "!="
+    if op == "contains":
+        return str(literal) in str(value)
+    if isinstance(literal, float):
+        try:
+            left = float(value)
+        except (TypeError, ValueError):
+            return op == "!="
+        right = literal
+    else:
+        left = str(value)
+        right = literal
+    if op in ("=", "=="): return left == right
+    if op == "!=": return left != right
+    if op == ">": return left > right
+    if op == ">=": return left >= right
+    if op == "<": return left < right
+    if op == "<=": return left <= right
+    raise ValueError(f"不支持的运算符: {op}")
+
+def compile_record_filter(filter_info):
+    """
+    将飞书过滤公式编译为本地判断函数 fields -> bool
+    无法解析时返回 None (调用方应回退到云端过滤)
+    """
+    if not filter_info:
+        return lambda fields: True
+    try:
+        tokens = tokenize_filter(filter_info)
+    except ValueError:
+        return None
+    pos = [0]
+
+    def peek():
+        return tokens[pos[0]] if pos[0] < len(tokens) else (None, None)
+
+    def take(kind=None, val=None):
+        tok = peek()
+        if tok[0] is None or (kind and tok[0] != kind) or (val is not None and tok[1] != val):
+            raise ValueError(f"过滤公式语法错误: {filter_info}")
+        pos[0] += 1
+        return tok
+
+    def parse_or():
+        left = parse_and()
+        while peek() == ("op", "||"):
+            take()
+            right = parse_and()
+            left = (lambda a, b: lambda f: a(f) or b(f))(left, right)
+        return left
+
+    def parse_and():
+        left = parse_unary()
+        while peek() == ("op", "&&"):
+            take()
+            right = parse_unary()
+            left = (lambda a, b: lambda f: a(f) and b(f))(left, right)
+        return left
+
+    def parse_unary():
+        kind, val = peek()
+        if kind == "func":
+            take()
+            args = [parse_or()]
+            while peek() == ("op", ","):
+                take()
+                args.append(parse_or())
+            take("op", ")")
+            if val == "AND":
+                return lambda f: all(a(f) for a in args)
+            if val == "OR":
+                return lambda f: any(a(f) for a in args)
+            if len(args) != 1:
+                raise ValueError("NOT 只接受一个参数")
+            return lambda f: not args[0](f)
+        if (kind, val) == ("op", "("):
+            take()
+            inner = parse_or()
+            take("op", ")")
+            return inner
+        if kind == "field":
+            take()
+            nk, nv = peek()
+            if nk == "contains":
+                take()
+                lit = take()
+                if lit[0] not in ("str", "num"):
+                    raise ValueError("contains 需要字面量参数")
+                take("op", ")")
+                op, literal = "contains", lit[1]
+            elif nk == "op" and nv in ("=", "==", "!=", ">", ">=", "<", "<="):
+                take()
+                lit = take()
+                if lit[0] not in ("str", "num"):
+                    raise ValueError("比较运算需要字面量")
+                op, literal = nv, lit[1]
+            else:
+                raise ValueError(f"过滤公式语法错误: {filter_info}")
+            return (lambda name, o, l: lambda f: compare_field_value(f.get(name), o, l))(val, op, literal)
+        raise ValueError(f"过滤公式语法错误: {filter_info}")
+
+    try:
+        predicate = parse_or()
+        if pos[0] != len(tokens):
+            raise ValueError(f"过滤公式存在多余内容: {filter_info}")
+        return predicate
+    except ValueError:
+        return None
+
+# -------------------------- 本地副本：SQLite 存储 --------------------------
+class LocalRecord:
+    """本地副本返回的记录 (兼容 SDK 记录的 record_id / fields 属性，也支持 r['fields'] 写法)"""
+    __slots__ = ("record_id", "fields", "last_modified_time")
+
+    def __init__(self, record_id, fields, last_modified_time=None):
+        self.record_id = record_id
+        self.fields = fields
+        self.last_modified_time = last_modified_time
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+def record_to_parts(record):
+    """兼容 SDK 记录对象与 dict，取出 (record_id, fields, last_modified_time)"""
+    if isinstance(record, dict):
+        return record.get("record_id"), record.get("fields") or {}, record.get("last_modified_time")
+    return getattr(record, "record_id", None), getattr(record, "fields", None) or {}, getattr(record, "last_modified_time", None)
+
+REPLICA_FIELD_HINTED = set() # 已提示过缺少修改时间字段的表
+
+def ensure_modified_time_field(client, app_token, table_id, create=None):
+    """
+    查找"最后修改时间"类型字段，作为增量同步的水位字段
+    create=True (或开启 REPLICA_AUTO_ADD_FIELD) 时缺失则在云端表中新建；否则只提示一次，副本按全量同步
+    """
+    create = REPLICA_AUTO_ADD_FIELD if create is None else create
+    try:
+        fields = list_table_fields(client, app_token, table_id)
+        if fields is None:
+            return None
+        for fld in fields:
+            if fld.type == FT.MODIFIED_TIME:
+                return fld.field_name
+            
+        if not create:
+            if table_id not in REPLICA_FIELD_HINTED:
+                REPLICA_FIELD_HINTED.add(table_id)
+                log.info(f"ℹ️ 表 {table_id} 没有修改时间字段，本地副本将按全量同步",
+                         extra={"solution": f"可在 系统设置 -> 开启增量同步 中添加[{REPLICA_MODIFIED_FIELD}]字段"})
+            return None
+        req = CreateAppTableFieldRequest.builder() \
+            .app_token(app_token) \
+            .table_id(table_id) \
+            .request_body(AppTableField.builder().field_name(REPLICA_MODIFIED_FIELD).type(FT.MODIFIED_TIME).build()) \
+            .build()
+        resp = client.bitable.v1.app_table_field.create(req)
+        if resp.success():
+            log.info(f"✅ 已为表 {table_id} 添加[{REPLICA_MODIFIED_FIELD}]字段，用于增量同步", extra={"solution": "无"})
+            return REPLICA_MODIFIED_FIELD
+        log.warning(f"⚠️ 无法添加[{REPLICA_MODIFIED_FIELD}]字段: {resp.msg}", extra={"solution": "本地副本将改用全量同步"})
+    except Exception as e:
+        log.warning(f"⚠️ 检查修改时间字段失败: {e}", extra={"solution": "本地副本将改用全量同步"})
+    return None
+
+class LocalReplica:
+    """
+    飞书多维表格的本地 SQLite 副本
+    - 首次/定期全量同步，之后只拉取"最后修改时间"晚于水位的记录
+    - 读取时在本地执行过滤公式与字段投影
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = None
+        self.db_lock = threading.RLock()
+        self.table_locks = {}
+        self.last_sync = {} # table_id -> 本进程内最近一次成功同步的时间
+        self.last_prune = {} # table_id -> 本进程内最近一次核对云端记录ID (清除他人删除的记录) 的时间
+        self.sync_stats = {"full": 0, "incremental": 0, "pulled": 0, "pruned": 0, "failed": 0}
+
+    def connect(self):
+        with self.db_lock:
+            if self.conn is None:
+                self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+                self.conn.execute("PRAGMA journal_mode=WAL")
+                self.conn.create_function("ledger_crc", 2, lambda rid, raw: ledger_record_crc(rid, json.loads(raw)), deterministic=True)
+                self.conn.execute("""
+                    CREATE TABLE IF NOT EXISTS records (
+                        table_id TEXT NOT NULL,
+                        record_id TEXT NOT NULL,
+                        modified INTEGER DEFAULT 0,
+                        fields TEXT NOT NULL,
+                        PRIMARY KEY (table_id, record_id)
+                    )""")
+                self.conn.execute("""
+                    CREATE TABLE IF NOT EXISTS sync_meta (
+                        table_id TEXT PRIMARY KEY,
+                        app_token TEXT,
+                        watermark INTEGER DEFAULT 0,
+                        modified_field TEXT,
+                        last_full_sync REAL DEFAULT 0,
+                        last_sync REAL DEFAULT 0
+                    )""")
+                self.conn.commit()
+            return self.conn
+
+    def table_lock(self, table_id):
+        with self.db_lock:
+            if table_id not in self.table_locks:
+                self.table_locks[table_id] = threading.Lock()
+            return self.table_locks[table_id]
+
+    def get_meta(self, table_id):
+        conn = self.connect()
+        with self.db_lock:
+            row = conn.execute(
+                "SELECT watermark, modified_field, last_full_sync, last_sync FROM sync_meta WHERE table_id=?",
+                (table_id,)).fetchone()
+        if not row:
+            return None
+        return {"watermark": row[0] or 0, "modified_field": row[1], "last_full_sync": row[2] or 0, "last_sync": row[3] or 0}
+
+    def sync(self, client, app_token, table_id, force_full=False):
+        """同步单张表，返回是否成功"""
+        with self.table_lock(table_id):
+            now = time.time()
+            meta = self.get_meta(table_id)
+            if (not force_full and meta and table_id in self.last_sync
+                    and now - self.last_sync[table_id] < REPLICA_SYNC_INTERVAL):
+                return True
+                
+            modified_field = meta["modified_field"] if meta else None
+            full = (force_full or not meta or not modified_field
+                    or now - meta["last_full_sync"] > REPLICA_FULL_SYNC_HOURS * 3600)
+            if full and not modified_field:
+                modified_field = ensure_modified_time_field(client, app_token, table_id)
+                
+            remote_ids = None
+            REPORT_CONTEXT.syncing = True
+            try:
+                if full:
+                    items = fetch_records_remote(client, app_token, table_id, automatic_fields=True, raise_on_error=True)
+                else:
+                    since = max(0, meta["watermark"] - REPLICA_WATERMARK_SKEW_MS)
+                    items = fetch_records_remote(client, app_token, table_id,
+                                                 filter_info=f'CurrentValue.[{modified_field}]>={since}',
+                                                 automatic_fields=True, raise_on_error=True)
+                    # 增量同步看不到删除：只拉取记录ID (投影到修改时间一列) 与本地比对
+                    if now - self.last_prune.get(table_id, 0) >= REPLICA_PRUNE_INTERVAL:
+                        remote_ids = {record_to_parts(r)[0] for r in fetch_records_remote(
+                            client, app_token, table_id, field_names=[modified_field], raise_on_error=True,
+                            page_size=REPLICA_ID_PAGE_SIZE)}
+            except Exception as e:
+                self.sync_stats["failed"] += 1
+                log.warning(f"⚠️ 本地副本同步失败 ({table_id}): {e}", extra={"solution": "将使用上次同步的数据"})
+                return False
+            finally:
+                REPORT_CONTEXT.syncing = False
+                
+            watermark = meta["watermark"] if (meta and not full) else 0
+            dup_index = DUPLICATE_INDEXES.get(table_id)
+            if dup_index is not None and full:
+                dup_index.stale = True # 全量同步可能发现云端删除，查重索引下次使用前重建
+            rows = []
+            for item in items:
+                rid, fields, modified = record_to_parts(item)
+                if not rid:
+                    continue
+                modified = int(modified or 0)
+                watermark = max(watermark, modified)
+                rows.append((table_id, rid, modified, json.dumps(fields, ensure_ascii=False)))
+                if dup_index is not None and not full:
+                    dup_index.add(rid, fields) # 其他人新录入/修改的记录直接并入查重索引
+                
+            conn = self.connect()
+            with self.db_lock:
+                if full:
+                    conn.execute("DELETE FROM records WHERE table_id=?", (table_id,))
+                conn.executemany("""
+                    INSERT INTO records (table_id, record_id, modified, fields) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(table_id, record_id) DO UPDATE SET modified=excluded.modified, fields=excluded.fields
+                """, rows)
+                conn.execute("""
+                    INSERT INTO sync_meta (table_id, app_token, watermark, modified_field, last_full_sync, last_sync)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(table_id) DO UPDATE SET app_token=excluded.app_token, watermark=excluded.watermark,
+                        modified_field=excluded.modified_field, last_full_sync=excluded.last_full_sync,
+                        last_sync=excluded.last_sync
+                """, (table_id, app_token, watermark, modified_field,
+                      now if full else meta["last_full_sync"], now))
+                conn.commit()
+                gone = []
+                if remote_ids is not None:
+                    remote_ids.update(row[1] for row in rows)
+                    gone = [rid for (rid,) in conn.execute("SELECT record_id FROM records WHERE table_id=?", (table_id,))
+                            if rid not in remote_ids]
+            if gone:
+                self.remove_records(table_id, gone)
+                if dup_index is not None:
+                    for rid in gone:
+                        dup_index.remove(rid)
+                self.sync_stats["pruned"] += len(gone)
+            if full or remote_ids is not None:
+                self.last_prune[table_id] = now
+                
+            self.last_sync[table_id] = now
+            self.sync_stats["full" if full else "incremental"] += 1
+            self.sync_stats["pulled"] += len(rows)
+            # 离线模式：云端数据覆盖后重新叠加尚未同步的本地写入
+            if OFFLINE_JOURNAL is not None:
+                OFFLINE_JOURNAL.overlay(table_id)
+            return True
+
+    def refresh(self, client, app_token, table_id):
+        """
+        读取前的同步：离线模式下已有副本数据时不等待网络，交给后台同步线程拉取；
+        否则同 sync。返回副本是否可用
+        """
+        if OFFLINE_JOURNAL is not None and self.get_meta(table_id):
+            OFFLINE_JOURNAL.request_pull(app_token, table_id)
+            return True
+        return self.sync(client, app_token, table_id)
+
+    def query(self, client, app_token, table_id, filter_info=None, field_names=None):
+        """
+        以 get_all_records 的语义从本地副本读取
+        返回 None 表示无法由副本提供 (过滤公式不支持 / 从未同步成功)
+        """
+        pages = self.iter_query(client, app_token, table_id, filter_info=filter_info, field_names=field_names)
+        if pages is None:
+            return None
+        result = []
+        for page in pages:
+            result.extend(page)
+        return result
+
+    def iter_query(self, client, app_token, table_id, filter_info=None, field_names=None, page_size=100):
+        """同 query，但返回逐页解码的生成器 (无法由副本提供时返回 None)"""
+        predicate = compile_record_filter(filter_info)
+        if predicate is None:
+            return None
+        if not self.refresh(client, app_token, table_id) and not self.get_meta(table_id):
+            return None
+            
+        if isinstance(field_names, str):
+            try:
+                field_names = json.loads(field_names)
+            except ValueError:
+                field_names = [field_names]
+                
+        conn = self.connect()
+
+        def rows():
+            # 按 rowid 分段读取，内存中只保留一页原始数据 (不一次 fetchall 整张表)
+            last = 0
+            while True:
+                with self.db_lock:
+                    chunk = conn.execute(
+                        "SELECT rowid, record_id, modified, fields FROM records WHERE table_id=? AND rowid>? "
+                        "ORDER BY rowid LIMIT ?", (table_id, last, page_size)).fetchall()
+                if not chunk:
+                    return
+                last = chunk[-1][0]
+                for row in chunk:
+                    yield row[1:]
+
+        def pages():
+            page = []
+            for rid, modified, raw in rows():
+                fields = json.loads(raw)
+                if filter_info and not predicate(fields):
+                    continue
+                if field_names:
+                    fields = {k: fields[k] for k in field_names if k in fields}
+                page.append(LocalRecord(rid, fields, modified))
+                if len(page) >= page_size:
+                    yield page
+                    page = []
+            if page:
+                yield page
+        return pages()
+
+    def changed_since(self, table_id, since, field_names=None):
+        """返回修改时间不早于 since 的本地记录 (调用方负责先 sync)"""
+        conn = self.connect()
+        with self.db_lock:
+            rows = conn.execute(
+                "SELECT record_id, modified, fields FROM records WHERE table_id=? AND modified>=? ORDER BY rowid",
+                (table_id, since)).fetchall()
+        result = []
+        for rid, modified, raw in rows:
+            fields = json.loads(raw)
+            if field_names:
+                fields = {k: fields[k] for k in field_names if k in fields}
+            result.append(LocalRecord(rid, fields, modified))
+        return result
+
+    def month_fingerprints(self, table_id, date_field, start_ms, end_ms):
+        """
+        按月统计 [start_ms, end_ms) 内记录的 [条数, 校验和]，用于判断某月台账是否变化 (调用方负责先 sync)
+        校验和为各记录 ledger_record_crc 之和；date_field 为毫秒时间戳字段，月份按本地时间划分 (与 frame_datetime 一致)
+        """
+        conn = self.connect()
+        with self.db_lock:
+            rows = conn.execute("""
+                SELECT strftime('%Y-%m', d / 1000, 'unixepoch', 'localtime') AS ym, COUNT(*), SUM(ledger_crc(record_id, fields))
+                FROM (SELECT record_id, fields, json_extract(fields, ?) AS d FROM records WHERE table_id=?)
+                WHERE typeof(d) IN ('integer', 'real') AND d > 0 AND d >= ? AND d < ?
+                GROUP BY ym
+            """, (f'$."{date_field}"', table_id, start_ms, end_ms)).fetchall()
+        return {ym: [n, int(crc)] for ym, n, crc in rows}
+
+    def remove_records(self, table_id, record_ids):
+        """本程序删除云端记录后同步删除本地副本 (增量同步无法感知删除)"""
+        if not record_ids:
+            return
+        conn = self.connect()
+        with self.db_lock:
+            conn.executemany("DELETE FROM records WHERE table_id=? AND record_id=?",
+                             [(table_id, rid) for rid in record_ids])
+            conn.commit()
+        RECORD_CACHE.clear()
+        if SESSION_SNAPSHOT is not None:
+            SESSION_SNAPSHOT.remove(table_id, record_ids)
+
+    def get_record(self, table_id, record_id):
+        """返回 (fields, modified)，不存在时返回 None"""
+        conn = self.connect()
+        with self.db_lock:
+            row = conn.execute("SELECT fields, modified FROM records WHERE table_id=? AND record_id=?",
+                               (table_id, record_id)).fetchone()
+        return (json.loads(row[0]), row[1] or 0) if row else None
+
+    def put_record(self, table_id, record_id, fields, merge=False):
+        """写入本地记录 (离线写入)；merge=True 时合并到已有字段，保留原修改时间"""
+        conn = self.connect()
+        with self.db_lock:
+            row = conn.execute("SELECT fields FROM records WHERE table_id=? AND record_id=?",
+                               (table_id, record_id)).fetchone()
+            if row and merge:
+                merged = json.loads(row[0])
+                merged.update(fields)
+                conn.execute("UPDATE records SET fields=? WHERE table_id=? AND record_id=?",
+                             (json.dumps(merged, ensure_ascii=False), table_id, record_id))
+            elif not merge:
+                conn.execute("""
+                    INSERT INTO records (table_id, record_id, modified, fields) VALUES (?, ?, 0, ?)
+                    ON CONFLICT(table_id, record_id) DO UPDATE SET fields=excluded.fields
+                """, (table_id, record_id, json.dumps(fields, ensure_ascii=False)))
+            conn.commit()
+
+    def rename_record(self, table_id, old_id, new_id):
+        """离线新增的记录同步到云端后，把本地临时ID换成云端记录ID"""
+        conn = self.connect()
+        with self.db_lock:
+            conn.execute("UPDATE OR REPLACE records SET record_id=? WHERE table_id=? AND record_id=?",
+                         (new_id, table_id, old_id))
+            conn.commit()
+
+    def reset(self, table_id=None):
+        """清空副本 (下次读取时重新全量同步)"""
+        conn = self.connect()
+        with self.db_lock:
+            if table_id:
+                conn.execute("DELETE FROM records WHERE table_id=?", (table_id,))
+                conn.execute("DELETE FROM sync_meta WHERE table_id=?", (table_id,))
+                self.last_sync.pop(table_id, None)
+            else:
+                conn.execute("DELETE FROM records")
+                conn.execute("DELETE FROM sync_meta")
+                self.last_sync.clear()
+            conn.commit()
+        RECORD_CACHE.clear()
+
+    def status(self):
+        """各表的副本记录数与同步水位"""
+        conn = self.connect()
+        with self.db_lock:
+            rows = conn.execute("""
+                SELECT m.table_id, m.watermark, m.modified_field, m.last_sync,
+                       (SELECT COUNT(*) FROM records r WHERE r.table_id = m.table_id)
+                FROM sync_meta m
+            """).fetchall()
+        return [{"table_id": r[0], "watermark": r[1], "modified_field": r[2], "last_sync": r[3], "count": r[4]} for r in rows]
+
+LOCAL_REPLICA = LocalReplica(FILE_LOCAL_REPLICA)
+
+# -------------------------- 批量写入管道 --------------------------
+# 统一负责 batch_create / batch_update / batch_delete：
+# 按接口上限(100条)切块并发发送 (限速由 ServiceGuard 的 feishu.write 令牌桶统一负责)，只重试失败的块，并返回逐条结果；
+# 新增块带固定的 client_token，超时后重发由服务端去重，不会产生重复记录
+WRITE_BATCH_SIZE = 100
+WRITE_CONCURRENCY = int(os.getenv("WRITE_CONCURRENCY", 4)) # 同时在途的写请求数
+WRITE_MAX_RETRIES = 3
+WRITE_RETRY_DELAY = 1.0 # 首次重试等待(秒)，之后指数退避
+# 可重试的飞书错误码: 频率限制、写冲突、数据未就绪、超时；其余 1255xxx 为服务端内部错误
+WRITE_RETRY_CODES = FEISHU_RATE_LIMIT_CODES | FEISHU_TRANSIENT_CODES
+
+class WriteResult:
+    """
+    批量写入结果，results 与输入顺序一一对应:
+    {"ok": bool, "record_id": 记录ID或None, "error": 失败原因或None}
+    """
+    def __init__(self, action, total):
+        self.action = action
+        self.results = [None] * total
+        self.chunks = 0
+        self.retries = 0
+        self.elapsed = 0.0
+
+    @property
+    def success_count(self):
+        return sum(1 for r in self.results if r and r["ok"])
+
+    @property
+    def failed(self):
+        """失败条目 [(输入序号, 结果)]"""
+        return [(i, r) for i, r in enumerate(self.results) if not (r and r["ok"])]
+
+    @property
+    def record_ids(self):
+        """成功条目的记录ID (按输入顺序)"""
+        return [r["record_id"] for r in self.results if r and r["ok"]]
+
+    def error_summary(self):
+        errors = {}
+        for _, r in self.failed:
+            msg = r["error"] if r else "未发送"
+            errors[msg] = errors.get(msg, 0) + 1
+        return "; ".join(f"{msg} x{n}" for msg, n in errors.items())
+
+    def summary(self):
+        return (f"{self.action} 成功 {self.success_count}/{len(self.results)} 条, "
+                f"{self.chunks} 批, 重试 {self.retries} 次, 耗时 {self.elapsed:.1f}s")
+
+def to_write_item(item, action):
+    """把调用方传入的 字段dict / AppTableRecord / 记录ID 统一成接口需要的形态"""
+    if action == "delete":
+        return item if isinstance(item, str) else record_to_parts(item)[0]
+    if isinstance(item, dict):
+        if action == "update":
+            return AppTableRecord.builder().record_id(item["record_id"]).fields(item["fields"]).build()
+        return AppTableRecord.builder().fields(item).build()
+    return item
+
+def send_write_chunk(client, app_token, table_id, action, chunk, client_token=None):
+    """client_token: 新增请求的幂等键 (uuid)，同一键重复提交时服务端只执行一次"""
+    if action == "create":
+        builder = BatchCreateAppTableRecordRequest.builder() \
+            .app_token(app_token) \
+            .table_id(table_id) \
+            .request_body(BatchCreateAppTableRecordRequestBody.builder().records(chunk).build())
+        req = (builder.client_token(client_token) if client_token else builder).build()
+        return client.bitable.v1.app_table_record.batch_create(req)
+    if action == "update":
+        req = BatchUpdateAppTableRecordRequest.builder() \
+            .app_token(app_token) \
+            .table_id(table_id) \
+            .request_body(BatchUpdateAppTableRecordRequestBody.builder().records(chunk).build()) \
+            .build()
+        return client.bitable.v1.app_table_record.batch_update(req)
+    if action == "delete":
+        req = BatchDeleteAppTableRecordRequest.builder() \
+            .app_token(app_token) \
+            .table_id(table_id) \
+            .request_body(BatchDeleteAppTableRecordRequestBody.builder().records(chunk).build()) \
+            .build()
+        return client.bitable.v1.app_table_record.batch_delete(req)
+    raise ValueError(f"未知的写入类型: {action}")
+
+def is_retryable_write_error(resp):
+    code = getattr(resp, "code", None)
+    if not code:
+        return False # 没有错误码无法判断原因，不自动重发
+    return code in WRITE_RETRY_CODES or code >= 1255000
+
+def batch_write_records(client, app_token, table_id, records, action="create", chunk_size=WRITE_BATCH_SIZE,
+                        concurrency=None, max_retries=WRITE_MAX_RETRIES):
+    """
+    批量写入管道
+    records: create 传字段dict或AppTableRecord; update 传 {"record_id", "fields"} 或带 record_id 的 AppTableRecord;
+             delete 传记录ID
+    返回 WriteResult (逐条成功/失败)
+    """
+    items = [to_write_item(r, action) for r in records]
+    result = WriteResult(action, len(items))
+    if not items:
+        return result
+    if concurrency is None:
+        concurrency = WRITE_CONCURRENCY
+        
+    chunks = [(start, items[start:start + chunk_size]) for start in range(0, len(items), chunk_size)]
+    result.chunks = len(chunks)
+    stats_lock = threading.Lock()
+    t0 = time.time()
+
+    def run_chunk(start, chunk):
+        error = None
+        token = str(uuid.uuid4()) if action == "create" else None # 本块每次重发都用同一个
+        for attempt in range(max_retries + 1):
+            if attempt:
+                with stats_lock:
+                    result.retries += 1
+                time.sleep(WRITE_RETRY_DELAY * (2 ** (attempt - 1)))
+            try:
+                resp = send_write_chunk(client, app_token, table_id, action, chunk, client_token=token)
+            except CircuitOpenError as e:
+                error = str(e) # 请求未发出
+                break
+            except Exception as e:
+                # 超时/断线：请求可能已生效。修改与删除可安全重发，新增靠 client_token 去重
+                error = f"结果未知 (可能已写入): {e}" if action == "create" else str(e)
+                continue
+            if resp.success():
+                returned = (getattr(resp.data, "records", None) or []) if resp.data else []
+                for offset, item in enumerate(chunk):
+                    if action == "delete":
+                        record_id = item
+                        ok = getattr(returned[offset], "deleted", True) if offset < len(returned) else True
+                    else:
+                        record_id = returned[offset].record_id if offset < len(returned) else getattr(item, "record_id", None)
+                        ok = True
+                    result.results[start + offset] = {"ok": ok, "record_id": record_id, "error": None if ok else "未删除"}
+                return
+            error = f"{getattr(resp, 'code', '')} {resp.msg}".strip()
+            if not is_retryable_write_error(resp):
+                break
+        for offset, item in enumerate(chunk):
+            result.results[start + offset] = {"ok": False, "record_id": item if action == "delete" else getattr(item, "record_id", None),
+                                              "error": error}
+
+    workers = max(1, min(concurrency, len(chunks)))
+    if workers == 1:
+        for start, chunk in chunks:
+            run_chunk(start, chunk)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda c: run_chunk(*c), chunks))
+    result.elapsed = time.time() - t0
+
+    # 写入后清理该表的内存缓存并更新会话快照；删除需要同步到本地副本 (增量同步感知不到删除)
+    for key in [k for k in RECORD_CACHE if k[0] == table_id]:
+        RECORD_CACHE.pop(key, None)
+    if SESSION_SNAPSHOT is not None:
+        SESSION_SNAPSHOT.apply_write(table_id, action, items, result)
+    if table_id in DUPLICATE_INDEXES:
+        DUPLICATE_INDEXES[table_id].apply_write(action, items, result)
+    if action == "delete":
+        LOCAL_REPLICA.remove_records(table_id, result.record_ids)
+    if result.failed:
+        log.warning(f"⚠️ 批量写入部分失败: {result.summary()} ({result.error_summary()})", extra={"solution": "检查数据格式或稍后重试"})
+    elif result.chunks >= 10:
+        log.info(f"📤 批量写入统计: {result.summary()}", extra={"solution": "无"})
+    return result
+
+# -------------------------- 会话数据快照 --------------------------
+# interactive_menu 一次会话内共享：每张表首次读取时加载一次，之后的分析直接在内存中过滤，
+# 本程序自己的写入会同步到快照；可手动刷新，也可设置过期时间
+SESSION_SNAPSHOT_TTL = float(os.getenv("SESSION_SNAPSHOT_TTL", 0)) # 快照有效期(秒)，0 表示直到手动刷新
+SESSION_SNAPSHOT = None # 交互菜单启动时创建 SessionSnapshot
+
+class SessionSnapshot:
+    def __init__(self, ttl=None):
+        self.ttl = SESSION_SNAPSHOT_TTL if ttl is None else ttl
+        self.tables = {} # table_id -> {"loaded": 时间戳, "records": {record_id: LocalRecord}}
+        self.stale = set()
+        self.lock = threading.RLock()
+        self.stats = {"loads": 0, "hits": 0}
+
+    def is_fresh(self, table_id):
+        entry = self.tables.get(table_id)
+        if not entry or table_id in self.stale:
+            return False
+        return not self.ttl or time.time() - entry["loaded"] < self.ttl
+
+    def load(self, client, app_token, table_id):
+        records = None
+        if LOCAL_REPLICA_ENABLED:
+            records = LOCAL_REPLICA.query(client, app_token, table_id)
+        if records is None:
+            records = fetch_records_remote(client, app_token, table_id, raise_on_error=True)
+        snapshot = {}
+        for r in records:
+            rid, fields, modified = record_to_parts(r)
+            snapshot[rid] = LocalRecord(rid, fields, modified)
+        with self.lock:
+            self.tables[table_id] = {"loaded": time.time(), "records": snapshot}
+            self.stale.discard(table_id)
+            self.stats["loads"] += 1
+
+    def query(self, client, app_token, table_id, filter_info=None, field_names=None):
+        """与 get_all_records 语义相同；过滤公式无法在本地解析时返回 None"""
+        predicate = compile_record_filter(filter_info)
+        if predicate is None:
+            return None
+        if not self.is_fresh(table_id):
+            try:
+                self.load(client, app_token, table_id)
+            except Exception as e:
+                log.warning(f"⚠️ 会话快照加载失败: {e}", extra={"solution": "本次直接查询"})
+                return None
+        else:
+            self.stats["hits"] += 1
+            
+        if isinstance(field_names, str):
+            try:
+                field_names = json.loads(field_names)
+            except ValueError:
+                field_names = [field_names]
+        with self.lock:
+            records = list(self.tables[table_id]["records"].values())
+        result = []
+        for r in records:
+            if filter_info and not predicate(r.fields):
+                continue
+            # 返回副本，调用方修改字段不会污染快照
+            fields = {k: r.fields[k] for k in field_names if k in r.fields} if field_names else dict(r.fields)
+            result.append(LocalRecord(r.record_id, fields, r.last_modified_time))
+        return result
+
+    def apply_write(self, table_id, action, items, result):
+        """把 batch_write_records 的成功结果合并进快照"""
+        with self.lock:
+            entry = self.tables.get(table_id)
+            if not entry:
+                return
+            records = entry["records"]
+            for item, res in zip(items, result.results):
+                if not (res and res["ok"]):
+                    continue
+                rid = res["record_id"]
+                if action == "delete":
+                    records.pop(rid, None)
+                elif action == "update" and rid in records:
+                    records[rid].fields.update(record_to_parts(item)[1])
+                elif rid:
+                    records[rid] = LocalRecord(rid, dict(record_to_parts(item)[1]))
+                else:
+                    self.stale.add(table_id)
+
+    def remove(self, table_id, record_ids):
+        with self.lock:
+            entry = self.tables.get(table_id)
+            if entry:
+                for rid in record_ids:
+                    entry["records"].pop(rid, None)
+
+    def mark_stale(self, table_id=None):
+        """标记需要重新加载 (不指定表则全部刷新)"""
+        with self.lock:
+            self.stale.update([table_id] if table_id else self.tables.keys())
+
+    def summary(self):
+        with self.lock:
+            if not self.tables:
+                return "会话快照: 未加载"
+            count = sum(len(e["records"]) for e in self.tables.values())
+            oldest = min(e["loaded"] for e in self.tables.values())
+        minutes = int((time.time() - oldest) / 60)
+        return f"会话快照: {len(self.tables)} 张表 / {count:,} 条, {minutes} 分钟前加载 (命中 {self.stats['hits']} 次)"
+
+def note_record_write(table_id, created=None, deleted=None):
+    """
+    单条写入云端后调用：清理该表的内存缓存，会话快照下次读取时重新加载
+    created=(记录ID, 字段) / deleted=记录ID 时直接更新查重索引，其余写入让查重索引下次使用前重建
+    """
+    for key in [k for k in RECORD_CACHE if k[0] == table_id]:
+        RECORD_CACHE.pop(key, None)
+    if SESSION_SNAPSHOT is not None:
+        SESSION_SNAPSHOT.mark_stale(table_id)
+    entry = DUPLICATE_INDEXES.get(table_id)
+    if entry:
+        if created:
+            entry.add(*created)
+        elif deleted:
+            entry.remove(deleted)
+        else:
+            entry.stale = True
+
+# -------------------------- 离线模式：本地写入日志 --------------------------
+# OFFLINE_MODE=true 时，记录的新增/修改/删除先写入本地 SQLite 日志并立即叠加到本地副本 (不等待网络)，
+# 后台线程按顺序推送到飞书。推送前先增量拉取云端，若记录在本地修改所依据的版本之后又被云端改动，
+# 该条写入标记为冲突，由用户选择以本地为准或放弃
+OFFLINE_MODE = os.getenv("OFFLINE_MODE", "false").lower() == "true"
+OFFLINE_SYNC_INTERVAL = float(os.getenv("OFFLINE_SYNC_INTERVAL", 30)) # 后台同步间隔(秒)
+OFFLINE_ID_PREFIX = "local_" # 尚未同步的新增记录使用的临时记录ID
+OFFLINE_JOURNAL = None # 启用离线模式时由 enable_offline_mode 创建
+
+def journal_client_token(local_id):
+    """离线新增条目的幂等键 (由临时ID确定，每次重推都相同)"""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"cw-offline/{local_id}"))
+
+class OfflineJournal:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = None
+        self.db_lock = threading.RLock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.client = None
+        self.pull_requests = set() # 读取时请求后台拉取的 (app_token, table_id)
+        self.stats = {"synced": 0, "conflicts": 0, "failed": 0, "last_flush": 0, "last_error": None}
+
+    def connect(self):
+        with self.db_lock:
+            if self.conn is None:
+                self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+                self.conn.execute("PRAGMA journal_mode=WAL")
+                self.conn.execute("""
+                    CREATE TABLE IF NOT EXISTS journal (
+                        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                        created REAL,
+                        app_token TEXT,
+                        table_id TEXT NOT NULL,
+                        action TEXT NOT NULL,
+                        record_id TEXT,
+                        fields TEXT,
+                        base_modified INTEGER,
+                        status TEXT DEFAULT 'pending',
+                        error TEXT
+                    )""")
+                self.conn.execute("CREATE INDEX IF NOT EXISTS idx_journal_status ON journal (status, table_id)")
+                self.conn.execute("""
+                    CREATE TABLE IF NOT EXISTS id_map (
+                        local_id TEXT PRIMARY KEY,
+                        record_id TEXT NOT NULL
+                    )""")
+                self.conn.commit()
+            return self.conn
+
+    def append(self, app_token, table_id, action, record_id=None, fields=None):
+        """记录一次写入并立即叠加到本地副本，返回记录ID (新增时为临时ID)"""
+        if action == "create":
+            record_id = f"{OFFLINE_ID_PREFIX}{uuid.uuid4().hex[:12]}"
+        else:
+            record_id = self.resolve(record_id) or record_id
+        base = None
+        if action != "create":
+            current = LOCAL_REPLICA.get_record(table_id, record_id)
+            base = current[1] if current and current[1] else None
+            
+        conn = self.connect()
+        with self.db_lock:
+            conn.execute("""
+                INSERT INTO journal (created, app_token, table_id, action, record_id, fields, base_modified)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (time.time(), app_token, table_id, action, record_id,
+                  json.dumps(fields or {}, ensure_ascii=False), base))
+            conn.commit()
+        self.apply_local(table_id, action, record_id, fields or {})
+        note_record_write(table_id)
+        self.wakeup.set()
+        return record_id
+
+    def apply_local(self, table_id, action, record_id, fields):
+        if action == "create":
+            LOCAL_REPLICA.put_record(table_id, record_id, fields)
+        elif action == "update":
+            LOCAL_REPLICA.put_record(table_id, record_id, fields, merge=True)
+        elif action == "delete":
+            LOCAL_REPLICA.remove_records(table_id, [record_id])
+
+    def overlay(self, table_id):
+        """本地副本被云端数据覆盖后，重新叠加该表尚未同步的写入"""
+        for entry in self.entries("pending", table_id):
+            self.apply_local(table_id, entry["action"], self.resolve(entry["record_id"]) or entry["record_id"], entry["fields"])
+
+    def entries(self, status, table_id=None):
+        conn = self.connect()
+        sql = "SELECT seq, created, app_token, table_id, action, record_id, fields, base_modified, error FROM journal WHERE status=?"
+        params = [status]
+        if table_id:
+            sql += " AND table_id=?"
+            params.append(table_id)
+        with self.db_lock:
+            rows = conn.execute(sql + " ORDER BY seq", params).fetchall()
+        return [{"seq": r[0], "created": r[1], "app_token": r[2], "table_id": r[3], "action": r[4],
+                 "record_id": r[5], "fields": json.loads(r[6] or "{}"), "base_modified": r[7], "error": r[8]}
+                for r in rows]
+
+    def counts(self):
+        conn = self.connect()
+        with self.db_lock:
+            rows = conn.execute("SELECT status, COUNT(*) FROM journal GROUP BY status").fetchall()
+        return dict(rows)
+
+    def set_status(self, entries, status, error=None):
+        conn = self.connect()
+        with self.db_lock:
+            conn.executemany("UPDATE journal SET status=?, error=? WHERE seq=?",
+                             [(status, error, e["seq"]) for e in entries])
+            conn.commit()
+
+    def resolve(self, record_id):
+        """临时ID -> 云端记录ID (尚未同步时返回 None)；云端ID原样返回"""
+        if not record_id or not record_id.startswith(OFFLINE_ID_PREFIX):
+            return record_id
+        conn = self.connect()
+        with self.db_lock:
+            row = conn.execute("SELECT record_id FROM id_map WHERE local_id=?", (record_id,)).fetchone()
+        return row[0] if row else None
+
+    def flush(self, client):
+        """按写入顺序推送待同步记录，返回本次的 {"synced", "conflicts", "failed", "pending"}"""
+        with self.flush_lock:
+            result = {"synced": 0, "conflicts": 0, "failed": 0}
+            entries = self.entries("pending")
+            if entries:
+                self.push(client, entries, result)
+            for k in ("synced", "conflicts", "failed"):
+                self.stats[k] += result[k]
+            self.stats["last_flush"] = time.time()
+            result["pending"] = self.counts().get("pending", 0)
+            return result
+
+    def pull(self, client, app_token, table_id):
+        LOCAL_REPLICA.last_sync.pop(table_id, None)
+        return LOCAL_REPLICA.sync(client, app_token, table_id)
+
+    def request_pull(self, app_token, table_id):
+        """读取方不等待网络：登记该表，由后台线程下一轮增量同步"""
+        with self.db_lock:
+            if (app_token, table_id) in self.pull_requests:
+                return
+            self.pull_requests.add((app_token, table_id))
+        self.wakeup.set()
+
+    def pull_requested(self, client):
+        """后台线程执行读取方登记的同步 (按 REPLICA_SYNC_INTERVAL 节流)"""
+        with self.db_lock:
+            requests, self.pull_requests = self.pull_requests, set()
+        for app_token, table_id in requests:
+            LOCAL_REPLICA.sync(client, app_token, table_id)
+
+    def push(self, client, entries, result):
+        # 先增量拉取涉及的表，本地副本中的修改时间即云端当前版本
+        tables = {}
+        for e in entries:
+            tables.setdefault(e["table_id"], e["app_token"])
+        for table_id, app_token in tables.items():
+            if not self.pull(client, app_token, table_id):
+                self.stats["last_error"] = "无法连接飞书，稍后重试"
+                return
+                
+        # 同一张表、同一种操作的连续写入合并为一组 (修改/删除一次批量请求，新增逐条带幂等键)；遇到网络类错误即停止，保证顺序
+        pushed = set()
+        i = 0
+        while i < len(entries):
+            run = [entries[i]]
+            while (i + len(run) < len(entries) and len(run) < WRITE_BATCH_SIZE
+                   and entries[i + len(run)]["table_id"] == run[0]["table_id"]
+                   and entries[i + len(run)]["action"] == run[0]["action"]):
+                run.append(entries[i + len(run)])
+            i += len(run)
+            if not self.push_run(client, run, pushed, result):
+                break
+                
+        # 推送后再拉取一次，以云端新的修改时间作为仍待同步写入的冲突基准
+        for table_id in {t for t, _ in pushed}:
+            ok = self.pull(client, tables[table_id], table_id)
+            ids = {rid for t, rid in pushed if t == table_id}
+            conn = self.connect()
+            with self.db_lock:
+                for e in self.entries("pending", table_id):
+                    rid = self.resolve(e["record_id"])
+                    if rid in ids:
+                        current = LOCAL_REPLICA.get_record(table_id, rid) if ok else None
+                        conn.execute("UPDATE journal SET base_modified=? WHERE seq=?",
+                                     (current[1] if current and current[1] else None, e["seq"]))
+                conn.commit()
+
+    def push_run(self, client, run, pushed, result):
+        """推送一批写入；返回 False 表示云端暂不可用，应停止本轮同步"""
+        action, table_id, app_token = run[0]["action"], run[0]["table_id"], run[0]["app_token"]
+        ready = [] # [(日志条目, 云端记录ID或临时ID)]
+        for e in run:
+            rid = e["record_id"]
+            if action != "create":
+                rid = self.resolve(rid)
+                if rid is None:
+                    self.set_status([e], "failed", "依赖的离线新增记录未能同步")
+                    result["failed"] += 1
+                    continue
+                current = LOCAL_REPLICA.get_record(table_id, rid)
+                if e["base_modified"] and current and current[1] > e["base_modified"]:
+                    changed = datetime.fromtimestamp(current[1] / 1000).strftime("%Y-%m-%d %H:%M:%S")
+                    self.set_status([e], "conflict", f"云端记录已于 {changed} 被修改")
+                    result["conflicts"] += 1
+                    continue
+            ready.append((e, rid))
+        if not ready:
+            return True
+            
+        if action == "create":
+            # 新增逐条推送，client_token 由条目的临时ID确定：上次超时但已生效的条目重推时由服务端去重
+            for e, local_id in ready:
+                item = AppTableRecord.builder().fields(e["fields"]).build()
+                resp = self.send(client, app_token, table_id, action, [item], journal_client_token(local_id))
+                if resp is None:
+                    return False
+                if not resp.success():
+                    if not self.reject([e], resp, result):
+                        return False
+                    continue
+                returned = (resp.data.records if resp.data else None) or []
+                if len(returned) != 1:
+                    # 无法确定对应的云端记录，不能当作已同步
+                    self.set_status([e], "failed", f"云端返回 {len(returned)} 条记录，期望 1 条")
+                    result["failed"] += 1
+                    continue
+                record_id = returned[0].record_id
+                conn = self.connect()
+                with self.db_lock:
+                    conn.execute("INSERT OR REPLACE INTO id_map (local_id, record_id) VALUES (?, ?)",
+                                 (local_id, record_id))
+                    conn.commit()
+                LOCAL_REPLICA.rename_record(table_id, local_id, record_id)
+                pushed.add((table_id, record_id))
+                self.set_status([e], "synced")
+                result["synced"] += 1
+                note_record_write(table_id)
+            return True
+            
+        if action == "update":
+            merged = {}
+            for e, rid in ready:
+                merged.setdefault(rid, {}).update(e["fields"])
+            items = [AppTableRecord.builder().record_id(rid).fields(f).build() for rid, f in merged.items()]
+        else:
+            items = list(dict.fromkeys(rid for _, rid in ready))
+        resp = self.send(client, app_token, table_id, action, items)
+        if resp is None:
+            return False
+        if not resp.success():
+            return self.reject([e for e, _ in ready], resp, result)
+        pushed.update((table_id, rid) for _, rid in ready)
+        self.set_status([e for e, _ in ready], "synced")
+        result["synced"] += len(ready)
+        note_record_write(table_id)
+        return True
+
+    def send(self, client, app_token, table_id, action, items, client_token=None):
+        """发送一次写入；网络异常时返回 None (条目保持待同步，下轮以同一 client_token 重推)"""
+        try:
+            return send_write_chunk(client, app_token, table_id, action, items, client_token=client_token)
+        except Exception as e:
+            self.stats["last_error"] = str(e)
+            return None
+
+    def reject(self, entries, resp, result):
+        """处理失败响应；返回 False 表示可重试的错误 (停止本轮)，True 表示已标记失败、可继续"""
+        error = f"{getattr(resp, 'code', '')} {resp.msg}".strip()
+        self.stats["last_error"] = error
+        if is_retryable_write_error(resp):
+            return False
+        self.set_status(entries, "failed", error)
+        result["failed"] += len(entries)
+        log.warning(f"⚠️ 离线写入同步失败 ({len(entries)} 条): {error}", extra={"solution": "在[离线同步]菜单中查看"})
+        return True
+
+    def resolve_conflict(self, seq, keep_local):
+        """keep_local=True: 以本地为准重新推送；False: 放弃本地修改，重新拉取该表"""
+        conn = self.connect()
+        with self.db_lock:
+            row = conn.execute("SELECT table_id FROM journal WHERE seq=? AND status='conflict'", (seq,)).fetchone()
+            if not row:
+                return False
+            if keep_local:
+                conn.execute("UPDATE journal SET status='pending', base_modified=NULL, error=NULL WHERE seq=?", (seq,))
+            else:
+                conn.execute("UPDATE journal SET status='discarded' WHERE seq=?", (seq,))
+            conn.commit()
+        if not keep_local:
+            LOCAL_REPLICA.reset(row[0])
+        note_record_write(row[0])
+        self.wakeup.set()
+        return True
+
+    def start(self, client, interval=None):
+        """启动后台同步线程 (重复调用安全)"""
+        self.client = client
+        if self.thread and self.thread.is_alive():
+            return
+        interval = OFFLINE_SYNC_INTERVAL if interval is None else interval
+        self.stop_event.clear()
+
+        def loop():
+            while not self.stop_event.is_set():
+                try:
+                    result = self.flush(self.client)
+                    if result["synced"] or result["conflicts"] or result["failed"]:
+                        log.info(f"🛰️ 离线写入已同步 {result['synced']} 条，冲突 {result['conflicts']} 条，"
+                                 f"失败 {result['failed']} 条，剩余 {result['pending']} 条", extra={"solution": "无"})
+                    self.pull_requested(self.client)
+                except Exception as e:
+                    self.stats["last_error"] = str(e)
+                    log.warning(f"⚠️ 离线同步异常: {e}", extra={"solution": "稍后自动重试"})
+                if self.wakeup.wait(interval):
+                    self.stop_event.wait(1.0) # 有新写入时稍等片刻，攒成一批再推送
+                self.wakeup.clear()
+
+        self.thread = threading.Thread(target=loop, name="offline-sync", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=5):
+        self.stop_event.set()
+        self.wakeup.set()
+        if self.thread:
+            self.thread.join(timeout)
+
+    def summary(self):
+        counts = self.counts()
+        text = f"离线模式: 待同步 {counts.get('pending', 0)} 条"
+        if counts.get("conflict"):
+            text += f", 冲突 {counts['conflict']} 条"
+        if counts.get("failed"):
+            text += f", 失败 {counts['failed']} 条"
+        if self.stats["last_error"] and counts.get("pending"):
+            text += f" ({self.stats['last_error']})"
+        return text
+
+def offline_response(resp, data):
+    resp.code = 0
+    resp.msg = "success"
+    resp.data = data
+    return resp
+
+class OfflineRecordAPI:
+    """替代 client.bitable.v1.app_table_record：写操作记入离线日志后立即返回，读操作直接转发"""
+    def __init__(self, remote, journal):
+        self.remote = remote
+        self.journal = journal
+
+    def __getattr__(self, name):
+        return getattr(self.remote, name)
+
+    def create(self, req, *args, **kwargs):
+        fields = req.request_body.fields or {}
+        rid = self.journal.append(req.app_token, req.table_id, "create", fields=fields)
+        record = AppTableRecord.builder().record_id(rid).fields(fields).build()
+        return offline_response(CreateAppTableRecordResponse(),
+                                CreateAppTableRecordResponseBody.builder().record(record).build())
+
+    def batch_create(self, req, *args, **kwargs):
+        records = []
+        for r in req.request_body.records:
+            rid = self.journal.append(req.app_token, req.table_id, "create", fields=r.fields or {})
+            records.append(AppTableRecord.builder().record_id(rid).fields(r.fields or {}).build())
+        return offline_response(BatchCreateAppTableRecordResponse(),
+                                BatchCreateAppTableRecordResponseBody.builder().records(records).build())
+
+    def update(self, req, *args, **kwargs):
+        fields = req.request_body.fields or {}
+        rid = self.journal.append(req.app_token, req.table_id, "update", req.record_id, fields)
+        record = AppTableRecord.builder().record_id(rid).fields(fields).build()
+        return offline_response(UpdateAppTableRecordResponse(),
+                                UpdateAppTableRecordResponseBody.builder().record(record).build())
+
+    def batch_update(self, req, *args, **kwargs):
+        records = []
+        for r in req.request_body.records:
+            rid = self.journal.append(req.app_token, req.table_id, "update", r.record_id, r.fields or {})
+            records.append(AppTableRecord.builder().record_id(rid).fields(r.fields or {}).build())
+        return offline_response(BatchUpdateAppTableRecordResponse(),
+                                BatchUpdateAppTableRecordResponseBody.builder().records(records).build())
+
+    def delete(self, req, *args, **kwargs):
+        rid = self.journal.append(req.app_token, req.table_id, "delete", req.record_id)
+        return offline_response(DeleteAppTableRecordResponse(),
+                                DeleteAppTableRecordResponseBody.builder().deleted(True).record_id(rid).build())
+
+    def batch_delete(self, req, *args, **kwargs):
+        records = []
+        for record_id in req.request_body.records:
+            rid = self.journal.append(req.app_token, req.table_id, "delete", record_id)
+            records.append(DeleteRecord.builder().deleted(True).record_id(rid).build())
+        return offline_response(BatchDeleteAppTableRecordResponse(),
+                                BatchDeleteAppTableRecordResponseBody.builder().records(records).build())
+
+class ApiOverride:
+    """转发到原接口对象，只替换指定的属性"""
+    def __init__(self, target, **overrides):
+        self._target = target
+        self.__dict__.update(overrides)
+
+    def __getattr__(self, name):
+        return getattr(self._target, name)
+
+class OfflineClient:
+    """离线优先客户端：记录写入走离线日志，其余接口 (表/字段/查询等) 原样使用飞书客户端"""
+    def __init__(self, client, journal):
+        self.remote = client
+        self.journal = journal
+        records = OfflineRecordAPI(client.bitable.v1.app_table_record, journal)
+        self.bitable = ApiOverride(client.bitable, v1=ApiOverride(client.bitable.v1, app_table_record=records))
+
+    def __getattr__(self, name):
+        return getattr(self.remote, name)
+
+def enable_offline_mode(client):
+    """包装为离线优先客户端并启动后台同步 (重复调用安全)"""
+    global OFFLINE_JOURNAL
+    if isinstance(client, OfflineClient):
+        return client
+    if OFFLINE_JOURNAL is None:
+        OFFLINE_JOURNAL = OfflineJournal(FILE_OFFLINE_JOURNAL)
+    if not LOCAL_REPLICA_ENABLED:
+        log.warning("⚠️ 离线模式下未同步的数据只能从本地副本读取", extra={"solution": "请设置 LOCAL_REPLICA=true"})
+    OFFLINE_JOURNAL.start(client)
+    log.info(f"🛰️ 已启用离线模式，{OFFLINE_JOURNAL.summary()}", extra={"solution": "无"})
+    return OfflineClient(client, OFFLINE_JOURNAL)
+
+def offline_sync_menu():
+    """离线同步状态：立即同步 / 处理冲突"""
+    if OFFLINE_JOURNAL is None:
+        print("ℹ️ 未启用离线模式 (在 .env 中设置 OFFLINE_MODE=true)")
+        input("\n按回车返回...")
+        return
+    while True:
+        print(f"\n🛰️ {OFFLINE_JOURNAL.summary()}")
+        conflicts = OFFLINE_JOURNAL.entries("conflict")
+        failed = OFFLINE_JOURNAL.entries("failed")
+        for e in conflicts + failed:
+            label = "冲突" if e in conflicts else "失败"
+            print(f"  [{e['seq']}] {label} {e['action']} {e['record_id']} {json.dumps(e['fields'], ensure_ascii=False)[:60]} - {e['error']}")
+        print("1. 立即同步")
+        if conflicts:
+            print("2. 处理冲突 (以本地为准重新提交)")
+            print("3. 处理冲突 (放弃本地修改)")
+        print("0. 返回")
+        c = input("请选择: ").strip()
+        if c == "1":
+            if not OFFLINE_JOURNAL.client:
+                print("❌ 尚未连接飞书")
+                continue
+            result = OFFLINE_JOURNAL.flush(OFFLINE_JOURNAL.client)
+            print(f"✅ 已同步 {result['synced']} 条，冲突 {result['conflicts']} 条，失败 {result['failed']} 条，剩余 {result['pending']} 条")
+        elif c in ("2", "3") and conflicts:
+            seqs = input("输入冲突编号 (逗号分隔，回车=全部): ").strip()
+            targets = [int(x) for x in re.split(r"[,，\s]+", seqs) if x.isdigit()] if seqs else [e["seq"] for e in conflicts]
+            done = sum(1 for seq in targets if OFFLINE_JOURNAL.resolve_conflict(seq, keep_local=(c == "2")))
+            print(f"✅ 已处理 {done} 条冲突")
+        else:
+            return
+
+# -------------------------- 列式加载 (pandas) --------------------------
+# 把拉取的记录按列直接转换为带类型的 DataFrame，聚合类报表用向量化 groupby 代替逐行循环
+FRAME_DATE_COLUMNS = {"记账日期", "日期", "开票日期"} # 毫秒时间戳 -> datetime64 (本地时间)
+FRAME_AMOUNT_COLUMNS = {"实际收付金额", "账面金额", "有票成本", "无票成本", "本次实际利润",
+                        "总金额", "数量", "单价", "不含税金额", "税额", "价税合计"} # -> float64
+FRAME_CATEGORY_COLUMNS = {"业务类型", "交易银行", "费用归类", "是否有票", "是否现金", "类型"} # -> category
+
+def frame_datetime(col):
+    """毫秒时间戳列 -> 本地时间 datetime64 (与 datetime.fromtimestamp 一致)，0/空/无法解析为 NaT"""
+    ms = pd.to_numeric(col, errors="coerce")
+    ms = ms.where(ms > 0)
+    return pd.to_datetime(ms, unit="ms", utc=True).dt.tz_convert(tz.tzlocal()).dt.tz_localize(None)
+
+def frame_amount(col):
+    """金额列 -> float64，兼容 "1,234.50" 这类文本，无法解析的按 0"""
+    if col.dtype == object:
+        col = col.map(lambda v: v.replace(",", "") if isinstance(v, str) else v)
+    return pd.to_numeric(col, errors="coerce").fillna(0.0).astype("float64")
+
+def records_to_frame(records, columns=None, defaults=None):
+    """
+    记录 (SDK对象/LocalRecord，可为生成器) -> 带类型的 DataFrame，index 为 record_id
+    columns: 需要的列 (缺失的字段为空值)；不指定时取所有记录字段的并集
+    defaults: {列名: 缺省值}，字段缺失时使用 (同 fields.get(列名, 缺省值))
+    """
+    defaults = defaults or {}
+    if columns is None:
+        records = list(records)
+        columns = []
+        for r in records:
+            for k in record_to_parts(r)[1]:
+                if k not in columns:
+                    columns.append(k)
+    ids = []
+    data = {c: [] for c in columns}
+    for r in records:
+        rid, fields, _ = record_to_parts(r)
+        ids.append(rid)
+        for c in columns:
+            data[c].append(fields.get(c, defaults.get(c)))
+            
+    df = pd.DataFrame(data, index=pd.Index(ids, name="record_id"), columns=list(columns))
+    for c in columns:
+        if c in FRAME_DATE_COLUMNS:
+            df[c] = frame_datetime(df[c])
+        elif c in FRAME_AMOUNT_COLUMNS:
+            df[c] = frame_amount(df[c])
+        elif c in FRAME_CATEGORY_COLUMNS:
+            try:
+                df[c] = df[c].astype("category")
+            except TypeError:
+                pass # 含列表等不可哈希的值时保持 object
+    return df
+
+def load_records_frame(client, app_token, table_id, filter_info=None, field_names=None, defaults=None):
+    """
+    拉取记录并转换为 DataFrame (流式逐页转换，不保留中间记录列表)
+    """
+    records = iter_all_records(client, app_token, table_id, filter_info=filter_info, field_names=field_names)
+    return records_to_frame(records, field_names, defaults=defaults)
+
+# -------------------------- 损益汇总立方体 --------------------------
+# 利润表、年度报表、月度分析、可视化报表共用同一套收支口径：
+# 台账一次向量化 groupby 得到 月份 × 收支 × 业务类型 × 费用归类 × 交易银行 × 是否有票 的汇总，各报表只做切片。
+# 已结束月份的汇总缓存到磁盘 (并由月度结账写入月度汇总表)，以本地副本中该月记录的校验和为准，数据未变时不再拉取重算
+PNL_INCOME_TYPES = ["收款"]
+PNL_EXPENSE_TYPES = ["付款", "费用"]
+PNL_CUBE_DIMS = ["月份", "收支", "业务类型", "费用归类", "交易银行", "是否有票"]
+PNL_CUBE_FIELDS = ["记账日期", "实际收付金额", "业务类型", "费用归类", "交易银行", "是否有票"]
+PNL_CUBE_DEFAULTS = {"业务类型": "", "费用归类": "未分类", "交易银行": "", "是否有票": "无票"} # 缺失/空值的归并口径
+PNL_CUBE_VERSION = 1 # 口径变化时递增，旧缓存作废
+PNL_CUBE_CACHE_ENABLED = os.getenv("PNL_CUBE_CACHE", "true").lower() == "true"
+PNL_CUBE_CACHE_FILE = FILE_PNL_CUBE_CACHE
+PNL_CUBE_CACHE = None # {"version", "tables": {table_id: {月份: {"fingerprint": [条数, 校验和], "rows": [...]}}}}
+PNL_CUBE_ROW_COLUMNS = PNL_CUBE_DIMS[1:] + ["金额", "笔数"] # 缓存/月度汇总中每行的列 (月份另存)
+PNL_CUBE_STATS = {"cached": 0, "summary": 0, "computed": 0, "stale": []} # 最近一次 load_pnl_cube 的月份来源
+
+def empty_pnl_cube():
+    cube = pd.DataFrame({c: pd.Series(dtype=object) for c in PNL_CUBE_DIMS})
+    cube["金额"] = pd.Series(dtype="float64")
+    cube["笔数"] = pd.Series(dtype="int64")
+    return cube
+
+def build_pnl_cube(df):
+    """
+    台账 DataFrame (records_to_frame 的结果，记账日期为 datetime64) -> 损益立方体
+    每行一个维度组合，列为 PNL_CUBE_DIMS + 金额 + 笔数；没有记账日期的记录不计入
+    """
+    if df.empty or "记账日期" not in df:
+        return empty_pnl_cube()
+    df = df[df["记账日期"].notna()]
+    frame = pd.DataFrame({"月份": df["记账日期"].dt.strftime("%Y-%m")}, index=df.index)
+    for c, default in PNL_CUBE_DEFAULTS.items():
+        col = df[c].astype(object) if c in df else pd.Series(None, index=df.index, dtype=object)
+        frame[c] = col.where(col.notna() & (col != ""), default).astype(str)
+    frame["收支"] = "其他"
+    frame.loc[frame["业务类型"].isin(PNL_INCOME_TYPES), "收支"] = "收入"
+    frame.loc[frame["业务类型"].isin(PNL_EXPENSE_TYPES), "收支"] = "支出"
+    frame["金额"] = df["实际收付金额"] if "实际收付金额" in df else 0.0
+    if frame.empty:
+        return empty_pnl_cube()
+    cube = frame.groupby(PNL_CUBE_DIMS, sort=True)["金额"].agg(["sum", "count"]).reset_index()
+    return cube.rename(columns={"sum": "金额", "count": "笔数"})
+
+def pnl_sum(cube, by=None, kind=None, value="金额"):
+    """
+    立方体切片求和
+    by: 维度名或维度列表 (None 返回总数)；kind: 收入 / 支出 / 其他 (None 为全部)
+    """
+    if kind:
+        cube = cube[cube["收支"] == kind]
+    if by is None:
+        return cube[value].sum()
+    return cube.groupby(by, sort=True)[value].sum()
+
+def load_pnl_cube_cache():
+    global PNL_CUBE_CACHE
+    if PNL_CUBE_CACHE is None:
+        PNL_CUBE_CACHE = {"version": PNL_CUBE_VERSION, "tables": {}}
+        if os.path.exists(PNL_CUBE_CACHE_FILE):
+            try:
+                with open(PNL_CUBE_CACHE_FILE, "r", encoding="utf-8") as f:
+                    cached = json.load(f)
+                if cached.get("version") == PNL_CUBE_VERSION:
+                    PNL_CUBE_CACHE = cached
+            except Exception as e:
+                log.warning(f"⚠️ 损益汇总缓存读取失败: {e}", extra={"solution": "将重新汇总"})
+    return PNL_CUBE_CACHE
+
+def save_pnl_cube_cache():
+    try:
+        with open(PNL_CUBE_CACHE_FILE, "w", encoding="utf-8") as f:
+            json.dump(PNL_CUBE_CACHE or {}, f, ensure_ascii=False)
+    except Exception as e:
+        log.warning(f"⚠️ 保存损益汇总缓存失败: {e}")
+
+def next_month_start(dt):
+    return datetime(dt.year + (dt.month == 12), dt.month % 12 + 1, 1)
+
+def month_starts(start, end):
+    """[start, end) 覆盖的各月月初"""
+    cur = datetime(start.year, start.month, 1)
+    while cur < end:
+        yield cur
+        cur = next_month_start(cur)
+
+def pnl_month_fingerprints(client, app_token, table_id, start_ms, end_ms):
+    """本地副本按月的 [条数, 校验和]；副本不可用时返回 None (此时不使用缓存)"""
+    if not (PNL_CUBE_CACHE_ENABLED and LOCAL_REPLICA_ENABLED and client is not None):
+        return None
+    try:
+        if not LOCAL_REPLICA.sync(client, app_token, table_id) and not LOCAL_REPLICA.get_meta(table_id):
+            return None
+        return LOCAL_REPLICA.month_fingerprints(table_id, "记账日期", start_ms, end_ms)
+    except sqlite3.Error as e:
+        log.warning(f"⚠️ 无法计算月度校验和: {e}", extra={"solution": "本次不使用损益汇总缓存"})
+        return None
+
+def ledger_record_crc(record_id, fields):
+    """台账记录在损益口径字段上的 CRC32 (与字段顺序及其他字段无关)，按月求和即为该月源数据的校验和"""
+    src = json.dumps([record_id] + [fields.get(k) for k in PNL_CUBE_FIELDS], ensure_ascii=False)
+    return zlib.crc32(src.encode("utf-8"))
+
+def ledger_month_fingerprints(records):
+    """与 LocalReplica.month_fingerprints 相同口径，但直接由已拉取的记录计算 (本地副本不可用时)"""
+    result = {}
+    for r in records:
+        rid, fields, _ = record_to_parts(r)
+        ms = fields.get("记账日期")
+        if isinstance(ms, bool) or not isinstance(ms, (int, float)) or ms <= 0:
+            continue
+        ym = datetime.fromtimestamp(int(ms) // 1000).strftime("%Y-%m")
+        fp = result.setdefault(ym, [0, 0])
+        fp[0] += 1
+        fp[1] += ledger_record_crc(rid, fields)
+    return result
+
+def pnl_checksum_text(fingerprint):
+    """[条数, 校验和] -> 月度汇总表中保存的校验和文本"""
+    return f"{fingerprint[0]}:{fingerprint[1]}"
+
+def pnl_month_cube(month, rows):
+    return pd.DataFrame(rows, columns=PNL_CUBE_ROW_COLUMNS).assign(月份=month)
+
+def pnl_cube_period(client, app_token, table_id, start, end):
+    """
+    load_pnl_cube 的实现，额外返回本地副本的月度指纹 (副本不可用时为 None)
+    已结束月份依次尝试: 本机磁盘缓存 -> 月度汇总表 (校验和一致且口径版本相同) -> 重新汇总
+    """
+    months = [m.strftime("%Y-%m") for m in month_starts(start, end)]
+    start_ms = int(start.timestamp() * 1000)
+    end_ms = int(end.timestamp() * 1000)
+    open_month = datetime.now().strftime("%Y-%m")
+    fingerprints = pnl_month_fingerprints(client, app_token, table_id, start_ms, end_ms)
+    
+    parts = []
+    missing = months
+    stale = []
+    from_summary = 0
+    if fingerprints is not None:
+        cached = load_pnl_cube_cache()["tables"].setdefault(table_id, {})
+        summaries = None
+        missing = []
+        for m in months:
+            fp = fingerprints.get(m, [0, 0])
+            entry = cached.get(m)
+            if m >= open_month:
+                missing.append(m)
+            elif entry and entry["fingerprint"] == fp:
+                parts.append(pnl_month_cube(m, entry["rows"]))
+            else:
+                if summaries is None:
+                    summaries = load_monthly_summaries(client, app_token)
+                summary = summaries.get(m)
+                if summary and summary["version"] == PNL_CUBE_VERSION and summary["checksum"] == pnl_checksum_text(fp):
+                    parts.append(pnl_month_cube(m, summary["rows"]))
+                    cached[m] = {"fingerprint": fp, "rows": summary["rows"]}
+                    from_summary += 1
+                else:
+                    if summary:
+                        stale.append(m)
+                    missing.append(m)
+        if from_summary:
+            save_pnl_cube_cache()
+    PNL_CUBE_STATS.update(cached=len(months) - len(missing) - from_summary, summary=from_summary,
+                          computed=len(missing), stale=stale)
+    if stale:
+        log.warning(f"⚠️ 已结账月份 {', '.join(stale)} 的台账在结账后有变动，本次按最新数据重新汇总",
+                    extra={"solution": "重新执行该月的月度结账以更新月度汇总表"})
+    
+    if missing:
+        lo = max(start_ms, int(datetime.strptime(missing[0], "%Y-%m").timestamp() * 1000))
+        hi = min(end_ms, int(next_month_start(datetime.strptime(missing[-1], "%Y-%m")).timestamp() * 1000))
+        df = load_records_frame(
+            client, app_token, table_id,
+            filter_info=f'AND(CurrentValue.[记账日期]>={lo}, CurrentValue.[记账日期]<{hi})',
+            field_names=PNL_CUBE_FIELDS, defaults=PNL_CUBE_DEFAULTS
+        )
+        fresh = build_pnl_cube(df)
+        fresh = fresh[fresh["月份"].isin(missing)]
+        parts.append(fresh)
+        
+        closed = [m for m in missing if m < open_month]
+        if fingerprints is not None and closed:
+            cached = load_pnl_cube_cache()["tables"].setdefault(table_id, {})
+            by_month = {m: g for m, g in fresh.groupby("月份")}
+            for m in closed:
+                g = by_month.get(m)
+                rows = [] if g is None else g[PNL_CUBE_ROW_COLUMNS].values.tolist()
+                cached[m] = {"fingerprint": fingerprints.get(m, [0, 0]), "rows": rows}
+            save_pnl_cube_cache()
+            
+    parts = [p for p in parts if not p.empty]
+    if not parts:
+        return empty_pnl_cube(), fingerprints
+    cube = pd.concat(parts, ignore_index=True)[PNL_CUBE_DIMS + ["金额", "笔数"]]
+    cube["金额"] = cube["金额"].astype("float64")
+    cube["笔数"] = cube["笔数"].astype("int64")
+    return cube.sort_values(PNL_CUBE_DIMS, ignore_index=True), fingerprints
+
+def load_pnl_cube(client, app_token, table_id, start, end):
+    """
+    [start, end) 期间 (按月对齐的 datetime) 的损益立方体
+    已结束月份 (早于本月) 在数据未变化时直接取缓存或月度汇总表；其余月份一次拉取、向量化汇总，并把已结束月份写回缓存
+    """
+    return pnl_cube_period(client, app_token, table_id, start, end)[0]
+
+# -------------------------- 月度汇总表 (已结账期间) --------------------------
+# 月度结账时把该月的损益立方体连同源记录校验和写入"月度汇总表"，每月一条有效记录。
+# 年度类报表读取 12 条汇总 + 未结账月份即可；源数据在结账后被改动时校验和不再一致，
+# 报表会改用最新数据并提示重新结账，重新结账写入新记录并把旧记录标记为已失效 (旧记录内容保持不变)
+SUMMARY_TABLE_NAME = "月度汇总表"
+
+def load_monthly_summaries(client, app_token):
+    """月度汇总表中的有效记录 {月份: {"record_id", "checksum", "version", "rows", "closed_at"}}，表不存在时返回 {}"""
+    table_id = get_table_id_by_name(client, app_token, SUMMARY_TABLE_NAME)
+    if not table_id:
+        return {}
+    result = {}
+    for r in get_all_records(client, app_token, table_id, filter_info='CurrentValue.[状态]="有效"'):
+        rid, f, _ = record_to_parts(r)
+        month = normalize_field_value(f.get("月份"))
+        try:
+            rows = json.loads(normalize_field_value(f.get("汇总明细")) or "[]")
+        except ValueError:
+            log.warning(f"⚠️ 月度汇总 {month} 的汇总明细无法解析", extra={"solution": "重新执行该月的月度结账"})
+            continue
+        entry = {"record_id": rid, "checksum": normalize_field_value(f.get("校验和")), "version": int(f.get("口径版本") or 0),
+                 "rows": rows, "closed_at": f.get("结账时间") or 0}
+        if month and (month not in result or entry["closed_at"] >= result[month]["closed_at"]):
+            result[month] = entry
+    return result
+
+def materialize_monthly_summaries(client, app_token, start, end):
+    """
+    把 [start, end) 内已结束月份的损益汇总写入月度汇总表 (每月一条，附源记录校验和)
+    校验和与口径版本都一致的月份跳过；否则写入新记录，并把原有效记录标记为已失效
+    返回 {"created": [...], "replaced": [...], "unchanged": [...]}，失败返回 None
+    """
+    ledger_id = get_table_id_by_name(client, app_token, "日常台账表")
+    if not ledger_id:
+        return None
+    created = create_summary_table(client, app_token)
+    if not created or not created[0]:
+        return None
+    summary_id = created[1]
+        
+    this_month = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    end = min(end, this_month)
+    result = {"created": [], "replaced": [], "unchanged": []}
+    if start >= end:
+        return result
+    cube, fingerprints = pnl_cube_period(client, app_token, ledger_id, start, end)
+    if fingerprints is None:
+        start_ms, end_ms = int(start.timestamp() * 1000), int(end.timestamp() * 1000)
+        records = list(iter_all_records(client, app_token, ledger_id, field_names=PNL_CUBE_FIELDS,
+                                        filter_info=f'AND(CurrentValue.[记账日期]>={start_ms}, CurrentValue.[记账日期]<{end_ms})'))
+        fingerprints = ledger_month_fingerprints(records)
+        cube = build_pnl_cube(records_to_frame(records, PNL_CUBE_FIELDS, defaults=PNL_CUBE_DEFAULTS))
+        
+    existing = load_monthly_summaries(client, app_token)
+    by_month = {m: g for m, g in cube.groupby("月份")}
+    closed_at = int(time.time() * 1000)
+    new_rows, retired = [], []
+    for m in (d.strftime("%Y-%m") for d in month_starts(start, end)):
+        checksum = pnl_checksum_text(fingerprints.get(m, [0, 0]))
+        old = existing.get(m)
+        if old and old["checksum"] == checksum and old["version"] == PNL_CUBE_VERSION:
+            result["unchanged"].append(m)
+            continue
+        g = by_month.get(m, empty_pnl_cube())
+        new_rows.append({
+            "月份": m,
+            "收入": float(pnl_sum(g, kind="收入")),
+            "支出": float(pnl_sum(g, kind="支出")),
+            "笔数": int(g["笔数"].sum()),
+            "汇总明细": json.dumps(g[PNL_CUBE_ROW_COLUMNS].values.tolist(), ensure_ascii=False),
+            "校验和": checksum,
+            "口径版本": PNL_CUBE_VERSION,
+            "状态": "有效",
+            "结账时间": closed_at,
+        })
+        if old:
+            retired.append(old["record_id"])
+            result["replaced"].append(m)
+        else:
+            result["created"].append(m)
+            
+    if new_rows:
+        written = batch_write_records(client, app_token, summary_id, new_rows, action="create")
+        if written.failed:
+            log.error(f"❌ 月度汇总写入失败: {written.error_summary()}", extra={"solution": "稍后重新执行月度结账"})
+            return None
+    if retired:
+        written = batch_write_records(client, app_token, summary_id,
+                                      [{"record_id": rid, "fields": {"状态": "已失效"}} for rid in retired], action="update")
+        if written.failed:
+            log.warning(f"⚠️ 旧的月度汇总未能标记为已失效: {written.error_summary()}", extra={"solution": "可在飞书中手工修改状态"})
+    if result["replaced"]:
+        log.warning(f"⚠️ 已结账月份 {', '.join(result['replaced'])} 的台账有变动，月度汇总已重新生成", extra={"solution": "核对结账后的改动"})
+    return result
+
+# -------------------------- 关键词匹配 (Aho-Corasick) --------------------------
+# 分类规则与往来单位别名都是"文本中是否包含某个关键词"的判断，规则多时逐条 in 扫描很慢。
+# 这里把全部关键词预编译成一个自动机，每次匹配只扫描文本一遍，耗时与规则条数无关
+class KeywordMatcher:
+    """
+    多关键词子串匹配
+    patterns: [(关键词, 优先级)]，优先级越小越优先；search 返回命中关键词中优先级最高者的序号
+    """
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.goto = [{}]
+        self.best = [None] # 每个状态(含其后缀链)上命中的最优关键词序号
+        self.always = None # 空关键词：任何文本都命中
+        for idx, (key, rank) in enumerate(self.patterns):
+            if not key:
+                self.always = self.better(self.always, idx)
+                continue
+            node = 0
+            for ch in key:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][ch] = nxt
+                    self.goto.append({})
+                    self.best.append(None)
+                node = nxt
+            self.best[node] = self.better(self.best[node], idx)
+            
+        # 广度优先构建失败链，并把后缀状态的命中结果并入当前状态
+        self.fail = [0] * len(self.goto)
+        pending = list(self.goto[0].values())
+        while pending:
+            nxt_level = []
+            for node in pending:
+                for ch, child in self.goto[node].items():
+                    f = self.fail[node]
+                    while f and ch not in self.goto[f]:
+                        f = self.fail[f]
+                    target = self.goto[f].get(ch, 0)
+                    self.fail[child] = target if target != child else 0
+                    self.best[child] = self.better(self.best[child], self.best[self.fail[child]])
+                    nxt_level.append(child)
+            pending = nxt_level
+
+    def better(self, a, b):
+        if a is None:
+            return b
+        if b is None:
+            return a
+        return a if self.patterns[a][1] <= self.patterns[b][1] else b
+
+    def search(self, text):
+        result = self.always
+        node = 0
+        goto, fail, best = self.goto, self.fail, self.best
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if best[node] is not None:
+                result = self.better(result, best[node])
+        return result
+
+    def match(self, text):
+        """返回命中的最优关键词，未命中返回 None"""
+        idx = self.search(text)
+        return None if idx is None else self.patterns[idx][0]
+
+KEYWORD_MATCHERS = {} # 名称 -> (源字典, 关键词数, 自动机, 匹配文本->原始关键词)
+
+def keyword_matcher(name, source, build):
+    """
+    取(必要时重建)某个关键词字典的自动机
+    规则文件加载或热修改后调用 rebuild_keyword_matchers；另按字典对象和条数兜底检测变化
+    """
+    cached = KEYWORD_MATCHERS.get(name)
+    if cached and cached[0] is source and cached[1] == len(source):
+        return cached[2], cached[3]
+    matcher, originals = build(source)
+    KEYWORD_MATCHERS[name] = (source, len(source), matcher, originals)
+    return matcher, originals
+
+def build_category_matcher(rules):
+    # 规则按文件中的顺序优先 (与逐条匹配时先命中者胜出一致)，匹配不区分大小写
+    keys = list(rules.keys())
+    return KeywordMatcher([(k.lower(), i) for i, k in enumerate(keys)]), keys
+
+def build_alias_matcher(aliases):
+    # 更长的别名优先，等长时按添加顺序
+    keys = list(aliases.keys())
+    return KeywordMatcher([(k, (-len(k), i)) for i, k in enumerate(keys)]), keys
+
+def rebuild_keyword_matchers():
+    """分类规则/别名被修改后调用，下次匹配时重新编译"""
+    KEYWORD_MATCHERS.clear()
 
 # 自动分类规则 (关键词 -> 往来单位/费用类型)
 def load_category_rules():
@@ -853,46 +3293,205 @@ def resolve_partner(name):
     if name in PARTNER_ALIASES:
         return PARTNER_ALIASES[name]
         
-    # 2. 模糊匹配 (按别名长度倒序，优先匹配更长的别名)
+    # 2. 模糊匹配 (优先匹配更长的别名)
     # 例如：规则 "张三"->A, "张三丰"->B. 输入 "张三丰转账".
     # 应该匹配 "张三丰" 而不是 "张三".
-    sorted_aliases = sorted(PARTNER_ALIASES.keys(), key=len, reverse=True)
-    
-    for alias in sorted_aliases:
-        if alias in name:
-            # log.info(f"💡 触发别名匹配: '{alias}' in '{name}' -> '{PARTNER_ALIASES[alias]}'")
-            return PARTNER_ALIASES[alias]
+    matcher, aliases = keyword_matcher("aliases", PARTNER_ALIASES, build_alias_matcher)
+    idx = matcher.search(name)
+    if idx is not None:
+        return PARTNER_ALIASES[aliases[idx]]
             
     return name
 
+# 常见银行摘要垃圾词
+BANK_GARBAGE_PREFIXES = [
+    "PAYMENT TO", "TRANSFER FROM", "REMITTANCE", 
+    "跨行转账", "网银转账", "银企直联", "手机转账", "批量转账",
+    "付款给", "收到", "支付", "转账", "汇款", "网转", "电汇", "回单", "记账",
+    "用途:", "摘要:", "附言:", "备注:", "说明:",
+    "工资:", "报销:", "代发:",
+    "用途：", "摘要：", "附言：", "备注：", "说明：",
+    "工资：", "报销：", "代发："
+]
+# 一次性去除开头连续出现的垃圾词 (长的在前，防止误伤)
+BANK_GARBAGE_RE = re.compile(
+    r"^(?:(?:" + "|".join(re.escape(g) for g in sorted(BANK_GARBAGE_PREFIXES, key=len, reverse=True)) + r")\s*)+",
+    re.IGNORECASE)
+
 def clean_description(text):
     """清洗摘要，移除无用前缀"""
     if not text: return ""
-    text = str(text).strip()
-    # 常见银行摘要垃圾词 (按长度倒序排列，优先匹配长的)
-    garbage = [
-        "PAYMENT TO", "TRANSFER FROM", "REMITTANCE", 
-        "跨行转账", "网银转账", "银企直联", "手机转账", "批量转账",
-        "付款给", "收到", "支付", "转账", "汇款", "网转", "电汇", "回单", "记账",
-        "用途:", "摘要:", "附言:", "备注:", "说明:",
-        "工资:", "报销:", "代发:",
-        "用途：", "摘要：", "附言：", "备注：", "说明：",
-        "工资：", "报销：", "代发："
-    ]
-    # 排序：长的在前面，防止误伤
-    garbage.sort(key=len, reverse=True)
-    
-    clean_text = text
-    # 循环去除前缀，直到没有匹配项
-    while True:
-        original = clean_text
-        for g in garbage:
-            if clean_text.upper().startswith(g):
-                clean_text = clean_text[len(g):].strip()
-        if clean_text == original:
-            break
-            
-    return clean_text
+    return BANK_GARBAGE_RE.sub("", str(text).strip())
+
+def categorize_statement_line(cleaned_memo, cleaned_desc, defer_ai=True):
+    """银行流水分类：先按摘要(带户名)匹配，未命中再单独匹配户名"""
+    category = auto_categorize(cleaned_memo, "其他", partner_name=cleaned_desc, defer_ai=defer_ai)
+    # (两者都只能交给 AI 时，保留带摘要的那一条)
+    if category == "其他":
+        fallback = auto_categorize(cleaned_desc, "其他", partner_name=cleaned_desc, defer_ai=defer_ai)
+        if not (isinstance(category, PendingCategory) and isinstance(fallback, PendingCategory)):
+            category = fallback
+    return category
+
+def normalize_bank_statement(df, defer_ai=True):
+    """
+    列式清洗银行流水：摘要/户名去前缀 -> 别名解析 -> 自动分类
+    别名与分类按去重后的取值各算一次再映射回每行，结果与逐行处理一致。
+    返回与 df 同索引的 DataFrame: 摘要, 清洗摘要, 往来单位, 费用归类
+    """
+    def text_col(name):
+        return df[name].astype(str)
+    
+    memo = text_col("摘要") if "摘要" in df.columns else pd.Series("", index=df.index)
+    if "对方户名" in df.columns:
+        raw_desc = text_col("对方户名")
+    elif "对方账号" in df.columns:
+        raw_desc = text_col("对方账号")
+    elif "摘要" in df.columns:
+        raw_desc = memo
+    else:
+        raw_desc = pd.Series("未知", index=df.index)
+    
+    cleaned_memo = memo.str.strip().str.replace(BANK_GARBAGE_RE, "", regex=True)
+    cleaned_desc = raw_desc.str.strip().str.replace(BANK_GARBAGE_RE, "", regex=True)
+    
+    partners = {name: resolve_partner(name) for name in cleaned_desc.unique()}
+    cleaned_desc = cleaned_desc.map(partners)
+    
+    pairs = list(zip(cleaned_memo, cleaned_desc))
+    categories = {pair: categorize_statement_line(*pair, defer_ai=defer_ai) for pair in dict.fromkeys(pairs)}
+    
+    return pd.DataFrame({
+        "摘要": memo,
+        "清洗摘要": cleaned_memo,
+        "往来单位": cleaned_desc,
+        "费用归类": [categories[pair] for pair in pairs],
+    }, index=df.index)
+
+# 关键词映射表 (可能的列名 -> 标准列名)
+# 增加更多模糊匹配词
+EXCEL_HEADER_KEYWORDS = {
+    # 日期类
+    "日期": "记账日期", "时间": "记账日期", "交易日": "记账日期", "记账日": "记账日期", 
+    "入账时间": "记账日期", "交易时间": "记账日期",
+    
+    # 金额类
+    "金额": "实际收付金额", "发生额": "实际收付金额", "收支金额": "实际收付金额",
+    "交易金额": "实际收付金额", "收/支": "实际收付金额", "金额(元)": "实际收付金额",
+    
+    # 备注/摘要类
+    "摘要": "备注", "说明": "备注", "用途": "备注", "商品": "备注", "附言": "备注",
+    "交易摘要": "备注", "备注说明": "备注", "项目名称": "备注", "内容": "备注",
+    
+    # 往来单位类
+    "对方": "往来单位费用", "户名": "往来单位费用", "单位": "往来单位费用",
+    "对方户名": "往来单位费用", "对方账号名称": "往来单位费用", "交易对方": "往来单位费用",
+    "收/付款人": "往来单位费用", "商户名称": "往来单位费用",
+    
+    # 业务类型类 (通常不用，自动推断)
+    "借贷": "业务类型", "收付标志": "业务类型"
+}
+EXCEL_READ_ENGINE = os.getenv("EXCEL_READ_ENGINE", "auto").lower() # auto / calamine / openpyxl / default
+EXCEL_LAYOUT_CACHE_FILE = FILE_EXCEL_LAYOUT_CACHE
+EXCEL_LAYOUT_CACHE_MAX = 200
+EXCEL_LAYOUT_TOUCH_INTERVAL = 86400 # 命中后的"最近使用时间"只用于淘汰排序，隔这么久 (秒) 才落盘一次
+EXCEL_LAYOUT_CACHE = None # "工作表|列1|列2..." -> {"sheet", "header_row", "columns", "column_map", "used"}
+
+def excel_read_engine():
+    """auto 时优先使用 calamine (需 pip install python-calamine，解析速度为 openpyxl 的数倍)"""
+    if EXCEL_READ_ENGINE == "auto":
+        return "calamine" if importlib.util.find_spec("python_calamine") else None
+    return None if EXCEL_READ_ENGINE in ("", "default") else EXCEL_READ_ENGINE
+
+def load_excel_layout_cache():
+    global EXCEL_LAYOUT_CACHE
+    if EXCEL_LAYOUT_CACHE is None:
+        EXCEL_LAYOUT_CACHE = {}
+        if os.path.exists(EXCEL_LAYOUT_CACHE_FILE):
+            try:
+                with open(EXCEL_LAYOUT_CACHE_FILE, "r", encoding="utf-8") as f:
+                    EXCEL_LAYOUT_CACHE = json.load(f)
+            except Exception as e:
+                log.warning(f"⚠️ 表头布局缓存读取失败: {e}", extra={"solution": "将重新识别表头"})
+    return EXCEL_LAYOUT_CACHE
+
+def save_excel_layout_cache():
+    try:
+        with open(EXCEL_LAYOUT_CACHE_FILE, "w", encoding="utf-8") as f:
+            json.dump(EXCEL_LAYOUT_CACHE or {}, f, ensure_ascii=False, indent=2)
+    except Exception as e:
+        log.warning(f"⚠️ 保存表头布局缓存失败: {e}")
+
+def excel_layout_key(sheet_name, columns):
+    """布局指纹：工作表名 + 表头行内容"""
+    return "|".join([str(sheet_name)] + [str(c) for c in columns])
+
+def excel_header_labels(row_values):
+    """以某预览行为表头整表读取时 pandas 给出的列名 (空单元格为 Unnamed: i，重名依次追加 .1/.2)"""
+    labels, seen = [], set()
+    for i, val in enumerate(row_values):
+        label = f"Unnamed: {i}" if pd.isna(val) else str(val)
+        base, n = label, 0
+        while label in seen:
+            n += 1
+            label = f"{base}.{n}"
+        seen.add(label)
+        labels.append(label)
+    return labels
+
+def match_excel_layout(sheet_name, df_preview):
+    """按表头内容在同名工作表的全部已知布局中查找与预览一致的一个，未命中返回 None"""
+    cache = load_excel_layout_cache()
+    header_rows = {v["header_row"] for v in cache.values() if v.get("sheet") == sheet_name}
+    for row in sorted(header_rows):
+        if row >= len(df_preview):
+            continue
+        layout = cache.get(excel_layout_key(sheet_name, excel_header_labels(df_preview.iloc[row].values)))
+        if layout and layout["header_row"] == row:
+            return layout
+    return None
+
+def touch_excel_layout(layout):
+    """更新最近使用时间；只在距上次落盘超过 EXCEL_LAYOUT_TOUCH_INTERVAL 时才写文件"""
+    now = time.time()
+    stale = now - layout.get("used", 0) > EXCEL_LAYOUT_TOUCH_INTERVAL
+    layout["used"] = now
+    if stale:
+        save_excel_layout_cache()
+
+def remember_excel_layout(sheet_name, header_row_idx, columns, column_map):
+    cache = load_excel_layout_cache()
+    columns = [str(c) for c in columns]
+    cache[excel_layout_key(sheet_name, columns)] = {
+        "sheet": sheet_name, "header_row": int(header_row_idx), "columns": columns,
+        "column_map": column_map, "used": time.time()
+    }
+    if len(cache) > EXCEL_LAYOUT_CACHE_MAX:
+        for key in sorted(cache, key=lambda k: cache[k].get("used", 0))[:len(cache) - EXCEL_LAYOUT_CACHE_MAX]:
+            del cache[key]
+    save_excel_layout_cache()
+
+def detect_excel_header(df_preview):
+    """
+    扫描预览行寻找表头，返回 (表头行号, 列映射)；未找到时行号为 -1
+    策略：只要包含"日期"和("金额"或"发生额"或"支出")的行，就算表头
+    """
+    for idx, row in df_preview.iterrows():
+        row_str = " ".join([str(x) for x in row.values])
+        if ("日期" in row_str or "时间" in row_str) and ("金额" in row_str or "发生额" in row_str or "支出" in row_str):
+            # 构建列映射 (精准匹配 -> 包含匹配，包含匹配按映射表顺序先命中者胜出)
+            matcher, keys = keyword_matcher("excel_headers", EXCEL_HEADER_KEYWORDS, build_category_matcher)
+            column_map = {}
+            for val in row.values:
+                val_str = str(val).strip()
+                if val_str in EXCEL_HEADER_KEYWORDS:
+                    column_map[val_str] = EXCEL_HEADER_KEYWORDS[val_str]
+                    continue
+                hit = matcher.search(val_str.lower())
+                if hit is not None:
+                    column_map[val_str] = EXCEL_HEADER_KEYWORDS[keys[hit]]
+            return idx, column_map
+    return -1, {}
 
 def read_excel_smart(file_path):
     """
@@ -900,62 +3499,22 @@ def read_excel_smart(file_path):
     1. 自动寻找表头行 (包含 '日期', '金额' 等关键词)
     2. 自动重命名列为标准字段
     3. 返回标准化的 DataFrame
+    识别过的表头布局会被记住：预览行与同名工作表的任一已知布局表头一致时直接复用列映射，
+    否则重新识别；无论哪种情况都只读取预览 + 整表各一次。
     """
     try:
-        with pd.ExcelFile(file_path) as xl:
+        with pd.ExcelFile(file_path, engine=excel_read_engine()) as xl:
             # 优先读 '日常台账表'，否则读第一个 Sheet
             sheet_name = "日常台账表" if "日常台账表" in xl.sheet_names else xl.sheet_names[0]
             
             # 先读前 20 行来找表头
             df_preview = pd.read_excel(xl, sheet_name=sheet_name, header=None, nrows=20)
-            
-            header_row_idx = -1
-            column_map = {}
-            
-            # 关键词映射表 (可能的列名 -> 标准列名)
-            # 增加更多模糊匹配词
-            keyword_map = {
-                # 日期类
-                "日期": "记账日期", "时间": "记账日期", "交易日": "记账日期", "记账日": "记账日期", 
-                "入账时间": "记账日期", "交易时间": "记账日期",
-                
-                # 金额类
-                "金额": "实际收付金额", "发生额": "实际收付金额", "收支金额": "实际收付金额",
-                "交易金额": "实际收付金额", "收/支": "实际收付金额", "金额(元)": "实际收付金额",
-                
-                # 备注/摘要类
-                "摘要": "备注", "说明": "备注", "用途": "备注", "商品": "备注", "附言": "备注",
-                "交易摘要": "备注", "备注说明": "备注", "项目名称": "备注", "内容": "备注",
-                
-                # 往来单位类
-                "对方": "往来单位费用", "户名": "往来单位费用", "单位": "往来单位费用",
-                "对方户名": "往来单位费用", "对方账号名称": "往来单位费用", "交易对方": "往来单位费用",
-                "收/付款人": "往来单位费用", "商户名称": "往来单位费用",
+            layout = match_excel_layout(sheet_name, df_preview)
+            if layout:
+                header_row_idx, column_map = layout["header_row"], layout["column_map"]
+            else:
+                header_row_idx, column_map = detect_excel_header(df_preview)
                 
-                # 业务类型类 (通常不用，自动推断)
-                "借贷": "业务类型", "收付标志": "业务类型"
-            }
-            
-            # 扫描寻找表头
-            # 策略优化：只要包含"日期"和("金额"或"发生额"或"支出")的行，就算表头
-            for idx, row in df_preview.iterrows():
-                row_str = " ".join([str(x) for x in row.values])
-                if ("日期" in row_str or "时间" in row_str) and ("金额" in row_str or "发生额" in row_str or "支出" in row_str):
-                    header_row_idx = idx
-                    # 构建列映射 (精准匹配 -> 包含匹配)
-                    for col_idx, val in enumerate(row.values):
-                        val_str = str(val).strip()
-                        # 1. 精准匹配
-                        if val_str in keyword_map:
-                            column_map[val_str] = keyword_map[val_str]
-                            continue
-                        # 2. 包含匹配
-                        for k, v in keyword_map.items():
-                            if k in val_str:
-                                column_map[val_str] = v 
-                                break 
-                    break
-                    
             if header_row_idx == -1:
                 # 没找到明显表头，假设第一行就是
                 header_row_idx = 0
@@ -963,6 +3522,11 @@ def read_excel_smart(file_path):
                 
             # 重新读取数据
             df = pd.read_excel(xl, sheet_name=sheet_name, header=header_row_idx)
+            if layout and [str(c) for c in df.columns] == layout["columns"]:
+                touch_excel_layout(layout)
+            elif column_map:
+                # 未命中缓存，或预览之外的行让整表多出了列：按实际列名记住该布局
+                remember_excel_layout(sheet_name, header_row_idx, df.columns, column_map)
         
         # 重命名列
         df.rename(columns=column_map, inplace=True)
@@ -978,80 +3542,472 @@ def read_excel_smart(file_path):
 
 # 智能分类：历史记忆库
 HISTORY_CATEGORY_MAP = {}
-AI_CACHE_FILE = FILE_AI_CACHE
+AI_CACHE_FILE = FILE_AI_CACHE # 旧版 JSON 缓存，首次打开数据库时导入
+AI_CACHE_DB = FILE_AI_CACHE_DB
+AI_CACHE_MAX_ENTRIES = int(os.getenv("AI_CACHE_MAX_ENTRIES", 50000)) # 超出后按最近使用时间淘汰
+AI_CACHE_TOUCH_BATCH = 200 # 命中后的"最近使用时间"攒够多少条再写库
 AI_CACHE_MAP = {}
 AI_CACHE_LOADED = False
 
+class AICategoryCache:
+    """
+    AI 分类缓存 (SQLite 键值表)
+    - 按需逐条查询，启动时不做全量加载
+    - 写入为单行 upsert；超过上限时按最近使用时间 (LRU) 淘汰到 90%
+    - 提供与 dict 相同的 get/in/[]/update 用法
+    """
+    def __init__(self, db_path, max_entries=AI_CACHE_MAX_ENTRIES, legacy_json=None):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.legacy_json = legacy_json
+        self.conn = None
+        self.lock = threading.RLock()
+        self.size = 0
+        self.touched = {}
+        self.stats = {"hits": 0, "misses": 0, "writes": 0, "evicted": 0}
+
+    def connect(self):
+        with self.lock:
+            if self.conn is None:
+                self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+                self.conn.execute("PRAGMA journal_mode=WAL")
+                self.conn.execute("""
+                    CREATE TABLE IF NOT EXISTS cache (
+                        key TEXT PRIMARY KEY,
+                        category TEXT NOT NULL,
+                        created REAL DEFAULT 0,
+                        last_used REAL DEFAULT 0
+                    )""")
+                self.conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_last_used ON cache (last_used)")
+                self.conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+                self.conn.commit()
+                self.size = self.conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+                self.import_legacy()
+            return self.conn
+
+    def import_legacy(self):
+        """一次性导入旧版 JSON 缓存 (原文件保留不动)"""
+        if not self.legacy_json or not os.path.exists(self.legacy_json):
+            return
+        if self.conn.execute("SELECT 1 FROM meta WHERE name='legacy_json'").fetchone():
+            return
+        try:
+            with open(self.legacy_json, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.put_many(data.items(), evict=False)
+            log.info(f"📦 已将 {len(data)} 条旧版AI分类缓存导入数据库", extra={"solution": "无"})
+        except Exception as e:
+            log.warning(f"⚠️ 导入旧版AI缓存失败: {e}", extra={"solution": "忽略旧缓存"})
+        self.conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('legacy_json', ?)", (str(time.time()),))
+        self.conn.commit()
+
+    def get(self, key, default=None):
+        conn = self.connect()
+        with self.lock:
+            row = conn.execute("SELECT category FROM cache WHERE key=?", (key,)).fetchone()
+            if not row:
+                self.stats["misses"] += 1
+                return default
+            self.stats["hits"] += 1
+            self.touched[key] = time.time()
+            if len(self.touched) >= AI_CACHE_TOUCH_BATCH:
+                self.flush()
+            return row[0]
+
+    def __contains__(self, key):
+        conn = self.connect()
+        with self.lock:
+            return conn.execute("SELECT 1 FROM cache WHERE key=?", (key,)).fetchone() is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, category):
+        self.put_many([(key, category)])
+
+    def __len__(self):
+        self.connect()
+        return self.size
+
+    def update(self, mapping):
+        self.put_many(mapping.items() if isinstance(mapping, dict) else mapping)
+
+    def put_many(self, items, evict=True):
+        """单个事务内写入 [(key, category)]"""
+        conn = self.connect()
+        now = time.time()
+        with self.lock:
+            for key, category in items:
+                cur = conn.execute("UPDATE cache SET category=?, last_used=? WHERE key=?", (category, now, key))
+                if cur.rowcount == 0:
+                    conn.execute("INSERT INTO cache (key, category, created, last_used) VALUES (?, ?, ?, ?)",
+                                 (key, category, now, now))
+                    self.size += 1
+                self.stats["writes"] += 1
+            conn.commit()
+            if evict and self.max_entries and self.size > self.max_entries:
+                self.evict()
+
+    def evict(self):
+        """按最近使用时间淘汰到上限的 90%，留出余量避免每次写入都触发"""
+        with self.lock:
+            self.flush()
+            target = int(self.max_entries * 0.9)
+            excess = self.size - target
+            if excess <= 0:
+                return 0
+            self.conn.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY last_used LIMIT ?)", (excess,))
+            self.conn.commit()
+            self.size = self.conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+            self.stats["evicted"] += excess
+            return excess
+
+    def flush(self):
+        """把攒下的命中时间写回数据库"""
+        with self.lock:
+            if not self.touched or self.conn is None:
+                return
+            self.conn.executemany("UPDATE cache SET last_used=? WHERE key=?",
+                                  [(ts, key) for key, ts in self.touched.items()])
+            self.conn.commit()
+            self.touched.clear()
+
+    def compact(self):
+        """淘汰超限条目并回收文件空间"""
+        with self.lock:
+            self.connect()
+            removed = self.evict() if self.max_entries and self.size > self.max_entries else 0
+            self.flush()
+            self.conn.execute("VACUUM")
+            return removed
+
+    def summary(self):
+        self.connect()
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            "条目": self.size,
+            "上限": self.max_entries,
+            "命中": self.stats["hits"],
+            "未命中": self.stats["misses"],
+            "命中率": f"{self.stats['hits'] / lookups:.1%}" if lookups else "-",
+            "写入": self.stats["writes"],
+            "淘汰": self.stats["evicted"],
+            "文件(KB)": round(os.path.getsize(self.db_path) / 1024, 1) if os.path.exists(self.db_path) else 0,
+        }
+
 def load_ai_cache():
-    """加载本地AI分类缓存"""
+    """打开本地AI分类缓存 (按需查询，不做全量加载)"""
     global AI_CACHE_MAP, AI_CACHE_LOADED
-    if os.path.exists(AI_CACHE_FILE):
+    if not isinstance(AI_CACHE_MAP, AICategoryCache) or AI_CACHE_MAP.db_path != AI_CACHE_DB:
         try:
-            with open(AI_CACHE_FILE, "r", encoding="utf-8") as f:
-                AI_CACHE_MAP = json.load(f)
-            log.info(f"🧠 已加载 {len(AI_CACHE_MAP)} 条AI分类缓存", extra={"solution": "无"})
+            store = AICategoryCache(AI_CACHE_DB, AI_CACHE_MAX_ENTRIES, legacy_json=AI_CACHE_FILE)
+            store.connect()
+            AI_CACHE_MAP = store
+            log.info(f"🧠 AI分类缓存: {len(store)} 条", extra={"solution": "无"})
         except Exception as e:
-            log.warning(f"⚠️ 加载AI缓存失败: {e}", extra={"solution": "无"})
+            log.warning(f"⚠️ 打开AI缓存失败: {e}", extra={"solution": "本次运行使用内存缓存"})
             AI_CACHE_MAP = {}
     AI_CACHE_LOADED = True
 
 def save_ai_cache():
-    """保存AI分类缓存到本地"""
+    """提交AI分类缓存 (新条目写入时已落盘，这里只回写命中时间)"""
     try:
-        with open(AI_CACHE_FILE, "w", encoding="utf-8") as f:
-            json.dump(AI_CACHE_MAP, f, ensure_ascii=False, indent=2)
+        if isinstance(AI_CACHE_MAP, AICategoryCache):
+            AI_CACHE_MAP.flush()
     except Exception as e:
         log.warning(f"⚠️ 保存AI缓存失败: {e}")
 
-def load_history_knowledge(client, app_token):
-    """从飞书加载最近的历史分类习惯 (智能记忆)"""
-    global HISTORY_CATEGORY_MAP
-    HISTORY_CATEGORY_MAP = {}
-    
-    # 同时加载AI缓存
-    load_ai_cache()
-    
-    table_id = get_table_id_by_name(client, app_token, "日常台账表")
-    if not table_id: return
-    
-    # 获取最近2000条记录
-    log.info("🧠 正在学习历史分类习惯...", extra={"solution": "无"})
-    # 使用进度条
-    # records = get_all_records(client, app_token, table_id, field_names=["备注", "往来单位费用", "费用归类"])
-    # 优化：get_all_records 本身比较慢，但这里无法直接插入进度条，除非修改 get_all_records
-    # 暂时保持原样，或者给 get_all_records 加一个 verbose 参数
-    records = get_all_records(client, app_token, table_id, field_names=["备注", "往来单位费用", "费用归类"])
-    
-    # 倒序遍历，越新的越优先
+# 历史分类索引：持久化到本地 SQLite，按修改时间水位增量合并
+HISTORY_INDEX_DB = FILE_HISTORY_INDEX
+HISTORY_INDEX_REBUILD_HOURS = float(os.getenv("HISTORY_INDEX_REBUILD_HOURS", 24)) # 定期全量重建，清除已删除/已改分类记录留下的旧条目
+HISTORY_INDEX_FIELDS = ["备注", "往来单位费用", "费用归类"]
+HISTORY_INDEX = None # {"app_token", "table_id", "watermark", "built", "entries": {key: [分类, 修改时间]}, "samples": {记录ID: [摘要, 往来单位, 分类]}, "dirty_entries", "dirty_samples"}
+CATEGORY_MODEL_THRESHOLD = float(os.getenv("CATEGORY_MODEL_THRESHOLD", 0.85)) # 本地模型置信度达到该值才采用，否则交给 AI
+CATEGORY_MODEL_MIN_SAMPLES = 20 # 训练样本太少时不启用
+CATEGORY_MODEL = None
+
+class CategoryModel:
+    """
+    本地分类模型：字符 1/2-gram + 往来单位特征的多项式朴素贝叶斯
+    - 样本按记录ID保存，同一记录重复学习时先撤销旧样本，可随历史索引增量更新
+    - 纯 Python 计数实现，训练与推断都不依赖网络
+    """
+    def __init__(self, samples=None):
+        self.samples = samples if samples is not None else {}
+        self.class_docs = {}
+        self.class_tokens = {}
+        self.token_counts = {} # 分类 -> {特征: 次数}
+        self.vocab = {} # 特征 -> 出现该特征的样本数
+        for sample_id, (memo, partner, cat) in list(self.samples.items()):
+            self.add(memo, partner, cat)
+
+    @staticmethod
+    def features(memo, partner=None):
+        text = re.sub(r"\s+", "", str(memo or "").lower())
+        feats = list(text) + [text[i:i + 2] for i in range(len(text) - 1)]
+        partner = str(partner or "").strip()
+        if partner and partner not in ["散户", "nan"]:
+            feats.append(f"P:{partner}")
+        return feats
+
+    def add(self, memo, partner, cat, sign=1):
+        feats = self.features(memo, partner)
+        self.class_docs[cat] = self.class_docs.get(cat, 0) + sign
+        self.class_tokens[cat] = self.class_tokens.get(cat, 0) + sign * len(feats)
+        counts = self.token_counts.setdefault(cat, {})
+        for tok in feats:
+            counts[tok] = counts.get(tok, 0) + sign
+            if counts[tok] <= 0:
+                del counts[tok]
+        for tok in set(feats):
+            self.vocab[tok] = self.vocab.get(tok, 0) + sign
+            if self.vocab[tok] <= 0:
+                del self.vocab[tok]
+        if self.class_docs[cat] <= 0:
+            for table in (self.class_docs, self.class_tokens, self.token_counts):
+                table.pop(cat, None)
+
+    def learn(self, sample_id, memo, partner, cat):
+        """学习/更新一条样本，返回样本是否有变化"""
+        old = self.samples.get(sample_id)
+        if old == [memo, partner, cat]:
+            return False
+        if old:
+            self.add(*old, sign=-1)
+        self.samples[sample_id] = [memo, partner, cat]
+        self.add(memo, partner, cat)
+        return True
+
+    def forget(self, sample_id):
+        old = self.samples.pop(sample_id, None)
+        if old:
+            self.add(*old, sign=-1)
+        return old is not None
+
+    def predict(self, memo, partner=None):
+        """返回 (分类, 置信度)；样本不足或没有任何已知特征时返回 (None, 0.0)"""
+        if len(self.samples) < CATEGORY_MODEL_MIN_SAMPLES or not self.class_docs:
+            return None, 0.0
+        feats = [tok for tok in self.features(memo, partner) if tok in self.vocab]
+        if not feats:
+            return None, 0.0
+        total_docs = sum(self.class_docs.values())
+        vocab_size = len(self.vocab)
+        scores = {}
+        for cat, docs in self.class_docs.items():
+            counts = self.token_counts[cat]
+            denom = self.class_tokens[cat] + vocab_size
+            score = math.log(docs / total_docs)
+            for tok in feats:
+                score += math.log((counts.get(tok, 0) + 1) / denom)
+            scores[cat] = score
+        best = max(scores, key=scores.get)
+        norm = sum(math.exp(v - scores[best]) for v in scores.values())
+        return best, 1.0 / norm
+
+class HistoryIndexStore:
+    """
+    历史分类索引 (SQLite)
+    - entries: 特征 -> (分类, 修改时间)；samples: 记录ID -> 本地模型样本；meta: 台账与水位
+    - 增量合并后只 upsert/删除变更过的特征和样本，全量重建时才清表重写
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = None
+        self.lock = threading.RLock()
+
+    def connect(self):
+        with self.lock:
+            if self.conn is None:
+                self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+                self.conn.execute("PRAGMA journal_mode=WAL")
+                self.conn.execute("""
+                    CREATE TABLE IF NOT EXISTS entries (
+                        key TEXT PRIMARY KEY,
+                        category TEXT NOT NULL,
+                        modified INTEGER DEFAULT 0
+                    )""")
+                self.conn.execute("""
+                    CREATE TABLE IF NOT EXISTS samples (
+                        record_id TEXT PRIMARY KEY,
+                        memo TEXT,
+                        partner TEXT,
+                        category TEXT NOT NULL
+                    )""")
+                self.conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+                self.conn.commit()
+            return self.conn
+
+    def load(self):
+        """读出整个索引；尚未建立过时返回 None"""
+        conn = self.connect()
+        with self.lock:
+            meta = dict(conn.execute("SELECT name, value FROM meta").fetchall())
+            if "table_id" not in meta:
+                return None
+            return {
+                "app_token": meta.get("app_token"), "table_id": meta["table_id"],
+                "watermark": int(meta.get("watermark") or 0), "built": float(meta.get("built") or 0),
+                "entries": {key: [cat, modified] for key, cat, modified in
+                            conn.execute("SELECT key, category, modified FROM entries")},
+                "samples": {rid: [memo, partner, cat] for rid, memo, partner, cat in
+                            conn.execute("SELECT record_id, memo, partner, category FROM samples")},
+                "dirty_entries": set(), "dirty_samples": set(),
+            }
+
+    def save(self, index, full=False):
+        """单个事务内写回：full=True 清表重写，否则只写 dirty_entries/dirty_samples 中的键"""
+        conn = self.connect()
+        entries, samples = index["entries"], index.get("samples", {})
+        entry_keys = list(entries) if full else index["dirty_entries"]
+        sample_ids = list(samples) if full else index["dirty_samples"]
+        with self.lock:
+            if full:
+                conn.execute("DELETE FROM entries")
+                conn.execute("DELETE FROM samples")
+            conn.executemany("INSERT OR REPLACE INTO entries (key, category, modified) VALUES (?, ?, ?)",
+                             [(key, *entries[key]) for key in entry_keys if key in entries])
+            conn.executemany("INSERT OR REPLACE INTO samples (record_id, memo, partner, category) VALUES (?, ?, ?, ?)",
+                             [(rid, *samples[rid]) for rid in sample_ids if rid in samples])
+            conn.executemany("DELETE FROM samples WHERE record_id=?",
+                             [(rid,) for rid in sample_ids if rid not in samples])
+            conn.executemany("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)",
+                             [(name, str(index[name])) for name in ("app_token", "table_id", "watermark", "built")])
+            conn.commit()
+        index["dirty_entries"].clear()
+        index["dirty_samples"].clear()
+
+HISTORY_INDEX_STORE = None
+
+def history_index_store():
+    global HISTORY_INDEX_STORE
+    if HISTORY_INDEX_STORE is None or HISTORY_INDEX_STORE.db_path != HISTORY_INDEX_DB:
+        HISTORY_INDEX_STORE = HistoryIndexStore(HISTORY_INDEX_DB)
+    return HISTORY_INDEX_STORE
+
+def read_history_index():
+    try:
+        return history_index_store().load()
+    except Exception as e:
+        log.warning(f"⚠️ 历史分类索引读取失败: {e}", extra={"solution": "将全量重建"})
+    return None
+
+def save_history_index(index, full=False):
+    try:
+        history_index_store().save(index, full=full)
+    except Exception as e:
+        log.warning(f"⚠️ 保存历史分类索引失败: {e}")
+
+def fold_history_records(index, records):
+    """把记录合并进索引；同一特征以修改时间较新的分类为准，变更的键记入 dirty_*。返回变更的条目数"""
+    entries = index["entries"]
+    changed = 0
     total = len(records)
-    for i, r in enumerate(reversed(records)):
-        if i % 200 == 0: # 每200条刷新一次进度
+    for i, r in enumerate(records):
+        if total > 2000 and i % 500 == 0:
             show_progress_bar(i + 1, total, prefix='学习中', suffix='', length=20)
-            
-        f = r.fields
+        rid, f, modified = record_to_parts(r)
+        modified = int(modified or 0)
+        index["watermark"] = max(index["watermark"], modified)
+        
         memo = str(f.get("备注") or "").strip()
         partner = str(f.get("往来单位费用") or "").strip()
         cat = str(f.get("费用归类") or "").strip()
-        
+        if CATEGORY_MODEL is not None and rid:
+            if cat and cat not in ["nan", "其他", "未知"]:
+                learned = CATEGORY_MODEL.learn(rid, memo, partner, cat)
+            else:
+                learned = CATEGORY_MODEL.forget(rid)
+            if learned:
+                index["dirty_samples"].add(rid)
         if not cat: continue
         
-        # 1. 记住 "摘要关键词" -> "分类" (取前10个字作为特征)
+        keys = []
+        # 1. "摘要关键词" -> "分类" (取前10个字作为特征)
         if memo and len(memo) > 1:
-            key = memo[:10].lower()
-            if key not in HISTORY_CATEGORY_MAP:
-                HISTORY_CATEGORY_MAP[key] = cat
-                
-        # 2. 记住 "往来单位" -> "分类"
+            keys.append(memo[:10].lower())
+        # 2. "往来单位" -> "分类" (加上前缀区分，匹配优先级低于摘要)
         if partner and partner not in ["散户", ""]:
-            # 往来单位优先级低一点，加上前缀区分
-            p_key = f"PARTNER:{partner}"
-            if p_key not in HISTORY_CATEGORY_MAP:
-                HISTORY_CATEGORY_MAP[p_key] = cat
-                
-    show_progress_bar(total, total, prefix='学习完成', suffix='', length=20)
-    log.info(f"✅ 已学习 {len(HISTORY_CATEGORY_MAP)} 条历史分类规则", extra={"solution": "无"})
+            keys.append(f"PARTNER:{partner}")
+            
+        for key in keys:
+            old = entries.get(key)
+            if old is None or modified >= old[1]:
+                if old is None or old[0] != cat:
+                    changed += 1
+                if old != [cat, modified]:
+                    index["dirty_entries"].add(key)
+                entries[key] = [cat, modified]
+                HISTORY_CATEGORY_MAP[key] = cat
+    if total > 2000:
+        show_progress_bar(total, total, prefix='学习完成', suffix='', length=20)
+    return changed
+
+def fetch_history_changes(client, app_token, table_id, since):
+    """拉取修改时间不早于 since 的台账记录 (since=0 为全部)"""
+    if LOCAL_REPLICA_ENABLED and client is not None and LOCAL_REPLICA.sync(client, app_token, table_id):
+        return LOCAL_REPLICA.changed_since(table_id, since, HISTORY_INDEX_FIELDS)
+        
+    filter_info = None
+    if since:
+        fields = list_table_fields(client, app_token, table_id) or []
+        if any(f.field_name == REPLICA_MODIFIED_FIELD for f in fields):
+            filter_info = f'CurrentValue.[{REPLICA_MODIFIED_FIELD}]>={since}'
+    records = fetch_records_remote(client, app_token, table_id, filter_info=filter_info,
+                                   field_names=HISTORY_INDEX_FIELDS, automatic_fields=True)
+    if since and not filter_info:
+        records = [r for r in records if int(record_to_parts(r)[2] or 0) >= since]
+    return records
 
-def auto_categorize(description, default_val, partner_name=None):
+def load_history_knowledge(client, app_token, force_rebuild=False):
+    """从飞书加载历史分类习惯 (智能记忆)；索引保存在本地，每次只合并上次之后修改过的记录"""
+    global HISTORY_CATEGORY_MAP, HISTORY_INDEX, CATEGORY_MODEL
+    
+    # 同时加载AI缓存
+    load_ai_cache()
+    
+    table_id = get_table_id_by_name(client, app_token, "日常台账表")
+    if not table_id: return
+    
+    index = HISTORY_INDEX if HISTORY_INDEX is not None else read_history_index()
+    now = time.time()
+    full = (force_rebuild or not index or index.get("app_token") != app_token or index.get("table_id") != table_id
+            or now - index.get("built", 0) > HISTORY_INDEX_REBUILD_HOURS * 3600)
+    if full:
+        log.info("🧠 正在学习历史分类习惯 (全量)...", extra={"solution": "无"})
+        index = {"app_token": app_token, "table_id": table_id, "watermark": 0, "built": now, "entries": {},
+                 "samples": {}, "dirty_entries": set(), "dirty_samples": set()}
+    if full or HISTORY_INDEX is not index:
+        HISTORY_CATEGORY_MAP = {key: value[0] for key, value in index["entries"].items()}
+        CATEGORY_MODEL = CategoryModel(index["samples"])
+    HISTORY_INDEX = index
+    
+    since = max(0, index["watermark"] - REPLICA_WATERMARK_SKEW_MS) if index["watermark"] else 0
+    records = fetch_history_changes(client, app_token, table_id, since)
+    fold_history_records(index, records)
+    if full or records:
+        save_history_index(index, full=full)
+    log.info(f"✅ 已学习 {len(HISTORY_CATEGORY_MAP)} 条历史分类规则, 本地模型样本 {len(CATEGORY_MODEL.samples)} 条 (本次合并 {len(records)} 条记录)", extra={"solution": "无"})
+
+class PendingCategory(str):
+    """延迟到批量阶段再由 AI 推断的分类；在此之前按默认值参与比较和写入"""
+    def __new__(cls, default_val, description, partner_name, cache_key):
+        obj = super().__new__(cls, default_val)
+        obj.description = description
+        obj.partner_name = partner_name
+        obj.cache_key = cache_key
+        return obj
+
+def auto_categorize(description, default_val, partner_name=None, defer_ai=False):
+    """
+    规则库 -> 历史记忆 -> AI缓存 -> AI推断。
+    defer_ai=True 时不逐条调用 AI，而是返回 PendingCategory，
+    由调用方在循环结束后用 resolve_pending_categories 批量补全。
+    """
     if not description and not partner_name:
         return default_val
     
@@ -1065,9 +4021,10 @@ def auto_categorize(description, default_val, partner_name=None):
     desc_str = str(description).lower()
     
     # 1. 优先匹配明确的【规则库】 (category_rules.json)
-    for key, value in AUTO_CATEGORY_RULES.items():
-        if key.lower() in desc_str:
-            return value
+    matcher, keys = keyword_matcher("category_rules", AUTO_CATEGORY_RULES, build_category_matcher)
+    idx = matcher.search(desc_str)
+    if idx is not None:
+        return AUTO_CATEGORY_RULES[keys[idx]]
             
     # 2. 其次匹配【历史记忆】 (History Knowledge)
     # 2.1 匹配摘要前缀
@@ -1085,13 +4042,21 @@ def auto_categorize(description, default_val, partner_name=None):
     # 2.3 [V9.5新特性] 匹配本地AI缓存 (Smart Cache)
     # 避免重复调用AI接口，节省Token并提升速度
     cache_key = f"{desc_str}|{str(partner_name).lower()}"
-    if cache_key in AI_CACHE_MAP:
-        # print(f"   🧠 命中本地AI缓存: {cache_key[:20]}... -> {AI_CACHE_MAP[cache_key]}")
-        return AI_CACHE_MAP[cache_key]
+    cached = AI_CACHE_MAP.get(cache_key)
+    if cached:
+        return cached
+    
+    # 2.4 本地分类模型 (由历史台账训练，置信度足够才采用，减少 AI 调用)
+    if CATEGORY_MODEL is not None:
+        model_cat, confidence = CATEGORY_MODEL.predict(description, partner_name)
+        if model_cat and confidence >= CATEGORY_MODEL_THRESHOLD:
+            return model_cat
             
     # 3. [V9.4新特性] 尝试 AI 智能推断
     # 只有当描述足够长(>2)或有明确往来单位时才调用，避免浪费 Token
     if (len(desc_str) > 2 or partner_name) and ZHIPUAI_API_KEY:
+        if defer_ai:
+            return PendingCategory(default_val, description, partner_name, cache_key)
         ai_cat = ai_guess_category(description, partner_name)
         if ai_cat:
             print(f"   🧠 AI 智能推断: '{description}' -> [{ai_cat}]")
@@ -1102,6 +4067,50 @@ def auto_categorize(description, default_val, partner_name=None):
             
     return default_val
 
+def resolve_pending_categories(rows, field="费用归类"):
+    """
+    批量补全 rows 中的 PendingCategory (rows 为字段字典或 AppTableRecord)。
+    相同的 (摘要, 往来单位) 只问一次，按 AI_BATCH_SIZE 拼成多笔提示词并发请求，
+    结束后只写一次缓存文件。返回成功推断的行数。
+    """
+    pending = []
+    for row in rows:
+        fields = row if isinstance(row, dict) else row.fields
+        if fields and isinstance(fields.get(field), PendingCategory):
+            pending.append(fields)
+    if not pending:
+        return 0
+    
+    todo = {}
+    for fields in pending:
+        value = fields[field]
+        if value.cache_key not in todo and value.cache_key not in AI_CACHE_MAP:
+            todo.setdefault(value.cache_key, (value.description, value.partner_name))
+    
+    learned = {}
+    if todo:
+        keys = list(todo)
+        chunks = [keys[i:i + AI_BATCH_SIZE] for i in range(0, len(keys), AI_BATCH_SIZE)]
+        print(f"   🧠 AI 批量推断 {len(keys)} 种交易 ({len(pending)} 行, {len(chunks)} 次请求)...")
+        with ThreadPoolExecutor(max_workers=max(1, min(AI_BATCH_WORKERS, len(chunks)))) as executor:
+            results = executor.map(lambda chunk: ai_guess_categories([todo[k] for k in chunk]), chunks)
+            for chunk, categories in zip(chunks, results):
+                for key, category in zip(chunk, categories):
+                    if category:
+                        learned[key] = category
+        if learned:
+            AI_CACHE_MAP.update(learned)
+            save_ai_cache()
+    
+    resolved = 0
+    for fields in pending:
+        value = fields[field]
+        category = learned.get(value.cache_key) or AI_CACHE_MAP.get(value.cache_key)
+        fields[field] = category or str(value)
+        if category:
+            resolved += 1
+    return resolved
+
 def parse_smart_text(text):
     """
     智能解析自然语言账目 (V1.0)
@@ -1260,7 +4269,7 @@ def import_bank_records_to_feishu(client, app_token, records_list):
         # 尝试自动分类补全 (费用归类)
         category = str(r.get("费用归类", ""))
         if not category or category == "nan" or category == "未知" or category == "":
-            category = auto_categorize(r.get("备注", ""), "其他", partner_name=r.get("往来单位费用", ""))
+            category = auto_categorize(r.get("备注", ""), "其他", partner_name=r.get("往来单位费用", ""), defer_ai=True)
 
         fields = {
             "记账日期": ts,
@@ -1278,24 +4287,14 @@ def import_bank_records_to_feishu(client, app_token, records_list):
         }
         feishu_records.append(AppTableRecord.builder().fields(fields).build())
     
-    # 分批提交 (每次100条)
-    batch_size = 100
-    success_count = 0
-    for i in range(0, len(feishu_records), batch_size):
-        batch = feishu_records[i:i+batch_size]
-        req = BatchCreateAppTableRecordRequest.builder() \
-            .app_token(app_token) \
-            .table_id(table_id) \
-            .request_body(BatchCreateAppTableRecordRequestBody.builder().records(batch).build()) \
-            .build()
+    resolve_pending_categories(feishu_records)
+    
+    # 批量写入管道 (自动分批/并发/失败重试)
+    result = batch_write_records(client, app_token, table_id, feishu_records)
+    success_count = result.success_count
+    if result.failed:
+        log.error(f"❌ {len(result.failed)} 条导入失败: {result.error_summary()}")
         
-        resp = client.bitable.v1.app_table_record.batch_create(req)
-        if resp.success():
-            success_count += len(batch)
-            log.info(f"✅ 第 {i//batch_size + 1} 批导入成功 ({len(batch)}条)")
-        else:
-            log.error(f"❌ 第 {i//batch_size + 1} 批导入失败: {resp.msg}")
-            
     if success_count > 0:
         send_bot_message(f"✅ 已自动导入 {success_count} 条银行流水到台账！", "reconcile")
         print(f"✅ 成功导入 {success_count} 条记录。")
@@ -1305,217 +4304,1059 @@ def import_bank_records_to_feishu(client, app_token, records_list):
         except:
             pass
 
-def generate_reconciliation_report(matched_count, unmatched_list, ledger_unmatched_list=None):
-    """生成对账结果可视化报告 (包含双向差异)"""
-    if ledger_unmatched_list is None: ledger_unmatched_list = []
-    
-    total_bank = matched_count + len(unmatched_list)
-    total_ledger_issues = len(ledger_unmatched_list)
-    
-    if total_bank == 0 and total_ledger_issues == 0: return
-    
-    html = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="UTF-8">
-        <title>银行对账报告 - {datetime.now().strftime('%Y-%m-%d')}</title>
-        <script src="https://cdn.jsdelivr.net/npm/echarts@5.4.3/dist/echarts.min.js"></script>
-        <style>
-            body {{ font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; background-color: #f4f6f9; margin: 0; padding: 20px; }}
-            .container {{ max-width: 1200px; margin: 0 auto; background: white; padding: 30px; border-radius: 10px; box-shadow: 0 4px 6px rgba(0,0,0,0.1); }}
-            h1 {{ color: #2c3e50; text-align: center; border-bottom: 2px solid #3498db; padding-bottom: 10px; }}
-            .summary {{ display: flex; justify-content: space-around; margin: 30px 0; }}
-            .card {{ text-align: center; padding: 20px; background: #f8f9fa; border-radius: 8px; width: 22%; }}
-            .number {{ font-size: 24px; font-weight: bold; color: #2c3e50; }}
-            .chart-row {{ display: flex; justify-content: space-between; height: 400px; margin: 20px 0; }}
-            .chart-box {{ width: 48%; height: 100%; }}
-            table {{ width: 100%; border-collapse: collapse; margin-top: 20px; font-size: 14px; }}
-            th, td {{ border: 1px solid #ddd; padding: 12px; text-align: left; }}
-            th {{ background-color: #3498db; color: white; }}
-            tr:nth-child(even) {{ background-color: #f2f2f2; }}
-            .badge {{ padding: 5px 10px; border-radius: 4px; font-size: 12px; }}
-            .badge-danger {{ background-color: #e74c3c; color: white; }}
-            .badge-warning {{ background-color: #f39c12; color: white; }}
-            .section-title {{ margin-top: 40px; color: #2c3e50; border-left: 5px solid #3498db; padding-left: 10px; }}
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <h1>🏦 银行对账报告</h1>
-            <p style="text-align: center; color: #7f8c8d;">生成时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</p>
-            
-            <div class="summary">
-                <div class="card">
-                    <div class="number" style="color: #3498db;">{total_bank}</div>
-                    <div>银行流水总数</div>
-                </div>
-                <div class="card">
-                    <div class="number" style="color: #27ae60;">{matched_count}</div>
-                    <div>✅ 自动匹配成功</div>
-                </div>
-                <div class="card">
-                    <div class="number" style="color: #e74c3c;">{len(unmatched_list)}</div>
-                    <div>❌ 银行有而台账无</div>
-                </div>
-                <div class="card">
-                    <div class="number" style="color: #f39c12;">{len(ledger_unmatched_list)}</div>
-                    <div>❓ 台账有而银行无</div>
-                </div>
-            </div>
+# -------------------------- 对账匹配引擎 --------------------------
+# 台账按 金额(分) -> 日期有序数组 建索引，每笔流水只二分查找容差窗口内的候选。
+# 候选关系按连通分量求一一对应的最优指派：先保证匹配笔数最多，再让金额/日期偏差之和最小，
+# 避免先到先得把本该配给后一笔流水的台账记录抢走
+RECONCILE_EXACT_LIMIT = 200 # 连通分量(流水+台账)超过该规模时改用按偏差从小到大的贪心指派
 
-            <div class="chart-row">
-                <div id="pie-chart" class="chart-box"></div>
-                <div id="bar-chart" class="chart-box"></div>
-            </div>
+def reconcile_amount_cents(amount_tol=None):
+    """金额差小于 RECONCILE_THRESHOLD 视为一致 (默认 0.01 即精确到分)，返回允许的最大差额(分)"""
+    tol = RECONCILE_THRESHOLD if amount_tol is None else amount_tol
+    return max(int(math.ceil(tol * 100 - 1e-9)) - 1, 0)
 
-            <h3 class="section-title">❌ 异常类型一：银行流水有，但台账未记录 ({len(unmatched_list)}条)</h3>
-            <p style="color: #7f8c8d; font-size: 14px;">👉 建议：检查是否漏记，可使用"待补录流水.xlsx"直接导入</p>
-            <table>
-                <thead>
-                    <tr>
-                        <th>日期</th>
-                        <th>摘要</th>
-                        <th>金额</th>
-                        <th>对象</th>
-                        <th>建议分类</th>
-                        <th>原因</th>
-                    </tr>
-                </thead>
-                <tbody>
+class LedgerMatchIndex:
     """
-    
-    for item in unmatched_list:
-        html += f"""
-                    <tr>
-                        <td>{item.get('记账日期')}</td>
-                        <td>{item.get('备注')}</td>
-                        <td>{item.get('实际收付金额')}</td>
-                        <td>{item.get('往来单位费用')}</td>
-                        <td>{item.get('费用归类')}</td>
-                        <td><span class="badge badge-danger">{item.get('原因')}</span></td>
-                    </tr>
-        """
-        
-    html += f"""
-                </tbody>
-            </table>
+    台账候选索引
+    entries: [(金额, 日期序数)]，日期序数为 date.toordinal()；candidates 返回的是 entries 中的序号
+    """
+    def __init__(self, entries):
+        buckets = {}
+        for i, (amount, day) in enumerate(entries):
+            buckets.setdefault(int(round(amount * 100)), []).append((day, i))
+        self.keys = sorted(buckets)
+        self.days = {}
+        self.ids = {}
+        for key, items in buckets.items():
+            items.sort()
+            self.days[key] = [d for d, _ in items]
+            self.ids[key] = [i for _, i in items]
+        self.size = len(entries)
+
+    def candidates(self, amount, day, tol_cents, days_tol):
+        """容差窗口内的台账 [(序号, 金额差(分), 日期差(天))]"""
+        cents = int(round(amount * 100))
+        out = []
+        lo = bisect.bisect_left(self.keys, cents - tol_cents)
+        hi = bisect.bisect_right(self.keys, cents + tol_cents)
+        for key in self.keys[lo:hi]:
+            days, ids = self.days[key], self.ids[key]
+            start = bisect.bisect_left(days, day - days_tol)
+            end = bisect.bisect_right(days, day + days_tol)
+            for j in range(start, end):
+                out.append((ids[j], abs(key - cents), abs(days[j] - day)))
+        return out
+
+class ReconcileMatchResult:
+    """
+    对账匹配结果
+    bank_to_ledger[流水序号] = 台账序号 或 None
+    """
+    def __init__(self, bank_count, ledger_count):
+        self.bank_to_ledger = [None] * bank_count
+        self.ledger_matched = [False] * ledger_count
+        self.edges = 0
+        self.components = 0
+        self.greedy_components = 0
+        self.index_elapsed = 0.0
+        self.elapsed = 0.0
+
+    @property
+    def matched_count(self):
+        return sum(1 for l in self.bank_to_ledger if l is not None)
+
+    def pairs(self):
+        return [(b, l) for b, l in enumerate(self.bank_to_ledger) if l is not None]
+
+    def summary(self):
+        return (f"流水 {len(self.bank_to_ledger)} 笔 x 台账 {len(self.ledger_matched)} 笔, "
+                f"匹配 {self.matched_count} 笔, 候选 {self.edges} 对 / {self.components} 组"
+                f"{f' (贪心 {self.greedy_components} 组)' if self.greedy_components else ''}, "
+                f"建索引 {self.index_elapsed * 1000:.0f}ms, 总耗时 {self.elapsed * 1000:.0f}ms")
+
+def min_cost_assignment(cost):
+    """
+    匈牙利算法 (行数 <= 列数)，返回每行分配到的列
+    cost 为稠密矩阵，O(行^2 x 列)；只用于候选连通分量这种小矩阵
+    """
+    n, m = len(cost), len(cost[0])
+    inf = float("inf")
+    u, v = [0.0] * (n + 1), [0.0] * (m + 1)
+    p, way = [0] * (m + 1), [0] * (m + 1)
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = [inf] * (m + 1)
+        used = [False] * (m + 1)
+        while True:
+            used[j0] = True
+            i0, delta, j1 = p[j0], inf, 0
+            row = cost[i0 - 1]
+            for j in range(1, m + 1):
+                if not used[j]:
+                    cur = row[j - 1] - u[i0] - v[j]
+                    if cur < minv[j]:
+                        minv[j], way[j] = cur, j0
+                    if minv[j] < delta:
+                        delta, j1 = minv[j], j
+            for j in range(m + 1):
+                if used[j]:
+                    u[p[j]] += delta
+                    v[j] -= delta
+                else:
+                    minv[j] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+    result = [None] * n
+    for j in range(1, m + 1):
+        if p[j]:
+            result[p[j] - 1] = j - 1
+    return result
+
+def assign_component(banks, ledgers, edges):
+    """
+    一个连通分量内的最优指派，edges: {(流水序号, 台账序号): 偏差代价(0~1)}
+    不存在的边代价取 min(行,列)+1，大于任何一组合法边的代价之和，因此优先最大化匹配笔数
+    """
+    if len(banks) == 1 or len(ledgers) == 1:
+        b, l = min(edges, key=lambda e: (edges[e], e))
+        return [(b, l)]
+    transpose = len(banks) > len(ledgers)
+    rows, cols = (ledgers, banks) if transpose else (banks, ledgers)
+    missing = float(len(rows) + 1)
+    if transpose:
+        cost = [[edges.get((b, l), missing) for b in cols] for l in rows]
+    else:
+        cost = [[edges.get((b, l), missing) for l in cols] for b in rows]
+    pairs = []
+    for r, c in enumerate(min_cost_assignment(cost)):
+        if c is None:
+            continue
+        b, l = (cols[c], rows[r]) if transpose else (rows[r], cols[c])
+        if (b, l) in edges:
+            pairs.append((b, l))
+    return pairs
 
-            <h3 class="section-title">❓ 异常类型二：台账已记，但银行流水无 ({len(ledger_unmatched_list)}条)</h3>
-            <p style="color: #7f8c8d; font-size: 14px;">👉 建议：检查是否多记、重复记账、日期偏差过大(>2天)或银行选错</p>
-            <table>
-                <thead>
-                    <tr>
-                        <th>日期</th>
-                        <th>摘要</th>
-                        <th>金额</th>
-                        <th>往来对象</th>
-                        <th>登记银行</th>
-                        <th>原因</th>
-                    </tr>
-                </thead>
-                <tbody>
+def match_bank_to_ledger(bank_lines, ledger_entries, amount_tol=None, days_tol=None, index=None):
+    """
+    银行流水与台账一一匹配
+    bank_lines / ledger_entries: [(金额, 日期序数)]
+    amount_tol 默认 RECONCILE_THRESHOLD，days_tol 默认 TOLERANCE_DAYS
+    """
+    started = time.perf_counter()
+    days_tol = TOLERANCE_DAYS if days_tol is None else days_tol
+    tol_cents = reconcile_amount_cents(amount_tol)
+    result = ReconcileMatchResult(len(bank_lines), len(ledger_entries))
+    if index is None:
+        index = LedgerMatchIndex(ledger_entries)
+    result.index_elapsed = time.perf_counter() - started
+
+    # 1. 候选边: 代价 = 金额偏差与日期偏差各自归一化后的平均值，取值 [0, 1)
+    bank_adj = {}
+    ledger_adj = {}
+    edges = {}
+    for b, (amount, day) in enumerate(bank_lines):
+        for l, cents_diff, day_diff in index.candidates(amount, day, tol_cents, days_tol):
+            edges[(b, l)] = (cents_diff / (tol_cents + 1) + day_diff / (days_tol + 1)) / 2
+            bank_adj.setdefault(b, []).append(l)
+            ledger_adj.setdefault(l, []).append(b)
+    result.edges = len(edges)
+
+    # 2. 按连通分量求解 (流水序号升序遍历，结果与输入顺序无关的部分保持确定)
+    seen_banks = set()
+    for start in sorted(bank_adj):
+        if start in seen_banks:
+            continue
+        banks, ledgers = [], []
+        seen_banks.add(start)
+        seen_ledgers = set()
+        pending = [start]
+        while pending:
+            b = pending.pop()
+            banks.append(b)
+            for l in bank_adj[b]:
+                if l in seen_ledgers:
+                    continue
+                seen_ledgers.add(l)
+                ledgers.append(l)
+                for nb in ledger_adj[l]:
+                    if nb not in seen_banks:
+                        seen_banks.add(nb)
+                        pending.append(nb)
+        banks.sort()
+        ledgers.sort()
+        comp_edges = {(b, l): edges[(b, l)] for b in banks for l in bank_adj[b]}
+        result.components += 1
+        if len(banks) + len(ledgers) > RECONCILE_EXACT_LIMIT:
+            result.greedy_components += 1
+            pairs = []
+            used_b, used_l = set(), set()
+            for (b, l), c in sorted(comp_edges.items(), key=lambda kv: (kv[1], kv[0])):
+                if b not in used_b and l not in used_l:
+                    used_b.add(b)
+                    used_l.add(l)
+                    pairs.append((b, l))
+        else:
+            pairs = assign_component(banks, ledgers, comp_edges)
+        for b, l in pairs:
+            result.bank_to_ledger[b] = l
+            result.ledger_matched[l] = True
+
+    result.elapsed = time.perf_counter() - started
+    return result
+
+def benchmark_reconcile_matching(n=50000, seed=0):
+    """生成 n 笔台账与 n 笔流水 (约9成可配对，含同金额的周期性收支)，输出匹配耗时"""
+    rng = random.Random(seed)
+    base = datetime(2026, 1, 1).toordinal()
+    recurring = [round(rng.uniform(500, 20000), 2) for _ in range(50)]
+    ledger = []
+    for _ in range(n):
+        amount = rng.choice(recurring) if rng.random() < 0.2 else round(rng.uniform(1, 50000), 2)
+        ledger.append((amount, base + rng.randrange(365)))
+    bank = []
+    for amount, day in ledger:
+        if rng.random() < 0.9:
+            bank.append((amount, day + rng.randint(-TOLERANCE_DAYS, TOLERANCE_DAYS)))
+        else:
+            bank.append((round(rng.uniform(1, 50000), 2), base + rng.randrange(365)))
+    rng.shuffle(bank)
+    result = match_bank_to_ledger(bank, ledger)
+    log.info(f"⏱️ 对账匹配基准: {result.summary()}", extra={"solution": "无"})
+    return result
+
+# -------------------------- 组合核销 (多对一 / 一对多) --------------------------
+# 客户一次转账结清多笔加工费、或一笔账分几次付清时，一一匹配找不到对应记录。
+# 这里在同一往来单位、日期窗口内的未核销账单中找金额之和相符的组合：
+# 候选按金额升序分成两半，各自枚举 (超过目标即剪枝) 后二分查找互补的一半 (折半枚举)
+SETTLEMENT_MAX_ITEMS = int(os.getenv("SETTLEMENT_MAX_ITEMS", 6)) # 一个组合最多几笔
+SETTLEMENT_MAX_CANDIDATES = int(os.getenv("SETTLEMENT_MAX_CANDIDATES", 30)) # 参与搜索的候选笔数 (按日期就近保留)
+SETTLEMENT_SEARCH_BUDGET = int(os.getenv("SETTLEMENT_SEARCH_BUDGET", 100000)) # 每次搜索最多枚举的子集数
+PAYMENT_MATCHER_SEARCH_BUDGET = int(os.getenv("PAYMENT_MATCHER_SEARCH_BUDGET", 200000)) # 交互式凑单：50笔候选中1~5笔组合全部枚举约14万个子集
+SETTLEMENT_WINDOW_DAYS = int(os.getenv("SETTLEMENT_WINDOW_DAYS", 31)) # 账单与款项相隔的最大天数
+
+def enumerate_subset_sums(cents, positions, limit, max_items, budget):
+    """
+    cents 升序；枚举 positions 中元素数 <= max_items 且和 <= limit 的子集
+    返回 ([(和, 序号元组)], 是否因预算截断)，budget 为单元素列表 (两半共用)
+    """
+    out = [(0, ())]
+    stack = [(0, 0, ())] # (下一个可选位置, 当前和, 已选序号)
+    while stack:
+        start, total, chosen = stack.pop()
+        if len(chosen) >= max_items:
+            continue
+        for k in range(start, len(positions)):
+            s = total + cents[positions[k]]
+            if s > limit:
+                break # 升序，后面只会更大
+            if budget[0] <= 0:
+                return out, True
+            budget[0] -= 1
+            combo = chosen + (positions[k],)
+            out.append((s, combo))
+            stack.append((k + 1, s, combo))
+    return out, False
+
+def find_settlement_combo(amounts, target, tol_cents=0, day_gaps=None, max_items=None, budget=None, min_items=1):
+    """
+    在候选金额中找和等于 target 的组合 (金额差 <= tol_cents 分)
+    day_gaps: 各候选与目标的日期差(天)，用于同等条件下的取舍
+    min_items: 组合最少笔数 (对账时为 2，单笔相符应由逐笔匹配在日期容差内处理)
+    平局规则: 笔数少 > 差额小 > 日期差之和小 > 序号字典序小，保证结果确定
+    返回 (候选序号元组 或 None, 是否因预算截断)
     """
+    max_items = SETTLEMENT_MAX_ITEMS if max_items is None else max_items
+    budget = [SETTLEMENT_SEARCH_BUDGET if budget is None else budget]
+    day_gaps = day_gaps or [0] * len(amounts)
+    goal = int(round(abs(target) * 100))
+    cents = [int(round(abs(a) * 100)) for a in amounts]
+    usable = sorted((i for i, c in enumerate(cents) if c > 0), key=lambda i: (cents[i], i))
+    if not usable or sum(cents[i] for i in usable) < goal - tol_cents:
+        return None, False
+
+    limit = goal + tol_cents
+    left, truncated_l = enumerate_subset_sums(cents, usable[0::2], limit, max_items, budget)
+    right, truncated_r = enumerate_subset_sums(cents, usable[1::2], limit, max_items, budget)
+    right.sort()
+    right_sums = [s for s, _ in right]
+
+    best, best_key = None, None
+    for s, combo in left:
+        lo = bisect.bisect_left(right_sums, goal - tol_cents - s)
+        hi = bisect.bisect_right(right_sums, limit - s)
+        for j in range(lo, hi):
+            other = right[j][1]
+            size = len(combo) + len(other)
+            if size < max(min_items, 1) or size > max_items or (best_key and size > best_key[0]):
+                continue
+            picked = tuple(sorted(combo + other))
+            key = (size, abs(s + right_sums[j] - goal), sum(day_gaps[i] for i in picked), picked)
+            if best_key is None or key < best_key:
+                best, best_key = picked, key
+    return best, truncated_l or truncated_r
 
-    for item in ledger_unmatched_list:
-        html += f"""
-                    <tr>
-                        <td>{item.get('记账日期')}</td>
-                        <td>{item.get('摘要')}</td>
-                        <td>{item.get('金额')}</td>
-                        <td>{item.get('往来')}</td>
-                        <td>{item.get('交易银行')}</td>
-                        <td><span class="badge badge-warning">{item.get('原因')}</span></td>
-                    </tr>
-        """
+def settle_by_combination(targets, pool, tol_cents=0, days_before=None, days_after=None, pool_used=None, min_items=1):
+    """
+    为每个目标在资金池中找一组金额之和相符的记录 (同往来单位、同收付方向、日期窗口内)
+    targets / pool: [(带符号金额, 日期序数, 往来单位)]
+    候选日期需落在 [目标日期 - days_before, 目标日期 + days_after]
+    pool_used: 已核销的池内序号 (会被更新)
+    min_items: 组合最少笔数
+    返回 ({目标序号: [池内序号]}, 截断次数)
+    """
+    days_before = SETTLEMENT_WINDOW_DAYS if days_before is None else days_before
+    days_after = TOLERANCE_DAYS if days_after is None else days_after
+    used = pool_used if pool_used is not None else set()
+    by_partner = {}
+    for i, (amount, day, partner) in enumerate(pool):
+        if partner and amount:
+            by_partner.setdefault((partner, amount > 0), []).append((day, i))
+    for items in by_partner.values():
+        items.sort()
+
+    settled = {}
+    truncated = 0
+    for t in sorted(range(len(targets)), key=lambda t: (targets[t][1], t)):
+        amount, day, partner = targets[t]
+        items = by_partner.get((partner, amount > 0)) if partner and amount else None
+        if not items:
+            continue
+        days = [d for d, _ in items]
+        start = bisect.bisect_left(days, day - days_before)
+        end = bisect.bisect_right(days, day + days_after)
+        window = [i for _, i in items[start:end] if i not in used]
+        if not window:
+            continue
+        window.sort(key=lambda i: (abs(pool[i][1] - day), i))
+        window = window[:SETTLEMENT_MAX_CANDIDATES]
+        combo, cut = find_settlement_combo([pool[i][0] for i in window], amount, tol_cents,
+                                           [abs(pool[i][1] - day) for i in window], min_items=min_items)
+        truncated += cut
+        if combo:
+            picked = sorted(window[k] for k in combo)
+            used.update(picked)
+            settled[t] = picked
+    return settled, truncated
+
+# -------------------------- HTML 报表模板 --------------------------
+# 报表页面写成模板常量，首次使用时编译为 Python 函数，按名称缓存在 REPORT_TEMPLATES (每进程只编译一次)：
+#   {{ 名称 }} / {{ 名称:,.2f }}                页面变量，默认 HTML 转义；{{ 名称|raw }} 原样输出
+#   {% if 名称 %} .. {% else %} .. {% endif %}   按变量真假输出
+#   {% for r in 名称 %} .. {{ r.字段 }} .. {% endfor %}   明细行：逐行渲染直接写入文件，整页不在内存中拼接
+# 各报表的样式与图表脚本写到报表目录下的 report_assets/ (内容不变不重写)，页面按相对路径引用
+REPORT_ASSET_DIR = "report_assets"
+REPORT_TEMPLATES = {} # 模板名 -> 编译后的 render(ctx, write, writelines)
+REPORT_ASSETS_WRITTEN = set() # 本进程已确认写好的 (资源路径, 内容哈希)
+TEMPLATE_TOKEN_RE = re.compile(r"\{\{(.*?)\}\}|\{%(.*?)%\}", re.S)
+
+def template_text(v):
+    return "" if v is None else str(v)
+
+def template_format(v, spec):
+    return "" if v is None else format(v, spec)
+
+def template_json(obj):
+    """嵌入 <script> 的 JSON 数据 (转义 '</'，避免提前闭合脚本标签)"""
+    return json.dumps(obj, ensure_ascii=False).replace("</", "<\\/")
+
+def compile_template_expr(expr, loop_var=None):
+    """'{{ }}' 中的表达式 -> Python 表达式源码 (明细行内 loop_var.字段 取当前行)"""
+    expr = expr.strip()
+    raw = expr.endswith("|raw")
+    if raw:
+        expr = expr[:-4].rstrip()
+    name, has_spec, spec = expr.partition(":")
+    scope, _, key = name.strip().partition(".")
+    if loop_var and scope == loop_var:
+        value = f"row.get({key!r})" if key else "row"
+    elif not key and scope:
+        value = f"ctx.get({scope!r})"
+    else:
+        raise ValueError(f"模板变量无法解析: {{{{ {expr} }}}}")
+    value = f"fmt({value}, {spec!r})" if has_spec else f"text({value})"
+    return value if raw else f"escape({value})"
+
+def compile_template(source, name="<template>"):
+    """模板源码 -> render(ctx, write, writelines)；语法见本节说明，明细行内不支持嵌套标签"""
+    lines = ["def render(ctx, write, writelines):"]
+    blocks = [] # 未闭合的 if/else
+    loop = None # (变量名, 集合名, [行内各段表达式])
+    pos = 0
+    tokens = []
+    for m in TEMPLATE_TOKEN_RE.finditer(source):
+        tokens.append(("text", source[pos:m.start()]))
+        tokens.append(("expr", m.group(1)) if m.group(1) is not None else ("tag", m.group(2)))
+        pos = m.end()
+    tokens.append(("text", source[pos:]))
+    for kind, value in tokens:
+        indent = "    " * (len(blocks) + 1)
+        words = value.split() if kind == "tag" else None
+        if loop is not None:
+            if words == ["endfor"]:
+                parts = ", ".join(loop[2]) or "''"
+                lines.append(f"{indent}writelines(map(lambda row: ''.join(({parts},)), ctx.get({loop[1]!r}) or ()))")
+                loop = None
+            elif kind == "tag":
+                raise ValueError(f"模板 {name}: 明细行内不支持标签 {{% {value.strip()} %}}")
+            elif kind == "text":
+                if value:
+                    loop[2].append(repr(value))
+            else:
+                loop[2].append(compile_template_expr(value, loop[0]))
+        elif kind == "text":
+            if value:
+                lines.append(f"{indent}write({value!r})")
+        elif kind == "expr":
+            lines.append(f"{indent}write({compile_template_expr(value)})")
+        elif len(words) == 2 and words[0] == "if":
+            lines.append(f"{indent}if ctx.get({words[1]!r}):")
+            lines.append(f"{indent}    pass")
+            blocks.append("if")
+        elif words == ["else"] and blocks and blocks[-1] == "if":
+            lines.append(f"{indent[4:]}else:")
+            lines.append(f"{indent}pass")
+            blocks[-1] = "else"
+        elif words == ["endif"] and blocks:
+            blocks.pop()
+        elif len(words) == 4 and words[0] == "for" and words[2] == "in":
+            loop = (words[1], words[3], [])
+        else:
+            raise ValueError(f"模板 {name}: 无法解析标签 {{% {value.strip()} %}}")
+    if blocks or loop is not None:
+        raise ValueError(f"模板 {name}: 存在未闭合的 if/for")
+    namespace = {"escape": html_escape, "text": template_text, "fmt": template_format}
+    exec(compile("\n".join(lines), f"<模板 {name}>", "exec"), namespace)
+    return namespace["render"]
+
+def report_template(name, source):
+    """按名称取编译好的模板 (每个进程只编译一次)"""
+    render = REPORT_TEMPLATES.get(name)
+    if render is None:
+        render = REPORT_TEMPLATES[name] = compile_template(source, name)
+    return render
+
+def write_report(path, render, ctx):
+    """渲染模板并直接写入文件，返回 path"""
+    with open(path, "w", encoding="utf-8") as f:
+        render(ctx, f.write, f.writelines)
+    return path
+
+def ensure_report_assets(report_dir, assets):
+    """
+    把报表样式/脚本写到 report_dir/report_assets/，已存在且内容相同的不再写
+    assets: {文件名: 内容}；返回各资源文件路径 (打包时一并带上)
+    """
+    asset_dir = os.path.join(report_dir, REPORT_ASSET_DIR)
+    paths = []
+    for fname, content in assets.items():
+        path = os.path.join(asset_dir, fname)
+        paths.append(path)
+        key = (os.path.abspath(path), hash(content))
+        if key in REPORT_ASSETS_WRITTEN and os.path.exists(path):
+            continue
+        data = content.encode("utf-8")
+        try:
+            with open(path, "rb") as f:
+                current = f.read()
+        except OSError:
+            current = None
+        if current != data:
+            os.makedirs(asset_dir, exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp" # 先写临时文件再替换，并行生成时不会读到半个文件
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        REPORT_ASSETS_WRITTEN.add(key)
+    return paths
+
+REPORT_CHARTS_JS = """
+// 报表图表 (ECharts)，数据由页面传入
+function cwReconcileCharts(d) {
+    echarts.init(document.getElementById('pie-chart')).setOption({
+        title: { text: '银行流水匹配情况', left: 'center' },
+        tooltip: { trigger: 'item' },
+        legend: { orient: 'vertical', left: 'left' },
+        series: [{
+            name: '匹配结果',
+            type: 'pie',
+            radius: ['40%', '70%'],
+            avoidLabelOverlap: false,
+            itemStyle: { borderRadius: 10, borderColor: '#fff', borderWidth: 2 },
+            label: { show: false, position: 'center' },
+            emphasis: { label: { show: true, fontSize: 20, fontWeight: 'bold' } },
+            labelLine: { show: false },
+            data: [
+                { value: d.matched, name: '匹配成功', itemStyle: { color: '#27ae60' } },
+                { value: d.unmatched, name: '银行未入账', itemStyle: { color: '#e74c3c' } }
+            ]
+        }]
+    });
+    echarts.init(document.getElementById('bar-chart')).setOption({
+        title: { text: '双向差异概览', left: 'center' },
+        tooltip: { trigger: 'axis', axisPointer: { type: 'shadow' } },
+        grid: { left: '3%', right: '4%', bottom: '3%', containLabel: true },
+        xAxis: [{ type: 'category', data: ['银行有台账无', '台账有银行无'], axisTick: { alignWithLabel: true } }],
+        yAxis: [{ type: 'value' }],
+        series: [{
+            name: '笔数',
+            type: 'bar',
+            barWidth: '60%',
+            data: [
+                { value: d.unmatched, itemStyle: { color: '#e74c3c' } },
+                { value: d.ledger, itemStyle: { color: '#f39c12' } }
+            ]
+        }]
+    });
+}
 
-    html += f"""
-                </tbody>
-            </table>
-            
-            <script>
-                var chartDom = document.getElementById('pie-chart');
-                var myChart = echarts.init(chartDom);
-                var option = {{
-                    title: {{ text: '银行流水匹配情况', left: 'center' }},
-                    tooltip: {{ trigger: 'item' }},
-                    legend: {{ orient: 'vertical', left: 'left' }},
-                    series: [
-                        {{
-                            name: '匹配结果',
-                            type: 'pie',
-                            radius: ['40%', '70%'],
-                            avoidLabelOverlap: false,
-                            itemStyle: {{
-                                borderRadius: 10,
-                                borderColor: '#fff',
-                                borderWidth: 2
-                            }},
-                            label: {{
-                                show: false,
-                                position: 'center'
-                            }},
-                            emphasis: {{
-                                label: {{
-                                    show: true,
-                                    fontSize: 20,
-                                    fontWeight: 'bold'
-                                }}
-                            }},
-                            labelLine: {{ show: false }},
-                            data: [
-                                {{ value: {matched_count}, name: '匹配成功', itemStyle: {{ color: '#27ae60' }} }},
-                                {{ value: {len(unmatched_list)}, name: '银行未入账', itemStyle: {{ color: '#e74c3c' }} }}
-                            ]
-                        }}
-                    ]
-                }};
-                myChart.setOption(option);
-                
-                var barDom = document.getElementById('bar-chart');
-                var barChart = echarts.init(barDom);
-                var barOption = {{
-                    title: {{ text: '双向差异概览', left: 'center' }},
-                    tooltip: {{ trigger: 'axis', axisPointer: {{ type: 'shadow' }} }},
-                    grid: {{ left: '3%', right: '4%', bottom: '3%', containLabel: true }},
-                    xAxis: [ {{ type: 'category', data: ['银行有台账无', '台账有银行无'], axisTick: {{ alignWithLabel: true }} }} ],
-                    yAxis: [ {{ type: 'value' }} ],
-                    series: [
-                        {{
-                            name: '笔数',
-                            type: 'bar',
-                            barWidth: '60%',
-                            data: [
-                                {{ value: {len(unmatched_list)}, itemStyle: {{ color: '#e74c3c' }} }},
-                                {{ value: {len(ledger_unmatched_list)}, itemStyle: {{ color: '#f39c12' }} }}
-                            ]
-                        }}
-                    ]
-                }};
-                barChart.setOption(barOption);
-            </script>
+function cwDashboardCharts(d) {
+    echarts.init(document.getElementById('main-chart')).setOption({
+        title: { text: '月度收支趋势图' },
+        tooltip: { trigger: 'axis' },
+        legend: { data: ['收入', '支出', '利润'] },
+        grid: { left: '3%', right: '4%', bottom: '3%', containLabel: true },
+        xAxis: { type: 'category', boundaryGap: false, data: d.months },
+        yAxis: { type: 'value' },
+        series: [
+            { name: '收入', type: 'line', stack: 'Total', areaStyle: {}, data: d.incomes, itemStyle: { color: '#3498db' } },
+            { name: '支出', type: 'line', stack: 'Total', areaStyle: {}, data: d.expenses, itemStyle: { color: '#e74c3c' } },
+            { name: '利润', type: 'bar', data: d.profits, itemStyle: { color: '#27ae60' } }
+        ]
+    });
+    echarts.init(document.getElementById('pie-chart')).setOption({
+        title: { text: '成本合规性分析', subtext: '有票 vs 无票', left: 'center' },
+        tooltip: { trigger: 'item' },
+        legend: { orient: 'vertical', left: 'left' },
+        series: [{
+            name: '成本构成',
+            type: 'pie',
+            radius: '50%',
+            data: d.compliance,
+            emphasis: { itemStyle: { shadowBlur: 10, shadowOffsetX: 0, shadowColor: 'rgba(0, 0, 0, 0.5)' } },
+            itemStyle: {
+                color: function(params) {
+                    var colorList = ['#27ae60', '#e74c3c'];
+                    return colorList[params.dataIndex];
+                }
+            }
+        }]
+    });
+}
+"""
+
+RECONCILE_REPORT_CSS = """
+body { font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; background-color: #f4f6f9; margin: 0; padding: 20px; }
+.container { max-width: 1200px; margin: 0 auto; background: white; padding: 30px; border-radius: 10px; box-shadow: 0 4px 6px rgba(0,0,0,0.1); }
+h1 { color: #2c3e50; text-align: center; border-bottom: 2px solid #3498db; padding-bottom: 10px; }
+.summary { display: flex; justify-content: space-around; margin: 30px 0; }
+.card { text-align: center; padding: 20px; background: #f8f9fa; border-radius: 8px; width: 22%; }
+.number { font-size: 24px; font-weight: bold; color: #2c3e50; }
+.chart-row { display: flex; justify-content: space-between; height: 400px; margin: 20px 0; }
+.chart-box { width: 48%; height: 100%; }
+table { width: 100%; border-collapse: collapse; margin-top: 20px; font-size: 14px; }
+th, td { border: 1px solid #ddd; padding: 12px; text-align: left; }
+th { background-color: #3498db; color: white; }
+tr:nth-child(even) { background-color: #f2f2f2; }
+.badge { padding: 5px 10px; border-radius: 4px; font-size: 12px; }
+.badge-danger { background-color: #e74c3c; color: white; }
+.badge-warning { background-color: #f39c12; color: white; }
+.section-title { margin-top: 40px; color: #2c3e50; border-left: 5px solid #3498db; padding-left: 10px; }
+"""
+
+RECONCILE_REPORT_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <title>银行对账报告 - {{ date }}</title>
+    <script src="https://cdn.jsdelivr.net/npm/echarts@5.4.3/dist/echarts.min.js"></script>
+    <script src="report_assets/report_charts.js"></script>
+    <link rel="stylesheet" href="report_assets/reconcile.css">
+</head>
+<body>
+    <div class="container">
+        <h1>🏦 银行对账报告</h1>
+        <p style="text-align: center; color: #7f8c8d;">生成时间: {{ generated }}</p>
+
+        <div class="summary">
+            <div class="card">
+                <div class="number" style="color: #3498db;">{{ total_bank }}</div>
+                <div>银行流水总数</div>
+            </div>
+            <div class="card">
+                <div class="number" style="color: #27ae60;">{{ matched_count }}</div>
+                <div>✅ 自动匹配成功</div>
+            </div>
+            <div class="card">
+                <div class="number" style="color: #e74c3c;">{{ unmatched_count }}</div>
+                <div>❌ 银行有而台账无</div>
+            </div>
+            <div class="card">
+                <div class="number" style="color: #f39c12;">{{ ledger_count }}</div>
+                <div>❓ 台账有而银行无</div>
+            </div>
         </div>
-    </body>
-    </html>
+
+        <div class="chart-row">
+            <div id="pie-chart" class="chart-box"></div>
+            <div id="bar-chart" class="chart-box"></div>
+        </div>
+
+        <h3 class="section-title">❌ 异常类型一：银行流水有，但台账未记录 ({{ unmatched_count }}条)</h3>
+        <p style="color: #7f8c8d; font-size: 14px;">👉 建议：检查是否漏记，可使用"待补录流水.xlsx"直接导入</p>
+        <table>
+            <thead>
+                <tr><th>日期</th><th>摘要</th><th>金额</th><th>对象</th><th>建议分类</th><th>原因</th></tr>
+            </thead>
+            <tbody>
+{% for r in unmatched %}                <tr><td>{{ r.记账日期 }}</td><td>{{ r.备注 }}</td><td>{{ r.实际收付金额 }}</td><td>{{ r.往来单位费用 }}</td><td>{{ r.费用归类 }}</td><td><span class="badge badge-danger">{{ r.原因 }}</span></td></tr>
+{% endfor %}            </tbody>
+        </table>
+
+        <h3 class="section-title">❓ 异常类型二：台账已记，但银行流水无 ({{ ledger_count }}条)</h3>
+        <p style="color: #7f8c8d; font-size: 14px;">👉 建议：检查是否多记、重复记账、日期偏差过大(>2天)或银行选错</p>
+        <table>
+            <thead>
+                <tr><th>日期</th><th>摘要</th><th>金额</th><th>往来对象</th><th>登记银行</th><th>原因</th></tr>
+            </thead>
+            <tbody>
+{% for r in ledger_unmatched %}                <tr><td>{{ r.记账日期 }}</td><td>{{ r.摘要 }}</td><td>{{ r.金额 }}</td><td>{{ r.往来 }}</td><td>{{ r.交易银行 }}</td><td><span class="badge badge-warning">{{ r.原因 }}</span></td></tr>
+{% endfor %}            </tbody>
+        </table>
+        <script>cwReconcileCharts({{ charts|raw }});</script>
+    </div>
+</body>
+</html>
+"""
+
+def generate_reconciliation_report(matched_count, unmatched_list, ledger_unmatched_list=None,
+                                   unmatched_total=None, ledger_total=None):
     """
+    生成对账结果可视化报告 (包含双向差异)，返回报告路径
+    unmatched_total / ledger_total: 明细只是部分样本时 (分段对账) 传入实际总数
+    """
+    if ledger_unmatched_list is None: ledger_unmatched_list = []
+    unmatched_count = len(unmatched_list) if unmatched_total is None else unmatched_total
+    ledger_count = len(ledger_unmatched_list) if ledger_total is None else ledger_total
+    
+    total_bank = matched_count + unmatched_count
+    total_ledger_issues = ledger_count
+    
+    if total_bank == 0 and total_ledger_issues == 0: return
     
     report_dir = "财务数据备份"
     if not os.path.exists(report_dir):
         os.makedirs(report_dir)
-        
-    filename = f"{report_dir}/对账报告_{datetime.now().strftime('%Y%m%d%H%M%S')}.html"
-    with open(filename, "w", encoding="utf-8") as f:
-        f.write(html)
+    ensure_report_assets(report_dir, {"reconcile.css": RECONCILE_REPORT_CSS, "report_charts.js": REPORT_CHARTS_JS})
+    
+    now = datetime.now()
+    filename = f"{report_dir}/对账报告_{now.strftime('%Y%m%d%H%M%S')}.html"
+    write_report(filename, report_template("reconcile", RECONCILE_REPORT_PAGE), {
+        "date": now.strftime('%Y-%m-%d'),
+        "generated": now.strftime('%Y-%m-%d %H:%M:%S'),
+        "total_bank": total_bank,
+        "matched_count": matched_count,
+        "unmatched_count": unmatched_count,
+        "ledger_count": ledger_count,
+        "unmatched": unmatched_list,
+        "ledger_unmatched": ledger_unmatched_list,
+        "charts": template_json({"matched": matched_count, "unmatched": unmatched_count, "ledger": ledger_count}),
+    })
         
     log.info(f"📊 对账可视化报告已生成: {filename}", extra={"solution": "浏览器打开查看"})
     try:
         os.startfile(filename)
     except:
         pass
+    return filename
+
+# -------------------------- 银行对账：分段流式模式 --------------------------
+# 年度流水动辄几十万行。分段模式先把流水逐块读入临时 SQLite，再按日期窗口逐段对账：
+# 每段只拉取该段日期(加容差)内的台账，待补录流水/台账异常记录边算边写入 Excel，内存占用与文件大小无关
+RECONCILE_STREAMING = os.getenv("RECONCILE_STREAMING", "auto").lower() # auto / true / false
+RECONCILE_STREAM_MIN_MB = float(os.getenv("RECONCILE_STREAM_MIN_MB", 5)) # auto 时流水文件超过该大小启用分段对账
+RECONCILE_WINDOW_DAYS = int(os.getenv("RECONCILE_WINDOW_DAYS", 31)) # 每段覆盖的流水天数
+RECONCILE_FETCH_PAD_DAYS = 7 # 台账拉取范围在流水日期前后各扩展的天数
+RECONCILE_CHUNK_ROWS = 5000 # 流式读取流水时每批行数
+RECONCILE_REPORT_SAMPLE = 2000 # 分段对账时可视化报告中最多列出的明细行数
+RECONCILE_UNMATCHED_COLUMNS = ["记账日期", "凭证号", "业务类型", "费用归类", "往来单位费用", "实际收付金额",
+                               "交易银行", "是否现金", "是否有票", "待补票标记", "备注", "原因"]
+RECONCILE_LEDGER_COLUMNS = ["记账日期", "业务类型", "金额", "摘要", "往来", "交易银行", "原因"]
+
+def reconcile_bank_profile(bank_choice):
+    """对账银行的默认取值与台账中识别该银行的关键词"""
+    if bank_choice == "2":
+        return {"name": "N银行/微信（现金）", "ticket": "无票", "cash": "是", "keywords": ["N银行", "微信", "现金", "私户"]}
+    return {"name": "G银行基本户", "ticket": "有票", "cash": "否",
+            "keywords": ["G银行", "工行", "ICBC", "对公"] if bank_choice == "1" else []}
+
+def ledger_exception_row(record, invalid, keywords):
+    """未匹配的台账记录 -> 台账异常记录行；不属于当前对账银行的返回 None"""
+    f = record_to_parts(record)[1]
+    r_bank = str(f.get("交易银行", "")).strip()
+    # 如果台账里没写银行，默认不报错(避免误报)；或者如果用户希望严查，可以调整策略
+    if not r_bank or not any(k in r_bank for k in keywords):
+        return None
+    try:
+        date_text = datetime.fromtimestamp(float(f.get("记账日期", 0)) / 1000).strftime("%Y-%m-%d")
+    except (TypeError, ValueError, OverflowError, OSError):
+        date_text = str(f.get("记账日期", ""))
+    return {
+        "记账日期": date_text,
+        "业务类型": f.get("业务类型",""),
+        "金额": f.get("实际收付金额",0),
+        "摘要": f.get("备注",""),
+        "往来": f.get("往来单位费用",""),
+        "交易银行": r_bank,
+        "原因": "金额或日期无法识别，未参与对账" if invalid else "台账有但流水无 (可能是多记、日期偏差大或金额不一致)"
+    }
+
+def reconcile_window(df, feishu_records, profile, exclude_ids=None):
+    """
+    一段银行流水与台账记录的匹配：一一匹配 -> 组合核销 -> 未匹配流水清洗与分类
+    df 须含 记账日期 / 实际收付金额 列；exclude_ids 为前一段已匹配的台账记录ID
+    返回 dict:
+      matched / settled: 匹配笔数 (含组合核销) / 其中组合核销笔数
+      unmatched: 待补录流水行
+      ledger_left: 未匹配台账 [(记录, 是否无法识别, 日期序数或None)]
+      ledger_matched: {记录ID: 日期序数}
+      invalid_ledger / invalid_bank: 无法识别的台账记录数 / 流水行数
+      summary: 一一匹配的统计与耗时
+    """
+    date_col, amount_col = "记账日期", "实际收付金额"
+    exclude_ids = exclude_ids or {}
+    
+    # 台账记录: (金额, 本地日期序数)，金额或日期无法识别的单独列出，不再静默丢弃
+    ledger_items = []
+    ledger_entries = []
+    ledger_invalid = []
+    for record in feishu_records:
+        rid, fields, _ = record_to_parts(record)
+        if rid in exclude_ids:
+            continue
+        try:
+            f_amount = float(fields.get('实际收付金额', 0))
+            f_day = datetime.fromtimestamp(float(fields['记账日期']) / 1000).toordinal()
+        except (KeyError, TypeError, ValueError, OverflowError, OSError):
+            ledger_invalid.append(record)
+            continue
+        ledger_items.append(record)
+        ledger_entries.append((f_amount, f_day))
+
+    # 银行流水同样转换为 (金额, 日期序数)
+    bank_dates = pd.to_datetime(df[date_col], errors="coerce")
+    bank_amounts = pd.to_numeric(df[amount_col], errors="coerce")
+    bank_valid = (bank_dates.notna() & bank_amounts.notna()).to_numpy()
+    bank_pos = [pos for pos, ok in enumerate(bank_valid) if ok]
+    bank_lines = [(float(bank_amounts.iat[pos]), bank_dates.iat[pos].toordinal()) for pos in bank_pos]
+
+    # 金额容差 RECONCILE_THRESHOLD、日期容差 TOLERANCE_DAYS 内求最优一一匹配
+    match = match_bank_to_ledger(bank_lines, ledger_entries)
+    matched_count = match.matched_count
+    unmatched_rows = [(pos, bank_dates.iat[pos], amount)
+                      for (amount, _), pos, ledger_idx in zip(bank_lines, bank_pos, match.bank_to_ledger)
+                      if ledger_idx is None]
+
+    # 未匹配流水统一做列式清洗 (去前缀 -> 别名 -> 分类)
+    unmatched = []
+    if unmatched_rows:
+        normalized = normalize_bank_statement(df.iloc[[pos for pos, _, _ in unmatched_rows]])
+        for (_, b_date, b_amount), line in zip(unmatched_rows, normalized.itertuples(index=False)):
+            unmatched.append({
+                "记账日期": b_date.strftime("%Y-%m-%d"),
+                "凭证号": "",
+                "业务类型": "付款" if b_amount < 0 else "收款",
+                "费用归类": line.费用归类,
+                "往来单位费用": line.往来单位,
+                "实际收付金额": b_amount,
+                "交易银行": profile["name"],
+                "是否现金": profile["cash"],
+                "是否有票": profile["ticket"],
+                "待补票标记": "否",
+                "备注": f"流水导入: {line.摘要}",
+                "原因": f"飞书无此金额或日期超{TOLERANCE_DAYS}天"
+            })
+
+    # 组合核销: 一笔流水结清同一往来单位的多笔台账，或一笔台账分多笔流水收付
+    settled_count = 0
+    if unmatched_rows:
+        tol_cents = reconcile_amount_cents()
+        # read_excel_smart 已把户名类表头统一为 往来单位费用，有则优先用它
+        mapped = df["往来单位费用"] if "往来单位费用" in df.columns else None
+        lines = []
+        for (pos, b_date, b_amount), u in zip(unmatched_rows, unmatched):
+            partner = mapped.iat[pos] if mapped is not None and pd.notna(mapped.iat[pos]) else u["往来单位费用"]
+            lines.append((b_amount, b_date.toordinal(), resolve_partner(clean_description(str(partner)))))
+        open_items = [i for i, matched in enumerate(match.ledger_matched) if not matched]
+        items = []
+        for i in open_items:
+            f = record_to_parts(ledger_items[i])[1]
+            amount, day = ledger_entries[i]
+            if amount > 0 and f.get("业务类型") in ("付款", "费用"):
+                amount = -amount
+            items.append((amount, day, resolve_partner(f.get("往来单位费用", ""))))
+
+        used_items = set()
+        # 只接受两笔及以上的组合：单笔相符已由逐笔匹配按 TOLERANCE_DAYS 判定过，不能借组合窗口放宽日期
+        many_to_one, cut_a = settle_by_combination(lines, items, tol_cents, pool_used=used_items, min_items=2)
+        rest_lines = [t for t in range(len(lines)) if t not in many_to_one]
+        rest_items = [k for k in range(len(items)) if k not in used_items]
+        one_to_many, cut_b = settle_by_combination([items[k] for k in rest_items], [lines[t] for t in rest_lines],
+                                                   tol_cents, days_before=TOLERANCE_DAYS, days_after=SETTLEMENT_WINDOW_DAYS,
+                                                   min_items=2)
+        settled_lines = set(many_to_one)
+        for k in used_items:
+            match.ledger_matched[open_items[k]] = True
+        for k, picked in one_to_many.items():
+            match.ledger_matched[open_items[rest_items[k]]] = True
+            settled_lines.update(rest_lines[p] for p in picked)
+        if settled_lines:
+            settled_count = len(settled_lines)
+            matched_count += settled_count
+            unmatched = [u for t, u in enumerate(unmatched) if t not in settled_lines]
+            log.info(f"🧩 组合核销: {len(many_to_one)} 笔流水对应多笔台账, {len(one_to_many)} 笔台账分多笔流水收付",
+                     extra={"solution": "无"})
+        if cut_a or cut_b:
+            log.warning(f"⚠️ {cut_a + cut_b} 次组合搜索达到上限被截断", extra={"solution": "可调大 SETTLEMENT_SEARCH_BUDGET"})
+    
+    # 未匹配流水的 AI 分类统一批量推断
+    resolve_pending_categories(unmatched)
+
+    ledger_left = [(r, False, day) for r, (_, day), matched in zip(ledger_items, ledger_entries, match.ledger_matched)
+                   if not matched]
+    ledger_left += [(r, True, None) for r in ledger_invalid]
+    ledger_matched = {record_to_parts(r)[0]: day
+                      for r, (_, day), matched in zip(ledger_items, ledger_entries, match.ledger_matched) if matched}
+    return {"matched": matched_count, "settled": settled_count, "unmatched": unmatched,
+            "ledger_left": ledger_left, "ledger_matched": ledger_matched,
+            "invalid_ledger": len(ledger_invalid), "invalid_bank": len(df) - len(bank_pos),
+            "summary": match.summary()}
+
+class ReconcileResultWriter:
+    """对账结果 Excel：按行追加写入 (xlsxwriter constant_memory)，首次写入时才创建文件"""
+    def __init__(self, path, columns, sheet_name=None):
+        self.path = path
+        self.columns = columns
+        self.sheet_name = sheet_name
+        self.workbook = None
+        self.ws = None
+        self.rows = 0
+
+    def write(self, rows):
+        if not rows:
+            return
+        if self.workbook is None:
+            self.workbook = xlsxwriter.Workbook(self.path, {"constant_memory": True})
+            self.ws = self.workbook.add_worksheet(self.sheet_name)
+            header = self.workbook.add_format({"bold": True, "border": 1})
+            for col, name in enumerate(self.columns):
+                self.ws.write(0, col, name, header)
+        for row in rows:
+            self.rows += 1
+            for col, name in enumerate(self.columns):
+                value = row.get(name)
+                if value is None or (isinstance(value, float) and math.isnan(value)):
+                    continue
+                self.ws.write(self.rows, col, value if isinstance(value, (str, int, float)) else str(value))
+
+    def close(self):
+        if self.workbook is not None:
+            self.workbook.close()
+            self.workbook = None
+
+def iter_excel_smart_chunks(file_path, chunk_rows=None):
+    """
+    流式读取 Excel (openpyxl 只读模式)：按 read_excel_smart 的规则识别表头并重命名列，
+    每次产出 chunk_rows 行的 DataFrame；非 xlsx 文件回退为整表读取后分块
+    """
+    chunk_rows = chunk_rows or RECONCILE_CHUNK_ROWS
+    if not str(file_path).lower().endswith((".xlsx", ".xlsm")):
+        df = read_excel_smart(file_path)
+        for start in range(0, len(df), chunk_rows):
+            yield df.iloc[start:start + chunk_rows]
+        return
+    wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        # 优先读 '日常台账表'，否则读第一个 Sheet
+        sheet_name = "日常台账表" if "日常台账表" in wb.sheetnames else wb.sheetnames[0]
+        rows = wb[sheet_name].iter_rows(values_only=True)
+        preview = list(itertools.islice(rows, 20))
+        if not preview:
+            return
+        header_row_idx, column_map = detect_excel_header(pd.DataFrame(preview))
+        if header_row_idx == -1:
+            header_row_idx = 0
+            log.warning("⚠️ 未找到明显的表头行，尝试默认第一行读取", extra={"solution": "请检查Excel格式"})
+        header = [f"Unnamed: {i}" if v is None else str(v) for i, v in enumerate(preview[header_row_idx])]
+        columns = [column_map.get(h.strip(), column_map.get(h, h)) for h in header]
+        width = len(columns)
+        
+        def frame(batch):
+            return pd.DataFrame([tuple(r[:width]) + (None,) * (width - len(r)) for r in batch], columns=columns)
+
+        batch = []
+        for row in itertools.chain(preview[header_row_idx + 1:], rows):
+            if all(v is None for v in row):
+                continue
+            batch.append(row)
+            if len(batch) >= chunk_rows:
+                yield frame(batch)
+                batch = []
+        if batch:
+            yield frame(batch)
+    finally:
+        wb.close()
+
+def iter_excel_dict_chunks(file_path, chunk_rows=None):
+    """逐块读回结果 Excel (首行为表头)，产出 [dict]"""
+    chunk_rows = chunk_rows or RECONCILE_CHUNK_ROWS
+    wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if not header:
+            return
+        while True:
+            batch = [{k: ("" if v is None else v) for k, v in zip(header, r)}
+                     for r in itertools.islice(rows, chunk_rows)]
+            if not batch:
+                break
+            yield batch
+    finally:
+        wb.close()
+
+def spool_bank_statement(file_path, spool_path):
+    """
+    把流水逐块写入临时 SQLite (按日期序数建索引)，供按日期窗口取出
+    返回 (连接, 最早日期序数, 最晚日期序数, 无法识别的行数)；缺少日期/金额列时返回 None
+    """
+    conn = sqlite3.connect(spool_path)
+    conn.execute("CREATE TABLE lines (seq INTEGER PRIMARY KEY, day INTEGER, row TEXT)")
+    seq = 0
+    invalid = 0
+    for chunk in iter_excel_smart_chunks(file_path):
+        if "记账日期" not in chunk.columns or "实际收付金额" not in chunk.columns:
+            log.error(f"❌ 银行流水Excel缺少必要的列 (需包含 日期/金额 关键词)", extra={"solution": "修改表头或使用智能模式"})
+            log.info(f"当前识别到的列: {chunk.columns.tolist()}", extra={"solution": "无"})
+            conn.close()
+            return None
+        dates = pd.to_datetime(chunk["记账日期"], errors="coerce")
+        valid = (dates.notna() & pd.to_numeric(chunk["实际收付金额"], errors="coerce").notna()).to_numpy()
+        invalid += int((~valid).sum())
+        records = chunk.to_dict("records")
+        batch = []
+        for ok, day, row in zip(valid, dates, records):
+            if ok:
+                row["记账日期"] = day.isoformat()
+                batch.append((seq, day.toordinal(), json.dumps(row, ensure_ascii=False, default=str)))
+                seq += 1
+        conn.executemany("INSERT INTO lines VALUES (?, ?, ?)", batch)
+    conn.execute("CREATE INDEX idx_lines_day ON lines (day, seq)")
+    conn.commit()
+    first, last = conn.execute("SELECT MIN(day), MAX(day) FROM lines").fetchone()
+    return conn, first, last, invalid
+
+def day_to_ms(day):
+    """日期序数 -> 当天0点的毫秒时间戳 (本地时间)"""
+    return int(datetime.fromordinal(day).timestamp() * 1000)
+
+def reconcile_statement_streaming(client, app_token, table_id, bank_excel_path, profile, unmatched_out, ledger_out):
+    """
+    分段对账：流水按 RECONCILE_WINDOW_DAYS 切段，每段只拉取 [段首-补齐, 段尾+补齐] 的台账；
+    补齐天数取 TOLERANCE_DAYS / 组合核销窗口中的较大者 (且不超出整份流水前后 7 天)。
+    段与段重叠区里已匹配的台账记录带入下一段排除；日期早于下一段拉取范围的未匹配台账才最终写出
+    返回 {"matched", "settled", "unmatched_sample", "ledger_sample", "unmatched_total", "ledger_total", "windows"}；失败返回 None
+    """
+    spool_fd, spool_path = tempfile.mkstemp(prefix="reconcile_", suffix=".db")
+    os.close(spool_fd)
+    conn = None
+    try:
+        spooled = spool_bank_statement(bank_excel_path, spool_path)
+        if spooled is None:
+            return None
+        conn, first_day, last_day, invalid_bank = spooled
+        if invalid_bank:
+            log.warning(f"⚠️ {invalid_bank} 行流水的日期或金额无法识别，已跳过", extra={"solution": "检查流水Excel"})
+        totals = {"matched": 0, "settled": 0, "unmatched_sample": [], "ledger_sample": [],
+                  "unmatched_total": 0, "ledger_total": 0, "windows": 0}
+        if first_day is None:
+            return totals
+        log.info(f"📅 提取流水日期范围: {datetime.fromordinal(first_day).date()} 至 {datetime.fromordinal(last_day).date()}",
+                 extra={"solution": "分段对账"})
+        
+        pad = max(TOLERANCE_DAYS, SETTLEMENT_WINDOW_DAYS)
+        lower = first_day - RECONCILE_FETCH_PAD_DAYS
+        upper = last_day + RECONCILE_FETCH_PAD_DAYS
+        carried = {} # 重叠区内已匹配的台账: 记录ID -> 日期序数
+        invalid_seen = set() # 无法识别日期的台账每段都会被拉到，只报告一次
+        
+        def emit(rows, sample_key, total_key, out):
+            out.write(rows)
+            totals[total_key] += len(rows)
+            room = RECONCILE_REPORT_SAMPLE - len(totals[sample_key])
+            if room > 0:
+                totals[sample_key].extend(rows[:room])
+
+        for ws in range(first_day, last_day + 1, RECONCILE_WINDOW_DAYS):
+            we = ws + RECONCILE_WINDOW_DAYS
+            is_last = we > last_day
+            fetch_from = max(ws - pad, lower)
+            fetch_to = min(we + pad, upper + 1)
+            rows = [json.loads(r) for (r,) in conn.execute(
+                "SELECT row FROM lines WHERE day>=? AND day<? ORDER BY seq", (ws, we))]
+            df = pd.DataFrame(rows)
+            del rows
+            filter_info = (f'AND(CurrentValue.[记账日期]>={day_to_ms(fetch_from)}, '
+                           f'CurrentValue.[记账日期]<{day_to_ms(fetch_to)})')
+            ledger = get_all_records(client, app_token, table_id, filter_info=filter_info)
+            if df.empty:
+                df = pd.DataFrame({"记账日期": [], "实际收付金额": []})
+            result = reconcile_window(df, ledger, profile, exclude_ids=carried)
+            del ledger, df
+            totals["windows"] += 1
+            totals["matched"] += result["matched"]
+            totals["settled"] += result["settled"]
+            emit(result["unmatched"], "unmatched_sample", "unmatched_total", unmatched_out)
+
+            # 下一段从 we - pad 开始拉取：更早的未匹配台账不会再出现，可以最终写出
+            final_before = upper + 1 if is_last else we - pad
+            exceptions = []
+            for record, invalid, day in result["ledger_left"]:
+                if invalid:
+                    rid = record_to_parts(record)[0]
+                    if rid in invalid_seen:
+                        continue
+                    invalid_seen.add(rid)
+                elif day >= final_before:
+                    continue
+                row = ledger_exception_row(record, invalid, profile["keywords"])
+                if row:
+                    exceptions.append(row)
+            emit(exceptions, "ledger_sample", "ledger_total", ledger_out)
+            carried = {rid: day for rid, day in itertools.chain(carried.items(), result["ledger_matched"].items())
+                       if day >= we - pad}
+            print(f"   ⏳ 已对账至 {datetime.fromordinal(min(we, last_day + 1) - 1).date()} "
+                  f"(匹配 {totals['matched']}, 待补录 {totals['unmatched_total']}, 台账异常 {totals['ledger_total']})")
+        return totals
+    finally:
+        if conn is not None:
+            conn.close()
+        try:
+            os.remove(spool_path)
+        except OSError:
+            pass
 
 # 银行流水对账 (智能模糊匹配 + 性能优化)
-@retry_on_failure(max_retries=2, delay=3)
-def reconcile_bank_flow(client, app_token, bank_excel_path):
+@retry_on_failure()
+def reconcile_bank_flow(client, app_token, bank_excel_path, streaming=None):
+    """
+    streaming: 是否分段流式对账；None 时按 RECONCILE_STREAMING (auto 表示文件超过 RECONCILE_STREAM_MIN_MB 时启用)
+    """
     log.info("📊 开始智能对账...", extra={"solution": "无"})
     
     # 1. 先读取银行流水 (为了获取日期范围，减少飞书数据拉取量)
@@ -1552,43 +5393,44 @@ def reconcile_bank_flow(client, app_token, bank_excel_path):
             if user_input:
                 bank_choice = user_input
         
-        bank_name = "G银行基本户"
-        default_ticket = "有票"
-        is_cash = "否"
-        
-        if bank_choice == "2":
-            bank_name = "N银行/微信（现金）"
-            default_ticket = "无票"
-            is_cash = "是"
-        log.info(f"✅ 当前设定: {bank_name}", extra={"solution": "无"})
+        profile = reconcile_bank_profile(bank_choice)
+        log.info(f"✅ 当前设定: {profile['name']}", extra={"solution": "无"})
 
-        # 使用智能读取
-        df = read_excel_smart(bank_excel_path)
-        if df.empty:
-            return False
+        if streaming is None:
+            if RECONCILE_STREAMING == "auto":
+                streaming = os.path.getsize(bank_excel_path) >= RECONCILE_STREAM_MIN_MB * 1024 * 1024
+            else:
+                streaming = RECONCILE_STREAMING == "true"
 
-        # 标准列名
-        date_col = "记账日期"
-        amount_col = "实际收付金额"
-        
-        if date_col not in df.columns or amount_col not in df.columns:
-            log.error(f"❌ 银行流水Excel缺少必要的列 (需包含 日期/金额 关键词)", extra={"solution": "修改表头或使用智能模式"})
-            log.info(f"当前识别到的列: {df.columns.tolist()}", extra={"solution": "无"})
-            return False
+        df = None
+        if not streaming:
+            # 使用智能读取
+            df = read_excel_smart(bank_excel_path)
+            if df.empty:
+                return False
 
-        # 获取日期范围用于过滤
-        try:
-            dates = pd.to_datetime(df[date_col])
-            min_date = dates.min()
-            max_date = dates.max()
-            # 扩大范围前后各7天，防止容差漏掉
-            filter_start_ts = int((min_date - timedelta(days=7)).timestamp() * 1000)
-            filter_end_ts = int((max_date + timedelta(days=7)).timestamp() * 1000)
-            log.info(f"📅 提取流水日期范围: {min_date.date()} 至 {max_date.date()}", extra={"solution": "无"})
-        except Exception as e:
-            log.warning(f"⚠️ 日期解析失败，将拉取全量数据: {e}", extra={"solution": "检查日期格式"})
-            filter_start_ts = None
-            filter_end_ts = None
+            # 标准列名
+            date_col = "记账日期"
+            amount_col = "实际收付金额"
+            
+            if date_col not in df.columns or amount_col not in df.columns:
+                log.error(f"❌ 银行流水Excel缺少必要的列 (需包含 日期/金额 关键词)", extra={"solution": "修改表头或使用智能模式"})
+                log.info(f"当前识别到的列: {df.columns.tolist()}", extra={"solution": "无"})
+                return False
+
+            # 获取日期范围用于过滤
+            try:
+                dates = pd.to_datetime(df[date_col])
+                min_date = dates.min()
+                max_date = dates.max()
+                # 扩大范围前后各7天，防止容差漏掉
+                filter_start_ts = int((min_date - timedelta(days=RECONCILE_FETCH_PAD_DAYS)).timestamp() * 1000)
+                filter_end_ts = int((max_date + timedelta(days=RECONCILE_FETCH_PAD_DAYS)).timestamp() * 1000)
+                log.info(f"📅 提取流水日期范围: {min_date.date()} 至 {max_date.date()}", extra={"solution": "无"})
+            except Exception as e:
+                log.warning(f"⚠️ 日期解析失败，将拉取全量数据: {e}", extra={"solution": "检查日期格式"})
+                filter_start_ts = None
+                filter_end_ts = None
 
     except Exception as e:
         log.error(f"❌ 读取Excel失败: {str(e)}", extra={"solution": "检查文件是否被占用"})
@@ -1599,186 +5441,84 @@ def reconcile_bank_flow(client, app_token, bank_excel_path):
     if not table_id:
         log.error("❌ 未找到'日常台账表'", extra={"solution": "先创建表格"})
         return False
-        
-    filter_info = None
-    if filter_start_ts and filter_end_ts:
-        # 构造组合过滤器
-        filter_info = f'AND(CurrentValue.[记账日期]>={filter_start_ts}, CurrentValue.[记账日期]<={filter_end_ts})'
-        log.info("🚀 启用云端数据过滤，仅拉取相关日期记录", extra={"solution": "性能优化"})
-
-    feishu_records = get_all_records(client, app_token, table_id, filter_info=filter_info)
-    log.info(f"📥 拉取到 {len(feishu_records)} 条相关记录", extra={"solution": "无"})
-    
-    # 构建飞书数据索引: Amount -> List of Records
-    feishu_amount_map = {}
-    for record in feishu_records:
-        fields = record['fields']
-        try:
-            # 修正：字段名应为 '实际收付金额'
-            f_amount = float(fields.get('实际收付金额', 0))
-            f_date = pd.to_datetime(fields.get('记账日期', 0), unit='ms')
-            
-            key = round(f_amount, 2)
-            if key not in feishu_amount_map:
-                feishu_amount_map[key] = []
-            
-            feishu_amount_map[key].append({
-                "record_id": record['record_id'],
-                "date": f_date,
-                "fields": fields,
-                "matched": False
-            })
-        except:
-            continue
-
-            
-    unmatched = []
-    matched_count = 0
-    
-    # 容差设置
-    # TOLERANCE_DAYS = 2 # Moved to global config
     
     # 加载历史分类知识
     load_history_knowledge(client, app_token)
 
-    for idx, row in df.iterrows():
-        try:
-            b_date = pd.to_datetime(row[date_col])
-            b_amount = float(row[amount_col])
-            b_amount_key = round(b_amount, 2)
-        except:
-            continue 
-        
-        # 查找匹配
-        candidates = feishu_amount_map.get(b_amount_key, [])
-        match_found = False
-        
-        for cand in candidates:
-            if cand["matched"]:
-                continue # 已经被其他流水匹配过了
-            
-            # 检查日期差
-            delta = abs((cand["date"] - b_date).days)
-            if delta <= TOLERANCE_DAYS:
-                cand["matched"] = True
-                match_found = True
-                matched_count += 1
-                break
-        
-        if not match_found:
-            # 构造符合导入格式的数据
-            raw_desc = str(row.get("对方户名", str(row.get("对方账号", row.get("摘要", "未知")))))
-            memo = str(row.get('摘要', ''))
-            
-            # 优化：清洗摘要
-            cleaned_memo = clean_description(memo)
-            cleaned_desc = clean_description(raw_desc)
-            
-            # 优化：解析别名 (张三 -> A客户)
-            cleaned_desc = resolve_partner(cleaned_desc)
-
-            # 尝试自动分类 (使用历史记忆)
-            # 逻辑：
-            # 1. 如果有明确规则匹配 cleaned_memo -> 用规则
-            # 2. 如果 cleaned_memo 在历史中出现过 -> 用历史
-            # 3. 如果 cleaned_desc 在历史中出现过 -> 用历史
-            category = auto_categorize(cleaned_memo, "其他", partner_name=cleaned_desc) 
-            
-            # 如果自动分类返回默认值，尝试单独匹配 cleaned_desc
-            if category == "其他":
-                 category = auto_categorize(cleaned_desc, "其他", partner_name=cleaned_desc)
-            
-            unmatched.append({
-                "记账日期": b_date.strftime("%Y-%m-%d"),
-                "凭证号": "",
-                "业务类型": "付款" if b_amount < 0 else "收款",
-                "费用归类": category,
-                "往来单位费用": cleaned_desc,
-                "实际收付金额": b_amount,
-                "交易银行": bank_name,
-                "是否现金": is_cash,
-                "是否有票": default_ticket,
-                "待补票标记": "否",
-                "备注": f"流水导入: {memo}",
-                "原因": "飞书无此金额或日期超2天"
-            })
-            
-    # [新增] 反向对账：检查台账中有，但银行流水中没有的记录 (可能是多记、重复或日期错误)
-    ledger_unmatched = []
-    
-    # 定义当前银行的关键词
-    target_bank_keywords = []
-    if bank_choice == "1":
-        target_bank_keywords = ["G银行", "工行", "ICBC", "对公"]
-    elif bank_choice == "2":
-        target_bank_keywords = ["N银行", "微信", "现金", "私户"]
-        
-    for key, records_list in feishu_amount_map.items():
-        for r in records_list:
-            if not r["matched"]:
-                # 检查该记录是否属于当前对账的银行
-                r_bank = str(r["fields"].get("交易银行", "")).strip()
-                
-                # 如果台账里没写银行，默认不报错(避免误报)；或者如果用户希望严查，可以调整策略
-                if not r_bank: continue
-                
-                is_target = False
-                for k in target_bank_keywords:
-                    if k in r_bank:
-                        is_target = True
-                        break
-                        
-                if is_target:
-                    # 找到了属于该银行但未匹配流水的数据
-                    f = r["fields"]
-                    ledger_unmatched.append({
-                        "记账日期": datetime.fromtimestamp(f.get("记账日期",0)/1000).strftime("%Y-%m-%d"),
-                        "业务类型": f.get("业务类型",""),
-                        "金额": f.get("实际收付金额",0),
-                        "摘要": f.get("备注",""),
-                        "往来": f.get("往来单位费用",""),
-                        "交易银行": r_bank,
-                        "原因": "台账有但流水无 (可能是多记、日期偏差大或金额不一致)"
-                    })
+    # 结果文件边算边写 (没有内容时不会生成文件)
+    stamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    unmatched_out = ReconcileResultWriter(f"待补录流水_{stamp}.xlsx", RECONCILE_UNMATCHED_COLUMNS, "日常台账表")
+    ledger_out = ReconcileResultWriter(f"台账异常记录_{stamp}.xlsx", RECONCILE_LEDGER_COLUMNS)
+    try:
+        if streaming:
+            log.info(f"🚀 启用分段对账 (每段 {RECONCILE_WINDOW_DAYS} 天)，逐段拉取台账并写出结果", extra={"solution": "大文件模式"})
+            totals = reconcile_statement_streaming(client, app_token, table_id, bank_excel_path, profile,
+                                                   unmatched_out, ledger_out)
+            if totals is None:
+                return False
+            matched_count, settled_count = totals["matched"], totals["settled"]
+            unmatched, ledger_unmatched = totals["unmatched_sample"], totals["ledger_sample"]
+            unmatched_total, ledger_total = totals["unmatched_total"], totals["ledger_total"]
+        else:
+            filter_info = None
+            if filter_start_ts and filter_end_ts:
+                # 构造组合过滤器
+                filter_info = f'AND(CurrentValue.[记账日期]>={filter_start_ts}, CurrentValue.[记账日期]<={filter_end_ts})'
+                log.info("🚀 启用云端数据过滤，仅拉取相关日期记录", extra={"solution": "性能优化"})
+
+            feishu_records = get_all_records(client, app_token, table_id, filter_info=filter_info)
+            log.info(f"📥 拉取到 {len(feishu_records)} 条相关记录", extra={"solution": "无"})
+
+            result = reconcile_window(df, feishu_records, profile)
+            log.info(f"🔗 {result['summary']}", extra={"solution": "无"})
+            if result["invalid_ledger"]:
+                log.warning(f"⚠️ {result['invalid_ledger']} 条台账记录的金额或日期无法识别，未参与匹配", extra={"solution": "见台账异常记录"})
+            if result["invalid_bank"]:
+                log.warning(f"⚠️ {result['invalid_bank']} 行流水的日期或金额无法识别，已跳过", extra={"solution": "检查流水Excel"})
+            matched_count, settled_count = result["matched"], result["settled"]
+            unmatched = result["unmatched"]
+
+            # [新增] 反向对账：检查台账中有，但银行流水中没有的记录 (可能是多记、重复或日期错误)
+            ledger_unmatched = [row for row in (ledger_exception_row(r, invalid, profile["keywords"])
+                                                for r, invalid, _ in result["ledger_left"]) if row]
+            unmatched_out.write(unmatched)
+            ledger_out.write(ledger_unmatched)
+            unmatched_total, ledger_total = len(unmatched), len(ledger_unmatched)
+    finally:
+        unmatched_out.close()
+        ledger_out.close()
 
     # 3. 输出结果
-    msg = f"智能对账完成！\n✅ 自动匹配：{matched_count}笔\n❌ 银行流水未入账：{len(unmatched)}笔"
-    if ledger_unmatched:
-        msg += f"\n⚠️ 台账多余记录 (疑似错误)：{len(ledger_unmatched)}笔"
+    msg = f"智能对账完成！\n✅ 自动匹配：{matched_count}笔"
+    if settled_count:
+        msg += f" (其中组合核销 {settled_count} 笔)"
+    msg += f"\n❌ 银行流水未入账：{unmatched_total}笔"
+    if ledger_total:
+        msg += f"\n⚠️ 台账多余记录 (疑似错误)：{ledger_total}笔"
         
     log.info(msg, extra={"solution": "查看导出文件"})
     
-    # 生成可视化报告
-    generate_reconciliation_report(matched_count, unmatched, ledger_unmatched)
-
-    # 导出 银行流水未入账
-    if unmatched:
-        res_df = pd.DataFrame(unmatched)
-        # 确保列顺序符合导入要求
-        cols = ["记账日期", "凭证号", "业务类型", "费用归类", "往来单位费用", "实际收付金额", 
-                "交易银行", "是否现金", "是否有票", "待补票标记", "备注", "原因"]
-        # 动态调整列，防止KeyError
-        final_cols = [c for c in cols if c in res_df.columns]
-        res_df = res_df[final_cols]
-        
-        res_path = f"待补录流水_{datetime.now().strftime('%Y%m%d%H%M%S')}.xlsx"
-        res_df.to_excel(res_path, index=False, sheet_name="日常台账表") 
-        log.info(f"📄 待补录清单已导出: {res_path}", extra={"solution": "检查后导入"})
-        
-    # 导出 台账多余记录
-    if ledger_unmatched:
-        l_df = pd.DataFrame(ledger_unmatched)
-        l_path = f"台账异常记录_{datetime.now().strftime('%Y%m%d%H%M%S')}.xlsx"
-        l_df.to_excel(l_path, index=False)
-        log.warning(f"📄 发现台账异常记录 (流水中没有): {l_path}", extra={"solution": "请核对是否多记或日期错误"})
-
-    if unmatched:
+    # 生成可视化报告 (分段对账时明细只列出前 RECONCILE_REPORT_SAMPLE 行)
+    generate_reconciliation_report(matched_count, unmatched, ledger_unmatched,
+                                   unmatched_total=unmatched_total, ledger_total=ledger_total)
+
+    if unmatched_out.rows:
+        log.info(f"📄 待补录清单已导出: {unmatched_out.path}", extra={"solution": "检查后导入"})
+    if ledger_out.rows:
+        log.warning(f"📄 发现台账异常记录 (流水中没有): {ledger_out.path}", extra={"solution": "请核对是否多记或日期错误"})
+
+    if unmatched_total:
         # 新增：询问是否直接导入 (按实际发生)
-        print(f"\n💡 发现 {len(unmatched)} 笔未匹配流水 (可能是新发生的收支)。")
+        print(f"\n💡 发现 {unmatched_total} 笔未匹配流水 (可能是新发生的收支)。")
         print("💡 小提示: 小企业通常付款/回款不一一对应，建议按'实际发生'直接导入。")
         import_choice = input("👉 是否直接将这些流水作为新账目导入飞书? (y/n) [推荐y]: ").strip().lower()
         if import_choice != 'n': 
-            import_bank_records_to_feishu(client, app_token, unmatched)
+            if streaming:
+                # 分段对账时从导出文件逐块读回导入，不在内存中保留全部未匹配流水
+                for batch in iter_excel_dict_chunks(unmatched_out.path):
+                    import_bank_records_to_feishu(client, app_token, batch)
+            else:
+                import_bank_records_to_feishu(client, app_token, unmatched)
             
     else:
         send_bot_message(f"{msg}\n🎉 账目完美平衡！", "reconcile")
@@ -1786,7 +5526,7 @@ def reconcile_bank_flow(client, app_token, bank_excel_path):
     return True
 
 # 往来对账 (导入外部账单核对)
-@retry_on_failure(max_retries=2, delay=3)
+@retry_on_failure()
 def reconcile_partner_flow(client, app_token, partner_excel_path=None):
     log.info("🤝 开始往来对账流程...", extra={"solution": "无"})
     
@@ -2141,21 +5881,11 @@ def batch_add_records(client, app_token, table_id, data_list):
         }
         records.append(AppTableRecord.builder().fields(fields).build())
         
-    # 分批写入
-    batch_size = 100
-    for i in range(0, len(records), batch_size):
-        batch = records[i:i+batch_size]
-        req = BatchCreateAppTableRecordRequest.builder() \
-            .app_token(app_token) \
-            .table_id(table_id) \
-            .request_body(BatchCreateAppTableRecordRequestBody.builder().records(batch).build()) \
-            .build()
-            
-        resp = client.bitable.v1.app_table_record.batch_create(req)
-        if resp.success():
-            log.info(f"✅ 已补录 {len(batch)} 条记录", extra={"solution": "无"})
-        else:
-            log.error(f"❌ 补录失败: {resp.msg}", extra={"solution": "检查权限"})
+    result = batch_write_records(client, app_token, table_id, records)
+    if result.success_count:
+        log.info(f"✅ 已补录 {result.success_count} 条记录", extra={"solution": "无"})
+    if result.failed:
+        log.error(f"❌ 补录失败 {len(result.failed)} 条: {result.error_summary()}", extra={"solution": "检查权限"})
 
 # 薪酬管理流程 (新)
 def manage_salary_flow(client, app_token):
@@ -2253,21 +5983,10 @@ def manage_salary_flow(client, app_token):
                     records.append(AppTableRecord.builder().fields(fields).build())
 
                 # Batch Write
-                batch_size = 100
-                total_success = 0
-                for i in range(0, len(records), batch_size):
-                    batch = records[i:i+batch_size]
-                    req = BatchCreateAppTableRecordRequest.builder() \
-                        .app_token(app_token) \
-                        .table_id(table_id) \
-                        .request_body(BatchCreateAppTableRecordRequestBody.builder().records(batch).build()) \
-                        .build()
-                    
-                    resp = client.bitable.v1.app_table_record.batch_create(req)
-                    if resp.success():
-                        total_success += len(batch)
-                    else:
-                        print(f"{Color.FAIL}❌ 部分写入失败: {resp.msg}{Color.ENDC}")
+                result = batch_write_records(client, app_token, table_id, records)
+                total_success = result.success_count
+                if result.failed:
+                    print(f"{Color.FAIL}❌ 部分写入失败: {result.error_summary()}{Color.ENDC}")
                 
                 print(f"{Color.OKGREEN}✅ 成功导入 {total_success} 条薪酬记录 ({month_input}){Color.ENDC}")
                 
@@ -2293,6 +6012,7 @@ def manage_salary_flow(client, app_token):
                     req_l = BatchCreateAppTableRecordRequest.builder().app_token(app_token).table_id(ledger_id).request_body(
                         BatchCreateAppTableRecordRequestBody.builder().records([rec]).build()).build()
                     resp_l = client.bitable.v1.app_table_record.batch_create(req_l)
+                    note_record_write(ledger_id)
                     if resp_l.success():
                          print(f"{Color.OKGREEN}✅ 已生成支出凭证: {total_net} 元{Color.ENDC}")
                     else:
@@ -2387,6 +6107,7 @@ def manage_salary_flow(client, app_token):
                     .build()
                 
                 resp = client.bitable.v1.app_table_record.batch_create(req)
+                note_record_write(ledger_id)
                 
                 if resp.success():
                     print(f"{Color.OKGREEN}✅ 凭证生成成功！已写入日常台账。{Color.ENDC}")
@@ -2401,7 +6122,7 @@ def get_ai_insight(data_context):
         
     log.info("🧠 正在进行AI财务诊断 (GLM-4-Flash)...", extra={"solution": "无"})
     try:
-        client = ZhipuAI(api_key=ZHIPUAI_API_KEY)
+        client = guard_ai_client(ZhipuAI(api_key=ZHIPUAI_API_KEY))
         
         prompt = f"""
         你是一位经验丰富的CFO（首席财务官）。请根据以下小企业本月财务数据，给出一段简练、专业的经营评价，并提出1条具体的改进建议。
@@ -2436,7 +6157,8 @@ def get_ai_insight(data_context):
         return ""
 
 # 税务统计 (含风险预警)
-@retry_on_failure(max_retries=2, delay=3)
+@retry_on_failure()
+@tracked_report
 def calculate_tax(client, app_token, target_year=None):
     if target_year:
         log.info(f"🧮 开始 {target_year}年度 税务及风险分析...", extra={"solution": "无"})
@@ -2455,41 +6177,24 @@ def calculate_tax(client, app_token, target_year=None):
     filter_str = f'AND(CurrentValue.[记账日期]>={start_ts}, CurrentValue.[记账日期]<{end_ts})'
     
     log.info(f"🔍 正在拉取 {year} 年度数据...", extra={"solution": "无"})
-    records = get_all_records(client, app_token, table_id, filter_info=filter_str)
+    df = load_records_frame(client, app_token, table_id, filter_info=filter_str,
+                            field_names=REPORT_FIELDS["calculate_tax"]["日常台账表"])
     
-    total_income_ticket = 0.0 # 有票收入
-    total_cost_ticket = 0.0   # 有票成本
-    total_cost_no_ticket = 0.0 # 无票成本 (总)
+    amount = df["实际收付金额"]
+    has_ticket = df["是否有票"] == "有票"
+    bank = df["交易银行"].astype(str)
+    is_g_bank = bank.str.contains("G银行|对公")
+    is_n_bank = bank.str.contains("N银行|现金|私户")
+    is_income = df["业务类型"] == "收款"
+    is_cost = df["业务类型"].isin(["付款", "费用"])
     
-    # 细分风险统计
-    g_bank_no_ticket = 0.0   # G银行(对公)无票支出 -> 高风险
-    n_bank_flow = 0.0        # N银行(私户)流水总额 -> 私户避税风险
+    total_income_ticket = float(amount[is_income & has_ticket].sum()) # 有票收入
+    total_cost_ticket = float(amount[is_cost & has_ticket].sum())     # 有票成本
+    total_cost_no_ticket = float(amount[is_cost & ~has_ticket].sum()) # 无票成本 (总)
     
-    for r in records:
-        fields = r.fields
-        has_ticket = fields.get("是否有票") == "有票"
-        bank = str(fields.get("交易银行", ""))
-        is_g_bank = "G银行" in bank or "对公" in bank
-        is_n_bank = "N银行" in bank or "现金" in bank or "私户" in bank
-        
-        biz_type = fields.get("业务类型")
-        amount = float(fields.get("实际收付金额", 0))
-        
-        if biz_type == "收款":
-            if has_ticket:
-                total_income_ticket += amount
-            if is_n_bank:
-                n_bank_flow += amount
-        elif biz_type == "付款" or biz_type == "费用":
-            if has_ticket:
-                total_cost_ticket += amount
-            else:
-                total_cost_no_ticket += amount
-                if is_g_bank:
-                    g_bank_no_ticket += amount
-            
-            if is_n_bank:
-                n_bank_flow += abs(amount)
+    # 细分风险统计
+    g_bank_no_ticket = float(amount[is_cost & ~has_ticket & is_g_bank].sum()) # G银行(对公)无票支出 -> 高风险
+    n_bank_flow = float(amount[is_income & is_n_bank].sum() + amount[is_cost & is_n_bank].abs().sum()) # N银行(私户)流水总额 -> 私户避税风险
                 
     # 计算
     vat_rate = VAT_RATE / 100.0
@@ -2699,6 +6404,7 @@ def resolve_missing_tickets(client, app_token, missing_list, table_id):
                     .build()
                     
                 resp = client.bitable.v1.app_table_record.update(req)
+                note_record_write(table_id)
                 if resp.success():
                     print("✅ 已更新为 [有票]")
                     count += 1
@@ -2710,6 +6416,64 @@ def resolve_missing_tickets(client, app_token, missing_list, table_id):
     print(f"\n🎉 补录完成！共更新 {count} 条记录。")
 
 
+DASHBOARD_REPORT_CSS = """
+body { font-family: 'Segoe UI', sans-serif; background: #f5f6fa; padding: 20px; }
+.container { max-width: 1200px; margin: 0 auto; }
+.card { background: white; border-radius: 8px; padding: 20px; margin-bottom: 20px; box-shadow: 0 2px 5px rgba(0,0,0,0.05); }
+h1 { color: #2c3e50; text-align: center; }
+.summary { display: flex; justify-content: space-around; margin-bottom: 20px; }
+.stat-box { text-align: center; padding: 15px; background: #fff; border-radius: 8px; flex: 1; margin: 0 10px; box-shadow: 0 2px 5px rgba(0,0,0,0.05); }
+.stat-value { font-size: 24px; font-weight: bold; color: #3498db; }
+.stat-label { color: #7f8c8d; font-size: 14px; }
+#main-chart { width: 100%; height: 500px; }
+#pie-chart { width: 100%; height: 400px; }
+.row { display: flex; gap: 20px; }
+.col-8 { flex: 2; }
+.col-4 { flex: 1; }
+"""
+
+DASHBOARD_REPORT_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="utf-8">
+    <title>财务经营分析仪表盘</title>
+    <script src="https://cdn.jsdelivr.net/npm/echarts@5.4.3/dist/echarts.min.js"></script>
+    <script src="report_assets/report_charts.js"></script>
+    <link rel="stylesheet" href="report_assets/dashboard.css">
+</head>
+<body>
+    <div class="container">
+        <h1>📊 {{ year }}年度财务经营分析</h1>
+
+        <div class="summary">
+            <div class="stat-box">
+                <div class="stat-value">¥ {{ income:,.2f }}</div>
+                <div class="stat-label">年度总收入</div>
+            </div>
+            <div class="stat-box">
+                <div class="stat-value" style="color: #e74c3c">¥ {{ expense:,.2f }}</div>
+                <div class="stat-label">年度总支出</div>
+            </div>
+            <div class="stat-box">
+                <div class="stat-value" style="color: #27ae60">¥ {{ profit:,.2f }}</div>
+                <div class="stat-label">年度净利润</div>
+            </div>
+        </div>
+
+        <div class="row">
+            <div class="card col-8">
+                <div id="main-chart"></div>
+            </div>
+            <div class="card col-4">
+                <div id="pie-chart"></div>
+            </div>
+        </div>
+        <script>cwDashboardCharts({{ charts|raw }});</script>
+    </div>
+</body>
+</html>
+"""
+
 # 生成HTML可视化报表
 @retry_on_failure(max_retries=2, delay=3)
 def generate_html_report(client, app_token, target_year=None):
@@ -2724,176 +6488,39 @@ def generate_html_report(client, app_token, target_year=None):
     if not table_id:
         return False
         
-    # 获取指定年度数据
-    start_ts = int(datetime(year, 1, 1).timestamp() * 1000)
-    end_ts = int(datetime(year + 1, 1, 1).timestamp() * 1000)
-    filter_str = f'AND(CurrentValue.[记账日期]>={start_ts}, CurrentValue.[记账日期]<{end_ts})'
-    records = get_all_records(client, app_token, table_id, filter_info=filter_str)
-    
-    # 数据处理
-    monthly_data = {} # month -> {income, expense, profit}
-    
-    for r in records:
-        fields = r.fields
-        r_date = fields.get("记账日期")
-        if not r_date: continue
-        
-        if isinstance(r_date, int):
-            date_obj = datetime.fromtimestamp(r_date / 1000)
-        else:
-            try:
-                date_obj = datetime.strptime(str(r_date).split(" ")[0], "%Y-%m-%d")
-            except: continue
-            
-        month_key = date_obj.strftime("%Y-%m")
-        if month_key not in monthly_data:
-            monthly_data[month_key] = {"income": 0, "expense": 0}
-            
-        amount = float(fields.get("实际收付金额", 0))
-        biz_type = fields.get("业务类型")
-        
-        if biz_type == "收款":
-            monthly_data[month_key]["income"] += amount
-        elif biz_type == "付款" or biz_type == "费用":
-            monthly_data[month_key]["expense"] += amount
+    # 指定年度的损益立方体 (已结账月份取缓存)
+    cube = load_pnl_cube(client, app_token, table_id, datetime(year, 1, 1), datetime(year + 1, 1, 1))
+    income_by_month = pnl_sum(cube, "月份", kind="收入")
+    expense_by_month = pnl_sum(cube, "月份", kind="支出")
             
     # 生成HTML
-    months = sorted(monthly_data.keys())
-    incomes = [round(monthly_data[m]["income"], 2) for m in months]
-    expenses = [round(monthly_data[m]["expense"], 2) for m in months]
-    profits = [round(monthly_data[m]["income"] - monthly_data[m]["expense"], 2) for m in months]
+    months = sorted(cube["月份"].unique())
+    incomes = [round(float(income_by_month.get(m, 0)), 2) for m in months]
+    expenses = [round(float(expense_by_month.get(m, 0)), 2) for m in months]
+    profits = [round(float(income_by_month.get(m, 0)) - float(expense_by_month.get(m, 0)), 2) for m in months]
     
     # 风险/合规数据
     total_cost = sum(expenses)
-    total_cost_ticket = 0
-    total_cost_no_ticket = 0
-    
-    for r in records:
-        fields = r.fields
-        biz_type = fields.get("业务类型")
-        if biz_type in ["付款", "费用"]:
-            amount = float(fields.get("实际收付金额", 0))
-            if fields.get("是否有票") == "有票":
-                total_cost_ticket += amount
-            else:
-                total_cost_no_ticket += amount
+    cost_by_ticket = pnl_sum(cube, "是否有票", kind="支出")
+    total_cost_ticket = float(cost_by_ticket.get("有票", 0))
+    total_cost_no_ticket = float(cost_by_ticket.sum()) - total_cost_ticket
                 
     compliance_data = [
         {"value": round(total_cost_ticket, 2), "name": "有票成本 (合规)"},
         {"value": round(total_cost_no_ticket, 2), "name": "无票成本 (风险)"}
     ]
     
-    html_content = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="utf-8">
-        <title>财务经营分析仪表盘</title>
-        <script src="https://cdn.jsdelivr.net/npm/echarts@5.4.3/dist/echarts.min.js"></script>
-        <style>
-            body {{ font-family: 'Segoe UI', sans-serif; background: #f5f6fa; padding: 20px; }}
-            .container {{ max-width: 1200px; margin: 0 auto; }}
-            .card {{ background: white; border-radius: 8px; padding: 20px; margin-bottom: 20px; box-shadow: 0 2px 5px rgba(0,0,0,0.05); }}
-            h1 {{ color: #2c3e50; text-align: center; }}
-            .summary {{ display: flex; justify-content: space-around; margin-bottom: 20px; }}
-            .stat-box {{ text-align: center; padding: 15px; background: #fff; border-radius: 8px; flex: 1; margin: 0 10px; box-shadow: 0 2px 5px rgba(0,0,0,0.05); }}
-            .stat-value {{ font-size: 24px; font-weight: bold; color: #3498db; }}
-            .stat-label {{ color: #7f8c8d; font-size: 14px; }}
-            #main-chart {{ width: 100%; height: 500px; }}
-            #pie-chart {{ width: 100%; height: 400px; }}
-            .row {{ display: flex; gap: 20px; }}
-            .col-8 {{ flex: 2; }}
-            .col-4 {{ flex: 1; }}
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <h1>📊 {year}年度财务经营分析</h1>
-            
-            <div class="summary">
-                <div class="stat-box">
-                    <div class="stat-value">¥ {sum(incomes):,.2f}</div>
-                    <div class="stat-label">年度总收入</div>
-                </div>
-                <div class="stat-box">
-                    <div class="stat-value" style="color: #e74c3c">¥ {sum(expenses):,.2f}</div>
-                    <div class="stat-label">年度总支出</div>
-                </div>
-                <div class="stat-box">
-                    <div class="stat-value" style="color: #27ae60">¥ {sum(profits):,.2f}</div>
-                    <div class="stat-label">年度净利润</div>
-                </div>
-            </div>
-            
-            <div class="row">
-                <div class="card col-8">
-                    <div id="main-chart"></div>
-                </div>
-                <div class="card col-4">
-                    <div id="pie-chart"></div>
-                </div>
-            </div>
-            
-            <script>
-                var chartDom = document.getElementById('main-chart');
-                var myChart = echarts.init(chartDom);
-                var option;
-
-                option = {{
-                    title: {{ text: '月度收支趋势图' }},
-                    tooltip: {{ trigger: 'axis' }},
-                    legend: {{ data: ['收入', '支出', '利润'] }},
-                    grid: {{ left: '3%', right: '4%', bottom: '3%', containLabel: true }},
-                    xAxis: {{ type: 'category', boundaryGap: false, data: {months} }},
-                    yAxis: {{ type: 'value' }},
-                    series: [
-                        {{ name: '收入', type: 'line', stack: 'Total', areaStyle: {{}}, data: {incomes}, itemStyle: {{ color: '#3498db' }} }},
-                        {{ name: '支出', type: 'line', stack: 'Total', areaStyle: {{}}, data: {expenses}, itemStyle: {{ color: '#e74c3c' }} }},
-                        {{ name: '利润', type: 'bar', data: {profits}, itemStyle: {{ color: '#27ae60' }} }}
-                    ]
-                }};
-                option && myChart.setOption(option);
-                
-                // 饼图
-                var pieDom = document.getElementById('pie-chart');
-                var pieChart = echarts.init(pieDom);
-                var pieOption = {{
-                    title: {{ text: '成本合规性分析', subtext: '有票 vs 无票', left: 'center' }},
-                    tooltip: {{ trigger: 'item' }},
-                    legend: {{ orient: 'vertical', left: 'left' }},
-                    series: [
-                        {{
-                            name: '成本构成',
-                            type: 'pie',
-                            radius: '50%',
-                            data: {compliance_data},
-                            emphasis: {{
-                                itemStyle: {{
-                                    shadowBlur: 10,
-                                    shadowOffsetX: 0,
-                                    shadowColor: 'rgba(0, 0, 0, 0.5)'
-                                }}
-                            }},
-                            itemStyle: {{
-                                color: function(params) {{
-                                    var colorList = ['#27ae60', '#e74c3c'];
-                                    return colorList[params.dataIndex];
-                                }}
-                            }}
-                        }}
-                    ]
-                }};
-                pieOption && pieChart.setOption(pieOption);
-            </script>
-        </div>
-    </body>
-    </html>
-    """
-    
+    ensure_report_assets(LOCAL_FOLDER, {"dashboard.css": DASHBOARD_REPORT_CSS, "report_charts.js": REPORT_CHARTS_JS})
     filename = f"财务分析报表_{datetime.now().strftime('%Y%m%d')}.html"
     filepath = os.path.join(LOCAL_FOLDER, filename)
-    with open(filepath, "w", encoding="utf-8") as f:
-        f.write(html_content)
+    write_report(filepath, report_template("dashboard", DASHBOARD_REPORT_PAGE), {
+        "year": year,
+        "income": sum(incomes),
+        "expense": sum(expenses),
+        "profit": sum(profits),
+        "charts": template_json({"months": [str(m) for m in months], "incomes": incomes, "expenses": expenses,
+                                 "profits": profits, "compliance": compliance_data}),
+    })
         
     log.info(f"✅ 报表已生成: {filepath}", extra={"solution": "双击打开HTML文件"})
     # 尝试自动打开
@@ -2905,9 +6532,196 @@ def generate_html_report(client, app_token, target_year=None):
     return True
 
 # 导出备份
+EXPORT_STREAMING = os.getenv("EXPORT_STREAMING", "true").lower() == "true" # 流式写入 (xlsxwriter constant_memory)
+EXPORT_PAGE_SIZE = 500 # 流式导出时每批写入的记录数
+EXPORT_WORKERS = 5 # 并行拉取的表数
+
+def export_cell_value(v):
+    """字段值 -> 单元格值：毫秒时间戳转为日期文本，列表/对象等转为文本"""
+    if isinstance(v, int) and v > 1000000000000: # 简单判断毫秒时间戳
+        try:
+            return datetime.fromtimestamp(v / 1000).strftime("%Y-%m-%d %H:%M:%S")
+        except (OverflowError, OSError, ValueError):
+            return v
+    if v is None or isinstance(v, (str, int, float)):
+        return v
+    return str(v)
+
+def export_formats(workbook):
+    return {
+        "header": workbook.add_format({
+            'bold': True,
+            'text_wrap': False,
+            'valign': 'top',
+            'fg_color': '#D7E4BC', # 浅绿背景
+            'border': 1
+        }),
+        "data": workbook.add_format({'border': 1}),
+        "date": workbook.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss', 'border': 1}),
+        "num": workbook.add_format({'num_format': '#,##0.00', 'border': 1}), # 千分位
+    }
+
+def set_export_columns(worksheet, columns, samples, formats):
+    """按列名与采样值设置列宽和列格式 (每列只设置一次)"""
+    for i, col in enumerate(columns):
+        # 检查列名长度
+        max_len = len(str(col)) * 2
+        # 检查数据长度 (取前50行采样，避免太慢)
+        for v in samples[i][:50]:
+            l = len(v)
+            # 中文占2字符简单估算
+            utf8_len = len(v.encode('utf-8'))
+            max_len = max(max_len, (utf8_len - l) / 2 + l)
+            
+        # 限制最大宽度
+        final_width = min(max_len + 2, 50)
+        # 针对特定列应用特定格式
+        if '金额' in str(col) or '单价' in str(col) or '原值' in str(col):
+            worksheet.set_column(i, i, final_width, formats["num"])
+        elif '日期' in str(col) or '时间' in str(col):
+            worksheet.set_column(i, i, 20, formats["date"]) # 日期固定宽一点
+        else:
+            worksheet.set_column(i, i, final_width, formats["data"])
+
+def export_sheet_names(tables):
+    names = []
+    for table in tables:
+        # Excel Sheet 名字不能超过31个字符
+        safe_name = table.name[:30]
+        # 处理重名Sheet (极其罕见)
+        if safe_name in names:
+            safe_name = table.name[:25] + "_1"
+        names.append(safe_name)
+    return names
+
+def write_export_page(sheet, page, schema, formats):
+    """把一页记录追加到工作表；首页时确定列 (首页出现的字段 + 表结构中的其余字段) 并写表头与列格式"""
+    ws = sheet["ws"]
+    if sheet["columns"] is None:
+        columns = list(dict.fromkeys(k for fields in page for k in fields))
+        columns += [name for name in schema if name not in columns]
+        sheet["columns"] = columns
+        for col_num, value in enumerate(columns):
+            ws.write(0, col_num, value, formats["header"])
+        samples = [[str(export_cell_value(fields.get(col, ""))) for fields in page[:50]] for col in columns]
+        set_export_columns(ws, columns, samples, formats)
+        sheet["row"] = 1
+    columns = sheet["columns"]
+    index = sheet.setdefault("index", {c: i for i, c in enumerate(columns)})
+    for fields in page:
+        for k, v in fields.items():
+            col = index.get(k)
+            if col is None:
+                # 表结构读取失败时才会出现：追加到最右侧 (表头已写出，无法补写)
+                col = index[k] = len(columns)
+                columns.append(k)
+                log.warning(f"⚠️ 表 {sheet['name']} 出现新字段 {k}，已追加到最后一列", extra={"solution": "无"})
+            value = export_cell_value(v)
+            if value is not None:
+                ws.write(sheet["row"], col, value)
+        sheet["row"] += 1
+
+def export_tables_streaming(client, app_token, tables, backup_path):
+    """
+    流式备份：各表并行拉取，每 EXPORT_PAGE_SIZE 条一批交给写入线程，
+    xlsxwriter constant_memory 模式逐行落盘，内存中每张表至多保留一批数据
+    """
+    workbook = xlsxwriter.Workbook(backup_path, {"constant_memory": True})
+    formats = export_formats(workbook)
+    sheets = [{"name": table.name, "ws": workbook.add_worksheet(name), "columns": None, "row": 0}
+              for table, name in zip(tables, export_sheet_names(tables))] # 保持原有顺序
+    pages = queue.Queue(maxsize=EXPORT_WORKERS)
+    cancelled = threading.Event()
+
+    def put(item):
+        while not cancelled.is_set():
+            try:
+                pages.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce(idx, table):
+        try:
+            schema = [f.field_name for f in (list_table_fields(client, app_token, table.table_id) or [])]
+            records = iter_all_records(client, app_token, table.table_id)
+            while True:
+                page = [r.fields for r in itertools.islice(records, EXPORT_PAGE_SIZE)]
+                if not page:
+                    break
+                if not put(("page", idx, page, schema)):
+                    return
+            put(("done", idx, None, None))
+        except Exception as e:
+            put(("error", idx, str(e), None))
+
+    log.info(f"🚀 启动并行备份，正在同时拉取 {len(tables)} 张表...", extra={"solution": "无"})
+    try:
+        with ThreadPoolExecutor(max_workers=EXPORT_WORKERS) as executor:
+            for idx, table in enumerate(tables):
+                executor.submit(produce, idx, table)
+            remaining = len(tables)
+            try:
+                while remaining:
+                    kind, idx, payload, schema = pages.get()
+                    sheet = sheets[idx]
+                    if kind == "page":
+                        write_export_page(sheet, payload, schema, formats)
+                        continue
+                    remaining -= 1
+                    if kind == "error":
+                        log.error(f"❌ 获取表 {sheet['name']} 失败: {payload}")
+                        if sheet["row"]:
+                            sheet["ws"].write(sheet["row"], 0, f"⚠️ 数据不完整: {payload}")
+                    print(f"   ✅ 已就绪: {sheet['name']} ({max(sheet['row'] - 1, 0)} 条)")
+            finally:
+                cancelled.set() # 写入出错时让仍在拉取的线程退出
+    finally:
+        workbook.close()
+
+def export_tables_in_memory(client, app_token, tables, backup_path):
+    """整表读入 DataFrame 后统一写入 (EXPORT_STREAMING=false 时使用)"""
+    table_data_map = {}
+    
+    def fetch_table_data(table):
+        t_name = table.name
+        t_id = table.table_id
+        try:
+            # 流式拉取：边接收分页边转换，无需等待最后一页
+            clean_data = []
+            for r in iter_all_records(client, app_token, t_id):
+                clean_data.append({k: export_cell_value(v) for k, v in r.fields.items()})
+            return t_name, pd.DataFrame(clean_data)
+        except Exception as e:
+            log.error(f"❌ 获取表 {t_name} 失败: {e}")
+            return t_name, pd.DataFrame()
+
+    log.info(f"🚀 启动并行备份，正在同时拉取 {len(tables)} 张表...", extra={"solution": "无"})
+    with ThreadPoolExecutor(max_workers=EXPORT_WORKERS) as executor:
+        future_to_table = {executor.submit(fetch_table_data, t): t for t in tables}
+        for future in as_completed(future_to_table):
+            t_name, df = future.result()
+            table_data_map[t_name] = df
+            print(f"   ✅ 已就绪: {t_name} ({len(df)} 条)")
+
+    log.info("💾 正在写入Excel文件...", extra={"solution": "无"})
+    # 使用 xlsxwriter 引擎以支持样式
+    with pd.ExcelWriter(backup_path, engine='xlsxwriter') as writer:
+        formats = export_formats(writer.book)
+        for table, safe_name in zip(tables, export_sheet_names(tables)):
+            df = table_data_map.get(table.name, pd.DataFrame())
+            df.to_excel(writer, sheet_name=safe_name, index=False)
+            worksheet = writer.sheets[safe_name]
+            # 应用表头格式
+            for col_num, value in enumerate(df.columns.values):
+                worksheet.write(0, col_num, value, formats["header"])
+            samples = [list(df[col].head(50).astype(str)) for col in df.columns]
+            set_export_columns(worksheet, list(df.columns), samples, formats)
+
 @retry_on_failure(max_retries=2, delay=3)
-def export_to_excel(client, app_token, target_path=None):
-    """全量备份：导出所有数据表到 Excel"""
+def export_to_excel(client, app_token, target_path=None, streaming=None):
+    """全量备份：导出所有数据表到 Excel (默认流式写入，大表不占用大量内存)"""
     log.info("💾 开始全量云端数据备份...", extra={"solution": "无"})
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     
@@ -2916,135 +6730,18 @@ def export_to_excel(client, app_token, target_path=None):
     else:
         backup_path = os.path.join(LOCAL_FOLDER, f"飞书台账全量备份_{timestamp}.xlsx")
     
-    try:
-        # 1. 获取所有数据表
-        tables = []
-        page_token = None
-        while True:
-            req = ListAppTableRequest.builder() \
-                .app_token(app_token) \
-                .page_size(20) \
-                .page_token(page_token) \
-                .build()
-            resp = client.bitable.v1.app_table.list(req)
-            if resp.success():
-                if resp.data.items:
-                    tables.extend(resp.data.items)
-                if not resp.data.has_more:
-                    break
-                page_token = resp.data.page_token
-            else:
-                log.error(f"无法获取表格列表: {resp.msg}")
-                break
+    try:
+        # 1. 获取所有数据表 (顺带刷新表名缓存)
+        tables = list_app_tables(client, app_token)
 
         if not tables:
             return False
 
-        # 2. [V9.5新特性] 并行获取数据 (Parallel Backup)
-        table_data_map = {}
-        
-        def fetch_table_data(table):
-            t_name = table.name
-            t_id = table.table_id
-            try:
-                # print(f"   ⏳ [并行] 正在拉取: {t_name}...") # 减少刷屏
-                records = get_all_records(client, app_token, t_id)
-                clean_data = []
-                if records:
-                    for r in records:
-                        row = r.fields.copy()
-                        # 转换时间戳
-                        for k, v in row.items():
-                            if isinstance(v, int) and v > 1000000000000: # 简单判断毫秒时间戳
-                                try:
-                                    row[k] = datetime.fromtimestamp(v / 1000).strftime("%Y-%m-%d %H:%M:%S")
-                                except:
-                                    pass
-                        clean_data.append(row)
-                return t_name, pd.DataFrame(clean_data)
-            except Exception as e:
-                log.error(f"❌ 获取表 {t_name} 失败: {e}")
-                return t_name, pd.DataFrame()
-
-        log.info(f"🚀 启动并行备份，正在同时拉取 {len(tables)} 张表...", extra={"solution": "无"})
-        with ThreadPoolExecutor(max_workers=5) as executor:
-            future_to_table = {executor.submit(fetch_table_data, t): t for t in tables}
-            for future in as_completed(future_to_table):
-                t_name, df = future.result()
-                table_data_map[t_name] = df
-                print(f"   ✅ 已就绪: {t_name} ({len(df)} 条)")
-
-        # 3. 写入 Excel (带美化)
-        log.info("💾 正在写入Excel文件...", extra={"solution": "无"})
-        # 使用 xlsxwriter 引擎以支持样式
-        with pd.ExcelWriter(backup_path, engine='xlsxwriter') as writer:
-            for table in tables: # 保持原有顺序
-                table_name = table.name
-                if table_name in table_data_map:
-                    df = table_data_map[table_name]
-                    # Excel Sheet 名字不能超过31个字符
-                    safe_name = table_name[:30]
-                    # 处理重名Sheet (极其罕见)
-                    if safe_name in writer.sheets:
-                        safe_name = (table_name[:25] + "_1")
-                    
-                    df.to_excel(writer, sheet_name=safe_name, index=False)
-                    
-                    # --- 美化开始 ---
-                    workbook = writer.book
-                    worksheet = writer.sheets[safe_name]
-                    
-                    # 格式定义
-                    header_fmt = workbook.add_format({
-                        'bold': True,
-                        'text_wrap': False,
-                        'valign': 'top',
-                        'fg_color': '#D7E4BC', # 浅绿背景
-                        'border': 1
-                    })
-                    data_fmt = workbook.add_format({
-                        'border': 1
-                    })
-                    date_fmt = workbook.add_format({
-                        'num_format': 'yyyy-mm-dd hh:mm:ss',
-                        'border': 1
-                    })
-                    num_fmt = workbook.add_format({
-                        'num_format': '#,##0.00', # 千分位
-                        'border': 1
-                    })
-                    
-                    # 应用表头格式
-                    for col_num, value in enumerate(df.columns.values):
-                        worksheet.write(0, col_num, value, header_fmt)
-                        
-                    # 自动调整列宽
-                    for i, col in enumerate(df.columns):
-                        max_len = 0
-                        # 检查列名长度
-                        max_len = max(max_len, len(str(col)) * 2) 
-                        # 检查数据长度 (取前50行采样，避免太慢)
-                        sample_vals = df[col].head(50).astype(str)
-                        for v in sample_vals:
-                            l = len(v)
-                            # 中文占2字符简单估算
-                            utf8_len = len(v.encode('utf-8'))
-                            display_len = (utf8_len - l)/2 + l
-                            max_len = max(max_len, display_len)
-                            
-                        # 限制最大宽度
-                        final_width = min(max_len + 2, 50) 
-                        worksheet.set_column(i, i, final_width, data_fmt)
-                        
-                        # 针对特定列应用特定格式
-                        if '金额' in str(col) or '单价' in str(col) or '原值' in str(col):
-                             worksheet.set_column(i, i, final_width, num_fmt)
-                        elif '日期' in str(col) or '时间' in str(col):
-                             worksheet.set_column(i, i, 20, date_fmt) # 日期固定宽一点
-                    # --- 美化结束 ---
-                    
-                else:
-                    pd.DataFrame().to_excel(writer, sheet_name=table_name[:30])
+        # 2. 并行拉取并写入 Excel (带美化)
+        if EXPORT_STREAMING if streaming is None else streaming:
+            export_tables_streaming(client, app_token, tables, backup_path)
+        else:
+            export_tables_in_memory(client, app_token, tables, backup_path)
 
         log.info(f"✅ 全量备份成功: {backup_path}", extra={"solution": "妥善保管"})
         if not target_path: # 如果是手动触发，发送通知
@@ -3055,7 +6752,7 @@ def export_to_excel(client, app_token, target_path=None):
         return False
 
 # 创建基础信息表
-@retry_on_failure(max_retries=2, delay=3)
+@retry_on_failure()
 def create_basic_info_table(client, app_token):
     # 先检查是否存在
     existing_id = get_table_id_by_name(client, app_token, "基础信息表")
@@ -3081,6 +6778,7 @@ def create_basic_info_table(client, app_token):
     
     resp = client.bitable.v1.app_table.create(req)
     if resp.success():
+        register_table_id(app_token, "基础信息表", resp.data.table_id)
         log.info("✅ 基础信息表创建成功", extra={"solution": "无"})
         return True, resp.data.table_id
     else:
@@ -3088,7 +6786,7 @@ def create_basic_info_table(client, app_token):
         return False, None
 
 # 创建往来单位表 (新)
-@retry_on_failure(max_retries=2, delay=3)
+@retry_on_failure()
 def create_partner_table(client, app_token):
     existing_id = get_table_id_by_name(client, app_token, "往来单位表")
     if existing_id:
@@ -3121,6 +6819,7 @@ def create_partner_table(client, app_token):
     
     resp = client.bitable.v1.app_table.create(req)
     if resp.success():
+        register_table_id(app_token, "往来单位表", resp.data.table_id)
         log.info("✅ 往来单位表创建成功", extra={"solution": "无"})
         return True, resp.data.table_id
     else:
@@ -3128,7 +6827,7 @@ def create_partner_table(client, app_token):
         return False, None
 
 # 创建发票管理表 (新)
-@retry_on_failure(max_retries=2, delay=3)
+@retry_on_failure()
 def create_invoice_table(client, app_token):
     existing_id = get_table_id_by_name(client, app_token, "发票管理表")
     if existing_id:
@@ -3168,6 +6867,7 @@ def create_invoice_table(client, app_token):
     
     resp = client.bitable.v1.app_table.create(req)
     if resp.success():
+        register_table_id(app_token, "发票管理表", resp.data.table_id)
         log.info("✅ 发票管理表创建成功", extra={"solution": "无"})
         return True, resp.data.table_id
     else:
@@ -3175,7 +6875,7 @@ def create_invoice_table(client, app_token):
         return False, None
 
 # 创建固定资产表 (新)
-@retry_on_failure(max_retries=2, delay=3)
+@retry_on_failure()
 def create_asset_table(client, app_token):
     existing_id = get_table_id_by_name(client, app_token, "固定资产表")
     if existing_id:
@@ -3214,6 +6914,7 @@ def create_asset_table(client, app_token):
     
     resp = client.bitable.v1.app_table.create(req)
     if resp.success():
+        register_table_id(app_token, "固定资产表", resp.data.table_id)
         log.info("✅ 固定资产表创建成功", extra={"solution": "无"})
         return True, resp.data.table_id
     else:
@@ -3221,7 +6922,7 @@ def create_asset_table(client, app_token):
         return False, None
 
 # 创建薪酬表 (新)
-@retry_on_failure(max_retries=2, delay=3)
+@retry_on_failure()
 def create_salary_table(client, app_token):
     existing_id = get_table_id_by_name(client, app_token, "薪酬管理表")
     if existing_id:
@@ -3257,14 +6958,54 @@ def create_salary_table(client, app_token):
     
     resp = client.bitable.v1.app_table.create(req)
     if resp.success():
+        register_table_id(app_token, "薪酬管理表", resp.data.table_id)
         log.info("✅ 薪酬管理表创建成功", extra={"solution": "无"})
         return True, resp.data.table_id
     else:
         log.error(f"❌ 薪酬管理表创建失败: {resp.msg}", extra={"solution": "检查权限"})
         return False, None
 
+# 创建月度汇总表 (月度结账写入，见 materialize_monthly_summaries)
+@retry_on_failure()
+def create_summary_table(client, app_token):
+    existing_id = get_table_id_by_name(client, app_token, SUMMARY_TABLE_NAME)
+    if existing_id:
+        return True, existing_id
+
+    req = CreateAppTableRequest.builder() \
+        .app_token(app_token) \
+        .request_body(CreateAppTableRequestBody.builder()
+            .table(ReqTable.builder()
+                .name(SUMMARY_TABLE_NAME)
+                .fields([
+                    AppTableCreateHeader.builder().field_name("月份").type(FT.TEXT).build(), # YYYY-MM
+                    AppTableCreateHeader.builder().field_name("收入").type(FT.NUMBER).build(),
+                    AppTableCreateHeader.builder().field_name("支出").type(FT.NUMBER).build(),
+                    AppTableCreateHeader.builder().field_name("笔数").type(FT.NUMBER).build(),
+                    AppTableCreateHeader.builder().field_name("汇总明细").type(FT.TEXT).build(), # 按 收支/业务类型/费用归类/交易银行/是否有票 的 JSON
+                    AppTableCreateHeader.builder().field_name("校验和").type(FT.TEXT).build(), # 源记录 条数:CRC 之和
+                    AppTableCreateHeader.builder().field_name("口径版本").type(FT.NUMBER).build(),
+                    AppTableCreateHeader.builder().field_name("状态").type(FT.SELECT).property(AppTableFieldProperty.builder().options([
+                        AppTableFieldPropertyOption.builder().name("有效").build(),
+                        AppTableFieldPropertyOption.builder().name("已失效").build()
+                    ]).build()).build(),
+                    AppTableCreateHeader.builder().field_name("结账时间").type(FT.DATE).build()
+                ])
+                .build())
+            .build()) \
+        .build()
+    
+    resp = client.bitable.v1.app_table.create(req)
+    if resp.success():
+        register_table_id(app_token, SUMMARY_TABLE_NAME, resp.data.table_id)
+        log.info(f"✅ {SUMMARY_TABLE_NAME}创建成功", extra={"solution": "无"})
+        return True, resp.data.table_id
+    else:
+        log.error(f"❌ {SUMMARY_TABLE_NAME}创建失败: {resp.msg}", extra={"solution": "检查权限"})
+        return False, None
+
 # 创建日常台账表
-@retry_on_failure(max_retries=2, delay=3)
+@retry_on_failure()
 def create_ledger_table(client, app_token):
     existing_id = get_table_id_by_name(client, app_token, "日常台账表")
     if existing_id:
@@ -3329,6 +7070,7 @@ def create_ledger_table(client, app_token):
     
     resp = client.bitable.v1.app_table.create(req)
     if resp.success():
+        register_table_id(app_token, "日常台账表", resp.data.table_id)
         log.info("✅ 日常台账表创建成功", extra={"solution": "无"})
         return True, resp.data.table_id
     else:
@@ -3359,12 +7101,7 @@ def fill_test_data(client, app_token):
             }
             records.append(AppTableRecord.builder().fields(fields).build())
         
-        req = BatchCreateAppTableRecordRequest.builder() \
-            .app_token(app_token) \
-            .table_id(table_id) \
-            .request_body(BatchCreateAppTableRecordRequestBody.builder().records(records).build()) \
-            .build()
-        client.bitable.v1.app_table_record.batch_create(req)
+        batch_write_records(client, app_token, table_id, records)
         log.info("✅ 往来单位表：已写入 5 条标准数据")
 
     # 2. 填充基础信息表
@@ -3384,12 +7121,7 @@ def fill_test_data(client, app_token):
             }
             records.append(AppTableRecord.builder().fields(fields).build())
         
-        req = BatchCreateAppTableRecordRequest.builder() \
-            .app_token(app_token) \
-            .table_id(table_id) \
-            .request_body(BatchCreateAppTableRecordRequestBody.builder().records(records).build()) \
-            .build()
-        client.bitable.v1.app_table_record.batch_create(req)
+        batch_write_records(client, app_token, table_id, records)
         log.info("✅ 基础信息表：已写入 3 条产品数据")
 
     # 3. 填充日常台账表 (生成本月真实流水的台账)
@@ -3430,12 +7162,7 @@ def fill_test_data(client, app_token):
             }
             records.append(AppTableRecord.builder().fields(fields).build())
         
-        req = BatchCreateAppTableRecordRequest.builder() \
-            .app_token(app_token) \
-            .table_id(table_id) \
-            .request_body(BatchCreateAppTableRecordRequestBody.builder().records(records).build()) \
-            .build()
-        client.bitable.v1.app_table_record.batch_create(req)
+        batch_write_records(client, app_token, table_id, records)
         log.info(f"✅ 日常台账表：已写入 {len(records)} 条演示流水")
 
     # 4. 填充发票管理表
@@ -3456,12 +7183,7 @@ def fill_test_data(client, app_token):
         }
         records.append(AppTableRecord.builder().fields(fields).build())
         
-        req = BatchCreateAppTableRecordRequest.builder() \
-            .app_token(app_token) \
-            .table_id(table_id) \
-            .request_body(BatchCreateAppTableRecordRequestBody.builder().records(records).build()) \
-            .build()
-        client.bitable.v1.app_table_record.batch_create(req)
+        batch_write_records(client, app_token, table_id, records)
         log.info("✅ 发票管理表：已写入演示发票")
 
     # 5. 填充固定资产表
@@ -3487,16 +7209,11 @@ def fill_test_data(client, app_token):
             }
             records.append(AppTableRecord.builder().fields(fields).build())
         
-        req = BatchCreateAppTableRecordRequest.builder() \
-            .app_token(app_token) \
-            .table_id(table_id) \
-            .request_body(BatchCreateAppTableRecordRequestBody.builder().records(records).build()) \
-            .build()
-        client.bitable.v1.app_table_record.batch_create(req)
+        batch_write_records(client, app_token, table_id, records)
         log.info("✅ 固定资产表：已写入演示资产")
 
 # 月度结账
-@retry_on_failure(max_retries=2, delay=3)
+@retry_on_failure()
 def monthly_close(client, app_token, ym_input=None):
     log.info("📅 开始月度结账流程...", extra={"solution": "无"})
     
@@ -3534,15 +7251,15 @@ def monthly_close(client, app_token, ym_input=None):
             target_year = today.year
 
     # 1. 自动修复缺失分类
-    print("\n[1/5] 正在检查并修复缺失分类...")
+    print("\n[1/6] 正在检查并修复缺失分类...")
     auto_fix_missing_categories(client, app_token, target_year)
     
     # 2. 导出备份
-    print("\n[2/5] 正在执行全量备份...")
+    print("\n[2/6] 正在执行全量备份...")
     backup_ok = export_to_excel(client, app_token)
     
     # 3. 生成报表
-    print("\n[3/5] 正在生成分析报表...")
+    print("\n[3/6] 正在生成分析报表...")
     report_ok = generate_html_report(client, app_token, target_year)
     
     if backup_ok and report_ok:
@@ -3550,18 +7267,31 @@ def monthly_close(client, app_token, ym_input=None):
         generate_excel_pnl_report(client, app_token, target_year, target_month)
         
         # 4. 税务测算 (一键结转增强)
-        print("\n[4/5] 正在进行税务风险测算及财务体检...")
+        print("\n[4/6] 正在进行税务风险测算及财务体检...")
         calculate_tax(client, app_token, target_year)
         financial_health_check(client, app_token, target_year)
 
         # 5. 导出标准凭证 (一键结转增强)
-        print("\n[5/5] 正在导出标准财务凭证...")
+        print("\n[5/6] 正在导出标准财务凭证...")
         export_standard_voucher(client, app_token, target_year, target_month)
         
+        # 6. 固化已结账月份的损益汇总 (附源记录校验和)，之后的年度报表直接读取
+        print("\n[6/6] 正在写入月度汇总...")
+        period_start = datetime(target_year, target_month or 1, 1)
+        period_end = next_month_start(period_start) if target_month else datetime(target_year + 1, 1, 1)
+        materialized = materialize_monthly_summaries(client, app_token, period_start, period_end)
+        if materialized is not None:
+            print(f"   新增 {len(materialized['created'])} 个月, 重新生成 {len(materialized['replaced'])} 个月, "
+                  f"未变化 {len(materialized['unchanged'])} 个月")
+        ledger_id = get_table_id_by_name(client, app_token, "日常台账表")
+        cube = load_pnl_cube(client, app_token, ledger_id, period_start, period_end) if ledger_id else empty_pnl_cube()
+        income, expense = float(pnl_sum(cube, kind="收入")), float(pnl_sum(cube, kind="支出"))
+        pnl_line = f"💰 收入 {income:,.2f} / 支出 {expense:,.2f} / 结余 {income - expense:+,.2f}"
+        
         if target_month:
-            msg = f"📅 {target_year}年{target_month}月 月度结账完成！\n✅ 数据已备份\n✅ 报表已生成\n✅ 税务已测算\n✅ 凭证已导出\n💡 请务必将本地生成的 Excel 和 HTML 文件打包存档。"
+            msg = f"📅 {target_year}年{target_month}月 月度结账完成！\n{pnl_line}\n✅ 数据已备份\n✅ 报表已生成\n✅ 税务已测算\n✅ 凭证已导出\n💡 请务必将本地生成的 Excel 和 HTML 文件打包存档。"
         else:
-            msg = f"🏆 {target_year}年度 年结完成！\n✅ 全年数据已备份\n✅ 年度报表已生成\n✅ 年度税务测算完成\n✅ 全年凭证已导出\n💡 请务必将本地生成的 Excel 和 HTML 文件打包存档。"
+            msg = f"🏆 {target_year}年度 年结完成！\n{pnl_line}\n✅ 全年数据已备份\n✅ 年度报表已生成\n✅ 年度税务测算完成\n✅ 全年凭证已导出\n💡 请务必将本地生成的 Excel 和 HTML 文件打包存档。"
             
         log.info("✅ 结账流程结束", extra={"solution": "存档"})
         send_bot_message(msg, "accountant")
@@ -3680,69 +7410,51 @@ def generate_excel_pnl_report(client, app_token, target_year=None, target_month=
             log.error(f"日期计算错误: {e}")
             return False
 
-    records = get_all_records(client, app_token, table_id, filter_info=filter_str)
-    if not records:
+    df = load_records_frame(
+        client, app_token, table_id, filter_info=filter_str,
+        field_names=["记账日期", "业务类型", "往来单位费用", "费用归类", "实际收付金额", "是否有票"],
+        defaults={**PNL_CUBE_DEFAULTS, "往来单位费用": ""}
+    )
+    if df.empty:
         log.warning("⚠️ 该期间无数据，跳过生成利润表")
         return False
         
-    data = []
-    for r in records:
-        fields = r.fields
-        data.append({
-            "记账日期": datetime.fromtimestamp(fields.get("记账日期", 0)/1000).strftime('%Y-%m-%d') if fields.get("记账日期") else "",
-            "业务类型": fields.get("业务类型", ""),
-            "往来单位费用": fields.get("往来单位费用", ""),
-            "费用归类": fields.get("费用归类", "其他"),
-            "实际收付金额": float(fields.get("实际收付金额", 0)),
-            "是否有票": fields.get("是否有票", "无票")
-        })
-        
-    df = pd.DataFrame(data)
+    # 收入/成本/科目/月度趋势取自损益立方体；往来单位不在立方体维度中，单独汇总
+    cube = build_pnl_cube(df)
+    # 底稿中日期保持 YYYY-MM-DD 文本
+    df["记账日期"] = df["记账日期"].dt.strftime('%Y-%m-%d').fillna("")
+    df = df.reset_index(drop=True)
     
     # 简单的利润表逻辑
-    income = df[df["业务类型"] == "收款"]["实际收付金额"].sum()
-    cost = df[df["业务类型"].isin(["付款", "费用"])]["实际收付金额"].sum()
+    is_cost = df["业务类型"].isin(PNL_EXPENSE_TYPES)
+    income = float(pnl_sum(cube, kind="收入"))
+    cost = float(pnl_sum(cube, kind="支出"))
     gross_profit = income - cost
+    expense_df = df[is_cost]
     
     # 按费用分类汇总 (往来单位)
     partner_summary = pd.DataFrame()
-    if not df[df["业务类型"].isin(["付款", "费用"])].empty:
-        partner_summary = df[df["业务类型"].isin(["付款", "费用"])].groupby("往来单位费用")["实际收付金额"].sum().reset_index()
+    if not expense_df.empty:
+        partner_summary = expense_df.groupby("往来单位费用", observed=True)["实际收付金额"].sum().reset_index()
         partner_summary.columns = ["往来单位", "金额"]
         partner_summary = partner_summary.sort_values(by="金额", ascending=False)
     
     # 按费用分类汇总 (费用归类)
     category_summary = pd.DataFrame()
-    if not df[df["业务类型"].isin(["付款", "费用"])].empty:
-        category_summary = df[df["业务类型"].isin(["付款", "费用"])].groupby("费用归类")["实际收付金额"].sum().reset_index()
+    if not expense_df.empty:
+        category_summary = pnl_sum(cube, "费用归类", kind="支出").reset_index()
         category_summary.columns = ["费用科目", "金额"]
         category_summary = category_summary.sort_values(by="金额", ascending=False)
     
     # 月度趋势 (仅在年度报表时生成)
     monthly_trend = pd.DataFrame()
-    if not target_month and not df.empty:
+    if not target_month and not expense_df.empty:
         try:
-            # Extract month from date
-            df['Month'] = df['记账日期'].apply(lambda x: x[:7] if x else '') # YYYY-MM
-            expense_df = df[df["业务类型"].isin(["付款", "费用"])]
-            if not expense_df.empty:
-                monthly_trend = expense_df.pivot_table(
-                    index='费用归类', 
-                    columns='Month', 
-                    values='实际收付金额', 
-                    aggfunc='sum', 
-                    fill_value=0
-                )
-                
-                # 按总金额排序 (降序)
-                # 计算每行的总和
-                monthly_trend['Total'] = monthly_trend.sum(axis=1)
-                # 排序
-                monthly_trend = monthly_trend.sort_values(by='Total', ascending=False)
-                # 移除 Total 列，避免写入 Excel 时重复
-                monthly_trend = monthly_trend.drop(columns=['Total'])
-                
-                monthly_trend = monthly_trend.reset_index()
+            monthly_trend = pnl_sum(cube, ["费用归类", "月份"], kind="支出").unstack("月份", fill_value=0)
+            # 按总金额排序 (降序)
+            monthly_trend = monthly_trend.loc[monthly_trend.sum(axis=1).sort_values(ascending=False).index]
+            monthly_trend.columns.name = None
+            monthly_trend = monthly_trend.reset_index()
         except Exception as e:
             log.warning(f"生成月度趋势失败: {e}")
 
@@ -3861,7 +7573,7 @@ def restore_from_backup():
         sys.exit(0)
 
 # 每日简报 (老板看板)
-@retry_on_failure(max_retries=2, delay=3)
+@retry_on_failure()
 def draw_ascii_bar_chart(data, title="统计图表"):
     """在终端绘制简单的ASCII柱状图"""
     if not data: return
@@ -4049,7 +7761,7 @@ def daily_briefing(client, app_token):
     # AI 点评 (如果有Key)
     if ZHIPUAI_API_KEY and today_tx_count > 0:
         try:
-            client_ai = ZhipuAI(api_key=ZHIPUAI_API_KEY)
+            client_ai = guard_ai_client(ZhipuAI(api_key=ZHIPUAI_API_KEY))
             prompt = f"今日公司收入{today_income}，支出{today_cost}。请用一句话给老板汇报，语气积极。"
             resp = client_ai.chat.completions.create(model="glm-4-flash", messages=[{"role": "user", "content": prompt}])
             ai_msg = resp.choices[0].message.content.strip()
@@ -4199,41 +7911,145 @@ def ai_data_query(client, app_token):
         except Exception as e:
             log.error(f"AI 响应失败: {e}")
 
-def check_duplicate(client, app_token, table_id, amount, date_str, partner, summary):
-    """检查是否存在重复记录 (最近7天，金额相同，摘要相似)"""
-    try:
-        # 获取最近记录
-        records = get_all_records(client, app_token, table_id, field_names=["记账日期", "实际收付金额", "备注", "往来单位费用"])
-        
-        target_date = datetime.strptime(date_str, "%Y-%m-%d")
-        target_amount = float(amount)
-        
-        for r in records:
-            f = r.fields
-            try:
-                r_date = datetime.fromtimestamp(f.get("记账日期", 0) / 1000)
-                r_amount = float(f.get("实际收付金额", 0))
-                r_partner = str(f.get("往来单位费用", ""))
-                r_summary = str(f.get("备注", ""))
-                
-                # 规则1: 金额必须完全相同
-                if abs(r_amount - target_amount) > 0.01:
-                    continue
-                    
-                # 规则2: 日期在前后3天内
-                if abs((r_date - target_date).days) > 3:
+# -------------------------- 重复录入检测索引 --------------------------
+# 每次录入前的查重原先都要整表下载台账再逐条比对。这里按表维护一个进程内索引：
+# 金额(分) -> 按日期排序的记录，首次使用时从本地副本/会话快照构建一次，之后随每次写入增量更新
+DUP_CHECK_DAYS = 3 # 前后几天内的同金额记录视为疑似重复
+DUP_INDEX_FIELDS = ["记账日期", "实际收付金额", "备注", "往来单位费用"]
+DUP_TEXT_RE = re.compile(r"[\s,，.。:：;；!！?？、/\\|()（）\[\]【】\-_'\"“”‘’]+")
+DUPLICATE_INDEXES = {} # table_id -> DuplicateIndex
+
+def dup_text(value):
+    """查重用的归一化文本：去掉空白和常见标点，英文转小写"""
+    return DUP_TEXT_RE.sub("", str(value or "")).lower()
+
+class DuplicateIndex:
+    """
+    台账查重索引
+    buckets: 金额(分) -> 按日期序数排序的 [(日期序数, 记录ID)]，日期无法识别的记为 0
+    entries: 记录ID -> (金额(分), 日期序数, 金额, 往来单位, 摘要, 归一化往来单位, 归一化摘要)
+    """
+    def __init__(self, records=None):
+        self.buckets = {}
+        self.entries = {}
+        self.stale = False
+        self.lock = threading.RLock()
+        for r in records or []:
+            rid, fields, _ = record_to_parts(r)
+            self.add(rid, fields)
+
+    @staticmethod
+    def record_day(ts):
+        try:
+            return datetime.fromtimestamp(float(ts) / 1000).toordinal()
+        except (TypeError, ValueError, OverflowError, OSError):
+            return 0
+
+    def add(self, record_id, fields):
+        """新增或覆盖一条记录"""
+        try:
+            amount = float(fields.get("实际收付金额", 0))
+        except (TypeError, ValueError):
+            self.remove(record_id)
+            return
+        partner = str(fields.get("往来单位费用") or "")
+        summary = str(fields.get("备注") or "")
+        cents = int(round(amount * 100))
+        day = self.record_day(fields.get("记账日期", 0))
+        with self.lock:
+            self.remove(record_id)
+            bisect.insort(self.buckets.setdefault(cents, []), (day, record_id))
+            self.entries[record_id] = (cents, day, amount, partner, summary, dup_text(partner), dup_text(summary))
+
+    def remove(self, record_id):
+        with self.lock:
+            entry = self.entries.pop(record_id, None)
+            if entry:
+                bucket = self.buckets[entry[0]]
+                bucket.remove((entry[1], record_id))
+                if not bucket:
+                    del self.buckets[entry[0]]
+
+    def update(self, record_id, fields):
+        """部分字段更新：与已有字段合并后重新索引 (未收录的记录按新增处理)"""
+        with self.lock:
+            entry = self.entries.get(record_id)
+            if entry:
+                merged = {"实际收付金额": entry[2], "往来单位费用": entry[3], "备注": entry[4]}
+                merged.update(fields)
+                if "记账日期" not in fields:
+                    merged["记账日期"] = int(datetime.fromordinal(entry[1]).timestamp() * 1000) if entry[1] else 0
+                fields = merged
+            self.add(record_id, fields)
+
+    def near(self, amount, day, days=DUP_CHECK_DAYS):
+        """金额相差不超过 0.01、日期相差不超过 days 天的记录ID (按日期排序)"""
+        cents = int(round(float(amount) * 100))
+        hits = []
+        with self.lock:
+            for key in (cents - 1, cents, cents + 1):
+                bucket = self.buckets.get(key)
+                if not bucket:
                     continue
-                    
-                # 规则3: 往来单位或摘要高度相似
-                if partner and partner in r_partner:
-                    return True, f"发现相似记录: {r_date.strftime('%Y-%m-%d')} {r_amount} {r_summary}"
-                if summary and summary[:5] in r_summary:
-                    return True, f"发现相似记录: {r_date.strftime('%Y-%m-%d')} {r_amount} {r_summary}"
-                    
-            except:
-                continue
-                
+                lo = bisect.bisect_left(bucket, (day - days, ""))
+                for d, rid in bucket[lo:]:
+                    if d > day + days:
+                        break
+                    if abs(self.entries[rid][2] - float(amount)) <= 0.01:
+                        hits.append((d, rid))
+        return [rid for _, rid in sorted(hits)]
+
+    def find_similar(self, amount, day, partner, summary):
+        """同金额、日期相近，且往来单位或摘要相似的记录 -> (是否重复, 提示)"""
+        partner_key = dup_text(partner)
+        summary_key = dup_text(summary)[:5]
+        for rid in self.near(amount, day):
+            _, r_day, r_amount, _, r_summary, r_partner_key, r_summary_key = self.entries[rid]
+            if (partner_key and partner_key in r_partner_key) or (summary_key and summary_key in r_summary_key):
+                date_text = datetime.fromordinal(r_day).strftime('%Y-%m-%d') if r_day else "未知日期"
+                return True, f"发现相似记录: {date_text} {r_amount} {r_summary}"
         return False, ""
+
+    def find_exact(self, amount, day, partner):
+        """同一天、同金额、同往来单位的已收录记录ID (用于体检中的重复录入检测)"""
+        for rid in self.near(amount, day, days=0):
+            entry = self.entries[rid]
+            if entry[1] == day and entry[2] == float(amount) and entry[3] == str(partner or ""):
+                return rid
+        return None
+
+    def apply_write(self, action, items, result):
+        """把 batch_write_records 的成功结果合并进索引"""
+        for item, res in zip(items, result.results):
+            if not (res and res["ok"]):
+                continue
+            rid = res["record_id"]
+            if action == "delete":
+                self.remove(rid)
+            elif not rid:
+                self.stale = True
+            elif action == "update":
+                self.update(rid, record_to_parts(item)[1])
+            else:
+                self.add(rid, record_to_parts(item)[1])
+
+def duplicate_index(client, app_token, table_id):
+    """取该表的查重索引，尚未构建或已失效时从本地副本/会话快照构建"""
+    index = DUPLICATE_INDEXES.get(table_id)
+    if index is not None and not index.stale and LOCAL_REPLICA_ENABLED and client is not None:
+        # 增量同步把其他人录入的记录并入索引 (全量同步时索引被标记失效)
+        LOCAL_REPLICA.refresh(client, app_token, table_id)
+    if index is None or index.stale:
+        index = DuplicateIndex(iter_all_records(client, app_token, table_id, field_names=DUP_INDEX_FIELDS))
+        DUPLICATE_INDEXES[table_id] = index
+    return index
+
+def check_duplicate(client, app_token, table_id, amount, date_str, partner, summary):
+    """检查是否存在重复记录 (前后3天内金额相同，且往来单位或摘要相似)"""
+    try:
+        index = duplicate_index(client, app_token, table_id)
+        target_day = datetime.strptime(date_str, "%Y-%m-%d").toordinal()
+        return index.find_similar(float(amount), target_day, partner, summary)
     except Exception as e:
         log.warning(f"查重失败: {e}")
         return False, ""
@@ -4385,6 +8201,7 @@ def smart_text_entry(client, app_token):
                 .build()
             
             resp = client.bitable.v1.app_table_record.create(req)
+            note_record_write(table_id, created=(resp.data.record.record_id, fields) if resp.success() else None)
             if resp.success():
                 print("✅ 录入成功！")
                 send_bot_message(f"✅ AI 文本录入成功: {data.get('summary')} - {data.get('amount')}元", "accountant")
@@ -4603,6 +8420,7 @@ def smart_image_entry(client, app_token, file_path=None, auto_confirm=False):
             .build()
         
         resp = client.bitable.v1.app_table_record.create(req)
+        note_record_write(table_id, created=(resp.data.record.record_id, fields) if resp.success() else None)
         if resp.success():
             print("✅ 录入成功！")
             send_bot_message(f"✅ AI 截图录入成功: {data.get('summary')} - {data.get('amount')}元", "accountant")
@@ -4705,6 +8523,7 @@ def learn_category_rules(client, app_token):
             rules[k] = v
             AUTO_CATEGORY_RULES[k] = v # 更新内存
             count += 1
+        rebuild_keyword_matchers()
             
         with open(FILE_CATEGORY_RULES, "w", encoding="utf-8") as f:
             json.dump(rules, f, ensure_ascii=False, indent=4)
@@ -4858,6 +8677,7 @@ def manage_partners_flow(client, app_token):
                 .build()
                 
             resp = client.bitable.v1.app_table_record.batch_create(req)
+            note_record_write(table_id)
             if resp.success():
                 print(f"{Color.OKGREEN}✅ 添加成功: {name} ({type_str}){Color.ENDC}")
             else:
@@ -4907,6 +8727,7 @@ def manage_aliases():
             if not real_name: continue
             
             PARTNER_ALIASES[alias] = real_name
+            rebuild_keyword_matchers()
             
             # 保存
             try:
@@ -4920,6 +8741,7 @@ def manage_aliases():
             alias = input("请输入要删除的别名: ").strip()
             if alias in PARTNER_ALIASES:
                 del PARTNER_ALIASES[alias]
+                rebuild_keyword_matchers()
                 # 保存
                 try:
                     with open(FILE_PARTNER_ALIASES, "w", encoding="utf-8") as f:
@@ -4959,6 +8781,7 @@ def manage_aliases():
                         if alias and real:
                             PARTNER_ALIASES[alias] = real
                             count += 1
+            rebuild_keyword_matchers()
             
             if count > 0:
                 # Save
@@ -5011,6 +8834,7 @@ def manage_aliases():
                     if a and r and a != "nan" and r != "nan":
                         PARTNER_ALIASES[a] = r
                         count += 1
+                rebuild_keyword_matchers()
                         
                 if count > 0:
                      # Save
@@ -5482,21 +9306,9 @@ def calculate_depreciation(client, app_token, auto_run=False, target_year=None,
         
     if confirm == 'y':
         # 批量写入
-        batch_size = 100
-        for i in range(0, len(depreciation_entries), batch_size):
-            batch = depreciation_entries[i:i+batch_size]
-            
-            # Convert dicts to AppTableRecord
-            record_objects = [AppTableRecord.builder().fields(entry).build() for entry in batch]
-            
-            req = BatchCreateAppTableRecordRequest.builder() \
-                .app_token(app_token) \
-                .table_id(ledger_table_id) \
-                .request_body(BatchCreateAppTableRecordRequestBody.builder().records(record_objects).build()) \
-                .build()
-            resp = client.bitable.v1.app_table_record.batch_create(req)
-            if not resp.success():
-                log.error(f"❌ 折旧凭证写入失败: {resp.msg}", extra={"solution": "检查网络"})
+        result = batch_write_records(client, app_token, ledger_table_id, depreciation_entries)
+        if result.failed:
+            log.error(f"❌ 折旧凭证写入失败: {result.error_summary()}", extra={"solution": "检查网络"})
             
         print("✅ 折旧凭证已生成！")
         send_bot_message(f"✅ 完成 {current_month_str} 折旧计提，总额: {total_depreciation}元", "accountant")
@@ -5930,6 +9742,7 @@ def auto_fix_missing_categories(client, app_token, target_year=None):
     records = get_all_records(client, app_token, table_id, filter_info=filter_str)
     
     updates = []
+    candidates = []
     
     for r in records:
         f = r.fields
@@ -5943,36 +9756,27 @@ def auto_fix_missing_categories(client, app_token, target_year=None):
         
         # 如果归类为空 或 为默认值 "其他"
         if not cat or cat in ["", "nan", "其他", "未知"]:
-            # 尝试自动分类
-            new_cat = auto_categorize(desc, "其他", partner_name=partner)
-            
-            # 如果自动分类找到了非默认值，且与原值不同
-            if new_cat != "其他" and new_cat != cat:
-                print(f"   🔧 自动修复: {partner} | {desc} -> {new_cat}")
-                updates.append(AppTableRecord.builder().record_id(r.record_id).fields({"费用归类": new_cat}).build())
+            # 尝试自动分类 (需要 AI 的先挂起，循环结束后批量推断)
+            new_cat = auto_categorize(desc, "其他", partner_name=partner, defer_ai=True)
+            candidates.append((r, cat, {"费用归类": new_cat}))
+    
+    resolve_pending_categories([fields for _, _, fields in candidates])
+    
+    for r, cat, fields in candidates:
+        new_cat = fields["费用归类"]
+        # 如果自动分类找到了非默认值，且与原值不同
+        if new_cat != "其他" and new_cat != cat:
+            f = r.fields
+            print(f"   🔧 自动修复: {f.get('往来单位费用', '')} | {f.get('备注', '')} -> {new_cat}")
+            updates.append(AppTableRecord.builder().record_id(r.record_id).fields(fields).build())
                 
     if updates:
         print(f"   📋 发现 {len(updates)} 条记录待修复，正在批量更新...")
         # [V9.6优化] 批量更新 (Batch Update)
-        batch_size = 100
-        total_success = 0
-        
-        for i in range(0, len(updates), batch_size):
-            batch = updates[i:i+batch_size]
-            try:
-                req = BatchUpdateAppTableRecordRequest.builder() \
-                    .app_token(app_token) \
-                    .table_id(table_id) \
-                    .request_body(BatchUpdateAppTableRecordRequestBody.builder().records(batch).build()) \
-                    .build()
-                resp = client.bitable.v1.app_table_record.batch_update(req)
-                if resp.success():
-                    total_success += len(batch)
-                    print(f"      ✅ 已更新批次 {i//batch_size + 1} ({len(batch)}条)")
-                else:
-                    log.error(f"❌ 批次更新失败: {resp.msg}")
-            except Exception as e:
-                log.error(f"❌ 批次更新异常: {e}")
+        result = batch_write_records(client, app_token, table_id, updates, action="update")
+        total_success = result.success_count
+        if result.failed:
+            log.error(f"❌ 批次更新失败: {result.error_summary()}")
                 
         print(f"   ✅ 成功修复 {total_success} 条记录")
     else:
@@ -6489,19 +10293,11 @@ def generate_monthly_expenses(client, app_token):
         records.append(AppTableRecord.builder().fields(fields).build())
         
     # Call batch create
-    batch_size = 100
-    for i in range(0, len(records), batch_size):
-        batch = records[i:i+batch_size]
-        req = BatchCreateAppTableRecordRequest.builder() \
-            .app_token(app_token) \
-            .table_id(table_id) \
-            .request_body(BatchCreateAppTableRecordRequestBody.builder().records(batch).build()) \
-            .build()
-        resp = client.bitable.v1.app_table_record.batch_create(req)
-        if not resp.success():
-             print(f"❌ 生成失败: {resp.msg}")
-        else:
-             print(f"✅ 第 {i//batch_size + 1} 批生成成功")
+    result = batch_write_records(client, app_token, table_id, records)
+    if result.failed:
+         print(f"❌ 生成失败: {result.error_summary()}")
+    else:
+         print(f"✅ 已生成 {result.success_count} 条")
 
     # Update cache
     try:
@@ -6650,6 +10446,7 @@ def create_inventory_table(client, app_token):
         
     resp = client.bitable.v1.app_table.create(req)
     if resp.success():
+        register_table_id(app_token, table_name, resp.data.table_id)
         print(f"✅ {table_name} 创建成功")
         return resp.data.table_id
     else:
@@ -6756,6 +10553,7 @@ def manage_inventory(client, app_token):
                     UpdateAppTableRecordRequest.builder().app_token(app_token).table_id(table_id).record_id(target_rec.record_id)
                     .request_body(AppTableRecord.builder().fields(fields).build()).build()
                 )
+                note_record_write(table_id)
             else:
                 # Create
                 # Ask for safety stock
@@ -6766,6 +10564,7 @@ def manage_inventory(client, app_token):
                     CreateAppTableRecordRequest.builder().app_token(app_token).table_id(table_id)
                     .request_body(AppTableRecord.builder().fields(fields).build()).build()
                 )
+                note_record_write(table_id)
             
             print(f"✅ 入库完成！当前库存: {new_qty} {unit}")
             
@@ -6789,6 +10588,7 @@ def manage_inventory(client, app_token):
                         CreateAppTableRecordRequest.builder().app_token(app_token).table_id(l_id)
                         .request_body(AppTableRecord.builder().fields(ef).build()).build()
                      )
+                     note_record_write(l_id)
                      print("✅ 支出已记录")
 
         elif choice == '3': # 出库
@@ -6818,6 +10618,7 @@ def manage_inventory(client, app_token):
                 UpdateAppTableRecordRequest.builder().app_token(app_token).table_id(table_id).record_id(target_rec.record_id)
                 .request_body(AppTableRecord.builder().fields({"当前库存": new_qty, "最后变动时间": int(datetime.now().timestamp() * 1000)}).build()).build()
             )
+            note_record_write(table_id)
             print(f"✅ 出库完成！剩余: {new_qty}")
             
         elif choice == '4': # 盘点
@@ -6839,6 +10640,7 @@ def manage_inventory(client, app_token):
                  UpdateAppTableRecordRequest.builder().app_token(app_token).table_id(table_id).record_id(target_rec.record_id)
                  .request_body(AppTableRecord.builder().fields({"当前库存": real_qty, "最后变动时间": int(datetime.now().timestamp() * 1000)}).build()).build()
              )
+             note_record_write(table_id)
              print(f"✅ 盘点已更新")
 
 # 智能回款/付款核销助手
@@ -6917,29 +10719,29 @@ def smart_payment_matcher(client, app_token):
         
     print(f"⏳ 正在计算凑单组合 (目标: {target_amt})...")
     
-    # 3. Find Subset
-    import itertools
-    
-    found = False
-    
+    # 3. Find Subset (折半枚举，1~5笔组合，允许1元误差)
     # Limit records to last 50 to avoid explosion
     target_recs.sort(key=lambda x: x["date"], reverse=True)
     working_recs = target_recs[:50] 
     
-    for r in range(1, 6): # Try 1 to 5 bills
-        for combo in itertools.combinations(working_recs, r):
-            s = sum(c["amt"] for c in combo)
-            if abs(s - target_amt) < 1.0: # Tolerance 1 yuan
-                print(f"\n{Color.OKGREEN}🎉 找到匹配组合! (误差: {s - target_amt:.2f}){Color.ENDC}")
-                for c in combo:
-                    d_str = datetime.fromtimestamp(c["date"]/1000).strftime("%Y-%m-%d")
-                    print(f" - {d_str} | {c['item']} {c['spec']} | ¥ {c['amt']}")
-                found = True
-                break
-        if found: break
-        
-    if not found:
-        print(f"\n{Color.WARNING}⚠️ 未找到精确匹配的组合 (尝试了最近50笔中的1-5笔组合){Color.ENDC}")
+    # 同等条件下优先更近期的账单
+    combo, truncated = find_settlement_combo([c["amt"] for c in working_recs], target_amt, tol_cents=99,
+                                             day_gaps=list(range(len(working_recs))), max_items=5,
+                                             budget=PAYMENT_MATCHER_SEARCH_BUDGET)
+    found = combo is not None
+    if found:
+        picked = [working_recs[k] for k in combo]
+        s = sum(c["amt"] for c in picked)
+        print(f"\n{Color.OKGREEN}🎉 找到匹配组合! (误差: {s - target_amt:.2f}){Color.ENDC}")
+        for c in picked:
+            d_str = datetime.fromtimestamp(c["date"]/1000).strftime("%Y-%m-%d")
+            print(f" - {d_str} | {c['item']} {c['spec']} | ¥ {c['amt']}")
+        
+    if not found and truncated:
+        print(f"\n{Color.WARNING}⚠️ 搜索量达到上限被提前截断，未能尝试完最近{len(working_recs)}笔中的全部1-5笔组合{Color.ENDC}")
+        print("建议：在 .env 中调大 PAYMENT_MATCHER_SEARCH_BUDGET 后重试，或手动核对。")
+    elif not found:
+        print(f"\n{Color.WARNING}⚠️ 未找到精确匹配的组合 (尝试了最近{len(working_recs)}笔中的1-5笔组合){Color.ENDC}")
         print("建议：手动核对或检查是否有抹零/扣款。")
         
     input("\n按回车继续...")
@@ -7596,6 +11398,7 @@ def manage_small_tools(client, app_token):
                             .request_body(BatchCreateAppTableRecordRequestBody.builder().records(recs).build()) \
                             .build()
                         resp = client.bitable.v1.app_table_record.batch_create(req)
+                        note_record_write(pf_table_id)
                         if resp.success():
                             print("✅ 已插入加工费示例记录 (收入/外协)")
                         else:
@@ -7811,23 +11614,10 @@ def update_dashboard_cache_silent(client, app_token):
         end_ts = int(end_dt.timestamp() * 1000)
         filter_cmd = f'CurrentValue.[记账日期]>={start_ts}&&CurrentValue.[记账日期]<{end_ts}'
         
-        records = get_all_records(client, app_token, table_id, filter_info=filter_cmd, field_names=["记账日期", "实际收付金额", "业务类型"])
-        
-        inc = 0.0
-        exp = 0.0
+        df = load_records_frame(client, app_token, table_id, filter_info=filter_cmd, field_names=["记账日期", "实际收付金额", "业务类型"])
         
-        for r in records:
-            f = r.fields
-            try:
-                ts = f.get("记账日期", 0)
-                val = float(f.get("实际收付金额", 0))
-                b_type = f.get("业务类型", "")
-                
-                if b_type == "收款":
-                    inc += val
-                elif b_type in ["付款", "费用"]:
-                    exp += val
-            except: pass
+        inc = float(df.loc[df["业务类型"] == "收款", "实际收付金额"].sum())
+        exp = float(df.loc[df["业务类型"].isin(["付款", "费用"]), "实际收付金额"].sum())
             
         net = inc - exp
         
@@ -7974,13 +11764,19 @@ def register_voucher(client, app_token):
     print(f"  📂 分类: {category}")
     print(f"  📝 备注: {remark}")
     print(f"  🧾 发票: {has_invoice}")
-    
-    if input("\n确认保存吗? (y/n): ").strip().lower() != 'y': return
 
-    # Save to Feishu
     table_id = get_table_id_by_name(client, app_token, "日常台账表")
     if not table_id: return
+
+    # 查重检测
+    is_dup, dup_msg = check_duplicate(client, app_token, table_id, amount, date_str, partner, remark)
+    if is_dup:
+        print(f"\n⚠️  警告: {dup_msg}")
+        print("    (可能重复录入！)")
     
+    if input("\n确认保存吗? (y/n): ").strip().lower() != 'y': return
+
+    # Save to Feishu
     fields = {
         "记账日期": ts,
         "业务类型": biz_type,
@@ -8001,7 +11797,8 @@ def register_voucher(client, app_token):
             
         resp = client.bitable.v1.app_table_record.create(req)
         if resp.success():
-            new_record_id = resp.data.record_id
+            new_record_id = resp.data.record.record_id
+            note_record_write(table_id, created=(new_record_id, fields))
             print(f"\n✅ {Color.GREEN}凭证保存成功！{Color.ENDC}")
             
             # Undo Logic
@@ -8016,6 +11813,8 @@ def register_voucher(client, app_token):
                         .record_id(new_record_id) \
                         .build()
                      if client.bitable.v1.app_table_record.delete(req_del).success():
+                         LOCAL_REPLICA.remove_records(table_id, [new_record_id])
+                         note_record_write(table_id, deleted=new_record_id)
                          print(f"🗑️ {Color.OKGREEN}已撤销上一条录入。{Color.ENDC}")
                          # 软删除日志
                          try:
@@ -8105,6 +11904,7 @@ def manage_category_rules():
             if not cat: continue
             
             AUTO_CATEGORY_RULES[key] = cat
+            rebuild_keyword_matchers()
             
             try:
                 with open(FILE_CATEGORY_RULES, "w", encoding="utf-8") as f:
@@ -8117,6 +11917,7 @@ def manage_category_rules():
             key = input("请输入要删除的关键词: ").strip()
             if key in AUTO_CATEGORY_RULES:
                 del AUTO_CATEGORY_RULES[key]
+                rebuild_keyword_matchers()
                 try:
                     with open(FILE_CATEGORY_RULES, "w", encoding="utf-8") as f:
                         json.dump(AUTO_CATEGORY_RULES, f, ensure_ascii=False, indent=4)
@@ -8184,6 +11985,10 @@ def manage_partner_aliases():
             aliases[k] = v
             with open(json_file, "w", encoding="utf-8") as f:
                 json.dump(aliases, f, indent=4, ensure_ascii=False)
+            # 同步到内存中的别名并重新编译匹配器
+            PARTNER_ALIASES.clear()
+            PARTNER_ALIASES.update(aliases)
+            rebuild_keyword_matchers()
             print(f"✅ 已保存: {k} -> {v}")
             
         elif c == '3':
@@ -8192,12 +11997,20 @@ def manage_partner_aliases():
                 del aliases[k]
                 with open(json_file, "w", encoding="utf-8") as f:
                     json.dump(aliases, f, indent=4, ensure_ascii=False)
+                # 同步到内存中的别名并重新编译匹配器
+                PARTNER_ALIASES.clear()
+                PARTNER_ALIASES.update(aliases)
+                rebuild_keyword_matchers()
                 print(f"✅ 已删除: {k}")
             else:
                 print("❌ 找不到该关键词")
 
 def interactive_menu():
     """Python版交互主菜单 (重构：按频率分组)"""
+    global SESSION_SNAPSHOT
+    # 本次会话共享的数据快照：连续运行多个分析时每张表只加载一次
+    SESSION_SNAPSHOT = SessionSnapshot()
+    
     # 启用 Windows ANSI 支持 (如果是 Windows)
     if os.name == 'nt':
         os.system('color')
@@ -8212,6 +12025,9 @@ def interactive_menu():
         
         # 显示仪表盘状态
         print(f"\n{draw_dashboard_ui()}")
+        print(f"{Color.CYAN}📸 {SESSION_SNAPSHOT.summary()}{Color.ENDC}")
+        if OFFLINE_JOURNAL is not None:
+            print(f"{Color.CYAN}🛰️ {OFFLINE_JOURNAL.summary()}{Color.ENDC}")
         
         print(f"\n{Color.OKGREEN}☀️ 日常高频 (Daily){Color.ENDC}")
         print("  00. 🚀 一键日结 (自动扫描+处理+备份) [推荐]")
@@ -8232,6 +12048,8 @@ def interactive_menu():
         print("  21. 🔍 快速查账 (搜索/导出)")
         print("  22. 🏥 财务体检 (风险扫描)")
         print("  23. 🧰 会计工具箱 (税额/大写/模板)")
+        print("  90. 🔄 刷新会话数据 (重新加载快照)")
+        print("  91. 🛰️ 离线同步 (待同步/冲突处理)")
         print("  97. ⚙️ 系统配置 (分类规则/别名)")
         print("  98. 🤖 AI 助手 (自然语言问答)")
         print("  99. ❌ 退出系统")
@@ -8265,6 +12083,8 @@ def interactive_menu():
                 "工具": "28", "大写": "28",
                 "配置": "97", "设置": "97",
                 "ai": "10", "助手": "10",
+                "刷新": "90",
+                "离线": "91", "同步": "91",
                 "退出": "99"
             }
             # 简单匹配
@@ -8317,6 +12137,15 @@ def interactive_menu():
         
         choice = real_choice # 传递给后续逻辑
         
+        if choice == '90':
+            SESSION_SNAPSHOT.mark_stale()
+            print("✅ 会话快照已标记刷新，下次查询时重新加载最新数据")
+            time.sleep(1)
+            continue
+        if choice == '91':
+            offline_sync_menu()
+            continue
+        
         if choice == '00':
             one_click_daily_closing(client, app_token)
         elif choice == '1': # 保留旧的截图记账入口，但在UI上隐藏了
@@ -8544,6 +12373,7 @@ def create_processing_fee_table(client, app_token):
 
     resp = client.bitable.v1.app_table.create(req)
     if resp.success():
+        register_table_id(app_token, "加工费明细表", resp.data.table_id)
         log.info("✅ 加工费明细表创建成功", extra={"solution": "无"})
         return resp.data.table_id
     else:
@@ -8577,6 +12407,7 @@ def create_processing_price_table(client, app_token):
 
     resp = client.bitable.v1.app_table.create(req)
     if resp.success():
+        register_table_id(app_token, "加工费价目表", resp.data.table_id)
         log.info("✅ 加工费价目表创建成功", extra={"solution": "无"})
         return resp.data.table_id
     else:
@@ -8644,6 +12475,7 @@ def manage_price_list(client, app_token):
                 .build()
                 
             if client.bitable.v1.app_table_record.create(req).success():
+                note_record_write(table_id)
                 print("✅ 价目已保存")
             else:
                 print("❌ 保存失败")
@@ -8691,6 +12523,7 @@ def manage_price_list(client, app_token):
                             .build()
                             
                         if client.bitable.v1.app_table_record.update(req).success():
+                            note_record_write(table_id)
                             print("✅ 修改成功")
                         else:
                             print("❌ 修改失败")
@@ -8717,6 +12550,8 @@ def manage_price_list(client, app_token):
                                 .record_id(target.record_id) \
                                 .build()
                             if client.bitable.v1.app_table_record.delete(req).success():
+                                LOCAL_REPLICA.remove_records(table_id, [target.record_id])
+                                note_record_write(table_id, deleted=target.record_id)
                                 print("✅ 删除成功")
                             else:
                                 print("❌ 删除失败")
@@ -8764,7 +12599,7 @@ def manage_price_list(client, app_token):
                         existing_map[key] = r.record_id
                 
                 batch_add = []
-                update_count = 0
+                batch_update = []
                 
                 for _, row in df.iterrows():
                     name = str(row['品名']).strip()
@@ -8781,33 +12616,19 @@ def manage_price_list(client, app_token):
                     
                     if key in existing_map:
                         # Update
-                        rid = existing_map[key]
-                        req = UpdateAppTableRecordRequest.builder() \
-                            .app_token(app_token) \
-                            .table_id(table_id) \
-                            .record_id(rid) \
-                            .request_body(AppTableRecord.builder().fields(fields).build()) \
-                            .build()
-                        client.bitable.v1.app_table_record.update(req)
-                        update_count += 1
+                        batch_update.append({"record_id": existing_map[key], "fields": fields})
                         print(f"   🔄 更新: {name} {spec}")
                     else:
                         # Add
                         batch_add.append(AppTableRecord.builder().fields(fields).build())
                 
-                # Execute Batch Add
-                if batch_add:
-                    batch_size = 100
-                    for i in range(0, len(batch_add), batch_size):
-                        batch = batch_add[i:i+batch_size]
-                        req = BatchCreateAppTableRecordRequest.builder() \
-                            .app_token(app_token) \
-                            .table_id(table_id) \
-                            .request_body(BatchCreateAppTableRecordRequestBody.builder().records(batch).build()) \
-                            .build()
-                        client.bitable.v1.app_table_record.batch_create(req)
+                # Execute Batch Add / Update
+                added = batch_write_records(client, app_token, table_id, batch_add)
+                updated = batch_write_records(client, app_token, table_id, batch_update, action="update")
                         
-                print(f"✅ 导入完成! 新增 {len(batch_add)} 条, 更新 {update_count} 条")
+                print(f"✅ 导入完成! 新增 {added.success_count} 条, 更新 {updated.success_count} 条")
+                if added.failed or updated.failed:
+                    print(f"⚠️ 失败 {len(added.failed) + len(updated.failed)} 条: {added.error_summary() or updated.error_summary()}")
                 
             except Exception as e:
                 print(f"❌ 导入出错: {e}")
@@ -9423,17 +13244,7 @@ def manage_settlement(client, app_token):
             
             # Execute Batch
             # Split into 100
-            count = 0
-            for i in range(0, len(batch_recs), 100):
-                batch = batch_recs[i:i+100]
-                req = BatchUpdateAppTableRecordRequest.builder() \
-                    .app_token(app_token) \
-                    .table_id(table_id) \
-                    .request_body(BatchUpdateAppTableRecordRequestBody.builder().records(batch).build()) \
-                    .build()
-                resp = client.bitable.v1.app_table_record.batch_update(req)
-                if resp.success():
-                    count += len(batch)
+            count = batch_write_records(client, app_token, table_id, batch_recs, action="update").success_count
             print(f"✅ 成功结算 {count} 笔记录")
 
     elif op == '2':
@@ -9459,17 +13270,7 @@ def manage_settlement(client, app_token):
             
             if input("❓ 确认执行? (y/n): ").strip().lower() == 'y':
                  # Execute Batch
-                count = 0
-                for i in range(0, len(batch_recs), 100):
-                    batch = batch_recs[i:i+100]
-                    req = BatchUpdateAppTableRecordRequest.builder() \
-                        .app_token(app_token) \
-                        .table_id(table_id) \
-                        .request_body(BatchUpdateAppTableRecordRequestBody.builder().records(batch).build()) \
-                        .build()
-                    resp = client.bitable.v1.app_table_record.batch_update(req)
-                    if resp.success():
-                        count += len(batch)
+                count = batch_write_records(client, app_token, table_id, batch_recs, action="update").success_count
                 print(f"✅ 成功结算 {count} 笔记录")
                 
         except:
@@ -9675,20 +13476,11 @@ def import_processing_records_from_excel(client, app_token):
 
         # 批量写入
         if records:
-            batch_size = 100
-            for i in range(0, len(records), batch_size):
-                batch = records[i:i+batch_size]
-                req = BatchCreateAppTableRecordRequest.builder() \
-                    .app_token(app_token) \
-                    .table_id(table_id) \
-                    .request_body(BatchCreateAppTableRecordRequestBody.builder().records(batch).build()) \
-                    .build()
-                resp = client.bitable.v1.app_table_record.batch_create(req)
-                if resp.success():
-                    success_count += len(batch)
-                    print(f"✅ 已导入 {success_count}/{len(records)} 条")
-                else:
-                    print(f"❌ 导入失败: {resp.msg}")
+            result = batch_write_records(client, app_token, table_id, records)
+            success_count = result.success_count
+            print(f"✅ 已导入 {success_count}/{len(records)} 条")
+            if result.failed:
+                print(f"❌ 导入失败: {result.error_summary()}")
                     
             # 导入后，询问是否学习新价格
             learn_prices = input("🎓 是否将导入的新品名/价格自动学习到【价目表】? (y/n) [n]: ").strip().lower() == 'y'
@@ -9747,17 +13539,7 @@ def learn_new_prices(client, app_token, records):
         batch_recs.append(AppTableRecord.builder().fields(fields).build())
         
     # Execute Batch
-    count = 0
-    for i in range(0, len(batch_recs), 100):
-        batch = batch_recs[i:i+100]
-        req = BatchCreateAppTableRecordRequest.builder() \
-            .app_token(app_token) \
-            .table_id(pt_id) \
-            .request_body(BatchCreateAppTableRecordRequestBody.builder().records(batch).build()) \
-            .build()
-        resp = client.bitable.v1.app_table_record.batch_create(req)
-        if resp.success():
-            count += len(batch)
+    count = batch_write_records(client, app_token, pt_id, batch_recs).success_count
             
     print(f"✅ 已自动添加 {count} 条新价格记录到价目表")
 
@@ -10022,9 +13804,7 @@ def generate_delivery_note(client, app_token):
         
         if batch_updates:
             # Batch update logic
-             for i in range(0, len(batch_updates), 100):
-                 req = BatchUpdateAppTableRecordRequest.builder().app_token(app_token).table_id(table_id).request_body(BatchUpdateAppTableRecordRequestBody.builder().records(batch_updates[i:i+100]).build()).build()
-                 client.bitable.v1.app_table_record.batch_update(req)
+             batch_write_records(client, app_token, table_id, batch_updates, action="update")
              print("✅ 已标记完成")
 
 def manage_processing_fee_flow(client, app_token):
@@ -10541,6 +14321,7 @@ def manage_processing_fee_flow(client, app_token):
                     .build()
                     
                 resp = client.bitable.v1.app_table_record.create(req)
+                note_record_write(table_id)
                 if resp.success():
                     print("✅ 保存成功！")
                     batch_total_amount += total
@@ -10564,6 +14345,7 @@ def manage_processing_fee_flow(client, app_token):
                                         .request_body(AppTableRecord.builder().fields({"单价": price}).build()) \
                                         .build()
                                     if client.bitable.v1.app_table_record.update(req).success():
+                                        note_record_write(pt_id)
                                         print("   ✅ 价目表已更新")
                                         # Update local cache
                                         existing_rec.fields['单价'] = price
@@ -10585,6 +14367,7 @@ def manage_processing_fee_flow(client, app_token):
                                     .request_body(AppTableRecord.builder().fields(fields).build()) \
                                     .build()
                                 resp = client.bitable.v1.app_table_record.create(req)
+                                note_record_write(pt_id)
                                 if resp.success():
                                     print("   ✅ 已添加到价目表")
                                     # Update local cache
@@ -10596,6 +14379,7 @@ def manage_processing_fee_flow(client, app_token):
 
 
 # 发票管理流程 (新)
+@tracked_report
 def debt_collection_assistant(client, app_token):
     """应收账款催收助手 (Debt Collection Assistant)"""
     print(f"\n{Color.FAIL}📢 应收账款催收助手 (Debt Collection){Color.ENDC}")
@@ -10608,7 +14392,8 @@ def debt_collection_assistant(client, app_token):
     print("⏳ 正在计算全量客户余额 (可能需要一点时间)...")
     
     # 1. Calculate All Balances
-    recs = get_all_records(client, app_token, table_id)
+    recs = get_all_records(client, app_token, table_id,
+                           field_names=REPORT_FIELDS["debt_collection_assistant"]["日常台账表"])
     
     cust_receipts = {} # Customer -> Total Receipt
     last_pay_date = {} # Customer -> Timestamp
@@ -10632,7 +14417,8 @@ def debt_collection_assistant(client, app_token):
     if not pf_table_id: return
     
     print("⏳ 正在拉取加工费记录并分析账龄...")
-    pf_recs = get_all_records(client, app_token, pf_table_id)
+    pf_recs = get_all_records(client, app_token, pf_table_id,
+                              field_names=REPORT_FIELDS["debt_collection_assistant"]["加工费明细表"])
     
     cust_debts = {} # Customer -> Total Fee
     last_biz_date = {} # Customer -> Timestamp
@@ -10879,36 +14665,15 @@ def generate_monthly_visual_report(client, app_token):
     if not l_id: return
     
     print("⏳ 正在分析财务数据...")
-    filter_l = f'AND(CurrentValue.[记账日期]>={start_ts}, CurrentValue.[记账日期]<{end_ts})'
-    l_recs = get_all_records(client, app_token, l_id, filter_info=filter_l)
-    
-    total_inc = 0.0
-    total_exp = 0.0
-    exp_cats = {} # Category -> Amount
+    cube = load_pnl_cube(client, app_token, l_id, start_dt, end_dt)
+    total_inc = float(pnl_sum(cube, kind="收入"))
+    total_exp = float(pnl_sum(cube, kind="支出"))
+    exp_cats = {cat: float(v) for cat, v in pnl_sum(cube, "费用归类", kind="支出").items()} # Category -> Amount
     
     # Energy Cost Analysis
-    energy_cost = 0.0
-    outsourced_cost = 0.0
-    
-    for r in l_recs:
-        t = r.fields.get("业务类型", "")
-        amt = float(r.fields.get("实际收付金额", 0))
-        cat = r.fields.get("费用归类", "其他")
-        
-        if t == "收款":
-            total_inc += amt
-        elif t in ["付款", "费用"]:
-            total_exp += amt
-            if cat not in exp_cats: exp_cats[cat] = 0.0
-            exp_cats[cat] += amt
-            
-            # Identify Energy Costs
-            if "电" in cat or "水" in cat or "气" in cat:
-                energy_cost += amt
-            
-            # Identify Outsourced Costs
-            if "外协" in cat:
-                outsourced_cost += amt
+    energy_cost = sum(v for cat, v in exp_cats.items() if "电" in cat or "水" in cat or "气" in cat)
+    # Identify Outsourced Costs
+    outsourced_cost = sum(v for cat, v in exp_cats.items() if "外协" in cat)
             
     # 2. Production (Processing Fee)
     pf_id = get_table_id_by_name(client, app_token, "加工费明细表")
@@ -11215,6 +14980,7 @@ def manage_invoice_flow(client, app_token):
                     BatchCreateAppTableRecordRequestBody.builder().records([AppTableRecord.builder().fields(fields).build()]).build()).build()
                 
                 if client.bitable.v1.app_table_record.batch_create(req).success():
+                    note_record_write(table_id)
                     print(f"{Color.OKGREEN}✅ {type_prefix}发票已登记: {inv_no}{Color.ENDC}")
                     
                     # 询问进入批量模式
@@ -11423,6 +15189,72 @@ def update_env_key(key, value):
     except Exception as e:
         print(f"❌ 保存配置失败: {e}")
 
+HEALTH_REPORT_CSS = """
+body { font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; background-color: #f4f6f9; margin: 0; padding: 20px; }
+.container { max-width: 900px; margin: 0 auto; background: white; padding: 40px; border-radius: 10px; box-shadow: 0 4px 6px rgba(0,0,0,0.1); }
+h1 { color: #2c3e50; border-bottom: 2px solid #e74c3c; padding-bottom: 10px; }
+.stats { display: flex; justify-content: space-between; margin-bottom: 30px; }
+.stat-box { background: #f8f9fa; padding: 20px; border-radius: 8px; text-align: center; width: 30%; }
+.stat-val { font-size: 24px; font-weight: bold; color: #e74c3c; }
+.risk-table { width: 100%; border-collapse: collapse; margin-top: 20px; }
+th, td { border: 1px solid #ddd; padding: 12px; text-align: left; }
+th { background-color: #e74c3c; color: white; }
+tr:nth-child(even) { background-color: #f2f2f2; }
+.tag { padding: 4px 8px; border-radius: 4px; color: white; font-size: 12px; }
+.tag-high { background-color: #c0392b; }
+.tag-mid { background-color: #e67e22; }
+.tag-low { background-color: #f1c40f; color: #333; }
+.ai-box { background-color: #e8f6f3; padding: 20px; border-left: 5px solid #1abc9c; margin-top: 30px; border-radius: 4px; }
+"""
+
+HEALTH_REPORT_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <title>财务体检报告 - {{ date }}</title>
+    <link rel="stylesheet" href="report_assets/health.css">
+</head>
+<body>
+    <div class="container">
+        <h1>🏥 财务健康体检报告</h1>
+        <p>生成时间: {{ generated }}</p>
+
+        <div class="stats">
+            <div class="stat-box">
+                <div class="stat-val">{{ large_cash }}</div>
+                <div>大额现金笔数 (>5k)</div>
+            </div>
+            <div class="stat-box">
+                <div class="stat-val">{{ no_ticket_amt:,.2f }}</div>
+                <div>无票支出总额</div>
+            </div>
+            <div class="stat-box">
+                <div class="stat-val">{{ risk_count }}</div>
+                <div>发现风险点总数</div>
+            </div>
+        </div>
+
+        <div class="ai-box">
+            <h3>🤖 AI 整改建议</h3>
+            {{ ai_advice|raw }}
+        </div>
+
+        <h3>⚠️ 风险详情清单</h3>
+        <table class="risk-table">
+            <thead>
+                <tr><th>风险等级</th><th>日期</th><th>类型</th><th>金额</th><th>说明</th></tr>
+            </thead>
+            <tbody>
+{% for r in risks %}                <tr><td><span class="tag {{ r.tag }}">{{ r.level }}</span></td><td>{{ r.date }}</td><td>{{ r.type }}</td><td>{{ r.amt:,.2f }}</td><td>{{ r.desc }}</td></tr>
+{% endfor %}            </tbody>
+        </table>
+    </div>
+</body>
+</html>
+"""
+HEALTH_RISK_TAGS = {"高": "tag-high", "中": "tag-mid"} # 其余等级为 tag-low
+
+@tracked_report
 def financial_health_check(client, app_token, target_year=None):
     """一键财务体检：扫描税务风险和数据异常 (生成HTML报告)"""
     if target_year:
@@ -11442,7 +15274,8 @@ def financial_health_check(client, app_token, target_year=None):
     end_ts = int(datetime(year + 1, 1, 1).timestamp() * 1000)
     filter_str = f'AND(CurrentValue.[记账日期]>={start_ts}, CurrentValue.[记账日期]<{end_ts})'
 
-    records = get_all_records(client, app_token, table_id, filter_info=filter_str)
+    records = get_all_records(client, app_token, table_id, filter_info=filter_str,
+                              field_names=REPORT_FIELDS["financial_health_check"]["日常台账表"])
     
     risks = []
     stats = {
@@ -11460,7 +15293,7 @@ def financial_health_check(client, app_token, target_year=None):
     
     # 风险详情列表 (用于生成报告)
     risk_details = []
-    seen_txns = {} # 用于查重 (key: date_amt_partner)
+    seen_txns = DuplicateIndex() # 用于查重 (同一天 + 金额 + 对象)，与录入查重共用索引结构
     
     # [新增] 可修复的异常
     duplicate_ids = [] # 待删除的重复记录ID
@@ -11499,8 +15332,8 @@ def financial_health_check(client, app_token, target_year=None):
         # 简单指纹: 日期 + 金额 + 对象 (忽略时分秒)
         # 注意: 只有非零金额才查重
         if amt != 0:
-            dup_key = f"{date_str}_{amt}_{partner}"
-            if dup_key in seen_txns:
+            dup_day = DuplicateIndex.record_day(date_ts)
+            if seen_txns.find_exact(amt, dup_day, partner):
                 msg = f"⚠️ [重复风险] 疑似重复录入: {date_str} {amt}元 - {partner}"
                 risks.append(msg)
                 risk_details.append({"date": date_str, "type": "重复录入", "amt": amt, "desc": f"与已有记录重复: {partner}", "level": "高"})
@@ -11511,7 +15344,7 @@ def financial_health_check(client, app_token, target_year=None):
                 if rid:
                     duplicate_ids.append(rid)
             else:
-                seen_txns[dup_key] = True
+                seen_txns.add(getattr(r, "record_id", None) or f"#{id(r)}", f)
 
         # 规则 1: 大额现金支付 (>5000)
         if is_cash and amt > 5000 and biz_type in ["付款", "费用"]:
@@ -11585,7 +15418,8 @@ def financial_health_check(client, app_token, target_year=None):
         # 针对 "日期" 字段的过滤器
         pf_filter = f'AND(CurrentValue.[日期]>={start_ts}, CurrentValue.[日期]<{end_ts})'
         try:
-            pf_records = get_all_records(client, app_token, pf_table_id, filter_info=pf_filter)
+            pf_records = get_all_records(client, app_token, pf_table_id, filter_info=pf_filter,
+                                         field_names=REPORT_FIELDS["financial_health_check"]["加工费明细表"])
             
             for r in pf_records:
                 f = r.fields
@@ -11647,118 +15481,40 @@ def financial_health_check(client, app_token, target_year=None):
     print(f"大额现金笔数: {stats['large_cash']}")
     print(f"无票金额总计: {stats['no_ticket_amt']:.2f} 元")
     
-    ai_advice = "暂无建议"
-    
-    # 如果有 AI，生成建议
-    if zhipu_client and risks:
-        try:
-            log.info("🤖 AI 正在生成整改建议...", extra={"solution": "请稍候"})
-            risk_text = "\n".join(risks[:10]) # 限制长度
-            response = zhipu_client.chat.completions.create(
-                model="glm-4-flash",
-                messages=[
-                    {"role": "system", "content": "你是一名资深税务会计。用户进行了一次财务体检，发现了以下风险点。请给出简短、专业的整改建议（3条以内，用HTML列表格式输出）。"},
-                    {"role": "user", "content": risk_text}
-                ]
-            )
-            ai_advice = response.choices[0].message.content
-            print(f"\n💡 AI 建议生成完毕")
-        except:
-            pass
-            
-    # 生成 HTML 报告
-    html = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="UTF-8">
-        <title>财务体检报告 - {datetime.now().strftime('%Y-%m-%d')}</title>
-        <style>
-            body {{ font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; background-color: #f4f6f9; margin: 0; padding: 20px; }}
-            .container {{ max-width: 900px; margin: 0 auto; background: white; padding: 40px; border-radius: 10px; box-shadow: 0 4px 6px rgba(0,0,0,0.1); }}
-            h1 {{ color: #2c3e50; border-bottom: 2px solid #e74c3c; padding-bottom: 10px; }}
-            .stats {{ display: flex; justify-content: space-between; margin-bottom: 30px; }}
-            .stat-box {{ background: #f8f9fa; padding: 20px; border-radius: 8px; text-align: center; width: 30%; }}
-            .stat-val {{ font-size: 24px; font-weight: bold; color: #e74c3c; }}
-            .risk-table {{ width: 100%; border-collapse: collapse; margin-top: 20px; }}
-            th, td {{ border: 1px solid #ddd; padding: 12px; text-align: left; }}
-            th {{ background-color: #e74c3c; color: white; }}
-            tr:nth-child(even) {{ background-color: #f2f2f2; }}
-            .tag {{ padding: 4px 8px; border-radius: 4px; color: white; font-size: 12px; }}
-            .tag-high {{ background-color: #c0392b; }}
-            .tag-mid {{ background-color: #e67e22; }}
-            .tag-low {{ background-color: #f1c40f; color: #333; }}
-            .ai-box {{ background-color: #e8f6f3; padding: 20px; border-left: 5px solid #1abc9c; margin-top: 30px; border-radius: 4px; }}
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <h1>🏥 财务健康体检报告</h1>
-            <p>生成时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</p>
-            
-            <div class="stats">
-                <div class="stat-box">
-                    <div class="stat-val">{stats['large_cash']}</div>
-                    <div>大额现金笔数 (>5k)</div>
-                </div>
-                <div class="stat-box">
-                    <div class="stat-val">{stats['no_ticket_amt']:,.2f}</div>
-                    <div>无票支出总额</div>
-                </div>
-                <div class="stat-box">
-                    <div class="stat-val">{len(risk_details)}</div>
-                    <div>发现风险点总数</div>
-                </div>
-            </div>
-
-            <div class="ai-box">
-                <h3>🤖 AI 整改建议</h3>
-                {ai_advice}
-            </div>
-
-            <h3>⚠️ 风险详情清单</h3>
-            <table class="risk-table">
-                <thead>
-                    <tr>
-                        <th>风险等级</th>
-                        <th>日期</th>
-                        <th>类型</th>
-                        <th>金额</th>
-                        <th>说明</th>
-                    </tr>
-                </thead>
-                <tbody>
-    """
-    
-    for r in risk_details:
-        tag_cls = "tag-low"
-        if r['level'] == "高": tag_cls = "tag-high"
-        elif r['level'] == "中": tag_cls = "tag-mid"
-        
-        html += f"""
-        <tr>
-            <td><span class="tag {tag_cls}">{r['level']}</span></td>
-            <td>{r['date']}</td>
-            <td>{r['type']}</td>
-            <td>{r['amt']:,.2f}</td>
-            <td>{r['desc']}</td>
-        </tr>
-        """
-        
-    html += """
-                </tbody>
-            </table>
-        </div>
-    </body>
-    </html>
-    """
+    ai_advice = "暂无建议"
     
+    # 如果有 AI，生成建议
+    if zhipu_client and risks:
+        try:
+            log.info("🤖 AI 正在生成整改建议...", extra={"solution": "请稍候"})
+            risk_text = "\n".join(risks[:10]) # 限制长度
+            response = zhipu_client.chat.completions.create(
+                model="glm-4-flash",
+                messages=[
+                    {"role": "system", "content": "你是一名资深税务会计。用户进行了一次财务体检，发现了以下风险点。请给出简短、专业的整改建议（3条以内，用HTML列表格式输出）。"},
+                    {"role": "user", "content": risk_text}
+                ]
+            )
+            ai_advice = response.choices[0].message.content
+            print(f"\n💡 AI 建议生成完毕")
+        except:
+            pass
+            
+    # 生成 HTML 报告
     report_dir = "财务数据备份"
     if not os.path.exists(report_dir): os.makedirs(report_dir)
-    filename = f"{report_dir}/体检报告_{datetime.now().strftime('%Y%m%d%H%M%S')}.html"
-    
-    with open(filename, "w", encoding="utf-8") as f:
-        f.write(html)
+    ensure_report_assets(report_dir, {"health.css": HEALTH_REPORT_CSS})
+    now = datetime.now()
+    filename = f"{report_dir}/体检报告_{now.strftime('%Y%m%d%H%M%S')}.html"
+    write_report(filename, report_template("health", HEALTH_REPORT_PAGE), {
+        "date": now.strftime('%Y-%m-%d'),
+        "generated": now.strftime('%Y-%m-%d %H:%M:%S'),
+        "large_cash": stats['large_cash'],
+        "no_ticket_amt": stats['no_ticket_amt'],
+        "risk_count": len(risk_details),
+        "ai_advice": ai_advice, # AI 按要求输出 HTML 列表，原样嵌入
+        "risks": ({**r, "tag": HEALTH_RISK_TAGS.get(r['level'], "tag-low")} for r in risk_details),
+    })
         
     log.info(f"📄 体检报告已生成: {filename}", extra={"solution": "浏览器打开查看"})
     try:
@@ -11772,18 +15528,12 @@ def financial_health_check(client, app_token, target_year=None):
         if input("👉 是否立即删除这些重复项? (y/n): ").strip().lower() == 'y':
             print("🗑️ 正在删除重复记录...")
             try:
-                # 批量删除
-                req = BatchDeleteAppTableRecordRequest.builder() \
-                    .app_token(app_token) \
-                    .table_id(table_id) \
-                    .request_body(BatchDeleteAppTableRecordRequestBody.builder().records(duplicate_ids).build()) \
-                    .build()
-                
-                resp = client.bitable.v1.app_table_record.batch_delete(req)
-                if resp.success():
+                # 批量删除 (管道内同步清理本地副本)
+                result = batch_write_records(client, app_token, table_id, duplicate_ids, action="delete")
+                if not result.failed:
                     print(f"✅ 已成功删除 {len(duplicate_ids)} 条重复记录！")
                 else:
-                    print(f"❌ 删除失败: {resp.msg}")
+                    print(f"❌ 删除失败 {len(result.failed)} 条: {result.error_summary()}")
             except Exception as e:
                 print(f"❌ 删除出错: {e}")
                 
@@ -11794,6 +15544,77 @@ def financial_health_check(client, app_token, target_year=None):
 
     return True
 
+DAILY_REPORT_CSS = """
+body { font-family: 'Segoe UI', sans-serif; background: #f0f2f5; padding: 20px; }
+.container { max-width: 800px; margin: 0 auto; background: white; padding: 30px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }
+h1 { color: #1a1a1a; border-bottom: 3px solid #3498db; padding-bottom: 10px; }
+.summary-box { display: flex; gap: 20px; margin: 20px 0; }
+.card { flex: 1; background: #f8f9fa; padding: 15px; border-radius: 8px; text-align: center; border: 1px solid #e9ecef; }
+.num { font-size: 24px; font-weight: bold; color: #2c3e50; }
+.label { color: #7f8c8d; font-size: 14px; }
+.income { color: #27ae60; }
+.expense { color: #c0392b; }
+
+h3 { margin-top: 30px; color: #34495e; border-left: 5px solid #3498db; padding-left: 10px; }
+table { width: 100%; border-collapse: collapse; margin-top: 10px; }
+th, td { padding: 10px; text-align: left; border-bottom: 1px solid #eee; }
+th { background: #f8f9fa; color: #7f8c8d; }
+
+.log-box { background: #2c3e50; color: #ecf0f1; padding: 15px; border-radius: 5px; font-family: monospace; max-height: 200px; overflow-y: auto; }
+.pending-alert { background: #fff3cd; color: #856404; padding: 10px; border-radius: 5px; margin-top: 10px; }
+"""
+
+DAILY_REPORT_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="utf-8">
+    <title>每日结账报告 - {{ date }}</title>
+    <link rel="stylesheet" href="report_assets/daily.css">
+</head>
+<body>
+    <div class="container">
+        <h1>📅 每日结账报告 <small style="font-size: 16px; color: #7f8c8d">{{ generated }}</small></h1>
+
+        <div class="summary-box">
+            <div class="card">
+                <div class="num income">+{{ income:,.2f }}</div>
+                <div class="label">今日收款</div>
+            </div>
+            <div class="card">
+                <div class="num expense">-{{ expense:,.2f }}</div>
+                <div class="label">今日支出</div>
+            </div>
+            <div class="card">
+                <div class="num">{{ tx_count }}</div>
+                <div class="label">业务笔数</div>
+            </div>
+            <div class="card">
+                <div class="num" style="color: #2980b9">{{ net:,.2f }}</div>
+                <div class="label">今日净现金流</div>
+            </div>
+        </div>
+
+        <h3>📝 今日业务明细</h3>
+{% if details %}        <table><thead><tr><th>类型</th><th>金额</th><th>对象</th><th>摘要</th></tr></thead><tbody>
+{% for d in details %}        <tr><td><span style='color:{{ d.color }}'>{{ d.type }}</span></td><td>{{ d.amt:,.2f }}</td><td>{{ d.partner }}</td><td>{{ d.desc }}</td></tr>
+{% endfor %}        </tbody></table>
+{% else %}        <p style='color:#999; text-align:center'>今日暂无收支记录</p>
+{% endif %}{% if pending %}
+        <h3>🔔 待办提醒</h3>
+        <div class="pending-alert">
+            <strong>发现 {{ pending_count }} 个待处理文件:</strong><br>
+            {{ pending }}
+        </div>
+{% endif %}{% if summary_log %}
+        <h3>⚙️ 系统处理日志</h3>
+        <div class="log-box">
+{% for line in summary_log %}        <div>{{ line }}</div>
+{% endfor %}        </div>
+{% endif %}    </div>
+</body>
+</html>
+"""
+
 def generate_daily_html_report(client, app_token, summary_log=None):
     """生成每日结账 HTML 报告"""
     log.info("📊 正在生成今日结账报告...", extra={"solution": "无"})
@@ -11843,97 +15664,22 @@ def generate_daily_html_report(client, app_token, summary_log=None):
     # 这里为了速度，暂时不全量查，只看传入的 summary_log 是否有提及
     
     # 生成 HTML
-    html = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="utf-8">
-        <title>每日结账报告 - {now.strftime('%Y-%m-%d')}</title>
-        <style>
-            body {{ font-family: 'Segoe UI', sans-serif; background: #f0f2f5; padding: 20px; }}
-            .container {{ max-width: 800px; margin: 0 auto; background: white; padding: 30px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }}
-            h1 {{ color: #1a1a1a; border-bottom: 3px solid #3498db; padding-bottom: 10px; }}
-            .summary-box {{ display: flex; gap: 20px; margin: 20px 0; }}
-            .card {{ flex: 1; background: #f8f9fa; padding: 15px; border-radius: 8px; text-align: center; border: 1px solid #e9ecef; }}
-            .num {{ font-size: 24px; font-weight: bold; color: #2c3e50; }}
-            .label {{ color: #7f8c8d; font-size: 14px; }}
-            .income {{ color: #27ae60; }}
-            .expense {{ color: #c0392b; }}
-            
-            h3 {{ margin-top: 30px; color: #34495e; border-left: 5px solid #3498db; padding-left: 10px; }}
-            table {{ width: 100%; border-collapse: collapse; margin-top: 10px; }}
-            th, td {{ padding: 10px; text-align: left; border-bottom: 1px solid #eee; }}
-            th {{ background: #f8f9fa; color: #7f8c8d; }}
-            
-            .log-box {{ background: #2c3e50; color: #ecf0f1; padding: 15px; border-radius: 5px; font-family: monospace; max-height: 200px; overflow-y: auto; }}
-            .pending-alert {{ background: #fff3cd; color: #856404; padding: 10px; border-radius: 5px; margin-top: 10px; }}
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <h1>📅 每日结账报告 <small style="font-size: 16px; color: #7f8c8d">{now.strftime('%Y-%m-%d %H:%M')}</small></h1>
-            
-            <div class="summary-box">
-                <div class="card">
-                    <div class="num income">+{today_income:,.2f}</div>
-                    <div class="label">今日收款</div>
-                </div>
-                <div class="card">
-                    <div class="num expense">-{today_expense:,.2f}</div>
-                    <div class="label">今日支出</div>
-                </div>
-                <div class="card">
-                    <div class="num">{tx_count}</div>
-                    <div class="label">业务笔数</div>
-                </div>
-                <div class="card">
-                    <div class="num" style="color: #2980b9">{today_income - today_expense:,.2f}</div>
-                    <div class="label">今日净现金流</div>
-                </div>
-            </div>
-            
-            <h3>📝 今日业务明细</h3>
-            """
-            
-    if details:
-        html += "<table><thead><tr><th>类型</th><th>金额</th><th>对象</th><th>摘要</th></tr></thead><tbody>"
-        for d in details:
-            color = "green" if d['type'] == "收款" else "red"
-            html += f"<tr><td><span style='color:{color}'>{d['type']}</span></td><td>{d['amt']:,.2f}</td><td>{d['partner']}</td><td>{d['desc']}</td></tr>"
-        html += "</tbody></table>"
-    else:
-        html += "<p style='color:#999; text-align:center'>今日暂无收支记录</p>"
-        
-    if pending_files:
-        html += f"""
-        <h3>🔔 待办提醒</h3>
-        <div class="pending-alert">
-            <strong>发现 {len(pending_files)} 个待处理文件:</strong><br>
-            {', '.join(pending_files[:5])} {'...' if len(pending_files)>5 else ''}
-        </div>
-        """
-        
-    if summary_log:
-        html += """
-        <h3>⚙️ 系统处理日志</h3>
-        <div class="log-box">
-        """
-        for line in summary_log:
-            html += f"<div>{line}</div>"
-        html += "</div>"
-        
-    html += """
-        </div>
-    </body>
-    </html>
-    """
-    
     report_dir = "日结报告"
     if not os.path.exists(report_dir): os.makedirs(report_dir)
+    ensure_report_assets(report_dir, {"daily.css": DAILY_REPORT_CSS})
     filename = f"{report_dir}/日结_{now.strftime('%Y%m%d')}.html"
-    
-    with open(filename, "w", encoding="utf-8") as f:
-        f.write(html)
+    write_report(filename, report_template("daily", DAILY_REPORT_PAGE), {
+        "date": now.strftime('%Y-%m-%d'),
+        "generated": now.strftime('%Y-%m-%d %H:%M'),
+        "income": today_income,
+        "expense": today_expense,
+        "tx_count": tx_count,
+        "net": today_income - today_expense,
+        "details": [{**d, "color": "green" if d['type'] == "收款" else "red"} for d in details],
+        "pending_count": len(pending_files),
+        "pending": f"{', '.join(pending_files[:5])} {'...' if len(pending_files)>5 else ''}" if pending_files else "",
+        "summary_log": summary_log,
+    })
         
     log.info(f"📄 日结报告已生成: {filename}")
     return filename
@@ -11948,39 +15694,25 @@ def generate_annual_report(client, app_token, year=None):
     table_id = get_table_id_by_name(client, app_token, "日常台账表")
     if not table_id: return False
     
-    # 获取全年数据
-    records = get_all_records(client, app_token, table_id)
-    
-    monthly_data = {m: {"income": 0.0, "expense": 0.0, "count": 0} for m in range(1, 13)}
-    category_summary = {} # {category: amount}
+    # 当年损益立方体 (已结账月份取缓存)，按月份/费用归类切片
+    cube = load_pnl_cube(client, app_token, table_id, datetime(year, 1, 1), datetime(year + 1, 1, 1))
+    counts = pnl_sum(cube, "月份", value="笔数")
+    income_by_month = pnl_sum(cube, "月份", kind="收入")
+    expense_by_month = pnl_sum(cube, "月份", kind="支出")
+    monthly_data = {}
+    for m in range(1, 13):
+        key = f"{year}-{m:02d}"
+        monthly_data[m] = {
+            "income": float(income_by_month.get(key, 0.0)),
+            "expense": float(expense_by_month.get(key, 0.0)),
+            "count": int(counts.get(key, 0))
+        }
     
-    total_income = 0.0
-    total_expense = 0.0
+    total_income = float(pnl_sum(cube, kind="收入"))
+    total_expense = float(pnl_sum(cube, kind="支出"))
     
-    for r in records:
-        f = r.fields
-        ts = f.get("记账日期", 0)
-        if not ts: continue
-        
-        dt = datetime.fromtimestamp(ts / 1000)
-        if dt.year != year: continue
-        
-        amt = float(f.get("实际收付金额", 0))
-        b_type = f.get("业务类型", "")
-        cat = f.get("费用归类", "未分类")
-        
-        monthly_data[dt.month]["count"] += 1
-        
-        if b_type == "收款":
-            monthly_data[dt.month]["income"] += amt
-            total_income += amt
-        elif b_type in ["付款", "费用"]:
-            monthly_data[dt.month]["expense"] += amt
-            total_expense += amt
-            
-            # 统计费用分类
-            if cat not in category_summary: category_summary[cat] = 0.0
-            category_summary[cat] += amt
+    # 统计费用分类 {category: amount}
+    category_summary = {cat: float(v) for cat, v in pnl_sum(cube, "费用归类", kind="支出").items()}
 
     # 生成 HTML
     html = f"""
@@ -12189,14 +15921,7 @@ def reset_system_data(client, app_token):
                 print(f"   🗑️ 正在清空 {t_name} ({len(recs)} 条)...")
                 # Batch delete
                 batch_ids = [r.record_id for r in recs]
-                for i in range(0, len(batch_ids), 100):
-                    batch = batch_ids[i:i+100]
-                    client.bitable.v1.app_table_record.batch_delete(
-                        BatchDeleteAppTableRecordRequest.builder()
-                        .app_token(app_token).table_id(t_id)
-                        .request_body(BatchDeleteAppTableRecordRequestBody.builder().records(batch).build())
-                        .build()
-                    )
+                batch_write_records(client, app_token, t_id, batch_ids, action="delete")
             else:
                 print(f"   ✓ {t_name} 已为空")
                 
@@ -12331,9 +16056,7 @@ def clean_partner_names(client, app_token):
                         batch.append(AppTableRecord.builder().record_id(r.record_id).fields({"往来单位": new_name}).build())
                     
                     # Batch Update
-                    for i in range(0, len(batch), 100):
-                        req = BatchUpdateAppTableRecordRequest.builder().app_token(app_token).table_id(t_pf).request_body(BatchUpdateAppTableRecordRequestBody.builder().records(batch[i:i+100]).build()).build()
-                        client.bitable.v1.app_table_record.batch_update(req)
+                    batch_write_records(client, app_token, t_pf, batch, action="update")
                     count += len(pf_recs)
                     
             # Update Ledger
@@ -12344,9 +16067,7 @@ def clean_partner_names(client, app_token):
                     for r in lg_recs:
                         batch.append(AppTableRecord.builder().record_id(r.record_id).fields({"往来单位费用": new_name}).build())
                         
-                    for i in range(0, len(batch), 100):
-                        req = BatchUpdateAppTableRecordRequest.builder().app_token(app_token).table_id(t_lg).request_body(BatchUpdateAppTableRecordRequestBody.builder().records(batch[i:i+100]).build()).build()
-                        client.bitable.v1.app_table_record.batch_update(req)
+                    batch_write_records(client, app_token, t_lg, batch, action="update")
                     count += len(lg_recs)
             
             print(f"✅ 已合并 {count} 条记录！")
@@ -12354,6 +16075,7 @@ def clean_partner_names(client, app_token):
 # 全局台账缓存 (用于快速查账)
 GLOBAL_LEDGER_CACHE = None
 
+@tracked_report
 def quick_search_ledger(client, app_token):
     """快速查账 (优化版：支持金额、日期、关键词智能搜索)"""
     global GLOBAL_LEDGER_CACHE
@@ -12367,7 +16089,8 @@ def quick_search_ledger(client, app_token):
     # 首次加载或刷新
     if GLOBAL_LEDGER_CACHE is None:
         print("⏳ 正在拉取全量台账数据 (首次加载)...")
-        GLOBAL_LEDGER_CACHE = get_all_records(client, app_token, table_id)
+        GLOBAL_LEDGER_CACHE = get_all_records(client, app_token, table_id,
+                                              field_names=REPORT_FIELDS["quick_search_ledger"]["日常台账表"])
         print(f"✅ 已缓存 {len(GLOBAL_LEDGER_CACHE)} 条记录")
     else:
         print(f"⚡ 使用本地缓存 ({len(GLOBAL_LEDGER_CACHE)} 条) - 输入 'reload' 强制刷新")
@@ -12383,7 +16106,8 @@ def quick_search_ledger(client, app_token):
         
         if query.lower() == 'reload':
             print("🔄 正在刷新数据...")
-            GLOBAL_LEDGER_CACHE = get_all_records(client, app_token, table_id)
+            GLOBAL_LEDGER_CACHE = get_all_records(client, app_token, table_id,
+                                                  field_names=REPORT_FIELDS["quick_search_ledger"]["日常台账表"])
             print(f"✅ 刷新完成: {len(GLOBAL_LEDGER_CACHE)} 条")
             continue
             
@@ -12521,6 +16245,8 @@ def quick_search_ledger(client, app_token):
                             resp = client.bitable.v1.app_table_record.delete(req)
                             
                             if resp.success():
+                                LOCAL_REPLICA.remove_records(table_id, [rid])
+                                note_record_write(table_id, deleted=rid)
                                 print("✅ 删除成功")
                                 # Update cache
                                 GLOBAL_LEDGER_CACHE = [r for r in GLOBAL_LEDGER_CACHE if getattr(r, 'record_id', '') != rid]
@@ -12720,14 +16446,20 @@ def quick_search_ledger(client, app_token):
 
 # 菜单：设置
 def settings_menu():
+    global FETCH_DIAGNOSTICS_ENABLED
     print("\n⚙️  系统设置 (修改后自动保存到 .env)")
     print("-----------------------------------")
     print(f"1. 增值税率 (当前: {VAT_RATE}%)")
     print(f"2. 对账容差天数 (当前: {TOLERANCE_DAYS}天)")
     print(f"3. 智谱AI Key (当前: {ZHIPUAI_API_KEY[:8]}...)" if ZHIPUAI_API_KEY else "3. 智谱AI Key (当前: 未配置)")
+    print(f"4. 本地数据副本 (当前: {'开启' if LOCAL_REPLICA_ENABLED else '关闭'})")
+    print(f"5. 数据拉取诊断 (当前: {'开启' if FETCH_DIAGNOSTICS_ENABLED else '关闭'})")
+    print("6. 接口调用统计 (限流/重试/熔断)")
+    print("7. AI分类缓存 (命中率/容量)")
+    print(f"8. 开启增量同步 (为云端表添加[{REPLICA_MODIFIED_FIELD}]字段)")
     print("0. 返回主菜单")
     
-    choice = input("\n请选择要修改的项 (0-3): ").strip()
+    choice = input("\n请选择要修改的项 (0-8): ").strip()
     
     if choice == "1":
         val = input("请输入新的税率 (例如 3): ").strip()
@@ -12751,6 +16483,65 @@ def settings_menu():
             update_env("ZHIPUAI_API_KEY", val)
             print("✅ API Key 已更新")
     
+    elif choice == "4":
+        status = LOCAL_REPLICA.status()
+        if not status:
+            print("📭 本地副本为空 (首次查询时自动同步)")
+        for st in status:
+            last = datetime.fromtimestamp(st["last_sync"]).strftime("%Y-%m-%d %H:%M:%S") if st["last_sync"] else "-"
+            mode = "增量" if st["modified_field"] else "全量"
+            print(f"  📦 {st['table_id']}: {st['count']} 条 | {mode}同步 | 最近同步 {last}")
+        print(f"  本次运行: 全量 {LOCAL_REPLICA.sync_stats['full']} 次, 增量 {LOCAL_REPLICA.sync_stats['incremental']} 次, "
+              f"拉取 {LOCAL_REPLICA.sync_stats['pulled']} 条, 清除已删除 {LOCAL_REPLICA.sync_stats['pruned']} 条, "
+              f"失败 {LOCAL_REPLICA.sync_stats['failed']} 次")
+        if input("👉 是否清空副本并在下次查询时全量重建? (y/n): ").strip().lower() == 'y':
+            LOCAL_REPLICA.reset()
+            print("✅ 本地副本已清空")
+    
+    elif choice == "5":
+        if FETCH_DIAGNOSTICS:
+            print(f"  {'报表':<28} {'查询次数':>8} {'记录数':>10} {'直接拉取(KB)':>12} {'副本同步(KB)':>12} {'按列拉取':>8}")
+            for name, st in sorted(FETCH_DIAGNOSTICS.items(), key=lambda x: x[1]["bytes"] + x[1]["sync_bytes"], reverse=True):
+                print(f"  {name:<28} {st['calls']:>8} {st['records']:>10,} {st['bytes'] / 1024:>12,.1f} "
+                      f"{st['sync_bytes'] / 1024:>12,.1f} {st['projected']:>8}")
+        else:
+            print("📭 暂无统计 (开启后运行报表即可看到每个报表拉取的记录数和数据量)")
+        FETCH_DIAGNOSTICS_ENABLED = not FETCH_DIAGNOSTICS_ENABLED
+        print(f"✅ 数据拉取诊断已{'开启' if FETCH_DIAGNOSTICS_ENABLED else '关闭'} (仅本次运行有效，长期开启请在 .env 设置 FETCH_DIAGNOSTICS=true)")
+    
+    elif choice == "6":
+        print(f"  {'接口':<14} {'调用':>6} {'重试':>6} {'限流':>6} {'失败':>6} {'拒绝':>6} {'当前速率':>8}  熔断")
+        for row in api_guard_stats():
+            print(f"  {row['接口']:<14} {row['calls']:>6} {row['retries']:>6} {row['throttles']:>6} {row['failures']:>6} "
+                  f"{row['rejected']:>6} {row['当前速率']:>8}  {row['熔断']}")
+    
+    elif choice == "7":
+        load_ai_cache()
+        if not isinstance(AI_CACHE_MAP, AICategoryCache):
+            print("❌ AI缓存数据库不可用")
+            return
+        for k, v in AI_CACHE_MAP.summary().items():
+            print(f"  {k:<8} {v}")
+        if input("👉 是否淘汰超限条目并压缩缓存文件? (y/n): ").strip().lower() == 'y':
+            removed = AI_CACHE_MAP.compact()
+            print(f"✅ 已压缩 (淘汰 {removed} 条)")
+    
+    elif choice == "8":
+        targets = [st["table_id"] for st in LOCAL_REPLICA.status() if not st["modified_field"]]
+        if not targets:
+            print("✅ 本地副本中的表都已按增量同步 (或尚未同步过任何表)")
+            return
+        print(f"📋 以下 {len(targets)} 张表缺少修改时间字段，目前每次都全量同步: {', '.join(targets)}")
+        print(f"   将在飞书中为这些表新增一个[{REPLICA_MODIFIED_FIELD}]字段 (系统字段，由飞书自动维护)")
+        if input("👉 确认修改云端表结构? (y/n): ").strip().lower() != 'y':
+            return
+        client = init_clients()
+        if not client:
+            return
+        for table_id in targets:
+            field = ensure_modified_time_field(client, APP_TOKEN, table_id, create=True)
+            print(f"  {'✅' if field else '❌'} {table_id}: {field or '添加失败，详见日志'}")
+    
     elif choice == "0":
         return
 
@@ -12842,17 +16633,7 @@ def manage_invoice_status(client, app_token):
                     batch_recs.append(AppTableRecord.builder().record_id(r.record_id).fields({"开票状态": "已开票"}).build())
             
             # Execute Batch
-            count = 0
-            for i in range(0, len(batch_recs), 100):
-                batch = batch_recs[i:i+100]
-                req = BatchUpdateAppTableRecordRequest.builder() \
-                    .app_token(app_token) \
-                    .table_id(table_id) \
-                    .request_body(BatchUpdateAppTableRecordRequestBody.builder().records(batch).build()) \
-                    .build()
-                resp = client.bitable.v1.app_table_record.batch_update(req)
-                if resp.success():
-                    count += len(batch)
+            count = batch_write_records(client, app_token, table_id, batch_recs, action="update").success_count
             print(f"✅ 成功标记 {count} 笔记录为已开票")
 
     elif op == '2':
@@ -12878,17 +16659,7 @@ def manage_invoice_status(client, app_token):
             
             if input("❓ 确认执行? (y/n): ").strip().lower() == 'y':
                  # Execute Batch
-                count = 0
-                for i in range(0, len(batch_recs), 100):
-                    batch = batch_recs[i:i+100]
-                    req = BatchUpdateAppTableRecordRequest.builder() \
-                        .app_token(app_token) \
-                        .table_id(table_id) \
-                        .request_body(BatchUpdateAppTableRecordRequestBody.builder().records(batch).build()) \
-                        .build()
-                    resp = client.bitable.v1.app_table_record.batch_update(req)
-                    if resp.success():
-                        count += len(batch)
+                count = batch_write_records(client, app_token, table_id, batch_recs, action="update").success_count
                 print(f"✅ 成功标记 {count} 笔记录为已开票")
                 
         except:
@@ -12896,113 +16667,235 @@ def manage_invoice_status(client, app_token):
 
 
 
-def generate_statement_html(cust_name, month_str, items, total_qty, total_amt, save_dir):
-    """生成对账单 HTML 版本"""
-    fname = os.path.join(save_dir, f"{str(cust_name).replace('/','_')}_{month_str}_对账单.html")
-    
-    rows = ""
-    for idx, it in enumerate(items):
-        bg = "#f9f9f9" if idx % 2 == 0 else "#fff"
-        rows += f"""
-        <tr style="background-color:{bg}">
-            <td>{it['日期']}</td>
-            <td>{it['品名']}</td>
-            <td>{it['规格']}</td>
-            <td style="text-align:right">{it['数量']}</td>
-            <td style="text-align:center">{it['单位']}</td>
-            <td style="text-align:right">{it['单价']:.2f}</td>
-            <td style="text-align:right;font-weight:bold">{it['金额']:.2f}</td>
-            <td style="color:#666;font-size:0.8em">{it['备注']}</td>
-        </tr>
-        """
-        
-    html = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="utf-8">
-        <title>{cust_name} 对账单 {month_str}</title>
-        <style>
-            body {{ font-family: 'Segoe UI', 'Microsoft YaHei', sans-serif; max-width: 900px; margin: 0 auto; padding: 30px; color: #333; }}
-            .header {{ text-align: center; border-bottom: 3px solid #3498db; padding-bottom: 20px; margin-bottom: 30px; }}
-            .title {{ font-size: 28px; font-weight: bold; color: #2c3e50; }}
-            .subtitle {{ font-size: 16px; color: #7f8c8d; margin-top: 5px; }}
-            .info-box {{ display: flex; justify-content: space-between; margin-bottom: 30px; background: #f8f9fa; padding: 20px; border-radius: 8px; }}
-            .info-item {{ font-size: 14px; }}
-            .label {{ color: #7f8c8d; font-weight: 600; }}
-            
-            table {{ width: 100%; border-collapse: collapse; margin-bottom: 30px; }}
-            th {{ background: #3498db; color: white; padding: 12px 8px; text-align: left; font-size: 14px; }}
-            td {{ padding: 10px 8px; border-bottom: 1px solid #eee; font-size: 14px; }}
-            
-            .summary {{ display: flex; justify-content: flex-end; margin-top: 20px; }}
-            .total-box {{ background: #fff3cd; padding: 15px 30px; border-radius: 8px; border: 1px solid #ffeeba; }}
-            .total-line {{ font-size: 16px; margin: 5px 0; text-align: right; }}
-            .grand-total {{ font-size: 24px; font-weight: bold; color: #d35400; border-top: 1px solid #e0c49e; padding-top: 10px; margin-top: 5px; }}
-            
-            .footer {{ margin-top: 50px; border-top: 1px solid #eee; padding-top: 20px; display: flex; justify-content: space-between; font-size: 14px; color: #7f8c8d; }}
-            .sign-area {{ width: 200px; height: 80px; border-bottom: 1px solid #333; margin-top: 30px; }}
-        </style>
-    </head>
-    <body>
-        <div class="header">
-            <div class="title">往来对账单 Statement of Account</div>
-            <div class="subtitle">月份 Period: {month_str}</div>
+STATEMENT_REPORT_CSS = """
+body { font-family: 'Segoe UI', 'Microsoft YaHei', sans-serif; max-width: 900px; margin: 0 auto; padding: 30px; color: #333; }
+.header { text-align: center; border-bottom: 3px solid #3498db; padding-bottom: 20px; margin-bottom: 30px; }
+.title { font-size: 28px; font-weight: bold; color: #2c3e50; }
+.subtitle { font-size: 16px; color: #7f8c8d; margin-top: 5px; }
+.info-box { display: flex; justify-content: space-between; margin-bottom: 30px; background: #f8f9fa; padding: 20px; border-radius: 8px; }
+.info-item { font-size: 14px; }
+.label { color: #7f8c8d; font-weight: 600; }
+
+table { width: 100%; border-collapse: collapse; margin-bottom: 30px; }
+th { background: #3498db; color: white; padding: 12px 8px; text-align: left; font-size: 14px; }
+td { padding: 10px 8px; border-bottom: 1px solid #eee; font-size: 14px; }
+tbody tr { background-color: #fff; }
+tbody tr:nth-child(odd) { background-color: #f9f9f9; }
+
+.summary { display: flex; justify-content: flex-end; margin-top: 20px; }
+.total-box { background: #fff3cd; padding: 15px 30px; border-radius: 8px; border: 1px solid #ffeeba; }
+.total-line { font-size: 16px; margin: 5px 0; text-align: right; }
+.grand-total { font-size: 24px; font-weight: bold; color: #d35400; border-top: 1px solid #e0c49e; padding-top: 10px; margin-top: 5px; }
+
+.footer { margin-top: 50px; border-top: 1px solid #eee; padding-top: 20px; display: flex; justify-content: space-between; font-size: 14px; color: #7f8c8d; }
+.sign-area { width: 200px; height: 80px; border-bottom: 1px solid #333; margin-top: 30px; }
+"""
+
+STATEMENT_REPORT_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="utf-8">
+    <title>{{ partner }} 对账单 {{ month }}</title>
+    <link rel="stylesheet" href="report_assets/statement.css">
+</head>
+<body>
+    <div class="header">
+        <div class="title">往来对账单 Statement of Account</div>
+        <div class="subtitle">月份 Period: {{ month }}</div>
+    </div>
+
+    <div class="info-box">
+        <div>
+            <div class="info-item"><span class="label">往来单位 (Partner):</span> {{ partner }}</div>
+            <div class="info-item"><span class="label">打印日期 (Date):</span> {{ printed }}</div>
         </div>
-        
-        <div class="info-box">
-            <div>
-                <div class="info-item"><span class="label">往来单位 (Partner):</span> {cust_name}</div>
-                <div class="info-item"><span class="label">打印日期 (Date):</span> {datetime.now().strftime('%Y-%m-%d')}</div>
-            </div>
-            <div style="text-align:right">
-                <div class="info-item"><span class="label">共计笔数:</span> {len(items)} 笔</div>
-            </div>
+        <div style="text-align:right">
+            <div class="info-item"><span class="label">共计笔数:</span> {{ count }} 笔</div>
         </div>
-        
-        <table>
-            <thead>
-                <tr>
-                    <th width="12%">日期</th>
-                    <th width="20%">品名</th>
-                    <th width="15%">规格</th>
-                    <th width="10%" style="text-align:right">数量</th>
-                    <th width="8%" style="text-align:center">单位</th>
-                    <th width="10%" style="text-align:right">单价</th>
-                    <th width="12%" style="text-align:right">金额</th>
-                    <th width="13%">备注</th>
-                </tr>
-            </thead>
-            <tbody>
-                {rows}
-            </tbody>
-        </table>
-        
-        <div class="summary">
-            <div class="total-box">
-                <div class="total-line">数量合计: <b>{total_qty:,.2f}</b></div>
-                <div class="total-line grand-total">金额合计: ¥ {total_amt:,.2f}</div>
-            </div>
+    </div>
+
+    <table>
+        <thead>
+            <tr>
+                <th width="12%">日期</th>
+                <th width="20%">品名</th>
+                <th width="15%">规格</th>
+                <th width="10%" style="text-align:right">数量</th>
+                <th width="8%" style="text-align:center">单位</th>
+                <th width="10%" style="text-align:right">单价</th>
+                <th width="12%" style="text-align:right">金额</th>
+                <th width="13%">备注</th>
+            </tr>
+        </thead>
+        <tbody>
+{% for it in items %}            <tr><td>{{ it.日期 }}</td><td>{{ it.品名 }}</td><td>{{ it.规格 }}</td><td style="text-align:right">{{ it.数量 }}</td><td style="text-align:center">{{ it.单位 }}</td><td style="text-align:right">{{ it.单价:.2f }}</td><td style="text-align:right;font-weight:bold">{{ it.金额:.2f }}</td><td style="color:#666;font-size:0.8em">{{ it.备注 }}</td></tr>
+{% endfor %}        </tbody>
+    </table>
+
+    <div class="summary">
+        <div class="total-box">
+            <div class="total-line">数量合计: <b>{{ total_qty:,.2f }}</b></div>
+            <div class="total-line grand-total">金额合计: ¥ {{ total_amt:,.2f }}</div>
         </div>
-        
-        <div class="footer">
-            <div style="text-align:center">
-                <div>我方制单 (Prepared By)</div>
-                <div class="sign-area"></div>
-            </div>
-            <div style="text-align:center">
-                <div>对方确认 (Confirmed By)</div>
-                <div class="sign-area"></div>
-                <div>请核对无误后签字盖章回传</div>
-            </div>
+    </div>
+
+    <div class="footer">
+        <div style="text-align:center">
+            <div>我方制单 (Prepared By)</div>
+            <div class="sign-area"></div>
         </div>
-    </body>
-    </html>
+        <div style="text-align:center">
+            <div>对方确认 (Confirmed By)</div>
+            <div class="sign-area"></div>
+            <div>请核对无误后签字盖章回传</div>
+        </div>
+    </div>
+</body>
+</html>
+"""
+
+def generate_statement_html(cust_name, month_str, items, total_qty, total_amt, save_dir, printed=None):
+    """生成对账单 HTML 版本 (printed: 打印日期，默认今天；样式在 save_dir/report_assets/statement.css)"""
+    fname = os.path.join(save_dir, f"{str(cust_name).replace('/','_')}_{month_str}_对账单.html")
+    ensure_report_assets(save_dir, {"statement.css": STATEMENT_REPORT_CSS})
+    return write_report(fname, report_template("statement", STATEMENT_REPORT_PAGE), {
+        "partner": cust_name,
+        "month": month_str,
+        "printed": (printed or datetime.now()).strftime('%Y-%m-%d'),
+        "count": len(items),
+        "items": items,
+        "total_qty": total_qty,
+        "total_amt": total_amt,
+    })
+
+# -------------------------- 批量对账单：分组与并行生成 --------------------------
+# 月末给几百家往来单位出对账单，耗时主要在渲染与写文件。记录一次遍历按单位分组，
+# 每家单位的 Excel/HTML 由 render_business_statement 独立生成，可放到进程池并行；
+# 打印日期与文档时间由调用方统一传入，串行与并行生成的文件逐字节一致
+STATEMENT_WORKERS = int(os.getenv("STATEMENT_WORKERS", min(4, os.cpu_count() or 1))) # 进程数，1 为串行
+STATEMENT_PARALLEL_MIN = int(os.getenv("STATEMENT_PARALLEL_MIN", 20)) # 单位数达到该值才启用进程池
+STATEMENT_COLUMNS = ["日期", "品名", "规格", "数量", "单位", "单价", "金额", "备注"]
+STATEMENT_COLUMN_WIDTHS = {"日期": 12, "品名": 15, "规格": 15, "金额": 12, "备注": 20} # 其余列按内容自适应
+
+def group_statement_items(records, aliases=None):
+    """加工费明细记录 -> {往来单位(别名归并后): [按日期排序的明细]}，一次遍历"""
+    aliases = aliases or {}
+    partner_data = {}
+    for r in records:
+        f = record_to_parts(r)[1]
+        raw_p = f.get("往来单位", "未知单位")
+        p = aliases.get(raw_p, raw_p)
+        ts = f.get("日期", 0)
+        partner_data.setdefault(p, []).append({
+            "日期": datetime.fromtimestamp(ts / 1000).strftime("%Y-%m-%d"),
+            "品名": f.get("品名", ""),
+            "规格": f.get("规格", ""),
+            "数量": float(f.get("数量", 0)),
+            "单位": f.get("单位", "件"),
+            "单价": float(f.get("单价", 0)),
+            "金额": float(f.get("总金额", 0)),
+            "备注": f.get("备注", "")
+        })
+    for items in partner_data.values():
+        items.sort(key=lambda x: x["日期"])
+    return partner_data
+
+def statement_file_stem(partner, month_str):
+    safe_name = str(partner).replace("/", "_").replace("\\", "_")
+    return f"{safe_name}_{month_str}_对账单"
+
+def write_statement_workbook(path, items, total_qty, total_amt, created):
     """
-    
-    with open(fname, "w", encoding="utf-8") as f:
-        f.write(html)
-    return fname
+    对账单 Excel (样式同 apply_excel_styles：蓝底表头、细边框、金额千分位、A4 横向一页宽)
+    文档创建时间固定为 created，相同数据生成的文件逐字节一致
+    """
+    rows = [[it[c] for c in STATEMENT_COLUMNS] for it in items]
+    rows.append(["合计", f"{len(items)} 笔", "", total_qty, "", "", total_amt, ""])
+    workbook = xlsxwriter.Workbook(path)
+    try:
+        workbook.set_properties({"created": created})
+        header = workbook.add_format({"bold": True, "font_color": "#FFFFFF", "bg_color": "#4F81BD", "border": 1,
+                                      "align": "center", "valign": "vcenter"})
+        cell = workbook.add_format({"border": 1, "valign": "vcenter"})
+        money = workbook.add_format({"border": 1, "valign": "vcenter", "num_format": "#,##0.00"})
+        ws = workbook.add_worksheet("对账单")
+        ws.set_paper(9) # A4
+        ws.set_landscape()
+        ws.fit_to_pages(1, 0)
+        ws.write_row(0, 0, STATEMENT_COLUMNS, header)
+        for r, row in enumerate(rows, start=1):
+            for c, v in enumerate(row):
+                is_money = STATEMENT_COLUMNS[c] in ("单价", "金额") and isinstance(v, (int, float))
+                ws.write(r, c, v, money if is_money else cell)
+        for c, col in enumerate(STATEMENT_COLUMNS):
+            width = STATEMENT_COLUMN_WIDTHS.get(col)
+            if width is None:
+                longest = max(len(str(v)) for v in [col] + [row[c] for row in rows])
+                width = min((longest + 2) * 1.2, 50)
+            ws.set_column(c, c, width)
+    finally:
+        workbook.close()
+
+def render_business_statement(job):
+    """
+    生成一家单位的对账单 (Excel + HTML)，可在子进程中执行
+    job: {"partner", "month", "items", "save_dir", "printed"(datetime)}
+    返回 (单位, [生成的文件], [错误信息])
+    """
+    partner, month_str, items = job["partner"], job["month"], job["items"]
+    total_qty = sum(it["数量"] for it in items)
+    total_amt = sum(it["金额"] for it in items)
+    files, errors = [], []
+    fname_xlsx = os.path.join(job["save_dir"], statement_file_stem(partner, month_str) + ".xlsx")
+    try:
+        write_statement_workbook(fname_xlsx, items, total_qty, total_amt, job["printed"])
+        files.append(fname_xlsx)
+    except Exception as e:
+        errors.append(f"生成 Excel 失败: {e}")
+    try:
+        files.append(generate_statement_html(partner, month_str, items, total_qty, total_amt, job["save_dir"],
+                                             printed=job["printed"]))
+    except Exception as e:
+        errors.append(f"生成 HTML 失败: {e}")
+    return partner, files, errors
+
+def render_statements(jobs, workers=None, progress=None):
+    """
+    批量生成对账单；单位数达到 STATEMENT_PARALLEL_MIN 且 workers > 1 时使用进程池
+    progress(已完成数, 总数, 单位) 在每家完成时回调；返回按 jobs 顺序的结果列表
+    """
+    workers = STATEMENT_WORKERS if workers is None else workers
+    results = [None] * len(jobs)
+    if workers > 1 and len(jobs) >= STATEMENT_PARALLEL_MIN:
+        for save_dir in dict.fromkeys(job["save_dir"] for job in jobs): # 样式先写好，子进程只需比对
+            ensure_report_assets(save_dir, {"statement.css": STATEMENT_REPORT_CSS})
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {pool.submit(render_business_statement, job): i for i, job in enumerate(jobs)}
+                for done, fut in enumerate(as_completed(futures), start=1):
+                    i = futures[fut]
+                    results[i] = fut.result()
+                    if progress:
+                        progress(done, len(jobs), results[i][0])
+            return results
+        except (OSError, BrokenProcessPool) as e:
+            log.warning(f"⚠️ 进程池不可用: {e}", extra={"solution": "改为逐家生成"})
+    for i, job in enumerate(jobs):
+        if results[i] is None:
+            results[i] = render_business_statement(job)
+        if progress:
+            progress(i + 1, len(jobs), results[i][0])
+    return results
+
+def archive_statements(zip_path, files, base_dir):
+    """把生成的对账单打包为一个 zip (按文件名排序、固定时间戳，相同内容的压缩包逐字节一致)"""
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for path in sorted(files):
+            info = zipfile.ZipInfo(os.path.relpath(path, base_dir), (1980, 1, 1, 0, 0, 0))
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with open(path, "rb") as f:
+                zf.writestr(info, f.read())
+    return zip_path
 
 def batch_generate_business_statements(client, app_token, pre_mode=None):
     """批量生成对账单 (支持 客户加工费 / 供应商外协费)"""
@@ -13068,84 +16961,34 @@ def batch_generate_business_statements(client, app_token, pre_mode=None):
         print(f"📭 {user_input} 无{mode_name}记录")
         return
 
-    # 分组数据
-    partner_data = {} # Partner -> List of dict
-    
-    for r in records:
-        f = r.fields
-        raw_p = f.get("往来单位", "未知单位")
-        p = aliases.get(raw_p, raw_p)
-        
-        ts = f.get("日期", 0)
-        d_str = datetime.fromtimestamp(ts/1000).strftime("%Y-%m-%d")
-        
-        item = {
-            "日期": d_str,
-            "品名": f.get("品名", ""),
-            "规格": f.get("规格", ""),
-            "数量": float(f.get("数量", 0)),
-            "单位": f.get("单位", "件"),
-            "单价": float(f.get("单价", 0)),
-            "金额": float(f.get("总金额", 0)),
-            "备注": f.get("备注", "")
-        }
-        if p not in partner_data: partner_data[p] = []
-        partner_data[p].append(item)
+    # 分组数据 (一次遍历)
+    partner_data = group_statement_items(records, aliases)
         
     # 生成文件
     save_dir = os.path.join(DATA_ROOT, f"{mode_name}对账单", user_input)
     if not os.path.exists(save_dir): os.makedirs(save_dir)
     
     print(f"📂 正在生成对账单 (共 {len(partner_data)} 家)...")
+    printed = datetime.now().replace(microsecond=0)
+    jobs = [{"partner": p, "month": user_input, "items": items, "save_dir": save_dir, "printed": printed}
+            for p, items in partner_data.items()]
     
-    for p_name, items in partner_data.items():
-        # 按日期排序
-        items.sort(key=lambda x: x["日期"])
+    def progress(done, total, partner):
+        print(f"\r   ⏳ 进度 {done}/{total} ({done * 100 // total}%)", end="", flush=True)
         
-        # 转 DataFrame
-        df = pd.DataFrame(items)
-        
-        # 添加合计行
-        total_qty = df["数量"].sum()
-        total_amt = df["金额"].sum()
-        
-        total_row = pd.DataFrame([{
-            "日期": "合计",
-            "品名": f"{len(items)} 笔",
-            "规格": "",
-            "数量": total_qty,
-            "单位": "",
-            "单价": "",
-            "金额": total_amt,
-            "备注": ""
-        }])
-        df = pd.concat([df, total_row], ignore_index=True)
-        
-        safe_name = str(p_name).replace("/", "_").replace("\\", "_")
-        
-        # 1. Excel
-        fname_xlsx = os.path.join(save_dir, f"{safe_name}_{user_input}_对账单.xlsx")
-        try:
-            with pd.ExcelWriter(fname_xlsx, engine='openpyxl') as writer:
-                df.to_excel(writer, index=False, sheet_name="对账单")
-                ws = writer.sheets["对账单"]
-                apply_excel_styles(ws)
-                # 调整列宽
-                ws.column_dimensions['A'].width = 12
-                ws.column_dimensions['B'].width = 15
-                ws.column_dimensions['C'].width = 15
-                ws.column_dimensions['G'].width = 12
-                ws.column_dimensions['H'].width = 20
-        except Exception as e:
-            print(f"❌ 生成 Excel 失败: {e}")
-
-        # 2. HTML (Visual)
-        try:
-            generate_statement_html(p_name, user_input, items, total_qty, total_amt, save_dir)
-        except Exception as e:
-            print(f"❌ 生成 HTML 失败: {e}")
+    results = render_statements(jobs, progress=progress)
+    print()
+    files = []
+    for partner, paths, errors in results:
+        files.extend(paths)
+        for err in errors:
+            print(f"❌ {partner}: {err}")
             
     print(f"✅ 全部生成完毕！文件保存在: {Color.UNDERLINE}{save_dir}{Color.ENDC}")
+    if files and input("📦 是否另外打包为一个压缩包? (y/N): ").strip().lower() == 'y':
+        files += ensure_report_assets(save_dir, {"statement.css": STATEMENT_REPORT_CSS}) # HTML 引用的样式一并打包
+        zip_path = archive_statements(os.path.join(save_dir, f"{mode_name}对账单_{user_input}.zip"), files, save_dir)
+        print(f"✅ 已打包: {zip_path}")
     try: os.startfile(save_dir)
     except: pass
 
@@ -13239,6 +17082,7 @@ def manage_supplier_payment(client, app_token):
         .build()
         
     resp = client.bitable.v1.app_table_record.create(req)
+    note_record_write(ledger_id)
     if resp.success():
         print(f"✅ 付款已记录到台账！")
         
@@ -13275,14 +17119,7 @@ def manage_supplier_payment(client, app_token):
                                      batch_recs.append(AppTableRecord.builder().record_id(r.record_id).fields({"结算状态": "已结算"}).build())
                                  
                                  # Execute Batch
-                                 for i in range(0, len(batch_recs), 100):
-                                     batch = batch_recs[i:i+100]
-                                     req_b = BatchUpdateAppTableRecordRequest.builder() \
-                                         .app_token(app_token) \
-                                         .table_id(pf_table_id) \
-                                         .request_body(BatchUpdateAppTableRecordRequestBody.builder().records(batch).build()) \
-                                         .build()
-                                     client.bitable.v1.app_table_record.batch_update(req_b)
+                                 batch_write_records(client, app_token, pf_table_id, batch_recs, action="update")
                                  print(f"✅ 已自动核销 {len(to_settle)} 笔记录")
                          else:
                              print("⚠️ 付款金额不足以核销最早的一笔记录，暂不执行核销。")
@@ -13340,6 +17177,7 @@ def manage_processing_payment(client, app_token):
         .build()
         
     resp = client.bitable.v1.app_table_record.create(req)
+    note_record_write(ledger_id)
     if resp.success():
         print(f"✅ 收款已记录到台账！")
         
@@ -13376,14 +17214,7 @@ def manage_processing_payment(client, app_token):
                                  batch_recs.append(AppTableRecord.builder().record_id(r.record_id).fields({"结算状态": "已结算"}).build())
                              
                              # Execute Batch
-                             for i in range(0, len(batch_recs), 100):
-                                 batch = batch_recs[i:i+100]
-                                 req_b = BatchUpdateAppTableRecordRequest.builder() \
-                                     .app_token(app_token) \
-                                     .table_id(pf_table_id) \
-                                     .request_body(BatchUpdateAppTableRecordRequestBody.builder().records(batch).build()) \
-                                     .build()
-                                 client.bitable.v1.app_table_record.batch_update(req_b)
+                             batch_write_records(client, app_token, pf_table_id, batch_recs, action="update")
                              print(f"✅ 已自动核销 {len(to_settle)} 笔记录")
                      else:
                          print("⚠️ 收款金额不足以核销最早的一笔记录，暂不执行核销。")
@@ -13410,7 +17241,7 @@ def generate_anodizing_demo_data(client, app_token):
         batch = []
         for p in prices:
             batch.append(AppTableRecord.builder().fields(p).build())
-        client.bitable.v1.app_table_record.batch_create(BatchCreateAppTableRecordRequest.builder().app_token(app_token).table_id(pt_id).request_body(BatchCreateAppTableRecordRequestBody.builder().records(batch).build()).build())
+        batch_write_records(client, app_token, pt_id, batch)
 
     # 2. 填充加工费记录 (Processing Fees)
     pf_id = create_processing_fee_table(client, app_token)
@@ -13470,7 +17301,7 @@ def generate_anodizing_demo_data(client, app_token):
         batch = []
         for r in records:
             batch.append(AppTableRecord.builder().fields(r).build())
-        client.bitable.v1.app_table_record.batch_create(BatchCreateAppTableRecordRequest.builder().app_token(app_token).table_id(pf_id).request_body(BatchCreateAppTableRecordRequestBody.builder().records(batch).build()).build())
+        batch_write_records(client, app_token, pf_id, batch)
 
     # 3. 填充日常台账 (Ledger)
     lg_id = create_ledger_table(client, app_token)
@@ -13520,7 +17351,7 @@ def generate_anodizing_demo_data(client, app_token):
         batch = []
         for r in recs:
             batch.append(AppTableRecord.builder().fields(r).build())
-        client.bitable.v1.app_table_record.batch_create(BatchCreateAppTableRecordRequest.builder().app_token(app_token).table_id(lg_id).request_body(BatchCreateAppTableRecordRequestBody.builder().records(batch).build()).build())
+        batch_write_records(client, app_token, lg_id, batch)
         
     print(f"{Color.OKGREEN}✅ 模拟数据生成完毕！请进入各个菜单查看效果。{Color.ENDC}")
 
@@ -13589,6 +17420,7 @@ def main():
     parser.add_argument("--generate-demo", action="store_true", help="[新] 生成氧化厂模拟数据 (小白专用)")
     parser.add_argument("--reset-system", action="store_true", help="[新] 系统初始化/重置 (数据清空)")
     parser.add_argument("--backup", action="store_true", help="[新] 全量数据备份")
+    parser.add_argument("--bench-reconcile", type=int, nargs='?', const=50000, help="对账匹配性能测试 (流水/台账笔数，默认50000)")
     
     args = parser.parse_args()
 
@@ -13608,6 +17440,10 @@ def main():
     if args.menu:
         interactive_menu()
         return
+
+    if args.bench_reconcile:
+        benchmark_reconcile_matching(args.bench_reconcile)
+        return
         
     if args.settings:
         settings_menu()
@@ -13646,6 +17482,7 @@ def main():
         create_asset_table(client, APP_TOKEN) # 新增
         create_salary_table(client, APP_TOKEN) # 新增
         create_processing_fee_table(client, APP_TOKEN) # 新增
+        create_summary_table(client, APP_TOKEN)
         print("✅ 所有表格初始化完成！")
         fill_test_data(client, APP_TOKEN)
         send_bot_message(f"✅ 表格初始化完成！Base: {APP_TOKEN}", "accountant")
@@ -13768,6 +17605,10 @@ def check_for_updates():
         log.warning(f"⚠️ 检查更新失败: {e}", extra={"solution": "请手动 git pull"})
 
 if __name__ == "__main__":
+    # 打包成 exe 后，进程池 (批量对账单) 的子进程会重新执行本入口；
+    # freeze_support 让子进程只运行任务，不再检查更新、进入菜单
+    multiprocessing.freeze_support()
+    
     # 启用 Windows ANSI 支持
     if os.name == 'nt':
         os.system('color')
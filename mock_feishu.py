@@ -1,14 +1,29 @@
 
+import re
+import json
+import time
 import uuid
 import logging
 
 class MockDataStore:
     # Global store for mock data
     tables = [] 
+    # 每次 list 调用计数 (用于验证缓存/增量同步效果)
+    list_calls = 0
+    # client_token -> 首次请求的响应 (模拟服务端的幂等去重)
+    client_tokens = {}
 
     @classmethod
     def reset(cls):
         cls.tables = []
+        cls.list_calls = 0
+        cls.client_tokens = {}
+
+    @classmethod
+    def now_ms(cls):
+        # 保证单调递增，模拟云端的最后修改时间
+        cls._last_ts = max(int(time.time() * 1000), getattr(cls, "_last_ts", 0) + 1)
+        return cls._last_ts
 
     @classmethod
     def get_table(cls, table_id):
@@ -29,14 +44,24 @@ class MockDataStore:
         if exist: return exist['table_id']
         
         tid = f"tbl_{uuid.uuid4().hex[:8]}"
-        cls.tables.append({"table_id": tid, "name": name, "records": []})
+        cls.tables.append({"table_id": tid, "name": name, "records": [], "fields": []})
         return tid
 
+def match_mock_filter(filter_str, record):
+    """仅支持增量同步用到的 CurrentValue.[修改时间字段]>=N，其余过滤条件忽略"""
+    if not filter_str: return True
+    m = re.match(r'^CurrentValue\.\[(.+?)\]>=(\d+)$', filter_str)
+    if not m: return True
+    return record.get("modified", 0) >= int(m.group(2))
+
+TABLE_NOT_FOUND = 1254041 # 飞书 TableIdNotFound
+
 class MockResponse:
-    def __init__(self, success=True, msg="success", data=None):
+    def __init__(self, success=True, msg="success", data=None, code=None):
         self._success = success
         self.msg = msg
         self.data = data
+        self.code = code
     def success(self): return self._success
 
 class MockObj:
@@ -62,9 +87,11 @@ class MockClient:
             def __init__(self):
                 self.app_table = self._AppTable()
                 self.app_table_record = self._AppTableRecord()
+                self.app_table_field = self._AppTableField()
 
             class _AppTable:
                 def list(self, req):
+                    MockDataStore.list_calls += 1
                     items = []
                     for t in MockDataStore.tables:
                         items.append(MockObj(table_id=t['table_id'], name=t['name']))
@@ -86,43 +113,95 @@ class MockClient:
                     tid = MockDataStore.create_table(name)
                     return MockResponse(data=MockObj(table_id=tid))
 
+            class _AppTableField:
+                def list(self, req):
+                    t = MockDataStore.get_table(req.table_id)
+                    if not t: return MockResponse(False, "Table not found", code=TABLE_NOT_FOUND)
+                    items = [MockObj(field_name=f['name'], type=f['type']) for f in t.get('fields', [])]
+                    return MockResponse(data=MockObj(items=items, has_more=False, page_token=None))
+
+                def create(self, req):
+                    t = MockDataStore.get_table(req.table_id)
+                    if not t: return MockResponse(False, "Table not found", code=TABLE_NOT_FOUND)
+                    body = req.request_body
+                    t.setdefault('fields', []).append({"name": body.field_name, "type": body.type})
+                    return MockResponse(data=MockObj(field=MockObj(field_name=body.field_name, type=body.type)))
+
             class _AppTableRecord:
                 def list(self, req):
+                    MockDataStore.list_calls += 1
                     t = MockDataStore.get_table(req.table_id)
-                    if not t: return MockResponse(False, "Table not found")
+                    if not t: return MockResponse(False, "Table not found", code=TABLE_NOT_FOUND)
                     
+                    # 字段投影: field_names 为 JSON 数组字符串
+                    wanted = getattr(req, 'field_names', None)
+                    wanted = json.loads(wanted) if wanted else None
                     items = []
                     for r in t['records']:
-                        items.append(MockObj(record_id=r['record_id'], fields=r['fields']))
-                    return MockResponse(data=MockObj(items=items, has_more=False, page_token=None))
+                        if not match_mock_filter(getattr(req, 'filter', None), r): continue
+                        fields = {k: v for k, v in r['fields'].items() if k in wanted} if wanted else r['fields']
+                        items.append(MockObj(record_id=r['record_id'], fields=fields,
+                                             last_modified_time=r.get('modified', 0)))
+                    # 分页: page_token 即偏移量
+                    page_size = getattr(req, 'page_size', None) or len(items) or 1
+                    start = int(getattr(req, 'page_token', None) or 0)
+                    end = start + page_size
+                    has_more = end < len(items)
+                    return MockResponse(data=MockObj(items=items[start:end], has_more=has_more,
+                                                     page_token=str(end) if has_more else None))
 
                 def batch_create(self, req):
                     t = MockDataStore.get_table(req.table_id)
-                    if not t: return MockResponse(False, "Table not found")
+                    if not t: return MockResponse(False, "Table not found", code=TABLE_NOT_FOUND)
+                    token = getattr(req, 'client_token', None)
+                    if token and token in MockDataStore.client_tokens:
+                        return MockDataStore.client_tokens[token]
                     
+                    created = []
                     for r in req.request_body.records:
                         rid = f"rec_{uuid.uuid4().hex[:8]}"
-                        t['records'].append({"record_id": rid, "fields": r.fields})
-                    return MockResponse()
+                        t['records'].append({"record_id": rid, "fields": r.fields, "modified": MockDataStore.now_ms()})
+                        created.append(MockObj(record_id=rid, fields=r.fields))
+                    resp = MockResponse(data=MockObj(records=created))
+                    if token:
+                        MockDataStore.client_tokens[token] = resp
+                    return resp
 
                 def create(self, req):
                     t = MockDataStore.get_table(req.table_id)
-                    if not t: return MockResponse(False, "Table not found")
+                    if not t: return MockResponse(False, "Table not found", code=TABLE_NOT_FOUND)
                     rid = f"rec_{uuid.uuid4().hex[:8]}"
-                    t['records'].append({"record_id": rid, "fields": req.request_body.fields})
-                    return MockResponse(data=MockObj(record_id=rid))
+                    t['records'].append({"record_id": rid, "fields": req.request_body.fields, "modified": MockDataStore.now_ms()})
+                    return MockResponse(data=MockObj(record_id=rid, record=MockObj(record_id=rid, fields=req.request_body.fields)))
                 
+                def update(self, req):
+                    t = MockDataStore.get_table(req.table_id)
+                    if not t: return MockResponse(False, "Table not found", code=TABLE_NOT_FOUND)
+                    for existing in t['records']:
+                        if existing['record_id'] == req.record_id:
+                            existing['fields'].update(req.request_body.fields)
+                            existing['modified'] = MockDataStore.now_ms()
+                    return MockResponse()
+
                 def batch_update(self, req):
                     t = MockDataStore.get_table(req.table_id)
-                    if not t: return MockResponse(False, "Table not found")
+                    if not t: return MockResponse(False, "Table not found", code=TABLE_NOT_FOUND)
                     for r in req.request_body.records:
                         for existing in t['records']:
                             if existing['record_id'] == r.record_id:
                                 existing['fields'].update(r.fields)
+                                existing['modified'] = MockDataStore.now_ms()
+                    return MockResponse()
+
+                def batch_delete(self, req):
+                    t = MockDataStore.get_table(req.table_id)
+                    if not t: return MockResponse(False, "Table not found", code=TABLE_NOT_FOUND)
+                    ids = set(req.request_body.records)
+                    t['records'] = [r for r in t['records'] if r['record_id'] not in ids]
                     return MockResponse()
                 
                 def delete(self, req):
                     t = MockDataStore.get_table(req.table_id)
-                    if not t: return MockResponse(False, "Table not found")
+                    if not t: return MockResponse(False, "Table not found", code=TABLE_NOT_FOUND)
                     t['records'] = [r for r in t['records'] if r['record_id'] != req.record_id]
                     return MockResponse()
@@ -26,6 +26,8 @@ MockDataStore.reset()
 # Patch init_clients
 CW.init_clients = lambda: MockClient()
 CW.APP_TOKEN = "mock_app_token"
+# 模拟表每次重建，清掉上次运行留下的表名缓存
+CW.invalidate_table_id_cache(CW.APP_TOKEN)
 CW.ZHIPUAI_API_KEY = "mock_ai_key"
 # Mock ZhipuAI to avoid errors
 CW.zhipu_client = MagicMock()
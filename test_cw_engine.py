@@ -0,0 +1,1280 @@
+# -*- coding: utf-8 -*-
+"""
+CW.py 数据引擎测试
+使用 mock_feishu 模拟飞书接口，验证本地副本、过滤公式解释等底层逻辑
+"""
+
+import os
+import sys
+import time
+from datetime import datetime
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import CW
+from mock_feishu import MockClient, MockDataStore, MockResponse
+
+
+@pytest.fixture
+def mock_env(tmp_path, monkeypatch):
+    """独立的模拟飞书 + 临时本地副本"""
+    MockDataStore.reset()
+    monkeypatch.setattr(CW, "LOCAL_REPLICA", CW.LocalReplica(str(tmp_path / "replica.db")))
+    monkeypatch.setattr(CW, "REPLICA_AUTO_ADD_FIELD", True) # 相当于已在设置菜单中开启增量同步
+    monkeypatch.setattr(CW, "FILE_TABLE_ID_CACHE", str(tmp_path / "table_ids.json"))
+    monkeypatch.setattr(CW, "TABLE_ID_CACHE", None)
+    CW.TABLE_ID_MISSES.clear()
+    monkeypatch.setattr(CW, "SESSION_SNAPSHOT", None)
+    CW.RECORD_CACHE.clear()
+    client = MockClient()
+    tid = MockDataStore.create_table("日常台账表")
+    return client, tid
+
+
+def add_mock_records(client, tid, rows):
+    recs = [CW.AppTableRecord.builder().fields(f).build() for f in rows]
+    req = CW.BatchCreateAppTableRecordRequest.builder().app_token("app").table_id(tid) \
+        .request_body(CW.BatchCreateAppTableRecordRequestBody.builder().records(recs).build()).build()
+    assert client.bitable.v1.app_table_record.batch_create(req).success()
+
+
+def mock_failure(msg, code=None):
+    resp = MockResponse(False, msg)
+    resp.code = code
+    return resp
+
+
+def test_compile_record_filter():
+    f = {"记账日期": 1000, "类型": "收入-加工服务", "结算状态": "未结算"}
+    assert CW.compile_record_filter('AND(CurrentValue.[记账日期]>=1000, CurrentValue.[记账日期]<2000)')(f)
+    assert not CW.compile_record_filter('CurrentValue.[记账日期]>1000')(f)
+    assert CW.compile_record_filter('CurrentValue.[记账日期]>=500&&CurrentValue.[类型]="收入-加工服务"')(f)
+    assert CW.compile_record_filter('CurrentValue.[结算状态]!="已结算"')(f)
+    # 缺失字段: != 为真，其余为假
+    assert CW.compile_record_filter('CurrentValue.[往来单位]!="A"')(f)
+    assert not CW.compile_record_filter('CurrentValue.[往来单位]="A"')(f)
+    assert CW.compile_record_filter('CurrentValue.[类型].contains("加工")')(f)
+    # 无法解析的公式回退云端
+    assert CW.compile_record_filter('TODAY()>CurrentValue.[记账日期]') is None
+
+
+def test_replica_incremental_sync(mock_env, monkeypatch):
+    client, tid = mock_env
+    monkeypatch.setattr(CW, "REPLICA_WATERMARK_SKEW_MS", 0)
+    add_mock_records(client, tid, [
+        {"记账日期": 1000, "实际收付金额": 10.0, "备注": "A"},
+        {"记账日期": 2000, "实际收付金额": 20.0, "备注": "B"},
+    ])
+
+    recs = CW.get_all_records(client, "app", tid, filter_info="CurrentValue.[记账日期]>=1500", field_names=["实际收付金额"])
+    assert [r.fields for r in recs] == [{"实际收付金额": 20.0}]
+    meta = CW.LOCAL_REPLICA.get_meta(tid)
+    assert meta["modified_field"] == CW.REPLICA_MODIFIED_FIELD
+
+    add_mock_records(client, tid, [{"记账日期": 3000, "实际收付金额": 30.0, "备注": "C"}])
+    before = CW.LOCAL_REPLICA.sync_stats["pulled"]
+    recs = CW.get_all_records(client, "app", tid)
+    assert [r.fields["备注"] for r in recs] == ["A", "B", "C"]
+    assert CW.LOCAL_REPLICA.sync_stats["incremental"] >= 1
+    # 增量同步只拉取了水位之后的记录
+    assert CW.LOCAL_REPLICA.sync_stats["pulled"] - before < 3
+    # 兼容 record['fields'] 写法
+    assert recs[0]["fields"]["备注"] == "A"
+
+
+def test_replica_prunes_remote_deletions(mock_env, monkeypatch):
+    client, tid = mock_env
+    monkeypatch.setattr(CW, "REPLICA_PRUNE_INTERVAL", 0)
+    add_mock_records(client, tid, [{"备注": "A"}, {"备注": "B"}, {"备注": "C"}])
+    assert len(CW.get_all_records(client, "app", tid)) == 3
+    # 其他人在飞书中删除一条：下一次增量同步按记录ID比对后清除
+    MockDataStore.get_table(tid)["records"] = [r for r in MockDataStore.get_table(tid)["records"] if r["fields"]["备注"] != "B"]
+    assert [r.fields["备注"] for r in CW.get_all_records(client, "app", tid)] == ["A", "C"]
+    assert CW.LOCAL_REPLICA.sync_stats == {"full": 1, "incremental": 1, "pulled": 5, "pruned": 1, "failed": 0}
+
+
+def test_replica_does_not_add_field_by_default(mock_env, monkeypatch):
+    client, tid = mock_env
+    monkeypatch.setattr(CW, "REPLICA_AUTO_ADD_FIELD", False)
+    add_mock_records(client, tid, [{"备注": "A"}])
+    assert len(CW.get_all_records(client, "app", tid)) == 1
+    assert CW.LOCAL_REPLICA.get_meta(tid)["modified_field"] is None
+    assert not any(f["name"] == CW.REPLICA_MODIFIED_FIELD for f in MockDataStore.get_table(tid)["fields"])
+    # 设置菜单中确认后才添加
+    assert CW.ensure_modified_time_field(client, "app", tid, create=True) == CW.REPLICA_MODIFIED_FIELD
+
+
+def test_replica_remove_records(mock_env):
+    client, tid = mock_env
+    add_mock_records(client, tid, [{"备注": "A"}, {"备注": "B"}])
+    recs = CW.get_all_records(client, "app", tid)
+    req = CW.DeleteAppTableRecordRequest.builder().app_token("app").table_id(tid).record_id(recs[0].record_id).build()
+    assert client.bitable.v1.app_table_record.delete(req).success()
+    CW.LOCAL_REPLICA.remove_records(tid, [recs[0].record_id])
+    assert [r.fields["备注"] for r in CW.get_all_records(client, "app", tid)] == ["B"]
+
+
+def test_iter_record_pages_prefetch(mock_env):
+    client, tid = mock_env
+    add_mock_records(client, tid, [{"备注": str(i)} for i in range(250)])
+
+    # 统计在调用方处理某页期间已发出的请求数
+    calls = []
+    original_list = client.bitable.v1.app_table_record.list
+    client.bitable.v1.app_table_record.list = lambda req: (calls.append(req.page_token), original_list(req))[1]
+
+    stats = CW.PageFetchStats(tid)
+    seen = []
+    for page in CW.iter_record_pages(client, "app", tid, prefetch=True, stats=stats):
+        if not seen:
+            time.sleep(0.2)
+            # 第一页处理期间，第二页请求已经在后台发出
+            assert len(calls) == 2
+        seen.extend(r.fields["备注"] for r in page)
+
+    assert seen == [str(i) for i in range(250)]
+    assert len(stats.page_latencies) == 3 and stats.records == 250
+    assert CW.LAST_FETCH_STATS[tid] is stats
+
+
+def test_iter_all_records_streams_from_replica(mock_env):
+    client, tid = mock_env
+    add_mock_records(client, tid, [{"记账日期": i} for i in range(5)])
+    got = [r.fields["记账日期"] for r in CW.iter_all_records(client, "app", tid, filter_info="CurrentValue.[记账日期]>=2")]
+    assert got == [2, 3, 4]
+
+    # 副本按页分段读取：取到第一页时尚未读取其余记录
+    statements = []
+    CW.LOCAL_REPLICA.connect().set_trace_callback(statements.append)
+    pages = CW.LOCAL_REPLICA.iter_query(client, "app", tid, page_size=2)
+    first = next(pages)
+    reads = [s for s in statements if "FROM records" in s]
+    assert [r.fields["记账日期"] for r in first] == [0, 1] and len(reads) == 1
+    assert [[r.fields["记账日期"] for r in p] for p in pages] == [[2, 3], [4]]
+    CW.LOCAL_REPLICA.connect().set_trace_callback(None)
+
+
+def test_table_id_cache(mock_env):
+    client, tid = mock_env
+    calls = CW.TABLE_LIST_STATS["list_calls"]
+    for _ in range(3):
+        assert CW.get_table_id_by_name(client, "app", "日常台账表") == tid
+    assert CW.TABLE_LIST_STATS["list_calls"] - calls == 1
+
+    # 不存在的表: 刷新一次后在 TTL 内不再重复请求
+    assert CW.get_table_id_by_name(client, "app", "不存在的表") is None
+    assert CW.get_table_id_by_name(client, "app", "不存在的表") is None
+    assert CW.TABLE_LIST_STATS["list_calls"] - calls == 2
+
+    # 新建表登记后直接命中 (建表前的存在性检查会刷新一次)
+    ok, new_tid = CW.create_basic_info_table(client, "app")
+    assert ok and CW.get_table_id_by_name(client, "app", "基础信息表") == new_tid
+    assert CW.TABLE_LIST_STATS["list_calls"] - calls == 3
+
+    # 持久化: 新进程读取文件即可命中
+    CW.TABLE_ID_CACHE = None
+    assert CW.get_table_id_by_name(client, "app", "日常台账表") == tid
+    assert CW.TABLE_LIST_STATS["list_calls"] - calls == 3
+
+
+def test_stale_table_id_relocated_once(mock_env, monkeypatch):
+    client, tid = mock_env
+    monkeypatch.setattr(CW, "FEISHU_GUARD", CW.ServiceGuard("飞书", ["feishu.read", "feishu.write", "feishu.meta"],
+                                                            CW.classify_feishu_response))
+    monkeypatch.setattr(CW, "TABLE_ID_REMAP", {})
+    CW.guard_feishu_client(client)
+    assert CW.get_table_id_by_name(client, "app", "日常台账表") == tid
+
+    # 表在飞书中被删除后重建：缓存的旧 ID 失效
+    MockDataStore.get_table(tid)["table_id"] = "tbl_rebuilt"
+    calls = CW.TABLE_LIST_STATS["list_calls"]
+    assert CW.batch_write_records(client, "app", tid, [{"备注": "新表"}]).success_count == 1
+    assert [r["fields"] for r in MockDataStore.get_table("tbl_rebuilt")["records"]] == [{"备注": "新表"}]
+    assert CW.get_table_id_by_name(client, "app", "日常台账表") == "tbl_rebuilt"
+    # 调用方手里的旧 ID 直接改写，不再重复刷新表列表
+    assert CW.batch_write_records(client, "app", tid, [{"备注": "再写"}]).success_count == 1
+    assert CW.TABLE_LIST_STATS["list_calls"] - calls == 1
+
+    # 表被删除且没有重建：返回原错误，表名缓存不再给出旧 ID
+    MockDataStore.tables.clear()
+    failed = CW.batch_write_records(client, "app", "tbl_rebuilt", [{"备注": "x"}])
+    assert failed.failed and CW.get_table_id_by_name(client, "app", "日常台账表") is None
+
+
+def test_batch_write_records_retries_failed_chunks(mock_env, monkeypatch):
+    client, tid = mock_env
+    monkeypatch.setattr(CW, "WRITE_RETRY_DELAY", 0)
+    original_create = client.bitable.v1.app_table_record.batch_create
+    attempts = []
+
+    def flaky_create(req):
+        # 第二批首次发送失败 (写冲突)，重试成功
+        first = req.request_body.records[0].fields["序号"]
+        attempts.append(first)
+        if first == 100 and attempts.count(100) == 1:
+            return mock_failure("Write conflict", 1254291)
+        return original_create(req)
+
+    client.bitable.v1.app_table_record.batch_create = flaky_create
+    result = CW.batch_write_records(client, "app", tid, [{"序号": i} for i in range(250)], concurrency=3)
+
+    assert result.chunks == 3 and result.retries == 1
+    assert result.success_count == 250 and not result.failed
+    assert sorted(attempts) == [0, 100, 100, 200]
+    # 逐条结果与输入顺序对应
+    stored = {r["record_id"]: r["fields"]["序号"] for r in MockDataStore.get_table(tid)["records"]}
+    assert [stored[rid] for rid in result.record_ids] == list(range(250))
+
+    # 服务端已写入但响应丢失：同一 client_token 重发，不产生重复记录
+    tokens = []
+    def lost_response(req):
+        tokens.append(req.client_token)
+        resp = original_create(req)
+        if len(tokens) == 1:
+            raise TimeoutError("read timed out")
+        return resp
+    client.bitable.v1.app_table_record.batch_create = lost_response
+    retried = CW.batch_write_records(client, "app", tid, [{"序号": 999}])
+    assert len(tokens) == 2 and tokens[0] and tokens[0] == tokens[1]
+    assert retried.success_count == 1
+    assert [r["fields"]["序号"] for r in MockDataStore.get_table(tid)["records"]].count(999) == 1
+
+
+def test_batch_write_records_update_and_delete(mock_env, monkeypatch):
+    client, tid = mock_env
+    monkeypatch.setattr(CW, "WRITE_RETRY_DELAY", 0)
+    created = CW.batch_write_records(client, "app", tid, [{"备注": str(i)} for i in range(5)])
+    assert [r.fields["备注"] for r in CW.get_all_records(client, "app", tid)] == ["0", "1", "2", "3", "4"]
+
+    updates = [{"record_id": rid, "fields": {"备注": "已改"}} for rid in created.record_ids[:2]]
+    assert CW.batch_write_records(client, "app", tid, updates, action="update").success_count == 2
+
+    deleted = CW.batch_write_records(client, "app", tid, created.record_ids[2:4], action="delete", chunk_size=1)
+    assert deleted.chunks == 2 and deleted.success_count == 2
+    # 删除同步到本地副本
+    assert [r.fields["备注"] for r in CW.get_all_records(client, "app", tid)] == ["已改", "已改", "4"]
+
+    # 返回的删除结果少于发送条数：缺的按已删除处理，缓存与副本照常清理
+    original_delete = client.bitable.v1.app_table_record.batch_delete
+    def short_delete(req):
+        resp = original_delete(req)
+        resp.data = type("Data", (), {"records": [type("Deleted", (), {"deleted": True})()]})()
+        return resp
+    client.bitable.v1.app_table_record.batch_delete = short_delete
+    deleted = CW.batch_write_records(client, "app", tid, [created.record_ids[0], created.record_ids[4]], action="delete")
+    assert deleted.success_count == 2
+    assert [r.fields["备注"] for r in CW.get_all_records(client, "app", tid)] == ["已改"]
+    client.bitable.v1.app_table_record.batch_delete = original_delete
+
+    # 不可重试的错误只发送一次
+    calls = []
+    client.bitable.v1.app_table_record.batch_create = lambda req: (calls.append(1), mock_failure("bad field", 1254060))[1]
+    failed = CW.batch_write_records(client, "app", tid, [{"备注": "x"}])
+    assert len(calls) == 1 and failed.failed and failed.failed[0][1]["error"] == "1254060 bad field"
+
+
+def test_report_fields_projection(mock_env, monkeypatch):
+    client, tid = mock_env
+    monkeypatch.setattr(CW, "LOCAL_REPLICA_ENABLED", False)
+    monkeypatch.setattr(CW, "FETCH_DIAGNOSTICS_ENABLED", True)
+    monkeypatch.setattr(CW, "FETCH_DIAGNOSTICS", {})
+    monkeypatch.setattr(CW, "TABLE_FIELD_CACHE", {})
+    MockDataStore.get_table(tid)["fields"] = [{"name": n, "type": 1} for n in ("记账日期", "实际收付金额", "备注")]
+    add_mock_records(client, tid, [{"记账日期": i, "实际收付金额": 1.0, "备注": "x" * 200} for i in range(3)])
+    CW.get_table_id_by_name(client, "app", "日常台账表")
+
+    declared = CW.ReportFields(["实际收付金额", "不存在的字段"])
+
+    def helper():
+        return CW.get_all_records(client, "app", tid)
+
+    # 声明中不存在的字段在云端投影前被剔除
+    @CW.tracked_report
+    def demo_report():
+        own = CW.get_all_records(client, "app", tid, field_names=declared)
+        streamed = list(CW.iter_all_records(client, "app", tid, field_names=declared))
+        return own, streamed, helper()
+
+    own, streamed, nested = demo_report()
+    assert [r.fields for r in own] == [{"实际收付金额": 1.0}] * 3
+    assert [r.fields for r in streamed] == [{"实际收付金额": 1.0}] * 3
+    # 报表内部调用的其他函数不受声明影响
+    assert nested[0].fields["备注"] == "x" * 200
+
+    st = CW.FETCH_DIAGNOSTICS["demo_report"]
+    assert st["calls"] == 3 and st["records"] == 9 and st["projected"] == 2
+    # 字节数按云端实际返回统计：两次按列拉取 + 一次全列
+    assert 3 * 200 < st["bytes"] < 2 * 3 * 200 and st["sync_bytes"] == 0
+
+    # 开启本地副本时，网络流量是全列的副本同步，单独计入 sync_bytes
+    monkeypatch.setattr(CW, "LOCAL_REPLICA_ENABLED", True)
+    CW.FETCH_DIAGNOSTICS.clear()
+    demo_report()
+    st = CW.FETCH_DIAGNOSTICS["demo_report"]
+    assert st["bytes"] == 0 and st["sync_bytes"] > 3 * 200
+    monkeypatch.setattr(CW, "LOCAL_REPLICA_ENABLED", False)
+    # 报表之外的查询不做投影
+    assert CW.get_all_records(client, "app", tid)[0].fields["备注"] == "x" * 200
+    # 各报表的取数都显式使用 REPORT_FIELDS 中的声明
+    frame = CW.load_records_frame(client, "app", tid, field_names=CW.REPORT_FIELDS["calculate_tax"]["日常台账表"])
+    assert list(frame.columns) == ["是否有票", "交易银行", "业务类型", "实际收付金额"]
+    assert frame["实际收付金额"].tolist() == [1.0] * 3
+
+
+def test_session_snapshot(mock_env, monkeypatch):
+    client, tid = mock_env
+    add_mock_records(client, tid, [{"记账日期": i, "备注": str(i)} for i in range(3)])
+    monkeypatch.setattr(CW, "SESSION_SNAPSHOT", CW.SessionSnapshot())
+
+    CW.get_all_records(client, "app", tid)
+    calls = MockDataStore.list_calls
+    # 同一会话内重复分析不再访问云端
+    assert len(CW.get_all_records(client, "app", tid, filter_info="CurrentValue.[记账日期]>=1")) == 2
+    assert [r.fields for r in CW.iter_all_records(client, "app", tid, field_names=["备注"])][0] == {"备注": "0"}
+    assert MockDataStore.list_calls == calls
+
+    # 调用方修改返回的记录不影响快照
+    CW.get_all_records(client, "app", tid)[0].fields["备注"] = "改坏"
+    assert CW.get_all_records(client, "app", tid)[0].fields["备注"] == "0"
+
+    # 本程序的批量写入直接合并进快照
+    created = CW.batch_write_records(client, "app", tid, [{"记账日期": 9, "备注": "新"}])
+    CW.batch_write_records(client, "app", tid, [{"record_id": created.record_ids[0], "fields": {"备注": "新2"}}], action="update")
+    first = CW.get_all_records(client, "app", tid)[0].record_id
+    CW.batch_write_records(client, "app", tid, [first], action="delete")
+    assert [r.fields["备注"] for r in CW.get_all_records(client, "app", tid)] == ["1", "2", "新2"]
+    assert MockDataStore.list_calls == calls
+
+    # 单条写入标记过期，下次读取重新加载
+    CW.note_record_write(tid)
+    CW.get_all_records(client, "app", tid)
+    assert MockDataStore.list_calls > calls
+    assert CW.SESSION_SNAPSHOT.stats["loads"] == 2
+
+
+def test_records_frame_and_vectorised_tax(mock_env, monkeypatch):
+    client, tid = mock_env
+    ts = int(datetime(2024, 3, 5, 10, 0).timestamp() * 1000)
+    add_mock_records(client, tid, [
+        {"记账日期": ts, "业务类型": "收款", "实际收付金额": 1130, "是否有票": "有票", "交易银行": "G银行"},
+        {"记账日期": ts, "业务类型": "收款", "实际收付金额": "2,000", "交易银行": "N银行"},
+        {"记账日期": ts, "业务类型": "付款", "实际收付金额": 300, "是否有票": "有票", "交易银行": "对公户"},
+        {"记账日期": ts, "业务类型": "费用", "实际收付金额": 50, "交易银行": "G银行"},
+        {"记账日期": ts, "业务类型": "费用", "实际收付金额": -20, "交易银行": "现金"},
+    ])
+
+    df = CW.records_to_frame(CW.iter_all_records(client, "app", tid), ["记账日期", "实际收付金额", "业务类型", "是否有票", "备注"],
+                             defaults={"是否有票": "无票"})
+    assert CW.pd.api.types.is_datetime64_dtype(df["记账日期"])
+    assert df["记账日期"].iloc[0] == datetime(2024, 3, 5, 10, 0)
+    assert df["实际收付金额"].dtype == "float64" and df["实际收付金额"].sum() == 3460.0
+    assert df["业务类型"].dtype == "category"
+    assert list(df["是否有票"]) == ["有票", "无票", "有票", "无票", "无票"]
+    assert df["备注"].isna().all()
+
+    monkeypatch.setattr(CW, "get_ai_insight", lambda ctx: "")
+    monkeypatch.setattr(CW, "VAT_RATE", 13)
+    msg = CW.calculate_tax(client, "app", target_year=2024)
+    assert "有票收入: 1,130.00" in msg
+    assert "有票成本: 300.00" in msg
+    assert "无票支出: 30.00 (含G银行: 50.00)" in msg
+    assert "预计增值税: 130.00" in msg
+
+
+def test_offline_reads_do_not_wait_for_feishu(mock_env, tmp_path, monkeypatch):
+    client, tid = mock_env
+    add_mock_records(client, tid, [{"记账日期": 1, "实际收付金额": 10.0, "备注": "A"}])
+    assert len(CW.get_all_records(client, "app", tid)) == 1 # 首次同步建立副本
+    journal = CW.OfflineJournal(str(tmp_path / "journal.db"))
+    monkeypatch.setattr(CW, "OFFLINE_JOURNAL", journal)
+    offline = CW.OfflineClient(client, journal)
+
+    # 飞书不可用：读取与查重直接使用已有副本，不发请求，只登记后台同步
+    online_list = MockClient._Bitable._V1._AppTableRecord.list
+    calls = []
+    monkeypatch.setattr(MockClient._Bitable._V1._AppTableRecord, "list",
+                        lambda self, req: (calls.append(1), (_ for _ in ()).throw(ConnectionError("offline")))[1])
+    assert [r.fields["备注"] for r in CW.get_all_records(offline, "app", tid)] == ["A"]
+    CW.DUPLICATE_INDEXES.clear()
+    CW.check_duplicate(offline, "app", tid, 10.0, "1970-01-01", "", "A")
+    assert calls == [] and journal.pull_requests == {("app", tid)}
+
+    # 恢复后由后台线程拉取他人新增的记录
+    monkeypatch.setattr(MockClient._Bitable._V1._AppTableRecord, "list", online_list)
+    add_mock_records(client, tid, [{"备注": "B"}])
+    journal.pull_requested(client)
+    assert not journal.pull_requests
+    assert {r.fields["备注"] for r in CW.get_all_records(offline, "app", tid)} == {"A", "B"}
+
+
+def test_offline_journal_sync_and_conflicts(mock_env, tmp_path, monkeypatch):
+    client, tid = mock_env
+    add_mock_records(client, tid, [{"备注": "云端"}])
+    remote_id = MockDataStore.get_table(tid)["records"][0]["record_id"]
+    journal = CW.OfflineJournal(str(tmp_path / "journal.db"))
+    monkeypatch.setattr(CW, "OFFLINE_JOURNAL", journal)
+    offline = CW.OfflineClient(client, journal)
+    assert len(CW.get_all_records(offline, "app", tid)) == 1
+
+    # 写入立即返回临时ID，本地读取可见，云端尚未变化
+    rid = CW.batch_write_records(offline, "app", tid, [{"备注": "离线新增"}]).record_ids[0]
+    assert rid.startswith(CW.OFFLINE_ID_PREFIX)
+    req = CW.UpdateAppTableRecordRequest.builder().app_token("app").table_id(tid).record_id(rid) \
+        .request_body(CW.AppTableRecord.builder().fields({"实际收付金额": 5}).build()).build()
+    assert offline.bitable.v1.app_table_record.update(req).success()
+    assert len(MockDataStore.get_table(tid)["records"]) == 1
+    assert {r.fields["备注"] for r in CW.get_all_records(offline, "app", tid)} == {"云端", "离线新增"}
+
+    # 云端不可用时保持待同步
+    online_list = MockClient._Bitable._V1._AppTableRecord.list
+    monkeypatch.setattr(MockClient._Bitable._V1._AppTableRecord, "list",
+                        lambda self, req: (_ for _ in ()).throw(ConnectionError("offline")))
+    assert journal.flush(client)["pending"] == 2
+    monkeypatch.setattr(MockClient._Bitable._V1._AppTableRecord, "list", online_list)
+
+    result = journal.flush(client)
+    assert result["synced"] == 2 and result["pending"] == 0
+    remote = {r["record_id"]: r["fields"] for r in MockDataStore.get_table(tid)["records"]}
+    new_id = journal.resolve(rid)
+    assert remote[new_id] == {"备注": "离线新增", "实际收付金额": 5}
+    assert {r.record_id for r in CW.get_all_records(offline, "app", tid)} == {remote_id, new_id}
+
+    # 本程序自己推送后的修改不算冲突
+    CW.batch_write_records(offline, "app", tid, [{"record_id": new_id, "fields": {"备注": "再改"}}], action="update")
+    assert journal.flush(client) == {"synced": 1, "conflicts": 0, "failed": 0, "pending": 0}
+
+    # 离线修改之后云端又被改动: 标记冲突，不覆盖云端
+    req = CW.UpdateAppTableRecordRequest.builder().app_token("app").table_id(tid).record_id(remote_id) \
+        .request_body(CW.AppTableRecord.builder().fields({"备注": "本地改"}).build()).build()
+    offline.bitable.v1.app_table_record.update(req)
+    client.bitable.v1.app_table_record.update(CW.UpdateAppTableRecordRequest.builder().app_token("app").table_id(tid)
+        .record_id(remote_id).request_body(CW.AppTableRecord.builder().fields({"备注": "别人改"}).build()).build())
+    assert journal.flush(client)["conflicts"] == 1
+    assert MockDataStore.get_table(tid)["records"][0]["fields"]["备注"] == "别人改"
+
+    # 以本地为准重新提交
+    seq = journal.entries("conflict")[0]["seq"]
+    assert journal.resolve_conflict(seq, keep_local=True)
+    assert journal.flush(client)["synced"] == 1
+    assert MockDataStore.get_table(tid)["records"][0]["fields"]["备注"] == "本地改"
+
+    # 新增已在云端生效但响应丢失：保持待同步，下轮用同一 client_token 重推，不产生重复记录
+    rid = CW.batch_write_records(offline, "app", tid, [{"备注": "超时新增"}]).record_ids[0]
+    real_create = MockClient._Bitable._V1._AppTableRecord.batch_create
+    tokens = []
+    def lost(self, req):
+        tokens.append(req.client_token)
+        resp = real_create(self, req)
+        if len(tokens) == 1:
+            raise TimeoutError("read timed out")
+        return resp
+    monkeypatch.setattr(MockClient._Bitable._V1._AppTableRecord, "batch_create", lost)
+    assert journal.flush(client)["pending"] == 1
+    assert journal.flush(client)["synced"] == 1
+    assert tokens[0] == tokens[1] == CW.journal_client_token(rid)
+    assert [r["fields"].get("备注") for r in MockDataStore.get_table(tid)["records"]].count("超时新增") == 1
+
+    # 返回的记录数对不上时不能当作已同步
+    CW.batch_write_records(offline, "app", tid, [{"备注": "无返回"}])
+    monkeypatch.setattr(MockClient._Bitable._V1._AppTableRecord, "batch_create",
+                        lambda self, req: MockResponse(data=type("Data", (), {"records": []})()))
+    assert journal.flush(client)["failed"] == 1
+    assert journal.entries("failed", tid)[-1]["fields"] == {"备注": "无返回"}
+
+
+def test_service_guard_throttle_retry_and_breaker(mock_env, monkeypatch):
+    client, tid = mock_env
+    monkeypatch.setattr(CW, "GUARD_BACKOFF_BASE", 0)
+    guard = CW.ServiceGuard("飞书", ["feishu.read", "feishu.write", "feishu.meta"], CW.classify_feishu_response)
+    guard.breaker = CW.CircuitBreaker("飞书", threshold=2, cooldown=0.05)
+    monkeypatch.setattr(CW, "FEISHU_GUARD", guard)
+    CW.guard_feishu_client(client)
+    api = client.bitable.v1.app_table_record
+
+    # 限流响应: 按服务端提示等待后在请求级别重试，并降低该接口族的速率
+    replies = [mock_failure("too many requests", code=1254290)]
+    replies[0].raw = type("Raw", (), {"headers": {"x-ogw-ratelimit-reset": "0.01"}})()
+    real_list = api._target.list
+    monkeypatch.setattr(api._target, "list", lambda req: replies.pop(0) if replies else real_list(req))
+    assert CW.get_all_records(client, "app", tid) == []
+    st = guard.stats["feishu.read"]
+    assert st["throttles"] == 1 and st["retries"] == 1
+    assert guard.buckets["feishu.read"].rate < CW.GUARD_RATES["feishu.read"][0]
+
+    # 业务错误不重试、不计入熔断
+    monkeypatch.setattr(api._target, "list", lambda req: mock_failure("bad filter", code=1254018))
+    assert not api.list(CW.ListAppTableRecordRequest.builder().app_token("app").table_id(tid).build()).success()
+    assert st["retries"] == 1 and guard.breaker.failures == 0
+
+    # 写请求超时/断线时可能已生效，不重发；被限流 (未执行) 时才重发
+    calls = []
+    def broken(req):
+        calls.append(req)
+        raise ConnectionError("down")
+    monkeypatch.setattr(api._target, "update", broken)
+    req = CW.UpdateAppTableRecordRequest.builder().app_token("app").table_id(tid).record_id("rec") \
+        .request_body(CW.AppTableRecord.builder().fields({}).build()).build()
+    with pytest.raises(ConnectionError):
+        api.update(req)
+    assert len(calls) == 1 and guard.stats["feishu.write"]["retries"] == 0
+    replies = [mock_failure("too many requests", code=99991400), CW.UpdateAppTableRecordResponse()]
+    monkeypatch.setattr(api._target, "update", lambda req: calls.append(req) or replies.pop(0))
+    api.update(req)
+    assert len(calls) == 3 and guard.stats["feishu.write"]["retries"] == 1
+
+    # 网络异常连续失败后熔断，之后直接失败不再发出请求
+    calls.clear()
+    monkeypatch.setattr(api._target, "list", broken)
+    list_req = CW.ListAppTableRecordRequest.builder().app_token("app").table_id(tid).build()
+    with pytest.raises(CW.CircuitOpenError):
+        api.list(list_req)
+    assert len(calls) == 2 and guard.breaker.trips == 1
+    with pytest.raises(CW.CircuitOpenError):
+        api.update(req)
+    assert len(calls) == 2 and guard.stats["feishu.write"]["rejected"] == 1
+
+    # 冷却后放行一次试探请求，成功则恢复
+    time.sleep(0.06)
+    monkeypatch.setattr(api._target, "update", lambda req: CW.UpdateAppTableRecordResponse())
+    api.update(req)
+    assert guard.breaker.state == "closed"
+
+
+def test_streaming_export_matches_in_memory(mock_env, tmp_path, monkeypatch):
+    client, tid = mock_env
+    ts = int(datetime(2024, 5, 6, 7, 8, 9).timestamp() * 1000)
+    add_mock_records(client, tid, [{"记账日期": ts, "实际收付金额": i * 1.5, "备注": f"第{i}笔", "附件": ["a", "b"]} for i in range(5)])
+    other = MockDataStore.create_table("往来单位表")
+    add_mock_records(client, other, [{"往来单位名称": "甲"}])
+    monkeypatch.setattr(CW, "EXPORT_PAGE_SIZE", 2)
+
+    def read_back(streaming):
+        out = tmp_path / ("stream" if streaming else "memory")
+        out.mkdir()
+        assert CW.export_to_excel(client, "app", str(out), streaming=streaming)
+        path = next(out.iterdir())
+        wb = CW.openpyxl.load_workbook(path)
+        sheets = {}
+        for ws in wb.worksheets:
+            rows = list(ws.iter_rows(values_only=True))
+            header = rows[0] if rows else ()
+            sheets[ws.title] = [{h: v for h, v in zip(header, row) if h} for row in rows[1:]]
+        return wb, sheets
+
+    wb, streamed = read_back(True)
+    _, in_memory = read_back(False)
+    assert list(streamed) == ["日常台账表", "往来单位表"]
+    for name, rows in in_memory.items():
+        assert [{k: r.get(k) for k in row} for row, r in zip(rows, streamed[name])] == rows
+    assert streamed["日常台账表"][4]["记账日期"] == "2024-05-06 07:08:09"
+    assert streamed["日常台账表"][4]["附件"] == "['a', 'b']"
+
+    # 表头样式与金额列格式保持不变
+    ws = wb["日常台账表"]
+    header = [c.value for c in ws[1]]
+    assert ws.cell(1, 1).font.bold
+    assert ws.cell(2, header.index("实际收付金额") + 1).number_format == "#,##0.00"
+
+
+def test_keyword_matcher_keeps_rule_priority(monkeypatch):
+    import random
+    rng = random.Random(7)
+    alphabet = "张三丰李四电费ABab"
+    words = lambda n, lo, hi: ["".join(rng.choice(alphabet) for _ in range(rng.randint(lo, hi))) for _ in range(n)]
+    rules = {k: f"分类{i}" for i, k in enumerate(words(60, 1, 4))}
+    aliases = {k: f"单位{i}" for i, k in enumerate(words(60, 1, 5))}
+    monkeypatch.setattr(CW, "AUTO_CATEGORY_RULES", rules)
+    monkeypatch.setattr(CW, "PARTNER_ALIASES", aliases)
+    monkeypatch.setattr(CW, "AI_CACHE_LOADED", True)
+    monkeypatch.setattr(CW, "ZHIPUAI_API_KEY", "")
+
+    def old_categorize(desc):
+        for key, value in rules.items():
+            if key.lower() in desc.lower():
+                return value
+        return "默认"
+
+    def old_resolve(name):
+        if name in aliases:
+            return aliases[name]
+        for alias in sorted(aliases, key=len, reverse=True):
+            if alias in name:
+                return aliases[alias]
+        return name
+
+    for text in words(300, 0, 12):
+        assert CW.auto_categorize(text, "默认") == old_categorize(text)
+        assert CW.resolve_partner(text) == old_resolve(text.strip())
+
+    # 热修改后重新编译
+    rules["zz"] = "新分类"
+    del rules[next(iter(rules))]
+    CW.rebuild_keyword_matchers()
+    assert CW.auto_categorize("ZZ", "默认") == old_categorize("ZZ")
+
+
+def test_keyword_matcher_cost_independent_of_rule_count():
+    import random
+    rng = random.Random(1)
+    text = "".join(rng.choice("收到某某公司货款转账手续费电费") for _ in range(40))
+
+    def per_call(n):
+        keys = ["".join(rng.choice("甲乙丙丁戊己庚辛壬癸") for _ in range(6)) + str(i) for i in range(n)]
+        matcher = CW.KeywordMatcher([(k, i) for i, k in enumerate(keys)])
+        best = float("inf")
+        for _ in range(5):
+            t0 = time.perf_counter()
+            for _ in range(200):
+                matcher.search(text)
+            best = min(best, time.perf_counter() - t0)
+        return best
+
+    small, large = per_call(50), per_call(5000)
+    # 逐条扫描时规则数增加100倍耗时也约增加100倍；自动机只与文本长度有关
+    assert large < small * 5
+
+
+def test_batched_ai_categorisation(tmp_path, monkeypatch):
+    import re
+    import threading
+    from types import SimpleNamespace
+
+    calls = []
+    lock = threading.Lock()
+
+    def create(model, messages):
+        prompt = messages[0]["content"]
+        items = re.findall(r"^\d+\. 交易对象: .* \| 交易摘要: (.*)$", prompt, re.M)
+        with lock:
+            calls.append(items)
+        content = CW.json.dumps([f"AI-{desc}" for desc in items], ensure_ascii=False)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+    fake = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    saves = []
+    monkeypatch.setattr(CW, "zhipu_client", fake)
+    monkeypatch.setattr(CW, "ZHIPUAI_API_KEY", "test")
+    monkeypatch.setattr(CW, "AUTO_CATEGORY_RULES", {"电费": "水电费"})
+    monkeypatch.setattr(CW, "HISTORY_CATEGORY_MAP", {})
+    store = CW.AICategoryCache(str(tmp_path / "ai_cache.db"))
+    store["已缓存摘要|某公司"] = "办公费"
+    monkeypatch.setattr(CW, "AI_CACHE_MAP", store)
+    monkeypatch.setattr(CW, "AI_CACHE_LOADED", True)
+    monkeypatch.setattr(CW, "AI_BATCH_SIZE", 4)
+    original_save = CW.save_ai_cache
+    monkeypatch.setattr(CW, "save_ai_cache", lambda: (saves.append(1), original_save()))
+
+    rows = []
+    for i in range(30):
+        desc = f"摘要{i % 10}"  # 10 种不同摘要，各重复 3 次
+        rows.append({"费用归类": CW.auto_categorize(desc, "其他", partner_name="某公司", defer_ai=True)})
+    rows.append({"费用归类": CW.auto_categorize("交电费", "其他", partner_name="某公司", defer_ai=True)})
+    rows.append({"费用归类": CW.auto_categorize("已缓存摘要", "其他", partner_name="某公司", defer_ai=True)})
+    assert not calls
+    assert rows[0]["费用归类"] == "其他"
+
+    assert CW.resolve_pending_categories(rows) == 30
+    assert sorted(len(c) for c in calls) == [2, 4, 4]
+    assert rows[0]["费用归类"] == "AI-摘要0" and rows[29]["费用归类"] == "AI-摘要9"
+    assert rows[30]["费用归类"] == "水电费" and rows[31]["费用归类"] == "办公费"
+    assert saves == [1]
+    assert len(store) == 11 and store.stats["writes"] == 11
+
+    # 已写入缓存，再次导入不再请求
+    again = [{"费用归类": CW.auto_categorize("摘要3", "其他", partner_name="某公司", defer_ai=True)}]
+    assert again[0]["费用归类"] == "AI-摘要3"
+    assert len(calls) == 3
+
+
+def test_ai_category_cache_store(tmp_path):
+    legacy = tmp_path / "ai_category_cache.json"
+    legacy.write_text(CW.json.dumps({f"旧摘要{i}|散户": "办公费" for i in range(5)}, ensure_ascii=False), encoding="utf-8")
+    db = str(tmp_path / "ai_cache.db")
+
+    store = CW.AICategoryCache(db, max_entries=10, legacy_json=str(legacy))
+    assert len(store) == 5 and store.get("旧摘要0|散户") == "办公费"
+    assert store.get("不存在") is None
+    assert store.stats["hits"] == 1 and store.stats["misses"] == 1
+
+    # 再次打开不会重复导入，数据在库里而不是内存
+    store.conn.close()
+    store = CW.AICategoryCache(db, max_entries=10, legacy_json=str(legacy))
+    assert len(store) == 5
+
+    # 超过上限后按最近使用淘汰：刚读过的 旧摘要1 保留，其余最旧的被淘汰
+    time.sleep(0.01)
+    store.get("旧摘要1|散户")
+    store.flush()
+    store.update({f"新摘要{i}|散户": "快递费" for i in range(6)})
+    assert len(store) == 9 and store.stats["evicted"] == 2
+    assert "旧摘要1|散户" in store and "旧摘要0|散户" not in store
+    assert store["新摘要5|散户"] == "快递费"
+    with pytest.raises(KeyError):
+        store["旧摘要0|散户"]
+    assert store.summary()["条目"] == 9
+
+
+def test_history_index_incremental(mock_env, tmp_path, monkeypatch):
+    client, tid = mock_env
+    monkeypatch.setattr(CW, "REPLICA_WATERMARK_SKEW_MS", 0)
+    monkeypatch.setattr(CW, "HISTORY_INDEX_DB", str(tmp_path / "history_index.db"))
+    monkeypatch.setattr(CW, "HISTORY_INDEX", None)
+    monkeypatch.setattr(CW, "HISTORY_CATEGORY_MAP", {})
+    monkeypatch.setattr(CW, "CATEGORY_MODEL", None)
+    monkeypatch.setattr(CW, "AI_CACHE_DB", str(tmp_path / "ai_cache.db"))
+    monkeypatch.setattr(CW, "AI_CACHE_MAP", {})
+    folded = []
+    original_fold = CW.fold_history_records
+    monkeypatch.setattr(CW, "fold_history_records", lambda index, records: (folded.append(len(records)), original_fold(index, records))[1])
+
+    add_mock_records(client, tid, [
+        {"备注": "购买打印纸A4", "往来单位费用": "文具店", "费用归类": "办公费"},
+        {"备注": "滴滴出行", "往来单位费用": "滴滴", "费用归类": "差旅费-交通"},
+        {"备注": "收到货款", "往来单位费用": "散户", "费用归类": ""},
+    ])
+    CW.load_history_knowledge(client, "app")
+    assert CW.HISTORY_CATEGORY_MAP == {"购买打印纸a4": "办公费", "PARTNER:文具店": "办公费",
+                                       "滴滴出行": "差旅费-交通", "PARTNER:滴滴": "差旅费-交通"}
+    assert folded == [3]
+    assert len(CW.CATEGORY_MODEL.samples) == 2
+
+    # 新进程：从本地索引恢复，只合并水位上的一条 (>= 水位，重复合并无副作用) 和新增的一条
+    monkeypatch.setattr(CW, "HISTORY_INDEX", None)
+    monkeypatch.setattr(CW, "HISTORY_CATEGORY_MAP", {})
+    add_mock_records(client, tid, [{"备注": "购买打印纸A4", "往来单位费用": "文具店", "费用归类": "耗材"}])
+    CW.load_history_knowledge(client, "app")
+    assert folded == [3, 2]
+    assert len(CW.CATEGORY_MODEL.samples) == 3
+    assert CW.HISTORY_CATEGORY_MAP["购买打印纸a4"] == "耗材"
+    assert CW.HISTORY_CATEGORY_MAP["滴滴出行"] == "差旅费-交通"
+
+    # 无变化时不再全量扫描，也不改写任何特征或样本
+    writes = []
+    conn = CW.history_index_store().connect()
+    conn.set_trace_callback(lambda sql: writes.append(sql) if sql.startswith(("INSERT OR REPLACE INTO entries", "INSERT OR REPLACE INTO samples", "DELETE")) else None)
+    CW.load_history_knowledge(client, "app")
+    conn.set_trace_callback(None)
+    assert folded == [3, 2, 1]
+    assert writes == []
+    stored = CW.read_history_index()
+    assert stored["entries"] == CW.HISTORY_INDEX["entries"] and stored["samples"] == CW.HISTORY_INDEX["samples"]
+
+    CW.load_history_knowledge(client, "app", force_rebuild=True)
+    assert folded[-1] == 4 and CW.HISTORY_CATEGORY_MAP["PARTNER:文具店"] == "耗材"
+
+
+# 原逐行实现 (clean_description -> resolve_partner -> 两次 auto_categorize) 的录制结果
+BANK_NORMALIZE_FIXTURES = [
+    ["跨行转账 电费", "张三", "电费", "A客户", "水电费"],
+    ["网银转账用途：房租", "张三丰转账", "房租", "B客户", "房租物业"],
+    ["PAYMENT TO 顺丰速运", "收到 顺丰速运", "顺丰速运", "顺丰", "快递费"],
+    ["payment to x", "nan", "x", "nan", "其他"],
+    ["收到 货款", "李四", "货款", "李四", "其他"],
+    ["  支付  转账  办公用品 ", "PAYMENT TO 王五", "办公用品", "王五", "办公费"],
+    ["用途:工资：报销:差旅", "", "差旅", "", "其他"],
+    ["转账", "转账张三", "", "A客户", "采购款"],
+    ["", "网银转账", "", "", "其他"],
+    ["nan", "未知", "nan", "未知", "其他"],
+    ["REMITTANCE收到张三丰", "张三", "张三丰", "A客户", "采购款"],
+    ["付款给张三", "张三丰转账", "张三", "B客户", "其他"],
+    ["说明：电汇回单", "收到 顺丰速运", "", "顺丰", "快递费"],
+    ["网转记账 其他事项", "nan", "其他事项", "nan", "其他"],
+    ["transfer from abc", "李四", "abc", "李四", "其他"],
+    ["银企直联批量转账", "PAYMENT TO 王五", "", "王五", "其他"],
+    ["代发：工资", "", "工资", "", "其他"],
+    ["手机转账 附言: 顺丰", "转账张三", "顺丰", "A客户", "快递费"],
+]
+
+
+def test_normalize_bank_statement_matches_fixtures(monkeypatch):
+    monkeypatch.setattr(CW, "AUTO_CATEGORY_RULES", {"电费": "水电费", "顺丰": "快递费", "房租": "房租物业"})
+    monkeypatch.setattr(CW, "PARTNER_ALIASES", {"张三": "A客户", "张三丰": "B客户", "顺丰速运": "顺丰"})
+    monkeypatch.setattr(CW, "HISTORY_CATEGORY_MAP", {"办公用品": "办公费", "PARTNER:A客户": "采购款"})
+    monkeypatch.setattr(CW, "AI_CACHE_LOADED", True)
+    monkeypatch.setattr(CW, "ZHIPUAI_API_KEY", "")
+    CW.rebuild_keyword_matchers()
+
+    for memo, _, cleaned_memo, _, _ in BANK_NORMALIZE_FIXTURES:
+        assert CW.clean_description(memo) == cleaned_memo
+
+    rows = BANK_NORMALIZE_FIXTURES * 50
+    df = CW.pd.DataFrame({"摘要": [r[0] for r in rows], "对方户名": [r[1] for r in rows]},
+                         index=CW.pd.Index([7] * len(rows)))
+    out = CW.normalize_bank_statement(df)
+    assert out["摘要"].tolist() == [r[0] for r in rows]
+    assert out["清洗摘要"].tolist() == [r[2] for r in rows]
+    assert out["往来单位"].tolist() == [r[3] for r in rows]
+    assert out["费用归类"].tolist() == [r[4] for r in rows]
+
+    # 缺少户名列时退回对方账号/摘要
+    out = CW.normalize_bank_statement(CW.pd.DataFrame({"摘要": ["收到 张三丰"]}))
+    assert out.iloc[0]["往来单位"] == "B客户" and out.iloc[0]["清洗摘要"] == "张三丰"
+    out = CW.normalize_bank_statement(CW.pd.DataFrame({"金额": [1.0]}))
+    assert out.iloc[0]["往来单位"] == "未知" and out.iloc[0]["摘要"] == ""
+
+
+def test_read_excel_smart_layout_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(CW, "EXCEL_LAYOUT_CACHE_FILE", str(tmp_path / "layouts.json"))
+    monkeypatch.setattr(CW, "EXCEL_LAYOUT_CACHE", None)
+    monkeypatch.setattr(CW, "EXCEL_READ_ENGINE", "default")
+    rows = [["某银行交易明细"], ["账号: 6222"], ["交易日期", "交易金额", "对方户名", "交易摘要", "余额"],
+            ["2026-01-02", -100.5, "张三", "电费", 1000], ["2026-01-03", 200, "李四", "货款", 1200]]
+    path = tmp_path / "bank.xlsx"
+    CW.pd.DataFrame(rows).to_excel(path, header=False, index=False)
+
+    reads = []
+    original_read = CW.pd.read_excel
+    monkeypatch.setattr(CW.pd, "read_excel", lambda *a, **k: (reads.append(k.get("header")), original_read(*a, **k))[1])
+
+    first = CW.read_excel_smart(str(path))
+    assert reads == [None, 2]
+    assert list(first.columns) == ["记账日期", "实际收付金额", "往来单位费用", "备注", "余额"]
+    assert first["实际收付金额"].tolist() == [-100.5, 200]
+
+    # 新进程读取同一格式：预览命中缓存布局，整表只读一次，不重写缓存文件
+    monkeypatch.setattr(CW, "EXCEL_LAYOUT_CACHE", None)
+    saved_at = os.path.getmtime(CW.EXCEL_LAYOUT_CACHE_FILE)
+    real_detect = CW.detect_excel_header
+    detect = lambda *a: pytest.fail("命中缓存时不应重新识别表头")
+    monkeypatch.setattr(CW, "detect_excel_header", detect)
+    reads.clear()
+    second = CW.read_excel_smart(str(path))
+    assert reads == [None, 2]
+    assert second.equals(first)
+    assert os.path.getmtime(CW.EXCEL_LAYOUT_CACHE_FILE) == saved_at
+
+    # 同名工作表的另一种格式：识别后与原布局并存，两种文件交替读取都命中缓存
+    monkeypatch.setattr(CW, "detect_excel_header", real_detect)
+    other = tmp_path / "other.xlsx"
+    CW.pd.DataFrame([["日期", "金额", "用途"], ["2026-01-05", 5, "快递"]]).to_excel(other, header=False, index=False)
+    reads.clear()
+    third = CW.read_excel_smart(str(other))
+    assert reads == [None, 0]
+    assert list(third.columns) == ["记账日期", "实际收付金额", "备注"]
+    assert len(CW.load_excel_layout_cache()) == 2
+
+    monkeypatch.setattr(CW, "detect_excel_header", detect)
+    for p, expected in [(path, first), (other, third), (path, first)]:
+        reads.clear()
+        assert CW.read_excel_smart(str(p)).equals(expected)
+        assert reads == [None, 2 if p == path else 0]
+
+
+def test_local_category_model(monkeypatch):
+    import random
+    rng = random.Random(3)
+    vocab = {
+        "差旅费-交通": ["滴滴打车", "高铁票", "机票改签", "出租车费", "地铁充值"],
+        "快递费": ["顺丰寄件", "中通快递", "京东物流运费", "圆通到付"],
+        "办公费": ["打印纸", "墨盒采购", "办公桌椅", "文具一批"],
+    }
+    model = CW.CategoryModel()
+    for i in range(90):
+        cat = rng.choice(list(vocab))
+        model.learn(f"rec{i}", rng.choice(vocab[cat]) + rng.choice(["", "报销", "费用"]), "散户", cat)
+
+    assert model.predict("周五滴滴打车回公司")[0] == "差旅费-交通"
+    assert model.predict("顺丰寄件给客户")[0] == "快递费"
+    cat, confidence = model.predict("采购墨盒")
+    assert cat == "办公费" and confidence > 0.9
+    assert model.predict("xyz") == (None, 0.0)
+
+    # 改分类后重新学习同一记录：计数被替换而不是累加
+    before = len(model.samples)
+    model.learn("rec0", "打印纸", "散户", "办公费")
+    model.learn("rec0", "打印纸", "散户", "办公费")
+    assert len(model.samples) == before
+    model.forget("rec0")
+    assert len(model.samples) == before - 1
+    rebuilt = CW.CategoryModel(dict(model.samples))
+    assert rebuilt.class_docs == model.class_docs and rebuilt.vocab == model.vocab
+
+    # 作为规则/历史与 AI 之间的一层：置信度足够时不调用 AI
+    calls = []
+    monkeypatch.setattr(CW, "CATEGORY_MODEL", model)
+    monkeypatch.setattr(CW, "AUTO_CATEGORY_RULES", {})
+    monkeypatch.setattr(CW, "HISTORY_CATEGORY_MAP", {})
+    monkeypatch.setattr(CW, "AI_CACHE_MAP", {})
+    monkeypatch.setattr(CW, "AI_CACHE_LOADED", True)
+    monkeypatch.setattr(CW, "ZHIPUAI_API_KEY", "test")
+    monkeypatch.setattr(CW, "ai_guess_category", lambda desc, partner: calls.append(desc) or "AI分类")
+    assert CW.auto_categorize("中通快递寄样品", "其他", partner_name="散户") == "快递费"
+    assert not calls
+    monkeypatch.setattr(CW, "CATEGORY_MODEL_THRESHOLD", 1.01)
+    assert CW.auto_categorize("中通快递寄样品", "其他", partner_name="散户") == "AI分类"
+    assert calls == ["中通快递寄样品"]
+
+
+def test_reconcile_matching_engine():
+    import itertools
+    import random
+    d = 739000
+    # 先到先得会让第一笔流水占走后一笔流水唯一可配的台账
+    bank = [(100.0, d), (100.0, d + 4)]
+    ledger = [(100.0, d + 2), (100.0, d - 2)]
+    result = CW.match_bank_to_ledger(bank, ledger, amount_tol=0.01, days_tol=2)
+    assert result.bank_to_ledger == [1, 0] and result.matched_count == 2
+
+    # 金额容差: 默认精确到分；放宽后优先选金额/日期偏差更小的
+    assert CW.match_bank_to_ledger([(50.0, d)], [(50.01, d)], amount_tol=0.01, days_tol=2).matched_count == 0
+    result = CW.match_bank_to_ledger([(50.0, d)], [(50.04, d), (50.01, d + 1), (50.0, d + 2)], amount_tol=0.05, days_tol=2)
+    assert result.bank_to_ledger == [1]
+
+    # 匈牙利算法与穷举一致
+    rng = random.Random(5)
+    for _ in range(30):
+        n, m = rng.randint(1, 5), rng.randint(5, 6)
+        cost = [[rng.randint(0, 9) for _ in range(m)] for _ in range(n)]
+        got = CW.min_cost_assignment(cost)
+        assert len(set(got)) == n
+        best = min(sum(cost[i][p[i]] for i in range(n)) for p in itertools.permutations(range(m), n))
+        assert sum(cost[i][got[i]] for i in range(n)) == best
+
+    # 超大连通分量退化为贪心，结果仍是合法的一一匹配
+    bank = [(10.0, d + i % 3) for i in range(300)]
+    ledger = [(10.0, d + i % 3) for i in range(250)]
+    result = CW.match_bank_to_ledger(bank, ledger, amount_tol=0.01, days_tol=2)
+    assert result.greedy_components == 1 and result.matched_count == 250
+    matched = [l for l in result.bank_to_ledger if l is not None]
+    assert len(set(matched)) == len(matched)
+
+
+def test_reconcile_matching_benchmark():
+    t0 = time.perf_counter()
+    result = CW.benchmark_reconcile_matching(20000)
+    assert result.matched_count > 17000
+    assert time.perf_counter() - t0 < 10
+
+
+def test_settlement_combo_search():
+    import itertools
+    import random
+    rng = random.Random(11)
+    for _ in range(40):
+        amounts = [rng.randint(1, 400) * 5.0 for _ in range(rng.randint(1, 12))]
+        target = sum(rng.sample(amounts, rng.randint(1, min(4, len(amounts))))) + rng.choice([0, 0, 0.5])
+        combo, truncated = CW.find_settlement_combo(amounts, target, tol_cents=0, max_items=4)
+        best = None
+        for size in range(1, 5):
+            hits = [c for c in itertools.combinations(range(len(amounts)), size)
+                    if round(sum(amounts[i] for i in c) * 100) == round(target * 100)]
+            if hits:
+                best = min(hits)
+                break
+        assert not truncated and combo == best
+
+    # 预算耗尽时截断但不报错
+    combo, truncated = CW.find_settlement_combo([1.0] * 30, 29.5, budget=100)
+    assert combo is None and truncated
+
+    # 凑单工具的预算足以枚举完 50 笔候选中的全部 1~5 笔组合 (大额账单不会被截断)
+    amounts = [rng.randint(1000, 50000) * 1.0 for _ in range(50)]
+    combo, truncated = CW.find_settlement_combo(amounts, sum(amounts[:5]) + 0.5, tol_cents=99, max_items=5,
+                                                budget=CW.PAYMENT_MATCHER_SEARCH_BUDGET)
+    assert not truncated and combo is not None
+
+
+def test_settle_by_combination_many_and_split():
+    d = 739000
+    # 一次回款结清多张加工单 (笔数少的组合优先)；其他客户、反方向的单据不参与
+    lines = [(1500.0, d, "A厂"), (-800.0, d, "B供应商")]
+    items = [(500.0, d - 20, "A厂"), (700.0, d - 10, "A厂"), (300.0, d - 3, "A厂"), (1000.0, d - 5, "A厂"),
+             (1500.0, d - 1, "C厂"), (-300.0, d - 2, "B供应商"), (-500.0, d - 4, "B供应商"), (800.0, d, "B供应商")]
+    settled, truncated = CW.settle_by_combination(lines, items)
+    assert settled == {0: [0, 3], 1: [5, 6]} and not truncated
+    # 超出日期窗口的不算
+    settled, _ = CW.settle_by_combination([(1200.0, d, "A厂")], items, days_before=15)
+    assert settled == {}
+    # 对账要求至少两笔：单笔相符的 (d-5 的 1000) 不借组合窗口放宽日期
+    assert CW.settle_by_combination([(1000.0, d, "A厂")], items)[0] == {0: [3]}
+    assert CW.settle_by_combination([(1000.0, d, "A厂")], items, min_items=2)[0] == {0: [1, 2]}
+    assert CW.settle_by_combination([(1500.0, d, "C厂")], items, min_items=2)[0] == {}
+
+    # 一笔台账分两次到账
+    targets = [(2000.0, d, "A厂")]
+    pool = [(1200.0, d + 3, "A厂"), (800.0, d + 20, "A厂"), (800.0, d + 60, "A厂")]
+    settled, _ = CW.settle_by_combination(targets, pool, days_before=2, days_after=31)
+    assert settled == {0: [0, 1]}
+
+
+def test_settlement_month_end_batch_speed():
+    import random
+    rng = random.Random(2)
+    d = 739000
+    lines, items = [], []
+    for p in range(300):
+        partner = f"客户{p}"
+        for _ in range(6):
+            bills = [rng.randint(100, 5000) * 1.0 for _ in range(rng.randint(1, 4))]
+            day = d + rng.randrange(60)
+            for b in bills:
+                items.append((b, day - rng.randrange(25), partner))
+            lines.append((sum(bills) + rng.choice([0, 0, 0, 13.0]), day, partner))
+    t0 = time.perf_counter()
+    settled, _ = CW.settle_by_combination(lines, items)
+    assert len(settled) > len(lines) * 0.6
+    assert time.perf_counter() - t0 < 15
+
+
+def test_streaming_reconciliation_matches_in_memory(mock_env, tmp_path, monkeypatch):
+    import random
+    client, tid = mock_env
+    rng = random.Random(4)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(CW, "EXCEL_LAYOUT_CACHE_FILE", str(tmp_path / "layouts.json"))
+    monkeypatch.setattr(CW, "EXCEL_LAYOUT_CACHE", None)
+    monkeypatch.setattr(CW, "ZHIPUAI_API_KEY", "")
+    monkeypatch.setattr(CW, "load_history_knowledge", lambda *a, **k: None)
+    monkeypatch.setattr("builtins.input", lambda *a: "n")
+    reports = []
+    monkeypatch.setattr(CW, "generate_reconciliation_report", lambda *a, **k: reports.append((a, k)))
+
+    start = datetime(2026, 1, 1)
+    ledger, bank = [], []
+    for i in range(400):
+        day = start + CW.timedelta(days=rng.randrange(120))
+        amount = float(rng.randint(1, 3000))
+        if rng.random() < 0.8:
+            bank.append([(day + CW.timedelta(days=rng.randint(-2, 2))).strftime("%Y-%m-%d"), amount, f"单位{i}", "货款"])
+        if rng.random() < 0.9:
+            ledger.append({"记账日期": int(day.timestamp() * 1000), "实际收付金额": amount,
+                           "交易银行": "G银行基本户", "备注": f"L{i}", "往来单位费用": f"台账单位{i}"})
+    for i in range(0, len(ledger), 100):
+        add_mock_records(client, tid, ledger[i:i + 100])
+    rng.shuffle(bank)
+    path = tmp_path / "G银行流水.xlsx"
+    CW.pd.DataFrame(bank, columns=["交易日期", "交易金额", "对方户名", "摘要"]).to_excel(path, index=False)
+
+    def run(streaming):
+        reports.clear()
+        assert CW.reconcile_bank_flow(client, "app", str(path), streaming=streaming)
+        files = {}
+        for prefix in ("待补录流水_", "台账异常记录_"):
+            [name] = [p for p in os.listdir(tmp_path) if p.startswith(prefix)]
+            df = CW.pd.read_excel(tmp_path / name)
+            os.remove(tmp_path / name)
+            files[prefix] = sorted(map(tuple, df.astype(str).values.tolist()))
+        args, kwargs = reports[0]
+        return args[0], kwargs["unmatched_total"], kwargs["ledger_total"], files
+
+    monkeypatch.setattr(CW, "RECONCILE_WINDOW_DAYS", 10)
+    monkeypatch.setattr(CW, "RECONCILE_CHUNK_ROWS", 37)
+    in_memory = run(False)
+    streamed = run(True)
+    assert streamed == in_memory
+    assert in_memory[1] > 0 and in_memory[2] > 0
+
+
+def test_duplicate_index(mock_env, monkeypatch):
+    client, tid = mock_env
+    CW.DUPLICATE_INDEXES.clear()
+    ts = lambda s: int(datetime.strptime(s, "%Y-%m-%d").timestamp() * 1000)
+    add_mock_records(client, tid, [
+        {"记账日期": ts("2026-03-10"), "实际收付金额": 500.0, "往来单位费用": "张三（个人）", "备注": "办公室房租 3月"},
+        {"记账日期": ts("2026-03-01"), "实际收付金额": 88.0, "往来单位费用": "顺丰", "备注": "快递"},
+    ])
+    fetches = []
+    original = CW.iter_all_records
+    monkeypatch.setattr(CW, "iter_all_records", lambda *a, **k: fetches.append(a[2]) or original(*a, **k))
+
+    assert CW.check_duplicate(client, "app", tid, 500, "2026-03-12", "张三(个人)", "")[0]
+    assert CW.check_duplicate(client, "app", tid, "500.00", "2026-03-07", "", "办公室 房租")[0]
+    assert not CW.check_duplicate(client, "app", tid, 500, "2026-03-14", "张三", "")[0] # 超过3天
+    assert not CW.check_duplicate(client, "app", tid, 500.02, "2026-03-10", "张三", "")[0]
+    assert not CW.check_duplicate(client, "app", tid, 500, "2026-03-10", "李四", "水电")[0]
+    assert len(fetches) == 1 # 索引只构建一次
+
+    # 新录入的记录直接进入索引，无需重新下载；撤销后移除
+    CW.note_record_write(tid, created=("recNEW", {"记账日期": ts("2026-03-20"), "实际收付金额": 66.6, "往来单位费用": "李四"}))
+    assert CW.check_duplicate(client, "app", tid, 66.6, "2026-03-21", "李四", "")[0]
+    CW.note_record_write(tid, deleted="recNEW")
+    assert not CW.check_duplicate(client, "app", tid, 66.6, "2026-03-21", "李四", "")[0]
+    assert len(fetches) == 1
+
+    # 批量写入同步更新；其他未知写入让索引下次重建
+    recs = CW.get_all_records(client, "app", tid)
+    rid = next(r.record_id for r in recs if r.fields["备注"] == "快递")
+    CW.batch_write_records(client, "app", tid, [{"record_id": rid, "fields": {"实际收付金额": 99.0}}], action="update")
+    assert CW.check_duplicate(client, "app", tid, 99.0, "2026-03-01", "顺丰", "")[0]
+    assert not CW.check_duplicate(client, "app", tid, 88.0, "2026-03-01", "顺丰", "")[0]
+    CW.note_record_write(tid)
+    CW.check_duplicate(client, "app", tid, 1, "2026-03-01", "", "")
+    assert len(fetches) == 2
+
+    # 其他人在飞书录入的记录随增量同步并入索引
+    add_mock_records(client, tid, [{"记账日期": ts("2026-03-25"), "实际收付金额": 77.0, "往来单位费用": "王五"}])
+    assert CW.check_duplicate(client, "app", tid, 77.0, "2026-03-25", "王五", "")[0]
+    assert len(fetches) == 2
+
+    # 体检的同日同金额同对象去重
+    seen = CW.DuplicateIndex()
+    day = CW.DuplicateIndex.record_day(ts("2026-03-10"))
+    seen.add("r1", {"记账日期": ts("2026-03-10"), "实际收付金额": 500.0, "往来单位费用": "张三"})
+    assert seen.find_exact(500.0, day, "张三") == "r1"
+    assert seen.find_exact(500.0, day, "张三丰") is None
+    assert seen.find_exact(500.0, day + 1, "张三") is None
+
+
+def test_pnl_cube_engine_and_closed_month_cache(mock_env, tmp_path, monkeypatch):
+    client, tid = mock_env
+    monkeypatch.setattr(CW, "PNL_CUBE_CACHE_FILE", str(tmp_path / "cube.json"))
+    monkeypatch.setattr(CW, "PNL_CUBE_CACHE", None)
+    monkeypatch.setattr(CW, "REPLICA_WATERMARK_SKEW_MS", 0)
+    ts = lambda y, m, d: int(datetime(y, m, d, 9).timestamp() * 1000)
+    add_mock_records(client, tid, [
+        {"记账日期": ts(2024, 1, 5), "业务类型": "收款", "实际收付金额": 1000, "交易银行": "G银行", "是否有票": "有票"},
+        {"记账日期": ts(2024, 1, 9), "业务类型": "费用", "实际收付金额": "200.5", "费用归类": "电费", "交易银行": "G银行"},
+        {"记账日期": ts(2024, 1, 31), "业务类型": "付款", "实际收付金额": 300, "费用归类": "", "交易银行": "N银行"},
+        {"记账日期": ts(2024, 3, 2), "业务类型": "费用", "实际收付金额": 50, "费用归类": "外协加工", "是否有票": "有票"},
+        {"记账日期": ts(2024, 3, 2), "业务类型": "内部转账", "实际收付金额": 999},
+        {"实际收付金额": 77, "业务类型": "收款"}, # 无日期，不计入
+    ])
+
+    cube = CW.load_pnl_cube(client, "app", tid, datetime(2024, 1, 1), datetime(2025, 1, 1))
+    assert (CW.PNL_CUBE_STATS["cached"], CW.PNL_CUBE_STATS["computed"]) == (0, 12)
+    assert CW.pnl_sum(cube, kind="收入") == 1000
+    assert CW.pnl_sum(cube, kind="支出") == 550.5
+    assert CW.pnl_sum(cube, "月份", value="笔数").to_dict() == {"2024-01": 3, "2024-03": 2}
+    assert CW.pnl_sum(cube, "费用归类", kind="支出").to_dict() == {"外协加工": 50.0, "未分类": 300.0, "电费": 200.5}
+    assert CW.pnl_sum(cube, "交易银行", kind="支出").to_dict() == {"": 50.0, "G银行": 200.5, "N银行": 300.0}
+    assert CW.pnl_sum(cube, "是否有票", kind="支出").to_dict() == {"无票": 500.5, "有票": 50.0}
+
+    # 已结束月份直接取缓存 (包括跨进程的磁盘缓存)，结果与全量重算一致
+    monkeypatch.setattr(CW, "PNL_CUBE_CACHE", None)
+    fetches = []
+    original = CW.load_records_frame
+    monkeypatch.setattr(CW, "load_records_frame", lambda *a, **k: fetches.append(k.get("filter_info")) or original(*a, **k))
+    cached = CW.load_pnl_cube(client, "app", tid, datetime(2024, 1, 1), datetime(2025, 1, 1))
+    assert (CW.PNL_CUBE_STATS["cached"], CW.PNL_CUBE_STATS["computed"]) == (12, 0) and fetches == []
+    CW.pd.testing.assert_frame_equal(cached, cube)
+
+    # 某个已结束月份的数据变化后，只重算该月
+    rid = next(r.record_id for r in CW.get_all_records(client, "app", tid) if r.fields.get("费用归类") == "外协加工")
+    CW.batch_write_records(client, "app", tid, [{"record_id": rid, "fields": {"实际收付金额": 80}}], action="update")
+    cube = CW.load_pnl_cube(client, "app", tid, datetime(2024, 1, 1), datetime(2025, 1, 1))
+    assert (CW.PNL_CUBE_STATS["cached"], CW.PNL_CUBE_STATS["computed"]) == (11, 1) and len(fetches) == 1
+    assert CW.pnl_sum(cube, "月份", kind="支出").to_dict() == {"2024-01": 500.5, "2024-03": 80.0}
+
+    # 本月始终重新汇总
+    this_month = datetime(datetime.now().year, datetime.now().month, 1)
+    CW.load_pnl_cube(client, "app", tid, this_month, CW.next_month_start(this_month))
+    CW.load_pnl_cube(client, "app", tid, this_month, CW.next_month_start(this_month))
+    assert (CW.PNL_CUBE_STATS["cached"], CW.PNL_CUBE_STATS["computed"]) == (0, 1)
+
+
+def test_monthly_summaries_materialised_with_checksum(mock_env, tmp_path, monkeypatch):
+    client, tid = mock_env
+    monkeypatch.setattr(CW, "PNL_CUBE_CACHE_FILE", str(tmp_path / "cube.json"))
+    monkeypatch.setattr(CW, "PNL_CUBE_CACHE", None)
+    monkeypatch.setattr(CW, "REPLICA_WATERMARK_SKEW_MS", 0)
+    ts = lambda y, m, d: int(datetime(y, m, d, 9).timestamp() * 1000)
+    add_mock_records(client, tid, [
+        {"记账日期": ts(2024, 1, 5), "业务类型": "收款", "实际收付金额": 1000, "交易银行": "G银行", "是否有票": "有票"},
+        {"记账日期": ts(2024, 3, 9), "业务类型": "费用", "实际收付金额": 200.5, "费用归类": "电费", "备注": "三月"},
+        {"记账日期": ts(2024, 12, 31), "业务类型": "付款", "实际收付金额": 300},
+    ])
+    year = (datetime(2024, 1, 1), datetime(2025, 1, 1))
+
+    result = CW.materialize_monthly_summaries(client, "app", *year)
+    assert len(result["created"]) == 12 and not result["replaced"]
+    summaries = CW.load_monthly_summaries(client, "app")
+    assert summaries["2024-03"]["checksum"].startswith("1:") and summaries["2024-02"]["checksum"] == "0:0"
+    assert CW.materialize_monthly_summaries(client, "app", *year)["unchanged"] == list(summaries)
+
+    # 无本地缓存时 (如另一台电脑)，年度数据直接由 12 条汇总组成，不读取台账明细
+    monkeypatch.setattr(CW, "PNL_CUBE_CACHE_FILE", str(tmp_path / "other.json"))
+    monkeypatch.setattr(CW, "PNL_CUBE_CACHE", None)
+    fetches = []
+    original = CW.load_records_frame
+    monkeypatch.setattr(CW, "load_records_frame", lambda *a, **k: fetches.append(1) or original(*a, **k))
+    cube = CW.load_pnl_cube(client, "app", tid, *year)
+    assert CW.PNL_CUBE_STATS["summary"] == 12 and CW.PNL_CUBE_STATS["computed"] == 0 and fetches == []
+    assert CW.pnl_sum(cube, "月份", kind="支出").to_dict() == {"2024-03": 200.5, "2024-12": 300.0}
+
+    # 只改备注不影响校验和；改金额后该月被识别为需重新结账
+    rid = next(r.record_id for r in CW.get_all_records(client, "app", tid) if r.fields.get("备注") == "三月")
+    CW.batch_write_records(client, "app", tid, [{"record_id": rid, "fields": {"备注": "3月电费"}}], action="update")
+    CW.load_pnl_cube(client, "app", tid, *year)
+    assert CW.PNL_CUBE_STATS["stale"] == []
+    CW.batch_write_records(client, "app", tid, [{"record_id": rid, "fields": {"实际收付金额": 250}}], action="update")
+    cube = CW.load_pnl_cube(client, "app", tid, *year)
+    assert CW.PNL_CUBE_STATS["stale"] == ["2024-03"] and CW.PNL_CUBE_STATS["computed"] == 1
+    assert CW.pnl_sum(cube, kind="支出") == 550.0
+
+    result = CW.materialize_monthly_summaries(client, "app", *year)
+    assert result["replaced"] == ["2024-03"] and len(result["unchanged"]) == 11
+    sid = CW.get_table_id_by_name(client, "app", CW.SUMMARY_TABLE_NAME)
+    rows = [r.fields for r in CW.get_all_records(client, "app", sid) if r.fields["月份"] == "2024-03"]
+    assert sorted(f["状态"] for f in rows) == ["已失效", "有效"]
+    assert CW.load_monthly_summaries(client, "app")["2024-03"]["rows"] == [["支出", "费用", "电费", "", "无票", 250.0, 1]]
+
+    # 不使用本地副本时，由拉取的记录计算出相同的校验和
+    monkeypatch.setattr(CW, "LOCAL_REPLICA_ENABLED", False)
+    assert len(CW.materialize_monthly_summaries(client, "app", *year)["unchanged"]) == 12
+
+
+def test_parallel_statements_match_serial(tmp_path, monkeypatch):
+    ts = lambda d: int(datetime(2024, 5, d, 10).timestamp() * 1000)
+    records = [{"record_id": f"r{i}", "fields": {"往来单位": f"客户{i % 25}", "日期": ts(28 - i % 27), "品名": "镀锌件",
+                                                 "数量": i + 1, "单价": 1.5, "总金额": (i + 1) * 1.5, "备注": f"批次{i}"}}
+               for i in range(200)]
+    records.append({"record_id": "x", "fields": {"往来单位": "客户0(旧名)", "日期": ts(1), "数量": 1, "单价": 2, "总金额": 2}})
+    groups = CW.group_statement_items(records, {"客户0(旧名)": "客户0"})
+    assert len(groups) == 25 and len(groups["客户0"]) == 9
+    assert [it["日期"] for it in groups["客户0"]] == sorted(it["日期"] for it in groups["客户0"])
+
+    printed = datetime(2024, 6, 1, 9, 30)
+    outputs = {}
+    for mode, workers in (("serial", 1), ("parallel", 2)):
+        out = tmp_path / mode
+        out.mkdir()
+        jobs = [{"partner": p, "month": "2024-05", "items": items, "save_dir": str(out), "printed": printed}
+                for p, items in groups.items()]
+        seen = []
+        monkeypatch.setattr(CW, "STATEMENT_PARALLEL_MIN", 2)
+        results = CW.render_statements(jobs, workers=workers, progress=lambda done, total, p: seen.append(done))
+        assert seen == list(range(1, 26))
+        assert [r[0] for r in results] == list(groups) and all(not r[2] for r in results)
+        files = [f for r in results for f in r[1]]
+        assert len(files) == 50
+        zip_path = CW.archive_statements(str(tmp_path / f"{mode}.zip"), files, str(out))
+        outputs[mode] = {str(p.relative_to(out)): p.read_bytes() for p in out.rglob("*") if p.is_file()}
+        outputs[mode]["archive"] = open(zip_path, "rb").read()
+    assert outputs["serial"] == outputs["parallel"]
+
+    wb = CW.openpyxl.load_workbook(tmp_path / "serial" / "客户0_2024-05_对账单.xlsx")
+    rows = list(wb["对账单"].values)
+    assert rows[0] == tuple(CW.STATEMENT_COLUMNS)
+    assert rows[-1][:4] == ("合计", "9 笔", None, sum(it["数量"] for it in groups["客户0"]))
+
+
+def test_report_templates_stream_rows_and_share_assets(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(CW, "REPORT_TEMPLATES", {})
+    monkeypatch.setattr(CW, "REPORT_ASSETS_WRITTEN", set())
+    render = CW.compile_template("{% if a %}{{ b:,.2f }}{% else %}-{% endif %}|{% for x in xs %}<{{ x }}>{{ x.k|raw }}{% endfor %}")
+    out = []
+    render({"a": 1, "b": 1234.5, "xs": [{"k": "<i>"}]}, out.append, out.extend)
+    assert "".join(out) == "1,234.50|<{&#x27;k&#x27;: &#x27;&lt;i&gt;&#x27;}><i>"
+    with pytest.raises(ValueError):
+        CW.compile_template("{% for x in xs %}{% if x %}{% endif %}{% endfor %}")
+
+    unmatched = [{"记账日期": "2024-05-01", "备注": f"<b>货款{i}</b>", "实际收付金额": i * 1.5, "往来单位费用": "甲公司",
+                  "费用归类": "销售", "原因": "未匹配"} for i in range(10000)]
+    ledger = [{"记账日期": "2024-05-02", "摘要": "多记", "金额": 3, "往来": "乙公司", "交易银行": "工行", "原因": "无流水"}]
+    t0 = time.perf_counter()
+    first = CW.generate_reconciliation_report(5, unmatched, ledger)
+    assert time.perf_counter() - t0 < 1.0
+    html = open(first, encoding="utf-8").read()
+    compiled = CW.REPORT_TEMPLATES["reconcile"]
+    css = tmp_path / "财务数据备份" / "report_assets" / "reconcile.css"
+    mtime = css.stat().st_mtime_ns
+    second = CW.generate_reconciliation_report(5, unmatched[:1], ledger, unmatched_total=10000)
+    assert CW.REPORT_TEMPLATES["reconcile"] is compiled and css.stat().st_mtime_ns == mtime
+
+    assert html.count("badge-danger") == 10000 and "&lt;b&gt;货款9999&lt;/b&gt;" in html and "<b>" not in html
+    assert "<style>" not in html and 'href="report_assets/reconcile.css"' in html
+    assert '{"matched": 5, "unmatched": 10000, "ledger": 1}' in html
+    assert open(second, encoding="utf-8").read().count("badge-danger") == 1